@@ -37,6 +37,10 @@ import sys
 module_dir = Path(__file__).resolve().parent
 sys.path.append(str(module_dir))
 # noinspection PyPep8
+from pycheribuild.daemon import handle_daemon_commands  # only imports the standard library
+# Run the command in the cheribuild daemon if it is running (does not return in that case)
+handle_daemon_commands()
+# noinspection PyPep8
 from pycheribuild.__main__ import main  # "__main__" case
 
 main()
@@ -39,7 +39,7 @@ imports = []  # type: typing.List[str]
 from_imports = []  # type: typing.List[str]
 lines = []  # type: typing.List[str]
 handled_files = []  # type: typing.List[Path]
-ignored_files = [script_dir / "jenkins.py", script_dir / "config/jenkinsconfig.py"]
+ignored_files = [script_dir / "jenkins.py", script_dir / "config/jenkinsconfig.py", script_dir / "daemon.py"]
 empty_lines = 0
 
 
@@ -123,12 +123,17 @@ def check_all_files_used(directory: Path):
 # append all the individual files in the right order
 add_filtered_file(script_dir / "colour.py")
 add_filtered_file(script_dir / "utils.py")
+add_filtered_file(script_dir / "jobserver.py")
+add_filtered_file(script_dir / "build_log.py")
+add_filtered_file(script_dir / "build_timing.py")
 add_filtered_file(script_dir / "mtree.py")
 add_filtered_file(script_dir / "config/loader.py")
 add_filtered_file(script_dir / "config/target_info.py")
 add_filtered_file(script_dir / "config/chericonfig.py")
 add_filtered_file(script_dir / "config/defaultconfig.py")
+add_filtered_file(script_dir / "dependency_graph.py")
 add_filtered_file(script_dir / "targets.py")
+add_filtered_file(script_dir / "target_index.py")
 add_filtered_file(script_dir / "filesystemutils.py")
 add_filtered_file(script_dir / "projects/project.py")
 add_filtered_file(script_dir / "qemu_utils.py")
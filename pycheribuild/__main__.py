@@ -32,6 +32,7 @@ import os
 import shutil
 import subprocess
 import sys
+import typing
 # noinspection PyUnresolvedReferences
 from pathlib import Path
 
@@ -46,11 +47,13 @@ from .projects import *  # noqa: F401,F403
 # noinspection PyUnresolvedReferences
 from .projects.cross import *  # noqa: F401,F403
 from .projects.project import SimpleProject
+from .target_index import TargetIndex
 from .targets import target_manager
 from .processutils import (get_program_version, print_command, run_and_kill_children_on_exit, run_command)
 from .utils import (AnsiColour, coloured, fatal_error, have_working_internet_connection, init_global_config,
                     status_update)
 DIRS_TO_CHECK_FOR_UPDATES = [Path(__file__).parent.parent]
+RUN_EVERYTHING_TARGET = "__run_everything__"
 
 
 def update_check(config: DefaultCheriConfig):
@@ -100,6 +103,57 @@ def check_not_root():
                     " Please re-run as a non-root user.", pretend=False)
 
 
+def register_command_line_options(config_loader: JsonAndCommandLineConfigLoader):
+    # Registering the config options of all ~800 targets dominates the startup time. Use the cached index of all
+    # target options to only register the ones that are needed (unless we need all of them, e.g. for --help).
+    if os.getenv("CHERIBUILD_NO_TARGET_INDEX") or config_loader.is_generating_readme:
+        target_manager.register_command_line_options()
+        return
+    args = sys.argv[1:]
+    needs_all_targets = False
+    if config_loader.is_completing_arguments:
+        import shlex
+        try:
+            args = shlex.split(os.environ["COMP_LINE"])[1:]
+        except ValueError:
+            args = os.environ["COMP_LINE"].split()[1:]
+        # Completing "-" or "--" lists all options. Note: longer prefixes are included in COMP_LINE and are handled
+        # by registering all targets with matching options.
+        # noinspection PyProtectedMember
+        needs_all_targets = config_loader._argcomplete_prefix in ("-", "--")
+    fingerprint = TargetIndex.source_fingerprint()
+    index = TargetIndex.load(TargetIndex.default_path(), fingerprint)
+    if index is not None and not needs_all_targets and not TargetIndex.requires_all_targets(args):
+        config_loader.lazily_registered_option_keys = index.config_file_keys
+        target_manager.register_command_line_options(index, args)
+        return
+    target_manager.register_command_line_options()
+    # Note: when tab-completing only the options matching the current prefix are added so we can't create the index.
+    if index is None and not config_loader.is_completing_arguments:
+        TargetIndex.from_registered_options(target_manager, config_loader, fingerprint).save(
+            TargetIndex.default_path())
+
+
+def _all_target_names(config_loader: JsonAndCommandLineConfigLoader) -> "typing.List[str]":
+    # Don't suggest deprecated names when tab-completing
+    if config_loader.is_completing_arguments:
+        return list(sorted(target_manager.non_deprecated_target_names))
+    return list(sorted(target_manager.target_names))
+
+
+def create_cheri_config(*, register_all_options=False) -> DefaultCheriConfig:
+    config_loader = JsonAndCommandLineConfigLoader()
+    # Register all command line options
+    cheri_config = DefaultCheriConfig(config_loader, _all_target_names(config_loader) + [RUN_EVERYTHING_TARGET])
+    SimpleProject._config_loader = config_loader
+    if register_all_options:
+        # The cheribuild daemon (see daemon.py) handles arbitrary command lines so it needs all options.
+        target_manager.register_command_line_options()
+    else:
+        register_command_line_options(config_loader)
+    return cheri_config
+
+
 def real_main():
     # avoid weird errors with macos terminal:
     ensure_fd_is_blocking(sys.stdin.fileno())
@@ -107,18 +161,13 @@ def real_main():
     ensure_fd_is_blocking(sys.stderr.fileno())
 
     check_not_root()
+    run_cheribuild(create_cheri_config())
 
-    config_loader = JsonAndCommandLineConfigLoader()
-    # Don't suggest deprecated names when tab-completing
-    if config_loader.is_completing_arguments:
-        all_target_names = list(sorted(target_manager.non_deprecated_target_names))
-    else:
-        all_target_names = list(sorted(target_manager.target_names))
-    run_everything_target = "__run_everything__"
-    # Register all command line options
-    cheri_config = DefaultCheriConfig(config_loader, all_target_names + [run_everything_target])
-    SimpleProject._config_loader = config_loader
-    target_manager.register_command_line_options()
+
+def run_cheribuild(cheri_config: DefaultCheriConfig):
+    config_loader = cheri_config.loader
+    all_target_names = _all_target_names(config_loader)
+    run_everything_target = RUN_EVERYTHING_TARGET
     # load them from JSON/cmd line
     cheri_config.load()
     init_global_config(cheri_config)
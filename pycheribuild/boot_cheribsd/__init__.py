@@ -36,6 +36,9 @@
 import argparse
 import atexit
 import datetime
+import fcntl
+import hashlib
+import json
 import os
 import random
 import re
@@ -415,13 +418,125 @@ def set_ld_library_path_with_sysroot(qemu: CheriBSDInstance):
         prefix=purecap_install_prefix, l=cheri_libdir, var=cheri_ld_lib_path_var), timeout=3)
 
 
+class DecompressedImageCache(object):
+    """
+    A directory of decompressed kernels, disk images or test archives that can be shared between concurrent jobs.
+    Entries are named after the hash of the compressed file, so every job that uses the same archive shares a single
+    decompressed copy. Each entry has a lock file that is held shared while the entry is in use, so that the least
+    recently used entries can be evicted without affecting running jobs, and a second lock file that serializes the
+    decompression. The shared lock is held until release() is called (or the process exits).
+    """
+
+    _SUFFIXES = {"kernel": ".kernel", "test archive": ".tar"}
+
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock_fds = dict()  # type: typing.Dict[Path, typing.List[int]]
+
+    @staticmethod
+    def _lock_file(entry: Path, suffix: str) -> Path:
+        return entry.with_name(entry.name + suffix)
+
+    def _entries(self) -> "typing.List[Path]":
+        return [p for p in self.cache_dir.iterdir()
+                if p.is_file() and p.suffix in (".img", ".kernel", ".tar") and ".tmp" not in p.name]
+
+    def decompress(self, archive: Path, cmd: "typing.List[str]", what: str) -> Path:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        key = cached_file_hash(archive, self.cache_dir / "file-hashes.json")[:32]
+        entry = self.cache_dir / (key + self._SUFFIXES.get(what, ".img"))
+        if PRETEND:
+            print_cmd(cmd + [str(archive)], stdout=str(entry))
+            return entry
+        # Hold a shared lock while using the entry (only blocks while it is being evicted)
+        lock_fd = os.open(str(self._lock_file(entry, ".lock")), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        if entry.exists():
+            info("Using cached ", what, " ", entry, " for ", archive)
+        else:
+            # Creating the entry uses a separate lock since other jobs may already be holding the shared lock.
+            create_fd = os.open(str(self._lock_file(entry, ".create-lock")), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                try:
+                    fcntl.flock(create_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    info("Waiting for another job to extract ", what, " to cache entry ", entry)
+                    fcntl.flock(create_fd, fcntl.LOCK_EX)
+                if not entry.exists():
+                    info("Extracting ", archive, " to image cache ", entry)
+                    tmp = entry.with_name(entry.name + ".tmp" + str(os.getpid()))
+                    print_cmd(cmd + [str(archive)], stdout=str(tmp))
+                    try:
+                        with tmp.open("wb") as f:
+                            subprocess.check_call(cmd + [str(archive)], stdout=f)
+                        tmp.chmod(0o444)  # Jobs must use an overlay and never write to the shared image
+                        os.replace(str(tmp), str(entry))
+                    finally:
+                        if tmp.exists():
+                            tmp.unlink()
+            except BaseException:
+                os.close(lock_fd)
+                raise
+            finally:
+                os.close(create_fd)
+        try:
+            os.utime(str(entry))  # The mtime records the last use for the LRU eviction
+        except PermissionError:
+            pass  # created by another user
+        # Keep the shared lock until the entry is released to prevent eviction while it is being used
+        self._lock_fds.setdefault(entry, []).append(lock_fd)
+        self.evict(keep=entry)
+        return entry
+
+    def release(self, entry: Path):
+        """Drop the shared locks on entry so that it can be evicted by other jobs."""
+        for lock_fd in self._lock_fds.pop(entry, []):
+            os.close(lock_fd)
+
+    def release_all(self):
+        for entry in list(self._lock_fds):
+            self.release(entry)
+
+    def evict(self, keep: Path = None):
+        entries = []
+        for entry in self._entries():
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue  # Evicted concurrently
+            entries.append((st.st_mtime, st.st_size, entry))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            lock_fd = os.open(str(self._lock_file(entry, ".lock")), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # still in use by another job
+            else:
+                # Note: the lock file is not removed since other jobs may already have opened it.
+                info("Evicting least recently used image cache entry ", entry)
+                entry.unlink()
+                total_size -= size
+            finally:
+                os.close(lock_fd)
+
+
 def maybe_decompress(path: Path, force_decompression: bool, keep_archive=True, args: argparse.Namespace = None, *,
-                     what: str) -> Path:
+                     what: str, image_cache: DecompressedImageCache = None) -> Path:
     # drop the suffix and then try decompressing
     def bunzip(archive):
+        if image_cache is not None:
+            return image_cache.decompress(archive, ["bunzip2", "-c"], what)
         return decompress(archive, force_decompression, cmd=["bunzip2", "-v", "-f"], keep_archive=keep_archive)
 
     def unxz(archive):
+        if image_cache is not None:
+            return image_cache.decompress(archive, ["xz", "-T0", "-d", "-c"], what)
         return decompress(archive, force_decompression, cmd=["xz", "-d", "-v", "-f"], keep_archive=keep_archive)
 
     if args and getattr(args, "internal_shard", None) and not PRETEND:
@@ -435,7 +550,7 @@ def maybe_decompress(path: Path, force_decompression: bool, keep_archive=True, a
     bz2_guess = path.with_suffix(path.suffix + ".bz2")
     # try adding the archive suffix
     if bz2_guess.exists():
-        if path.is_file() and is_newer(path, bz2_guess):
+        if path.is_file() and is_newer(path, bz2_guess) and image_cache is None:
             info("Not Extracting ", bz2_guess, " since uncompressed image ", path, " is newer")
             return path
         info("Extracting ", bz2_guess, " since it is newer than uncompressed image ", path)
@@ -443,7 +558,7 @@ def maybe_decompress(path: Path, force_decompression: bool, keep_archive=True, a
 
     xz_guess = path.with_suffix(path.suffix + ".xz")
     if xz_guess.exists():
-        if path.is_file() and is_newer(path, xz_guess):
+        if path.is_file() and is_newer(path, xz_guess) and image_cache is None:
             info("Not Extracting ", xz_guess, " since uncompressed image ", path, " is newer")
             return path
         info("Extracting ", xz_guess, " since it is newer than uncompressed image ", path)
@@ -682,23 +797,206 @@ def start_dhclient(qemu: CheriBSDSpawnMixin, network_iface: str):
     qemu.expect_prompt(timeout=30)
 
 
-def boot_cheribsd(qemu_options: QemuOptions, qemu_command: typing.Optional[Path], kernel_image: Path,
-                  disk_image: typing.Optional[Path], ssh_port: typing.Optional[int],
-                  ssh_pubkey: typing.Optional[Path], *, smb_dirs: typing.List[SmbMount] = None, kernel_init_only=False,
-                  trap_on_unrepresentable=False, skip_ssh_setup=False, bios_path: Path = None) -> QemuCheriBSDInstance:
-    user_network_args = ""
-    if smb_dirs is None:
-        smb_dirs = []
+def find_qemu_img(qemu_command: typing.Optional[Path]) -> typing.Optional[Path]:
+    if qemu_command is not None and (qemu_command.parent / "qemu-img").is_file():
+        return qemu_command.parent / "qemu-img"
+    found = shutil.which("qemu-img")
+    return Path(found) if found else None
+
+
+def default_qemu_snapshot_dir() -> Path:
+    return Path(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "cheribuild", "qemu-snapshots")
+
+
+def default_test_duration_db() -> Path:
+    return Path(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "cheribuild", "test-durations.sqlite3")
+
+
+def cached_file_hash(path: Path, cache_file: Path) -> str:
+    # The kernel and disk image are usually extracted again for every run, so we can't use the path+mtime as
+    # the key. Hashing a multi-GB disk image takes a few seconds but that is still much faster than booting.
+    st = path.stat()
+    cache_key = "{}:{}:{}:{}".format(path.resolve(), st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def read_cache() -> dict:
+        try:
+            with cache_file.open("r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    result = read_cache().get(cache_key)
+    if result is not None:
+        return result
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    result = h.hexdigest()
+    # Concurrent jobs may also be adding hashes, so the update must happen under a lock to avoid losing entries.
+    lock_fd = os.open(str(cache_file.with_name(cache_file.name + ".lock")), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        cache = read_cache()
+        cache[cache_key] = result
+        tmp = cache_file.with_name(cache_file.name + ".tmp" + str(os.getpid()))
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(str(tmp), str(cache_file))
+    finally:
+        os.close(lock_fd)
+    return result
+
+
+class QemuSnapshot(object):
+    """
+    The saved machine state of a QEMU instance that has booted CheriBSD to a shell with the pexpect prompt set up.
+    The disk contents at that point are kept in a read-only qcow2 overlay on top of the (unmodified) disk image and each
+    run that restores the snapshot writes to its own overlay on top of that one.
+    Since the snapshot key only depends on the contents of the disk image, the overlay does not reference the disk image
+    directly but a symlink inside the snapshot directory that is updated to point to the current disk image.
+    """
+
+    def __init__(self, snapshot_dir: Path, qemu_img: Path, key: str):
+        self.snapshot_dir = snapshot_dir
+        self.qemu_img = qemu_img
+        self.key = key
+        self.overlay = snapshot_dir / (key + ".qcow2")
+        self.state = snapshot_dir / (key + ".vmstate")
+        self.base = snapshot_dir / (key + ".base")
+        self.monitor_socket = None  # type: typing.Optional[Path]
+        self._lock_fd = None  # type: typing.Optional[int]
+        self._tmpdir = None  # type: typing.Optional[Path]
+
+    @classmethod
+    def create(cls, snapshot_dir: Path, qemu_img: Path, qemu_args: typing.List[str], kernel_image: Path,
+               disk_image: Path, disk_image_format: str) -> "QemuSnapshot":
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        qemu_stat = Path(qemu_args[0]).stat()
+        h = hashlib.sha256()
+        # The kernel and disk image paths don't matter, only their contents
+        h.update(commandline_to_str(qemu_args).replace(str(kernel_image), "<kernel>").encode("utf-8"))
+        h.update("{}:{}".format(qemu_stat.st_size, qemu_stat.st_mtime_ns).encode("utf-8"))
+        h.update(disk_image_format.encode("utf-8"))
+        hash_cache = snapshot_dir / "file-hashes.json"
+        h.update(cached_file_hash(kernel_image, hash_cache).encode("utf-8"))
+        h.update(cached_file_hash(disk_image, hash_cache).encode("utf-8"))
+        return QemuSnapshot(snapshot_dir, qemu_img, h.hexdigest()[:32])
+
+    def exists(self) -> bool:
+        return self.state.is_file() and self.overlay.is_file()
+
+    def discard(self):
+        for f in (self.state, self.overlay, self.base):
+            if f.is_symlink() or f.exists():
+                f.unlink()
+
+    def link_disk_image(self, disk_image: Path):
+        """Point the backing file of the snapshot overlay to disk_image (which may have moved since creation)"""
+        target = str(disk_image.absolute())
+        if self.base.is_symlink() and os.readlink(str(self.base)) == target:
+            return
+        tmp_link = self._temporary_path("base.symlink")
+        if tmp_link.is_symlink():
+            tmp_link.unlink()
+        os.symlink(target, str(tmp_link))
+        os.replace(str(tmp_link), str(self.base))  # Atomic since other jobs may be restoring the snapshot
+
+    def try_lock(self) -> bool:
+        """Ensure only one job creates the snapshot (the others just cold boot)"""
+        self._lock_fd = os.open(str(self.snapshot_dir / (self.key + ".lock")), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            return False
+
+    def unlock(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _temporary_path(self, name: str) -> Path:
+        if self._tmpdir is None:
+            self._tmpdir = Path(tempfile.mkdtemp(prefix="run-", dir=str(self.snapshot_dir)))
+            atexit.register(shutil.rmtree, str(self._tmpdir), ignore_errors=True)
+        return self._tmpdir / name
+
+    def create_overlay(self, backing_file: Path, backing_format: str, name: str) -> Path:
+        overlay = self._temporary_path(name)
+        run_host_command([str(self.qemu_img), "create", "-q", "-f", "qcow2", "-F", backing_format,
+                          "-b", str(backing_file.absolute()), str(overlay)])
+        return overlay
+
+    def monitor_args(self) -> typing.List[str]:
+        self.monitor_socket = self._temporary_path("monitor.sock")
+        return ["-monitor", "unix:" + str(self.monitor_socket) + ",server,nowait"]
+
+    def _monitor_command(self, command: str, timeout=60) -> str:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(self.monitor_socket))
+            output = b""
+            for cmd in (None, command):
+                if cmd is not None:
+                    sock.sendall(cmd.encode("utf-8") + b"\n")
+                    output = b""
+                while not output.endswith(b"(qemu) "):
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    output += data
+            return output.decode("utf-8", errors="replace")
+
+    def save(self, child: "QemuCheriBSDInstance", overlay: Path, timeout=10 * 60) -> bool:
+        """Save the state of child and shut it down. The disk contents are already in overlay."""
+        success("===> Saving QEMU snapshot ", self.state)
+        tmp_state = self._temporary_path("vmstate")
+        try:
+            # Note: HMP only supports double-quoted strings, the single quotes are passed on to the shell
+            self._monitor_command('migrate -d "exec:cat > ' + shlex.quote(str(tmp_state)) + '"')
+            deadline = time.time() + timeout
+            while True:
+                status = self._monitor_command("info migrate")
+                if "Migration status: completed" in status:
+                    break
+                if "Migration status: failed" in status or time.time() > deadline:
+                    failure("Failed to save QEMU snapshot: ", status, exit=False)
+                    self._monitor_command("migrate_cancel")
+                    self._monitor_command("cont")  # The guest may have been paused for the final migration step
+                    return False
+                time.sleep(0.5)
+            self._monitor_command("quit")
+        except OSError as e:
+            failure("Failed to save QEMU snapshot: ", e, exit=False)
+            return False
+        child.expect([pexpect.EOF], timeout=60, timeout_fatal=False)
+        overlay.chmod(0o444)
+        os.replace(str(overlay), str(self.overlay))
+        os.replace(str(tmp_state), str(self.state))  # Write the state last since its presence marks a valid snapshot
+        return True
+
+
+def qemu_user_network_args(ssh_port: typing.Optional[int], smb_dirs: typing.List[SmbMount]) -> str:
+    result = ""
     if smb_dirs:
         for d in smb_dirs:
             if not Path(d.hostdir).exists():
                 failure("SMB share directory ", d.hostdir, " doesn't exist!")
-        user_network_args += ",smb=" + ":".join(d.qemu_arg for d in smb_dirs)
+        result += ",smb=" + ":".join(d.qemu_arg for d in smb_dirs)
     if ssh_port is not None:
-        user_network_args += ",hostfwd=tcp::" + str(ssh_port) + "-:22"
+        result += ",hostfwd=tcp::" + str(ssh_port) + "-:22"
+    return result
+
 
+def qemu_boot_commandline(qemu_options: QemuOptions, qemu_command: typing.Optional[Path], kernel_image: Path,
+                          disk: typing.Optional[Path], network_args: str, disk_format="raw", *,
+                          extra_args: typing.List[str] = None, bios_path: Path = None, kernel_init_only=False,
+                          trap_on_unrepresentable=False, skip_ssh_setup=False) -> typing.List[str]:
     if not qemu_options.can_boot_kernel_directly:
-        if not disk_image:
+        if not disk:
             failure("Cannot boot kernel directly and no disk image passed!")
     if bios_path is not None:
         bios_args = ["-bios", str(bios_path)]
@@ -706,39 +1004,113 @@ def boot_cheribsd(qemu_options: QemuOptions, qemu_command: typing.Optional[Path]
         bios_args = riscv_bios_arguments(qemu_options.xtarget, None)
     else:
         bios_args = []
-    qemu_args = qemu_options.get_commandline(qemu_command=qemu_command, kernel_file=kernel_image, disk_image=disk_image,
-                                             bios_args=bios_args, user_network_args=user_network_args,
-                                             add_network_device=True,
-                                             trap_on_unrepresentable=trap_on_unrepresentable,  # For debugging
-                                             add_virtio_rng=True  # faster entropy gathering
-                                             )
     kernel_commandline = []
     if kernel_init_only:
         kernel_commandline.append("init_path=/sbin/startup-benchmark.sh")
     if skip_ssh_setup:
         kernel_commandline.append("cheribuild.skip_sshd=1")
         kernel_commandline.append("cheribuild.skip_entropy=1")
+    result = qemu_options.get_commandline(qemu_command=qemu_command, kernel_file=kernel_image, disk_image=disk,
+                                          bios_args=bios_args, user_network_args=network_args,
+                                          add_network_device=True, disk_image_format=disk_format,
+                                          trap_on_unrepresentable=trap_on_unrepresentable,  # For debugging
+                                          add_virtio_rng=True  # faster entropy gathering
+                                          )
     if kernel_commandline:
-        qemu_args.append("-append")
-        qemu_args.append(" ".join(kernel_commandline))
-    success("Starting QEMU: ", " ".join(qemu_args))
+        result.append("-append")
+        result.append(" ".join(kernel_commandline))
+    return result + (extra_args or [])
+
+
+def boot_cheribsd(qemu_options: QemuOptions, qemu_command: typing.Optional[Path], kernel_image: Path,
+                  disk_image: typing.Optional[Path], ssh_port: typing.Optional[int],
+                  ssh_pubkey: typing.Optional[Path], *, smb_dirs: typing.List[SmbMount] = None, kernel_init_only=False,
+                  trap_on_unrepresentable=False, skip_ssh_setup=False, bios_path: Path = None,
+                  snapshot_dir: Path = None, disk_image_format="raw",
+                  _restoring_new_snapshot=False) -> QemuCheriBSDInstance:
+    if smb_dirs is None:
+        smb_dirs = []
+    user_network_args = qemu_user_network_args(ssh_port, smb_dirs)
+
+    def qemu_commandline(disk: typing.Optional[Path], network_args: str, disk_format="raw",
+                         extra_args: typing.List[str] = None) -> typing.List[str]:
+        return qemu_boot_commandline(qemu_options, qemu_command, kernel_image, disk, network_args, disk_format,
+                                     extra_args=extra_args, bios_path=bios_path, kernel_init_only=kernel_init_only,
+                                     trap_on_unrepresentable=trap_on_unrepresentable, skip_ssh_setup=skip_ssh_setup)
+
+    def start_qemu(qemu_args: typing.List[str]) -> QemuCheriBSDInstance:
+        success("Starting QEMU: ", " ".join(qemu_args))
+        global _SSH_SOCKET_PLACEHOLDER
+        if _SSH_SOCKET_PLACEHOLDER is not None:
+            _SSH_SOCKET_PLACEHOLDER.close()
+        qemu_cls = QemuCheriBSDInstance
+        if PRETEND:
+            qemu_cls = FakeQemuSpawn
+        result = qemu_cls(qemu_options, qemu_args[0], qemu_args[1:], ssh_port=ssh_port, ssh_pubkey=ssh_pubkey,
+                          encoding="utf-8", echo=False, timeout=60)
+        # child.logfile=sys.stdout.buffer
+        result.smb_dirs = smb_dirs
+        if QEMU_LOGFILE:
+            # Append since QEMU is started twice when creating a snapshot (truncated in _main())
+            result.logfile = QEMU_LOGFILE.open("a")
+        else:
+            result.logfile_read = sys.stdout
+        return result
+
+    snapshot = None
+    # If the snapshot that was just saved cannot be restored, creating a new one won't help either.
+    create_snapshot = not _restoring_new_snapshot
+    if snapshot_dir is not None and disk_image is not None and not kernel_init_only and not PRETEND:
+        qemu_img = find_qemu_img(qemu_command)
+        if qemu_img is None:
+            failure("Cannot use QEMU snapshots without qemu-img", exit=True)
+        # The host-side network options (SSH port and SMB directories) are not part of the guest state.
+        snapshot = QemuSnapshot.create(snapshot_dir, qemu_img, qemu_commandline(Path("<disk>"), ""), kernel_image,
+                                       disk_image, disk_image_format)
+        if snapshot.exists():
+            restore_starttime = datetime.datetime.now()
+            snapshot.link_disk_image(disk_image)
+            overlay = snapshot.create_overlay(snapshot.overlay, "qcow2", "disk.qcow2")
+            child = start_qemu(qemu_commandline(overlay, user_network_args, "qcow2", [
+                "-incoming", "exec:cat " + shlex.quote(str(snapshot.state))]))
+            child.sendline("")
+            if child.expect([PEXPECT_PROMPT_RE, pexpect.EOF], timeout=120, timeout_fatal=False) == 0:
+                success("===> restored CheriBSD from snapshot in ", datetime.datetime.now() - restore_starttime)
+                # The guest clock stopped when the snapshot was taken
+                child.run("date -u " + datetime.datetime.utcnow().strftime("%Y%m%d%H%M.%S"), timeout=30)
+                return child
+            failure("Could not restore QEMU snapshot ", snapshot.state, ", falling back to a cold boot", exit=False)
+            child.terminate(force=True)
+            snapshot.discard()
+
     qemu_starttime = datetime.datetime.now()
-    global _SSH_SOCKET_PLACEHOLDER
-    if _SSH_SOCKET_PLACEHOLDER is not None:
-        _SSH_SOCKET_PLACEHOLDER.close()
-    qemu_cls = QemuCheriBSDInstance
-    if PRETEND:
-        qemu_cls = FakeQemuSpawn
-    child = qemu_cls(qemu_options, qemu_args[0], qemu_args[1:], ssh_port=ssh_port, ssh_pubkey=ssh_pubkey,
-                     encoding="utf-8", echo=False, timeout=60)
-    # child.logfile=sys.stdout.buffer
-    child.smb_dirs = smb_dirs
-    if QEMU_LOGFILE:
-        child.logfile = QEMU_LOGFILE.open("w")
+    if snapshot is None:
+        child = start_qemu(qemu_commandline(disk_image, user_network_args, disk_image_format))
+    elif not create_snapshot or not snapshot.try_lock():
+        if create_snapshot:
+            info("Another job is creating the QEMU snapshot, booting without it.")
+        # The disk image is shared with the other jobs so write all changes to an overlay
+        overlay = snapshot.create_overlay(disk_image, disk_image_format, "private.qcow2")
+        snapshot = None
+        child = start_qemu(qemu_commandline(overlay, user_network_args, "qcow2"))
     else:
-        child.logfile_read = sys.stdout
+        snapshot.link_disk_image(disk_image)
+        overlay = snapshot.create_overlay(snapshot.base, disk_image_format, "snapshot.qcow2")
+        child = start_qemu(qemu_commandline(overlay, user_network_args, "qcow2", snapshot.monitor_args()))
     boot_and_login(child, starttime=qemu_starttime, kernel_init_only=kernel_init_only,
                    network_iface=qemu_options.network_interface_name())
+    if snapshot is not None:
+        saved = snapshot.save(child, overlay)
+        snapshot.unlock()
+        if not saved:
+            # The guest is still running, so just continue without the snapshot
+            failure("Could not create QEMU snapshot, continuing with the booted guest", exit=False)
+            return child
+        # Now continue from the saved state (this also ensures the snapshot can actually be restored)
+        return boot_cheribsd(qemu_options, qemu_command, kernel_image, disk_image, ssh_port, ssh_pubkey,
+                             smb_dirs=smb_dirs, trap_on_unrepresentable=trap_on_unrepresentable,
+                             skip_ssh_setup=skip_ssh_setup, bios_path=bios_path, snapshot_dir=snapshot_dir,
+                             disk_image_format=disk_image_format, _restoring_new_snapshot=True)
     return child
 
 
@@ -830,6 +1202,33 @@ def boot_and_login(child: CheriBSDSpawnMixin, *, starttime, kernel_init_only=Fal
     return
 
 
+def decompressed_test_archive(archive: Path, cache: DecompressedImageCache) -> Path:
+    """Return an uncompressed tar file with the contents of archive. The result is stored in the cache using the
+    hash of the archive as the name, so repeated runs with the same archive don't need to decompress it again."""
+    if archive.suffix not in (".xz", ".txz"):
+        return archive
+    return cache.decompress(archive, ["xz", "-T0", "-d", "-c"], "test archive")
+
+
+def stream_tarfile_to_guest(qemu: QemuCheriBSDInstance, tar_path: Path, target_dir: str):
+    """Extract tar_path in the guest by piping it into tar over an SSH ControlMaster connection."""
+    command = ["tar", "-xf", "-", "-C", target_dir]
+    if PRETEND:
+        print_cmd(["ssh", "-p", str(qemu.ssh_port), "root@localhost", "--"] + command, stdin=str(tar_path))
+        return
+    with tar_path.open("rb") as f:
+        qemu.run_command_via_ssh(command, stdin=f, use_controlmaster=True)
+
+
+def _report_throughput(path: Path, what: str, transfer: "typing.Callable[[], None]"):
+    start = time.time()
+    transfer()
+    duration = time.time() - start
+    size = path.stat().st_size if path.exists() else 0
+    success(what, " ", path.name, " (", round(size / (1024 * 1024), 1), " MiB) in ", round(duration, 1), "s (",
+            round(size / (1024 * 1024) / max(duration, 0.001), 1), " MiB/s)")
+
+
 def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_archives: list,
                    test_ld_preload_files: list,
                    test_setup_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], None]" = None):
@@ -870,15 +1269,24 @@ def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_ar
             scp_cmd = ["script", "--quiet", "--return", "--command", " ".join(scp_cmd), "/dev/null"]
         run_host_command(scp_cmd, cwd=str(src))
 
-    for archive in test_archives:
-        if smb_dirs:
-            run_host_command(["tar", "xJf", str(archive), "-C", str(smb_dirs[0].hostdir)])
+    with tempfile.TemporaryDirectory(dir=os.getcwd(), prefix="test_files_") as tmp:
+        # Without a cache directory the archives are decompressed to a temporary directory for this run only.
+        if args.test_archive_cache_dir:
+            cache = DecompressedImageCache(Path(args.test_archive_cache_dir),
+                                           int(args.test_archive_cache_max_size * 1024 ** 3))
         else:
-            # Extract to temporary directory and scp over
-            with tempfile.TemporaryDirectory(dir=os.getcwd(), prefix="test_files_") as tmp:
-                run_host_command(["tar", "xJf", str(archive), "-C", tmp])
-                run_host_command(["ls", "-la"], cwd=tmp)
-                do_scp(tmp)
+            cache = DecompressedImageCache(Path(tmp), sys.maxsize)
+        try:
+            for archive in test_archives:
+                tar_path = decompressed_test_archive(Path(archive), cache)
+                if smb_dirs:
+                    extract_cmd = ["tar", "xf", str(tar_path), "-C", str(smb_dirs[0].hostdir)]
+                    _report_throughput(tar_path, "Extracted", lambda: run_host_command(extract_cmd))
+                else:
+                    _report_throughput(tar_path, "Streamed", lambda: stream_tarfile_to_guest(qemu, tar_path, "/"))
+                cache.release(tar_path)
+        finally:
+            cache.release_all()
     ld_preload_target_paths = []
     for lib in test_ld_preload_files:
         assert isinstance(lib, Path)
@@ -1007,6 +1415,13 @@ def get_argument_parser() -> argparse.ArgumentParser:
                         help="Set this if tests are being run on the minimal disk image rather than the full one")
     parser.add_argument("--extract-images-to", help="Path where the compressed images should be extracted to")
     parser.add_argument("--reuse-image", action="store_true")
+    parser.add_argument("--image-cache-dir", type=Path, default=None,
+                        help="Decompress the kernel and disk image into this (shared) cache directory instead of next "
+                             "to the archive. Concurrent jobs using the same archive share one decompressed copy and "
+                             "write to their own qcow2 overlay instead of copying the disk image.")
+    parser.add_argument("--image-cache-max-size", type=float, default=50, metavar="GiB",
+                        help="Evict the least recently used entries once the image cache is larger than this "
+                             "(default: %(default)s GiB)")
     parser.add_argument("--keep-compressed-images", action="store_true", default=True, dest="keep_compressed_images")
     parser.add_argument("--no-keep-compressed-images", action="store_false", dest="keep_compressed_images")
     parser.add_argument("--make-disk-image-copy", default=True, action="store_true",
@@ -1042,6 +1457,26 @@ def get_argument_parser() -> argparse.ArgumentParser:
                         help="Setup mount paths + SSH for tests but don't actually run the tests (implies --interact)")
     parser.add_argument("--skip-ssh-setup", action="store_true",
                         help="Don't start sshd on boot. Saves a few seconds of boot time if not needed.")
+    parser.add_argument("--qemu-snapshot", action="store_true",
+                        help="Restore a QEMU snapshot of the booted system instead of cold-booting CheriBSD. The "
+                             "snapshot is created on first use and is keyed by the kernel, disk image and QEMU "
+                             "arguments. This implies --no-make-disk-image-copy since all writes go to an overlay.")
+    parser.add_argument("--qemu-snapshot-dir", type=Path, default=default_qemu_snapshot_dir(),
+                        help="Directory for the QEMU snapshots (default: '%(default)s')")
+    parser.add_argument("--test-archive-cache-dir", type=Path, default=None,
+                        help="Cache the decompressed test archives in this directory (e.g. "
+                             "~/.cache/cheribuild/test-archives) so that later runs with the same archives don't need "
+                             "to decompress them again. By default they are decompressed to a temporary directory.")
+    parser.add_argument("--test-archive-cache-max-size", type=float, default=10, metavar="GiB",
+                        help="Evict the least recently used test archives once the cache is larger than this "
+                             "(default: %(default)s GiB)")
+    parser.add_argument("--test-duration-db", type=Path, default=default_test_duration_db(),
+                        help="SQLite database with the test durations of previous runs. It is used to schedule the "
+                             "slowest tests first and to choose timeouts (default: '%(default)s')")
+    parser.add_argument("--no-test-duration-db", action="store_const", const=None, dest="test_duration_db",
+                        help="Don't read or record test durations")
+    parser.add_argument("--report-slowest-tests", metavar="N", type=int, default=10,
+                        help="Print the N slowest tests and regressions compared to previous runs after the tests")
     parser.add_argument("--pretend", "-p", action="store_true",
                         help="Don't actually boot CheriBSD just print what would happen")
     parser.add_argument("--interact", "-i", action="store_true")
@@ -1111,6 +1546,7 @@ def _main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace]
     global QEMU_LOGFILE
     if args.qemu_logfile:
         QEMU_LOGFILE = args.qemu_logfile
+        QEMU_LOGFILE.open("w").close()
 
     starttime = datetime.datetime.now()
 
@@ -1166,21 +1602,40 @@ def _main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace]
 
         force_decompression = True
         keep_compressed_images = False
+    image_cache = None
+    if args.image_cache_dir and not args.extract_images_to:
+        image_cache = DecompressedImageCache(Path(args.image_cache_dir), int(args.image_cache_max_size * 1024 ** 3))
     kernel = maybe_decompress(Path(args.kernel), force_decompression, keep_archive=keep_compressed_images, args=args,
-                              what="kernel")
+                              what="kernel", image_cache=image_cache)
     diskimg = None
     if args.disk_image:
         diskimg = maybe_decompress(Path(args.disk_image), force_decompression, keep_archive=keep_compressed_images,
-                                   args=args, what="disk image")
+                                   args=args, what="disk image", image_cache=image_cache)
 
     # Allow running multiple jobs in parallel by making a copy of the disk image
-    if diskimg is not None and args.make_disk_image_copy:
+    disk_image_format = "raw"
+    if args.qemu_snapshot:
+        info("Not making a copy of the disk image since all writes go to a qcow2 overlay when using snapshots")
+    elif diskimg is not None and image_cache is not None and find_qemu_img(args.qemu_cmd) is not None:
+        # The cached image is shared with other jobs, so write all changes to a copy-on-write overlay instead.
+        assert isinstance(diskimg, Path)
+        new_img = Path(args.disk_image).with_suffix(
+            ".runtests." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".pid" + str(os.getpid()) + ".qcow2")
+        run_host_command([str(find_qemu_img(args.qemu_cmd)), "create", "-q", "-f", "qcow2", "-F", "raw",
+                          "-b", str(diskimg.absolute()), str(new_img)])
+        if not args.keep_disk_image_copy:
+            atexit.register(run_host_command, ["rm", "-fv", str(new_img)])
+        diskimg = new_img
+        disk_image_format = "qcow2"
+    elif diskimg is not None and (args.make_disk_image_copy or image_cache is not None):
         assert isinstance(diskimg, Path)
         str(os.getpid())
         new_img = diskimg.with_suffix(
             ".img.runtests." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".pid" + str(os.getpid()))
         assert not new_img.exists()
         run_host_command(["cp", "-fv", str(diskimg), str(new_img)])
+        if image_cache is not None:
+            run_host_command(["chmod", "u+w", str(new_img)])  # cache entries are read-only
         if not args.keep_disk_image_copy:
             atexit.register(run_host_command, ["rm", "-fv", str(new_img)])
         diskimg = new_img
@@ -1190,7 +1645,8 @@ def _main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace]
                          ssh_port=args.ssh_port, ssh_pubkey=Path(args.ssh_key), smb_dirs=args.smb_mount_directories,
                          kernel_init_only=args.test_kernel_init_only,
                          trap_on_unrepresentable=args.trap_on_unrepresentable, skip_ssh_setup=args.skip_ssh_setup,
-                         bios_path=args.bios)
+                         bios_path=args.bios, snapshot_dir=args.qemu_snapshot_dir if args.qemu_snapshot else None,
+                         disk_image_format=disk_image_format)
     success("Booting CheriBSD took: ", datetime.datetime.now() - boot_starttime)
 
     tests_okay = True
@@ -0,0 +1,529 @@
+#
+# Copyright (c) 2020 Alex Richardson
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+An asyncio-based alternative to the pexpect-based QemuCheriBSDInstance. It provides the same expect()/run()/
+checked_run()/expect_prompt() interface (as coroutines) and the same kernel panic detection, but all guests share a
+single event loop, so one host process can drive many guests without one process or flush thread per guest. The
+console output that has not been matched yet is limited to max_buffer characters per guest.
+"""
+import asyncio
+import codecs
+import datetime
+import errno
+import fcntl
+import os
+import pty
+import random
+import re
+import shlex
+import subprocess
+import termios
+import typing
+from pathlib import Path
+
+from . import (CHERI_TRAP_MIPS, CHERI_TRAP_RISCV, CheriBSDCommandFailed, CheriBSDCommandTimeout,
+               CheriBSDMatchedErrorOutput, FATAL_ERROR_MESSAGES, INITIAL_PROMPT_CSH, INITIAL_PROMPT_SH, LOGIN,
+               MAX_SMBFS_RETRY, PANIC, PANIC_KDB, PANIC_PAGE_FAULT, PEXPECT_CONTINUATION_PROMPT_RE,
+               PEXPECT_CONTINUATION_PROMPT_SET_STR, PEXPECT_PROMPT, PEXPECT_PROMPT_RE, PEXPECT_PROMPT_SET_STR,
+               QemuCheriBSDInstance, RTLD_DSO_NOT_FOUND, SH_PROGRAM_NOT_FOUND, SHELL_OPEN, STOPPED, BOOT_FAILURE,
+               BOOT_FAILURE2, BOOT_FAILURE3, SmbMount, failure, info, pexpect, print_cmd, qemu_boot_commandline,
+               qemu_user_network_args, success)
+from ..config.compilation_targets import CrossCompileTarget
+from ..qemu_utils import QemuOptions
+
+PatternList = "typing.List[typing.Union[str, typing.Pattern, typing.Type[pexpect.ExceptionPexpect]]]"
+
+
+class AsyncCheriBSDInstance(object):
+    # A kernel panic in one guest must not terminate the other guests driven by the same process, so unlike
+    # QemuCheriBSDInstance the default is to return the match index of the panic message to the caller. If this is
+    # set, a CheriBSDCommandFailed exception is raised instead of calling sys.exit().
+    EXIT_ON_KERNEL_PANIC = False
+
+    def __init__(self, xtarget: CrossCompileTarget, *, name: str = "guest", timeout=60, max_buffer=256 * 1024,
+                 logfile: typing.TextIO = None, ssh_port: int = None, ssh_pubkey: Path = None):
+        self.xtarget = xtarget
+        self.name = name
+        self.timeout = timeout
+        self.max_buffer = max_buffer
+        self.logfile = logfile
+        self.ssh_port = ssh_port
+        self.ssh_public_key = ssh_pubkey
+        self.ssh_private_key = Path(ssh_pubkey).with_suffix("") if ssh_pubkey else None
+        self.ssh_user = "root"
+        self.smb_dirs = []  # type: typing.List[SmbMount]
+        self.smb_failed = False
+        self.process = None  # type: typing.Optional[asyncio.subprocess.Process]
+        self.buffer = ""
+        self.before = ""
+        self.after = ""
+        self.match = None  # type: typing.Optional[typing.Match]
+        self._fd = -1
+        self._eof = False
+        self._data_available = None  # type: typing.Optional[asyncio.Event]
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def __str__(self):
+        return "<{} {} (pid {}), buffer tail: {!r}>".format(type(self).__name__, self.name,
+                                                            self.process.pid if self.process else None,
+                                                            self.buffer[-100:])
+
+    async def spawn(self, command: str, args: typing.List[str], **kwargs):
+        """Start command with its stdin/stdout/stderr connected to a pseudo-terminal (like pexpect.spawn)."""
+        # Note: the event has to be created here since it is bound to the current event loop on Python < 3.10.
+        self._data_available = asyncio.Event()
+        master, slave = pty.openpty()
+        try:
+            # Make the pseudo-terminal the controlling terminal (like pexpect) so that closing it sends SIGHUP
+            self.process = await asyncio.create_subprocess_exec(
+                command, *args, stdin=slave, stdout=slave, stderr=slave, start_new_session=True,
+                preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0), **kwargs)
+        finally:
+            os.close(slave)
+        self._fd = master
+        os.set_blocking(master, False)
+        asyncio.get_event_loop().add_reader(master, self._read_available)
+
+    def _read_available(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Linux returns EIO once the other side of the pseudo-terminal has been closed
+            if e.errno != errno.EIO:
+                raise
+            data = b""
+        if not data:
+            self._eof = True
+            asyncio.get_event_loop().remove_reader(self._fd)
+        else:
+            text = self._decoder.decode(data)
+            if self.logfile is not None:
+                self.logfile.write(text)
+            self.buffer += text
+            if len(self.buffer) > self.max_buffer:
+                # Nobody is waiting for this output, only keep the most recent part
+                self.buffer = self.buffer[-self.max_buffer:]
+        self._data_available.set()
+
+    def send(self, s: str):
+        os.write(self._fd, s.encode("utf-8"))
+
+    def sendline(self, s: str = ""):
+        self.send(s + os.linesep)
+
+    def sendintr(self):
+        self.send("\x03")
+
+    def flush(self):
+        pass
+
+    async def _expect_impl(self, patterns: PatternList, *, timeout: float, exact: bool) -> int:
+        if timeout == -1:
+            timeout = self.timeout
+        compiled = []  # type: typing.List[typing.Optional[typing.Pattern]]
+        for p in patterns:
+            if p is pexpect.EOF or p is pexpect.TIMEOUT:
+                compiled.append(None)
+            elif isinstance(p, str):
+                compiled.append(re.compile(re.escape(p) if exact else p, re.DOTALL))
+            else:
+                compiled.append(p)
+        deadline = asyncio.get_event_loop().time() + timeout if timeout is not None else None
+        while True:
+            # Like pexpect, return the pattern that matches earliest in the output
+            best = None  # type: typing.Optional[typing.Tuple[int, int, typing.Match]]
+            for index, regex in enumerate(compiled):
+                if regex is None:
+                    continue
+                m = regex.search(self.buffer)
+                if m is not None and (best is None or m.start() < best[2].start()):
+                    best = (index, m.start(), m)
+            if best is not None:
+                index, _, m = best
+                self.before = self.buffer[:m.start()]
+                self.after = m.group(0)
+                self.match = m
+                self.buffer = self.buffer[m.end():]
+                return index
+            if self._eof:
+                self.before = self.buffer
+                self.buffer = ""
+                if pexpect.EOF in patterns:
+                    self.match = pexpect.EOF
+                    return patterns.index(pexpect.EOF)
+                raise pexpect.EOF("End of file from " + str(self))
+            self._data_available.clear()
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - asyncio.get_event_loop().time())
+                await asyncio.wait_for(self._data_available.wait(), remaining)
+            except asyncio.TimeoutError:
+                if pexpect.TIMEOUT in patterns:
+                    self.match = pexpect.TIMEOUT
+                    return patterns.index(pexpect.TIMEOUT)
+                raise pexpect.TIMEOUT("Timeout exceeded: " + str(self))
+
+    async def _expect_and_handle_panic_impl(self, options: list, timeout_msg, *, timeout_fatal=True, exact: bool,
+                                            timeout=-1, **kwargs):
+        panic_regexes = [PANIC, STOPPED, PANIC_KDB, PANIC_PAGE_FAULT]
+        if exact:
+            panic_regexes = [re.compile(re.escape(p)) for p in panic_regexes]
+        # Note: failure(exit=True) must not be used here since it would block the event loop and then terminate all
+        # guests driven by this process. Raise an exception instead so that only this guest's coroutine fails.
+        starttime = datetime.datetime.now()
+        try:
+            i = await self._expect_impl(options + panic_regexes, timeout=timeout, exact=exact)
+        except pexpect.TIMEOUT:
+            if timeout_fatal:
+                raise CheriBSDCommandTimeout(timeout_msg, ": ", str(self),
+                                             execution_time=datetime.datetime.now() - starttime)
+            failure(timeout_msg, ": ", str(self), exit=False)
+            return None
+        if i >= len(options):
+            await self.debug_kernel_panic()
+            if self.EXIT_ON_KERNEL_PANIC:
+                raise CheriBSDCommandFailed(self.name, ": EXITING DUE TO KERNEL PANIC!",
+                                            execution_time=datetime.datetime.now() - starttime)
+        return i
+
+    def is_panic_index(self, i: typing.Optional[int], options: list) -> bool:
+        """Returns true if i is the index returned by expect(options) for a kernel panic message."""
+        return i is not None and i >= len(options)
+
+    async def expect(self, patterns: PatternList, timeout=-1, pretend_result=None, timeout_fatal=True,
+                     log_patterns=True, timeout_msg="timeout", **kwargs):
+        assert isinstance(patterns, list), "expected list and not " + str(patterns)
+        if log_patterns:
+            info(self.name, ": expecting regex ", patterns)
+        return await self._expect_and_handle_panic_impl(patterns, timeout_msg, timeout_fatal=timeout_fatal,
+                                                        exact=False, timeout=timeout)
+
+    async def expect_exact(self, patterns: PatternList, timeout=-1, pretend_result=None, timeout_fatal=True,
+                           log_patterns=True, timeout_msg="timeout", **kwargs):
+        assert isinstance(patterns, list), "expected list and not " + str(patterns)
+        if log_patterns:
+            info(self.name, ": expecting literal ", patterns)
+        return await self._expect_and_handle_panic_impl(patterns, timeout_msg, timeout_fatal=timeout_fatal,
+                                                        exact=True, timeout=timeout)
+
+    async def expect_prompt(self, timeout=-1, timeout_msg="timeout", timeout_fatal=True, **kwargs):
+        return await self.expect_exact([PEXPECT_PROMPT], timeout=timeout, timeout_msg=timeout_msg,
+                                       timeout_fatal=timeout_fatal, **kwargs)
+
+    async def debug_kernel_panic(self):
+        failure(self.name, ": trying to get a stack trace for kernel panic: ", self.after, exit=False)
+        patterns = [pexpect.TIMEOUT, "db> ", "KDB: stack backtrace:"]
+        stack_backtrace_start_idx = 2
+        # Note: this does not use expect_exact() to avoid infinite recursion in a panic loop
+        i = await self._expect_impl(patterns, timeout=10, exact=True)
+        if i == 1:
+            success(self.name, ": got debugger prompt, requesting stack trace.")
+            self.sendline("bt")
+            i = await self._expect_impl(patterns, timeout=30, exact=True)
+        if i == stack_backtrace_start_idx:
+            success(self.name, ": kernel stack trace about to be printed:")
+            i = await self._expect_impl(patterns, timeout=30, exact=True)
+            if i == stack_backtrace_start_idx:
+                i = await self._expect_impl(patterns, timeout=5, exact=True)
+                if i == stack_backtrace_start_idx:
+                    failure("Unexpected output (infinite backtrace loop?): ", self.after, exit=False)
+        failure(self.name, ": GOT KERNEL PANIC!", exit=False)
+
+    async def run(self, cmd: str, *, expected_output=None, error_output=None, cheri_trap_fatal=True,
+                  ignore_cheri_trap=False, timeout=60):
+        """Same semantics as run_cheribsd_command()"""
+        self.sendline(cmd)
+        if expected_output:
+            await self.expect([expected_output], timeout=timeout)
+        results = [SH_PROGRAM_NOT_FOUND, RTLD_DSO_NOT_FOUND, pexpect.TIMEOUT,
+                   PEXPECT_PROMPT_RE, PEXPECT_CONTINUATION_PROMPT_RE]
+        error_output_index = -1
+        cheri_trap_indices = tuple()
+        if error_output:
+            error_output_index = len(results)
+            results.append(error_output)
+        if not ignore_cheri_trap:
+            cheri_trap_indices = (len(results), len(results) + 1)
+            results.append(CHERI_TRAP_MIPS)
+            results.append(CHERI_TRAP_RISCV)
+        starttime = datetime.datetime.now()
+        i = await self.expect(results, timeout=timeout)
+        runtime = datetime.datetime.now() - starttime
+        if i == 0:
+            raise CheriBSDCommandFailed("/bin/sh: command not found: ", cmd, execution_time=runtime)
+        elif i == 1:
+            raise CheriBSDCommandFailed("Missing shared library dependencies: ", cmd, execution_time=runtime)
+        elif i == 2:
+            raise CheriBSDCommandTimeout("timeout running ", cmd, execution_time=runtime)
+        elif i == 3:
+            success(self.name, ": ran '", cmd, "' successfully (in ", runtime.total_seconds(), "s)")
+        elif i == 4:
+            raise CheriBSDCommandFailed("Detected line continuation, cannot handle this yet! ", cmd,
+                                        execution_time=runtime)
+        elif i == error_output_index:
+            # wait up to 20 seconds for a prompt to ensure the full output has been printed
+            await self.expect_prompt(timeout=20, timeout_fatal=False)
+            raise CheriBSDMatchedErrorOutput("Matched error output ", error_output, " in ", cmd,
+                                             execution_time=runtime)
+        elif i in cheri_trap_indices:
+            # wait up to 20 seconds for a prompt to ensure the dump output has been printed
+            await self.expect_prompt(timeout=20, timeout_fatal=False)
+            if cheri_trap_fatal:
+                raise CheriBSDCommandFailed("Got CHERI TRAP!", execution_time=runtime)
+            else:
+                failure(self.name, ": Got CHERI TRAP!", exit=False)
+        else:
+            assert self.is_panic_index(i, results), "Unexpected match index " + str(i)
+            raise CheriBSDCommandFailed("Got kernel panic running '", cmd, "'", execution_time=runtime)
+
+    async def checked_run(self, cmd: str, *, timeout=600, ignore_cheri_trap=False, error_output: str = None,
+                          **kwargs):
+        """Same semantics as checked_run_cheribsd_command()"""
+        starttime = datetime.datetime.now()
+        self.sendline(
+            cmd + " ;if test $? -eq 0; then echo '__COMMAND' 'SUCCESSFUL__'; else echo '__COMMAND' 'FAILED__'; fi")
+        cheri_trap_indices = tuple()
+        error_output_index = None
+        results = ["__COMMAND SUCCESSFUL__", "__COMMAND FAILED__", PEXPECT_CONTINUATION_PROMPT_RE]
+        if not ignore_cheri_trap:
+            cheri_trap_indices = (len(results), len(results) + 1)
+            results.append(CHERI_TRAP_MIPS)
+            results.append(CHERI_TRAP_RISCV)
+        if error_output:
+            error_output_index = len(results)
+            results.append(error_output)
+        i = await self.expect(results + [pexpect.TIMEOUT], timeout=timeout, **kwargs)
+        runtime = datetime.datetime.now() - starttime
+        if i == len(results):  # Timeout
+            raise CheriBSDCommandTimeout("timeout after ", runtime, " running '", cmd, "': ", str(self),
+                                         execution_time=runtime)
+        elif i == 0:
+            success(self.name, ": ran '", cmd, "' successfully (in ", runtime.total_seconds(), "s)")
+            await self.expect_prompt(timeout=10)
+            return True
+        elif i == 2:
+            raise CheriBSDCommandFailed("Detected line continuation, cannot handle this yet! ", cmd,
+                                        execution_time=runtime)
+        elif i in cheri_trap_indices:
+            # wait up to 20 seconds for a prompt to ensure the dump output has been printed
+            await self.expect_prompt(timeout=20, timeout_fatal=False)
+            raise CheriBSDCommandFailed("Got CHERI trap running '", cmd, "' (after '", runtime.total_seconds(),
+                                        "s)", execution_time=runtime)
+        elif i == error_output_index:
+            # wait up to 20 seconds for the shell prompt
+            await self.expect_prompt(timeout=20, timeout_fatal=False)
+            raise CheriBSDMatchedErrorOutput("Matched error output '" + error_output + "' running '", cmd,
+                                             "' (after '", runtime.total_seconds(), ")", execution_time=runtime)
+        else:
+            raise CheriBSDCommandFailed("error running '", cmd, "' (after '", runtime.total_seconds(), "s)",
+                                        execution_time=runtime)
+
+    async def run_command_via_ssh(self, command: typing.List[str], *, stdout=None, stderr=None, check=True,
+                                  use_controlmaster=False, **kwargs) -> subprocess.CompletedProcess:
+        assert self.ssh_port is not None
+        ssh_command = ["ssh", "{user}@{host}".format(user=self.ssh_user, host="localhost"),
+                       "-p", str(self.ssh_port), "-i", str(self.ssh_private_key)]
+        ssh_command.extend(QemuCheriBSDInstance._ssh_options(use_controlmaster=use_controlmaster))
+        ssh_command.append("--")
+        ssh_command.extend(command)
+        print_cmd(ssh_command, **kwargs)
+        process = await asyncio.create_subprocess_exec(*ssh_command, stdout=stdout, stderr=stderr, **kwargs)
+        out, err = await process.communicate()
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, ssh_command, out, err)
+        return subprocess.CompletedProcess(ssh_command, process.returncode, out, err)
+
+    async def terminate(self, timeout=30):
+        # Closing the pseudo-terminal sends SIGHUP, then try SIGTERM and finally SIGKILL
+        self.close()
+        if self.process is None:
+            return
+        for signal_fn in (None, self.process.terminate, self.process.kill):
+            if self.process.returncode is not None:
+                break
+            if signal_fn is not None:
+                signal_fn()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout if signal_fn is not None else 1)
+            except asyncio.TimeoutError:
+                pass
+        await self.process.wait()
+
+    def close(self):
+        if self._fd != -1:
+            if not self._eof:
+                asyncio.get_event_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = -1
+
+
+async def set_pexpect_sh_prompt(child: AsyncCheriBSDInstance):
+    # See _set_pexpect_sh_prompt()
+    child.sendline("PROMPT_COMMAND=''")
+    child.sendline("PS2='{0}'".format(PEXPECT_CONTINUATION_PROMPT_SET_STR))
+    child.sendline("PS1='{0}'".format(PEXPECT_PROMPT_SET_STR))
+    await child.expect_prompt(timeout=60)
+    success(child.name, ": ===> successfully set PS1/PS2")
+
+
+async def start_dhclient(child: AsyncCheriBSDInstance, network_iface: str):
+    child.sendline("ifconfig {network_iface} up && dhclient {network_iface}".format(network_iface=network_iface))
+    options = [pexpect.TIMEOUT, "DHCPACK from 10.0.2.2", "dhclient already running",
+               "interface ([\\w\\d]+) does not exist"]
+    i = await child.expect(options, timeout=120)
+    if i == 1:
+        options = [pexpect.TIMEOUT, "bound to"]
+        i = await child.expect(options, timeout=120)
+    if child.is_panic_index(i, options):
+        raise CheriBSDCommandFailed("Got kernel panic while starting dhclient: ", str(child),
+                                    execution_time=datetime.timedelta())
+    if i == 0:
+        raise CheriBSDCommandTimeout("timeout awaiting dhclient ", str(child), execution_time=datetime.timedelta())
+    if i == 3:
+        raise CheriBSDCommandFailed("Expected network interface ", child.match.group(1), " does not exist",
+                                    execution_time=datetime.timedelta())
+    await child.expect_prompt(timeout=30)
+
+
+async def setup_ssh_for_root_login(child: AsyncCheriBSDInstance):
+    # See setup_ssh_for_root_login()
+    await child.run("mkdir -p /root/.ssh && chmod 700 /root /root/.ssh")
+    ssh_pubkey_contents = child.ssh_public_key.read_text(encoding="utf-8").strip()
+    chunk_size = 150
+    for part in (ssh_pubkey_contents[i:i + chunk_size] for i in range(0, len(ssh_pubkey_contents), chunk_size)):
+        await child.run("printf %s " + shlex.quote(part) + " >> /root/.ssh/authorized_keys")
+    await child.run("printf '\\n' >> /root/.ssh/authorized_keys")
+    await child.run("chmod 600 /root/.ssh/authorized_keys")
+    await child.run("echo 'PermitRootLogin without-password' >> /etc/ssh/sshd_config")
+    await child.checked_run("grep -n PermitRootLogin /etc/ssh/sshd_config")
+    child.sendline("service sshd restart")
+    options = ["service: not found", "Starting sshd.", "Cannot 'restart' sshd."]
+    if child.is_panic_index(await child.expect(options, timeout=120), options):
+        raise CheriBSDCommandFailed("Got kernel panic while restarting sshd: ", str(child),
+                                    execution_time=datetime.timedelta())
+    await child.expect_prompt(timeout=60)
+    await asyncio.sleep(2)  # avoid a rejection of the first connection
+    success(child.name, ": ===> SSH authorized_keys set up")
+
+
+async def mount_smb_directories(child: AsyncCheriBSDInstance):
+    # See _do_test_setup()
+    for index, d in enumerate(child.smb_dirs):
+        await child.run("mkdir -p '{}'".format(d.in_target))
+        mount_command = "mount_smbfs -I 10.0.2.4 -N //10.0.2.4/qemu{} '{}'".format(index + 1, d.in_target)
+        for trial in range(MAX_SMBFS_RETRY):
+            try:
+                await child.checked_run(mount_command, error_output="unable to open connection: syserr = ")
+                child.smb_failed = False
+                break
+            except CheriBSDMatchedErrorOutput as e:
+                failure(child.name, ": QEMU SMBD failed to mount ", d.in_target, " after ",
+                        e.execution_time.total_seconds(), " seconds. Trying ", (MAX_SMBFS_RETRY - trial - 1),
+                        " more time(s)", exit=False)
+                child.smb_failed = True
+                if trial == MAX_SMBFS_RETRY - 1:
+                    raise
+                await asyncio.sleep(2 + 8 * random.random())  # wait 2-10 seconds, hopefully the server is less busy
+
+
+async def boot_and_login(child: AsyncCheriBSDInstance, *, network_iface: typing.Optional[str]):
+    """Wait for the guest to boot and start a shell with the pexpect prompt (same steps as boot_and_login())."""
+    starttime = datetime.datetime.now()
+    boot_expect_strings = [LOGIN, SHELL_OPEN, BOOT_FAILURE, BOOT_FAILURE2, BOOT_FAILURE3]
+    i = await child.expect(boot_expect_strings + ["DHCPACK from "] + FATAL_ERROR_MESSAGES, timeout=20 * 60,
+                           timeout_msg="timeout awaiting login prompt")
+    have_dhclient = i == len(boot_expect_strings)
+    if have_dhclient:
+        i = await child.expect(boot_expect_strings + FATAL_ERROR_MESSAGES, timeout=5 * 60,
+                               timeout_msg="timeout awaiting login prompt")
+    if i == boot_expect_strings.index(LOGIN):
+        child.sendline("root")
+        i = await child.expect([INITIAL_PROMPT_CSH, INITIAL_PROMPT_SH], timeout=10 * 60,
+                               timeout_msg="timeout awaiting command prompt ")
+        if i == 0:  # /bin/csh prompt
+            child.sendline("sh")
+            i = await child.expect([INITIAL_PROMPT_CSH, INITIAL_PROMPT_SH], timeout=3 * 60,
+                                   timeout_msg="timeout starting /bin/sh")
+            if i == 1:  # POSIX sh without PS1
+                await set_pexpect_sh_prompt(child)
+        elif i == 1:  # /bin/sh prompt
+            await set_pexpect_sh_prompt(child)
+        else:
+            raise CheriBSDCommandFailed("Got kernel panic while logging in: ", str(child),
+                                        execution_time=datetime.datetime.now() - starttime)
+    elif i == boot_expect_strings.index(SHELL_OPEN):  # shell started from /etc/rc:
+        await child.expect_exact([INITIAL_PROMPT_SH], timeout=30)
+        await set_pexpect_sh_prompt(child)
+    else:
+        # Wait up to 20 seconds to ensure the trap/debugger output has been printed
+        await child.expect([pexpect.TIMEOUT], timeout=20)
+        raise CheriBSDCommandFailed("Error during boot login prompt: ", str(child), " match index=", i,
+                                    execution_time=datetime.datetime.now() - starttime)
+    if not have_dhclient and network_iface is not None:
+        await start_dhclient(child, network_iface)
+    success(child.name, ": ===> booted CheriBSD in ", datetime.datetime.now() - starttime)
+
+
+async def boot_cheribsd_async(qemu_options: QemuOptions, qemu_command: typing.Optional[Path], kernel_image: Path,
+                              disk_image: typing.Optional[Path], ssh_port: typing.Optional[int],
+                              ssh_pubkey: typing.Optional[Path], *, name: str = "guest",
+                              smb_dirs: typing.List[SmbMount] = None, skip_ssh_setup=False, bios_path: Path = None,
+                              disk_image_format="raw", logfile: typing.TextIO = None) -> AsyncCheriBSDInstance:
+    """Boot a guest and log in. The disk image must not be shared with other guests unless it is a qcow2 overlay."""
+    smb_dirs = smb_dirs or []
+    qemu_args = qemu_boot_commandline(qemu_options, qemu_command, kernel_image, disk_image,
+                                      qemu_user_network_args(ssh_port, smb_dirs), disk_image_format,
+                                      bios_path=bios_path, skip_ssh_setup=skip_ssh_setup)
+    success(name, ": starting QEMU: ", " ".join(qemu_args))
+    child = AsyncCheriBSDInstance(qemu_options.xtarget, name=name, logfile=logfile, ssh_port=ssh_port,
+                                  ssh_pubkey=ssh_pubkey)
+    child.smb_dirs = smb_dirs
+    await child.spawn(qemu_args[0], qemu_args[1:])
+    try:
+        await boot_and_login(child, network_iface=qemu_options.network_interface_name())
+        if ssh_pubkey is not None and not skip_ssh_setup:
+            await setup_ssh_for_root_login(child)
+    except BaseException:
+        await child.terminate()
+        raise
+    return child
+
+
+def run_concurrently(coroutines: "typing.Iterable[typing.Awaitable]") -> list:
+    """Run all coroutines on a new event loop and return their results (or the exception raised by them)."""
+    loop = asyncio.new_event_loop()
+    # The child watcher used for subprocesses on Python < 3.8 is only attached to the current event loop.
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.gather(*coroutines, return_exceptions=True))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,333 @@
+#
+# Copyright (c) 2020 Alex Richardson
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import errno
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+import typing
+from enum import Enum
+from pathlib import Path
+
+from .utils import fatal_error
+
+__all__ = ["BuildLogFile", "FilteredOutput", "flush_stdio", "LineFilter", "LogCompression",  # no-combine
+           "TerminalOutput", "iter_line_blocks", "prefix_lines"]  # no-combine
+
+
+class LogCompression(Enum):
+    NONE = ""
+    GZIP = ".gz"
+    ZSTD = ".zst"
+
+    @property
+    def suffix(self) -> str:
+        return self.value
+
+
+class BuildLogFile(object):
+    """
+    A build log that is optionally compressed while it is being written. The zstd compression runs in a separate
+    process so that it does not slow down the thread that reads the build output.
+    """
+
+    def __init__(self, path: Path, compression: LogCompression = LogCompression.NONE):
+        if str(path) == os.devnull:
+            compression = LogCompression.NONE  # no need to start a compressor if the output is discarded
+        self.path = path
+        self.name = str(path)
+        self.compression = compression
+        self._output = None  # type: typing.Optional[typing.BinaryIO]
+        self._compressor = None  # type: typing.Optional[subprocess.Popen]
+        if compression is LogCompression.GZIP:
+            # Appending creates a multi-member gzip file which zcat/zless handle fine
+            self.file = gzip.open(str(path), "ab", compresslevel=1)  # type: typing.BinaryIO
+        elif compression is LogCompression.ZSTD:
+            zstd = shutil.which("zstd")
+            if zstd is None:
+                fatal_error("Cannot write zstd-compressed build logs since zstd is not installed.", pretend=False,
+                            fixit_hint="Install zstd or use --log-compression=gzip")
+            self._output = path.open("ab")
+            self._compressor = subprocess.Popen([zstd, "-q", "-c", "-3"], stdin=subprocess.PIPE,
+                                                stdout=self._output)
+            self.file = self._compressor.stdin
+        else:
+            self.file = path.open("ab")
+
+    @property
+    def is_compressed(self) -> bool:
+        return self.compression is not LogCompression.NONE
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+
+    def close(self) -> None:
+        self.file.close()
+        if self._compressor is not None:
+            self._compressor.wait()
+        if self._output is not None:
+            self._output.close()
+
+    def __enter__(self) -> "BuildLogFile":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def iter_line_blocks(fd: int, chunk_size: int = 64 * 1024) -> "typing.Iterator[bytes]":
+    """
+    Reads from fd in large chunks and yields blocks that only contain complete lines (the final block may not end with
+    a newline if the output didn't). This avoids the per-line overhead of iterating over a file object.
+    """
+    partial = b""
+    while True:
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            if partial:
+                yield partial
+            return
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            partial += chunk
+            continue
+        yield partial + chunk[:end + 1]
+        partial = chunk[end + 1:]
+
+
+def prefix_lines(block: bytes, prefix: bytes) -> bytes:
+    if not prefix:
+        return block
+    if block.endswith(b"\n"):
+        return prefix + block[:-1].replace(b"\n", b"\n" + prefix) + b"\n"
+    return prefix + block.replace(b"\n", b"\n" + prefix)
+
+
+def flush_stdio(stream) -> None:
+    while True:
+        try:
+            # can lead to EWOULDBLOCK if stream cannot be flushed immediately
+            stream.flush()
+            break
+        except BlockingIOError as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+            time.sleep(0.1)
+
+
+class TerminalOutput(object):
+    """
+    Writes filtered build output to the terminal. Progress lines overwrite each other whereas all other lines are kept.
+    """
+
+    def __init__(self, clear_line_sequence: bytes = None, stream: "typing.BinaryIO" = None):
+        self._stream = stream
+        # ANSI escape sequence \e[2k clears the whole line, \r resets to beginning of line
+        # However, if the output is just a plain text file don't attempt to do any line clearing
+        if clear_line_sequence is None:
+            clear_line_sequence = b"\x1b[2K\r" if self.stream.isatty() else b"\n"
+        self.clear_line_sequence = clear_line_sequence
+        self.last_line_can_be_overwritten = False
+
+    @property
+    def stream(self) -> "typing.BinaryIO":
+        return self._stream if self._stream is not None else sys.stdout.buffer
+
+    def progress(self, line: bytes, output_prefix: bytes = b"") -> None:
+        if output_prefix:
+            # When building multiple targets concurrently the line can't be overwritten since other targets may have
+            # printed something in the meantime -> just skip the unimportant lines.
+            return
+        stream = self.stream
+        if self.last_line_can_be_overwritten:
+            stream.write(self.clear_line_sequence)
+        stream.write(line[:-1] if line.endswith(b"\n") else line)  # remove the newline at the end
+        stream.write(b" ")  # add a space so that there is a gap before error messages
+        flush_stdio(stream)
+        self.last_line_can_be_overwritten = True
+
+    def show(self, line: bytes, output_prefix: bytes = b"") -> None:
+        stream = self.stream
+        if self.last_line_can_be_overwritten:
+            stream.write(b"\n")
+        stream.write(output_prefix + line)
+        flush_stdio(stream)
+        self.last_line_can_be_overwritten = False
+
+    def status(self, line: bytes, output_prefix: bytes = b"") -> None:
+        # A major status update that replaces the current progress line
+        stream = self.stream
+        if self.last_line_can_be_overwritten:
+            stream.write(self.clear_line_sequence)
+        stream.write(output_prefix + line)
+        flush_stdio(stream)
+        self.last_line_can_be_overwritten = False
+
+    def write_block(self, block: bytes, output_prefix: bytes = b"", stream: "typing.BinaryIO" = None) -> None:
+        """Write unfiltered output (one or more complete lines) to stream (defaults to stdout)."""
+        if self.last_line_can_be_overwritten:
+            self.stream.write(b"\n")
+            if stream is not None:
+                flush_stdio(self.stream)
+            self.last_line_can_be_overwritten = False
+        if stream is None:
+            stream = self.stream
+        stream.write(prefix_lines(block, output_prefix))
+        flush_stdio(stream)
+
+    def finish(self) -> None:
+        if self.last_line_can_be_overwritten:
+            # add the final new line after the filtering
+            self.stream.write(b"\n")
+            flush_stdio(self.stream)
+            self.last_line_can_be_overwritten = False
+
+
+class LineFilter(object):
+    """
+    A declarative filter for the standard output of build tools. Unlike a Python callback that is invoked for every
+    line, it is applied to large blocks of output using precompiled regular expressions, so filtering the millions of
+    lines printed by e.g. buildworld is cheap.
+
+    Lines are classified as follows (first match wins): ignored lines are not shown at all; status lines replace the
+    current progress line; progress lines overwrite each other and are redrawn at most every redraw_interval
+    seconds; all other lines use the default action (PROGRESS or SHOW).
+    Prefixes and suffixes are matched against the line without the trailing newline.
+    """
+    PROGRESS = "progress"
+    SHOW = "show"
+
+    def __init__(self, *, default: str = PROGRESS, status_prefixes: "typing.Tuple[bytes, ...]" = (),
+                 progress_prefixes: "typing.Tuple[bytes, ...]" = (), ignored_lines: "typing.Tuple[bytes, ...]" = (),
+                 ignored_prefixes: "typing.Tuple[bytes, ...]" = (), ignored_suffixes: "typing.Tuple[bytes, ...]" = ()):
+        assert default in (self.PROGRESS, self.SHOW)
+        self.default = default
+        self.status_prefixes = tuple(status_prefixes)
+        ignored = b"|".join([re.escape(line) + b"\n" for line in ignored_lines] +
+                            [re.escape(prefix) for prefix in ignored_prefixes] +
+                            [b"[^\n]*" + re.escape(suffix) + b"\n" for suffix in ignored_suffixes])
+        status = b"|".join(re.escape(prefix) for prefix in status_prefixes)
+        progress = b"|".join(re.escape(prefix) for prefix in progress_prefixes)
+
+        def line_regex(include: bytes, *excludes: bytes) -> "typing.Pattern[bytes]":
+            pattern = b"^"
+            excludes = tuple(e for e in excludes if e)
+            if excludes:
+                pattern += b"(?!" + b"|".join(excludes) + b")"
+            if include:
+                pattern += b"(?=" + include + b")"
+            return re.compile(pattern + b"[^\n]*\n", re.MULTILINE)
+
+        # Lines that have to be handled individually (i.e. status lines and lines that are always shown)
+        self._important_line_regex = None  # type: typing.Optional[typing.Pattern[bytes]]
+        # Lines that update the progress line
+        self._progress_line_regex = None  # type: typing.Optional[typing.Pattern[bytes]]
+        if default == self.SHOW:
+            self._important_line_regex = line_regex(b"", ignored, progress)
+            if progress:
+                self._progress_line_regex = line_regex(progress, ignored)
+        else:
+            if status:
+                self._important_line_regex = line_regex(status, ignored)
+            self._progress_line_regex = line_regex(b"", ignored, status)
+
+    def important_lines(self, block: bytes) -> "typing.Iterator[typing.Match[bytes]]":
+        if self._important_line_regex is None:
+            return iter(())
+        return self._important_line_regex.finditer(block)
+
+    def last_progress_line(self, block: bytes, start: int, end: int) -> "typing.Optional[bytes]":
+        """:return: the last progress line in block[start:end] (which must start and end at line boundaries)"""
+        if self._progress_line_regex is None:
+            return None
+        line_end = end
+        while line_end > start:
+            line_start = max(block.rfind(b"\n", start, line_end - 1) + 1, start)
+            if self._progress_line_regex.match(block, line_start, line_end):
+                return block[line_start:line_end]
+            line_end = line_start
+        return None
+
+
+class FilteredOutput(object):
+    """
+    Applies a LineFilter (or a legacy per-line callback) to blocks of output and writes the result to the terminal.
+    """
+
+    def __init__(self, stdout_filter: "typing.Union[LineFilter, typing.Callable[[bytes], None]]",
+                 terminal: TerminalOutput, output_prefix: bytes = b"", redraw_interval: float = 0.1):
+        self.stdout_filter = stdout_filter
+        self.terminal = terminal
+        self.output_prefix = output_prefix
+        self.redraw_interval = redraw_interval
+        self._pending_progress_line = None  # type: typing.Optional[bytes]
+        self._last_redraw = 0.0
+
+    def _draw_pending_progress_line(self) -> None:
+        if self._pending_progress_line is not None:
+            self.terminal.progress(self._pending_progress_line, self.output_prefix)
+            self._pending_progress_line = None
+            self._last_redraw = time.monotonic()
+
+    def feed(self, block: bytes) -> None:
+        if not block.endswith(b"\n"):
+            block += b"\n"
+        line_filter = self.stdout_filter
+        if not isinstance(line_filter, LineFilter):
+            for line in block.splitlines(keepends=True):
+                line_filter(line)
+            return
+        pos = 0
+        for match in line_filter.important_lines(block):
+            progress_line = line_filter.last_progress_line(block, pos, match.start())
+            if progress_line is not None:
+                self._pending_progress_line = progress_line
+            line = match.group()
+            if line_filter.status_prefixes and line.startswith(line_filter.status_prefixes):
+                self._pending_progress_line = None
+                self.terminal.status(line, self.output_prefix)
+            else:
+                # Show the most recent progress line first so that e.g. warnings are printed with some context
+                self._draw_pending_progress_line()
+                self.terminal.show(line, self.output_prefix)
+            pos = match.end()
+        progress_line = line_filter.last_progress_line(block, pos, len(block))
+        if progress_line is not None:
+            self._pending_progress_line = progress_line
+        if time.monotonic() - self._last_redraw >= self.redraw_interval:
+            self._draw_pending_progress_line()
+
+    def finish(self) -> None:
+        self._draw_pending_progress_line()
+        self.terminal.finish()
@@ -0,0 +1,335 @@
+#
+# Copyright (c) 2020 Alex Richardson
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import json
+import os
+import sys
+import threading
+import time
+import typing
+from collections import OrderedDict
+from pathlib import Path
+
+from .utils import AnsiColour, coloured, status_update, warning_message
+
+__all__ = ["BuildTimingRecorder", "compare_timings", "format_duration", "get_build_timing_recorder",  # no-combine
+           "load_chrome_trace", "max_rss_bytes", "report_build_timings", "start_recording_build_timings",  # no-combine
+           "stop_recording_build_timings", "summarize_timings", "timed_phase", "TimingEvent"]  # no-combine
+
+# The phases of Project.process() in the order that they are shown in the summary table
+BUILD_PHASES = ("update", "clean", "configure", "compile", "install")
+
+
+def _thread_cpu_time() -> float:
+    # time.thread_time() was added in Python 3.7
+    return time.thread_time() if hasattr(time, "thread_time") else time.process_time()
+
+
+def max_rss_bytes(ru_maxrss: int) -> int:
+    # macOS reports ru_maxrss in bytes, everything else in kilobytes
+    return ru_maxrss if sys.platform == "darwin" else ru_maxrss * 1024
+
+
+class TimingEvent(object):
+    """A completed target, build phase or subprocess. Times are in seconds relative to the start of the recording"""
+    __slots__ = ("name", "category", "target", "thread", "start", "wall_time", "cpu_time", "max_rss", "args")
+
+    def __init__(self, name: str, category: str, target: str, thread: int, start: float, wall_time: float,
+                 cpu_time: float, max_rss: int, args: dict = None):
+        self.name = name
+        self.category = category
+        self.target = target
+        self.thread = thread
+        self.start = start
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.max_rss = max_rss
+        self.args = args
+
+    def to_trace_event(self, pid: int) -> dict:
+        args = OrderedDict(target=self.target, cpu_time=round(self.cpu_time, 3), max_rss=self.max_rss)
+        if self.args:
+            args.update(self.args)
+        return OrderedDict(name=self.name, cat=self.category, ph="X", ts=int(self.start * 1000000),
+                           dur=int(self.wall_time * 1000000), pid=pid, tid=self.thread, args=args)
+
+
+class _OpenPhase(object):
+    __slots__ = ("child_cpu_time", "max_rss")
+
+    def __init__(self):
+        # Resource usage of the subprocesses that were run while this phase was active
+        self.child_cpu_time = 0.0
+        self.max_rss = 0
+
+
+class _TimedPhase(object):
+    def __init__(self, recorder: "BuildTimingRecorder", name: str, category: str, target: "typing.Optional[str]",
+                 args: "typing.Optional[dict]"):
+        self._recorder = recorder
+        self._name = name
+        self._category = category
+        self._target = target
+        self._args = args
+        self._previous_target = None
+        self._phase = _OpenPhase()
+        self._start = 0.0
+        self._start_cpu = 0.0
+
+    def __enter__(self):
+        local = self._recorder._local
+        self._previous_target = self._recorder.current_target
+        if self._target is None:
+            self._target = self._previous_target
+        local.target = self._target
+        self._recorder._open_phases().append(self._phase)
+        self._start = self._recorder.now()
+        self._start_cpu = _thread_cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        cpu_time = _thread_cpu_time() - self._start_cpu + self._phase.child_cpu_time
+        wall_time = self._recorder.now() - self._start
+        open_phases = self._recorder._open_phases()
+        open_phases.pop()
+        if open_phases:
+            # The enclosing phase includes the subprocesses of this one (its own CPU time is measured directly)
+            open_phases[-1].child_cpu_time += self._phase.child_cpu_time
+            open_phases[-1].max_rss = max(open_phases[-1].max_rss, self._phase.max_rss)
+        self._recorder._local.target = self._previous_target
+        self._recorder.add_event(TimingEvent(self._name, self._category, self._target, self._recorder.thread_id(),
+                                             self._start, wall_time, cpu_time, self._phase.max_rss, self._args))
+        return False
+
+
+class _NoTiming(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timing = _NoTiming()
+
+
+class BuildTimingRecorder(object):
+    """
+    Collects the wall time, CPU time and peak RSS of all targets, build phases and subprocesses. The resource usage of
+    subprocesses is reported by processutils when they are reaped and added to the innermost phase of that thread.
+    """
+
+    def __init__(self):
+        self.events = []  # type: typing.List[TimingEvent]
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Small integers are much easier to read than thread idents in the trace viewer
+        self._thread_ids = OrderedDict()  # type: typing.Dict[int, typing.Tuple[int, str]]
+
+    def now(self) -> float:
+        return time.perf_counter() - self._start
+
+    def thread_id(self) -> int:
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._thread_ids:
+                self._thread_ids[thread.ident] = (len(self._thread_ids) + 1, thread.name)
+            return self._thread_ids[thread.ident][0]
+
+    @property
+    def current_target(self) -> str:
+        return getattr(self._local, "target", "")
+
+    def _open_phases(self) -> "typing.List[_OpenPhase]":
+        if not hasattr(self._local, "phases"):
+            self._local.phases = []
+        return self._local.phases
+
+    def add_event(self, event: TimingEvent):
+        with self._lock:
+            self.events.append(event)
+
+    def phase(self, name: str, *, category: str = "phase", target: str = None, args: dict = None) -> _TimedPhase:
+        return _TimedPhase(self, name, category, target, args)
+
+    def add_process(self, name: str, start: float, target: str, thread: int, cpu_time: float, max_rss: int,
+                    args: dict = None):
+        open_phases = self._open_phases()
+        if open_phases:
+            open_phases[-1].child_cpu_time += cpu_time
+            open_phases[-1].max_rss = max(open_phases[-1].max_rss, max_rss)
+        self.add_event(TimingEvent(name, "process", target, thread, start, self.now() - start, cpu_time, max_rss,
+                                   args))
+
+    def trace_events(self) -> "typing.List[dict]":
+        pid = os.getpid()
+        result = [OrderedDict(name="process_name", ph="M", pid=pid, tid=0, args={"name": "cheribuild"})]
+        with self._lock:
+            for tid, thread_name in self._thread_ids.values():
+                result.append(OrderedDict(name="thread_name", ph="M", pid=pid, tid=tid, args={"name": thread_name}))
+            result.extend(e.to_trace_event(pid) for e in sorted(self.events, key=lambda e: e.start))
+        return result
+
+    def write_chrome_trace(self, path: Path):
+        """Write the events in the Chrome trace event format (can be loaded in chrome://tracing or Perfetto)"""
+        trace = OrderedDict(traceEvents=self.trace_events(), displayTimeUnit="ms",
+                            otherData=OrderedDict(command=" ".join(sys.argv), start_time=self.start_time))
+        with path.open("w", encoding="utf-8") as f:
+            json.dump(trace, f, indent=1)
+
+
+_recorder = None  # type: typing.Optional[BuildTimingRecorder]
+
+
+def get_build_timing_recorder() -> "typing.Optional[BuildTimingRecorder]":
+    return _recorder
+
+
+def start_recording_build_timings() -> BuildTimingRecorder:
+    global _recorder
+    _recorder = BuildTimingRecorder()
+    return _recorder
+
+
+def stop_recording_build_timings() -> None:
+    global _recorder
+    _recorder = None
+
+
+def timed_phase(name: str, *, category: str = "phase", target: str = None, args: dict = None):
+    """Returns a context manager that records the duration of name if build timings are enabled"""
+    recorder = _recorder
+    if recorder is None:
+        return _no_timing
+    return recorder.phase(name, category=category, target=target, args=args)
+
+
+def load_chrome_trace(path: Path) -> "typing.List[dict]":
+    with path.open("r", encoding="utf-8") as f:
+        trace = json.load(f)
+    # The JSON array format without the enclosing object is also valid
+    return trace["traceEvents"] if isinstance(trace, dict) else trace
+
+
+class _TargetTimings(object):
+    def __init__(self):
+        self.phases = OrderedDict()  # type: typing.Dict[str, float]
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.max_rss = 0
+
+
+def _aggregate(trace_events: "typing.Iterable[dict]") -> "typing.Dict[str, _TargetTimings]":
+    result = OrderedDict()  # type: typing.Dict[str, _TargetTimings]
+    for event in trace_events:
+        if event.get("ph") != "X" or event.get("cat") not in ("target", "phase"):
+            continue
+        target = event["args"]["target"]
+        timings = result.setdefault(target, _TargetTimings())
+        duration = event["dur"] / 1000000
+        if event["cat"] == "target":
+            timings.wall_time += duration
+            timings.cpu_time += event["args"]["cpu_time"]
+            timings.max_rss = max(timings.max_rss, event["args"]["max_rss"])
+        else:
+            timings.phases[event["name"]] = timings.phases.get(event["name"], 0.0) + duration
+    return result
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return "{:.1f}s".format(seconds)
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}h{:02d}m".format(*divmod(minutes, 60))
+
+
+def summarize_timings(trace_events: "typing.Iterable[dict]") -> "typing.List[str]":
+    """:return: the lines of a table with the wall time of every phase and the total resource usage per target"""
+    timings = _aggregate(trace_events)
+    header = ["Target"] + list(BUILD_PHASES) + ["total", "CPU", "peak RSS"]
+    rows = [header]
+    for target, t in timings.items():
+        row = [target or "(none)"]
+        row.extend(format_duration(t.phases[p]) if p in t.phases else "-" for p in BUILD_PHASES)
+        row.extend([format_duration(t.wall_time), format_duration(t.cpu_time),
+                    "{:.0f} MiB".format(t.max_rss / (1024 * 1024))])
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return ["  ".join(cell.ljust(widths[0]) if i == 0 else cell.rjust(widths[i]) for i, cell in enumerate(row))
+            for row in rows]
+
+
+def compare_timings(old_events: "typing.Iterable[dict]", new_events: "typing.Iterable[dict]", *,
+                    threshold=0.1, min_seconds=1.0) -> "typing.List[typing.Tuple[str, str, float, float]]":
+    """
+    :return: the (target, phase, old, new) wall times of all targets and phases that took more than threshold
+    (relative) and min_seconds (absolute) longer in new_events. The total time of a target uses phase "total".
+    """
+    old = _aggregate(old_events)
+    regressions = []
+    for target, new_timings in _aggregate(new_events).items():
+        if target not in old:
+            continue
+        pairs = [("total", old[target].wall_time, new_timings.wall_time)]
+        pairs.extend((phase, old[target].phases[phase], duration) for phase, duration in new_timings.phases.items()
+                     if phase in old[target].phases)
+        for phase, old_duration, new_duration in pairs:
+            if new_duration - old_duration > max(min_seconds, old_duration * threshold):
+                regressions.append((target, phase, old_duration, new_duration))
+    return regressions
+
+
+def report_build_timings(recorder: BuildTimingRecorder, trace_path: "typing.Optional[Path]",
+                         compare_with: "typing.Optional[Path]") -> None:
+    trace_events = recorder.trace_events()
+    status_update("Build timings:")
+    for line in summarize_timings(trace_events):
+        print("  ", line)
+    if trace_path is not None:
+        recorder.write_chrome_trace(trace_path)
+        status_update("Wrote Chrome trace of the build to", trace_path)
+    if compare_with is not None:
+        try:
+            old_events = load_chrome_trace(compare_with)
+        except (OSError, ValueError, KeyError) as e:
+            warning_message("Could not load timings from", compare_with, e)
+            return
+        regressions = compare_timings(old_events, trace_events)
+        if not regressions:
+            status_update("No build time regressions compared to", compare_with)
+            return
+        warning_message("The following steps took longer than in", str(compare_with) + ":")
+        for target, phase, old_duration, new_duration in regressions:
+            print("  ", coloured(AnsiColour.red, target, phase, format_duration(old_duration), "->",
+                                 format_duration(new_duration),
+                                 "(+{:.0f}%)".format((new_duration / old_duration - 1) * 100) if old_duration else ""))
@@ -42,6 +42,10 @@ from .loader import ComputedDefaultValue, MyJsonEncoder
 from ..processutils import latest_system_clang_tool
 from ..utils import (ConfigBase, DoNotUseInIfStmt, have_working_internet_connection, status_update, warning_message)
 
+if typing.TYPE_CHECKING:  # no-combine
+    from ..build_log import LogCompression  # no-combine # noqa: F401
+    from ..jobserver import JobServer  # no-combine # noqa: F401
+
 
 class BuildType(Enum):
     DEFAULT = "Default"
@@ -164,6 +168,15 @@ class CheriConfig(ConfigBase):
         self.cheri_cap_table_abi = loader.add_option("cap-table-abi", help_hidden=True,
                                                      choices=("pcrel", "plt", "fn-desc"),
                                                      help="The ABI to use for cap-table mode")
+        self.timing_trace = loader.add_path_option(
+            "timing-trace", affects_build_output=False,
+            help="Record the wall time, CPU time and peak RSS of every build phase and subprocess and "
+                 "write them to this file in Chrome trace event format (viewable in chrome://tracing "
+                 "or https://ui.perfetto.dev). A summary table is printed at the end of the build.")
+        self.compare_timing_trace = loader.add_path_option(
+            "compare-timing-trace", metavar="TRACE", affects_build_output=False,
+            help="Compare the build timings with a trace file written by a previous --timing-trace build and report "
+                 "the targets and phases that took significantly longer.")
         self.cross_target_suffix = loader.add_option("cross-target-suffix", help_hidden=True, default="",
                                                      help="Add a suffix to the cross build and install directories. "
                                                           "With VALUE=-pcrel it will use "
@@ -177,7 +190,9 @@ class CheriConfig(ConfigBase):
         self.clean = None  # type: Optional[bool]
         self.force = None  # type: Optional[bool]
         self.write_logfile = None  # type: Optional[bool]
+        self.log_compression = None  # type: Optional[LogCompression]
         self.skip_update = None  # type: Optional[bool]
+        self.fetch_jobs = None  # type: Optional[int]
         self.skip_clone = None  # type: Optional[bool]
         self.confirm_clone = None  # type: Optional[bool]
         self.skip_configure = None  # type: Optional[bool]
@@ -242,6 +257,14 @@ class CheriConfig(ConfigBase):
 
         self.mips_cheri_bits = 128  # Backwards compat
         self.make_jobs = None  # type: Optional[int]
+        self.parallel_targets = None  # type: Optional[int]
+        self.keep_going = None  # type: Optional[bool]
+        # Maximum number of targets that are built at the same time. The make_jobs budget is split between them.
+        self.concurrent_target_count = 1
+        self.use_jobserver = None  # type: Optional[bool]
+        self.skip_unchanged_targets = None  # type: Optional[bool]
+        # Set while running targets if use_jobserver is true
+        self.jobserver = None  # type: Optional[JobServer]
 
         self.source_root = None  # type: Optional[Path]
         self.output_root = None  # type: Optional[Path]
@@ -372,7 +395,7 @@ class CheriConfig(ConfigBase):
             help="Build the firmware from source instead of downloading the latest release.")
 
         self.targets = None  # type: typing.Optional[typing.List[str]]
-        self.__optional_properties = ["preferred_xtarget", "internet_connection_last_checked_at"]
+        self.__optional_properties = ["preferred_xtarget", "internet_connection_last_checked_at", "jobserver"]
 
     def load(self):
         self.loader.load()
@@ -427,7 +450,13 @@ class CheriConfig(ConfigBase):
 
     @property
     def make_j_flag(self):
-        return "-j" + str(self.make_jobs)
+        return "-j" + str(self.make_jobs_per_target)
+
+    @property
+    def make_jobs_per_target(self) -> int:
+        # When building multiple targets concurrently (--parallel-targets) each of them gets a fixed share of the jobs
+        # so that the total never exceeds make_jobs (unless the jobserver is used).
+        return max(1, self.make_jobs // max(1, self.concurrent_target_count))
 
     @property
     def mips_cheri_bits_str(self):
@@ -32,6 +32,7 @@ from enum import Enum
 from pathlib import Path
 
 from .chericonfig import CheriConfig
+from ..build_log import LogCompression
 from .loader import ComputedDefaultValue, ConfigLoaderBase, JsonAndCommandLineConfigLoader
 from ..utils import default_make_jobs_count
 
@@ -74,7 +75,14 @@ class DefaultCheriConfig(CheriConfig):
         self.force = loader.add_bool_option("force", "f", help="Don't prompt for user input but use the default action")
         self.write_logfile = loader.add_bool_option("logfile", help="Write a logfile for the build steps",
                                                     default=False)
+        self.log_compression = loader.add_option(
+            "log-compression", type=LogCompression, default=LogCompression.NONE, affects_build_output=False,
+            help="Compress the logfiles written by --logfile (zstd requires the zstd program)")
         self.skip_update = loader.add_bool_option("skip-update", help="Skip the git pull step")
+        self.fetch_jobs = loader.add_option(
+            "fetch-jobs", type=int, default=8, affects_build_output=False,
+            help="Number of repositories to fetch concurrently before building the selected targets. Local changes "
+                 "are only merged once the target is built. Set to 1 to fetch each repository just before building.")
         self.skip_clone = False
         self.confirm_clone = loader.add_bool_option(
             "confirm-clone", help="Ask for confirmation before cloning repositories.")
@@ -111,6 +119,23 @@ class DefaultCheriConfig(CheriConfig):
                                                           as_readme_string="<system-dependent>")
         self.make_jobs = loader.add_option("make-jobs", "j", type=int, default=default_make_jobs_computed,
                                            help="Number of jobs to use for compiling")
+        self.parallel_targets = loader.add_option(
+            "parallel-targets", type=int, default=1, affects_build_output=False,
+            help="Build up to N targets concurrently if they don't depend on each other. The --make-jobs budget is "
+                 "split evenly between the targets that can be built at the same time.")
+        self.keep_going = loader.add_bool_option(
+            "keep-going", affects_build_output=False,
+            help="When building targets in parallel, continue building all targets that do not depend "
+                 "on a failed target instead of stopping after the first failure.")
+        self.use_jobserver = loader.add_bool_option(
+            "jobserver", affects_build_output=False,
+            help="Limit the total number of jobs of all build tools (including those started by other "
+                 "cheribuild instances using the same build root) to --make-jobs by sharing a GNU make "
+                 "jobserver token pool.")
+        self.skip_unchanged_targets = loader.add_bool_option(
+            "skip-unchanged-targets", affects_build_output=False,
+            help="Don't rebuild targets if the sources (git HEAD and uncommitted changes), the configuration options, "
+                 "the compiler and the dependencies are unchanged since the last successful build.")
 
         # configurable paths
         self.source_root = loader.add_path_option("source-root",
@@ -37,6 +37,7 @@ from .chericonfig import CheriConfig
 from .compilation_targets import CrossCompileTarget
 from .loader import ComputedDefaultValue, ConfigLoaderBase
 from .target_info import CompilerType
+from ..build_log import LogCompression
 from ..filesystemutils import FileSystemUtils
 from ..utils import default_make_jobs_count, fatal_error, OSInfo, warning_message
 
@@ -127,6 +128,11 @@ class JenkinsConfig(CheriConfig):
             "force-update", help="Do the updating (not recommended in jenkins!)")  # type: bool
         self.copy_compilation_db_to_source_dir = False
         self.make_without_nice = False
+        self.parallel_targets = 1
+        self.keep_going = False
+        self.use_jobserver = False
+        self.skip_unchanged_targets = False
+        self.fetch_jobs = 1
 
         self.make_jobs = loader.add_commandline_only_option("make-jobs", "j", type=int,
                                                             default=default_jenkins_make_jobs_count,
@@ -176,6 +182,7 @@ class JenkinsConfig(CheriConfig):
                                                              help="Clean build directory before building")
         self.force = True  # no user input in jenkins
         self.write_logfile = False  # jenkins stores the output anyway
+        self.log_compression = LogCompression.NONE
         self.skip_configure = loader.add_bool_option("skip-configure", help="Skip the configure step")
         self.force_configure = True
         self.include_dependencies = False
@@ -203,6 +203,8 @@ class ConfigLoaderBase(object):
         self.docker_group = self._parser.add_argument_group("Options controlling the use of docker for building")
         self.unknown_config_option_is_error = False
         self.completion_excludes = []
+        # Valid config file keys for options that have not been registered yet (see TargetIndex)
+        self.lazily_registered_option_keys = frozenset()  # type: typing.FrozenSet[str]
 
     def _load_command_line_args(self):
         if argcomplete and self.is_completing_arguments:
@@ -267,7 +269,7 @@ class ConfigLoaderBase(object):
     def add_option(self, name: str, shortname=None, default=None,
                    type: "typing.Union[typing.Type[T], typing.Callable[[str], T]]" = str, group=None, help_hidden=False,
                    _owning_class: "typing.Type" = None, _fallback_names: "typing.List[str]" = None,
-                   option_cls: "typing.Type[ConfigOptionBase]" = None, **kwargs) -> T:
+                   option_cls: "typing.Type[ConfigOptionBase]" = None, affects_build_output=True, **kwargs) -> T:
         comp_prefix = self._argcomplete_prefix
         while comp_prefix is not None:  # fake loop to allow early return
             if comp_prefix.startswith("--") and name.startswith(comp_prefix[2:]):
@@ -310,6 +312,8 @@ class ConfigLoaderBase(object):
         # noinspection PyArgumentList
         result = option_cls(name, shortname, default, type, _owning_class, _loader=self, group=group,
                             help_hidden=help_hidden, _fallback_names=_fallback_names, **kwargs)
+        # Options that don't change the files that are built are not part of the --skip-unchanged-targets fingerprint
+        result.affects_build_output = affects_build_output
         assert name not in self.options  # make sure we don't add duplicate options
         self.options[name] = result
         # noinspection PyTypeChecker
@@ -386,6 +390,7 @@ class ConfigOptionBase(object):
         self._fallback_names = _fallback_names  # for targets such as gdb-mips, etc
         self.alias_names = _alias_names  # for targets such as gdb-mips, etc
         self._is_default_value = False
+        self.affects_build_output = True
 
     # noinspection PyUnusedLocal
     def load_option(self, config: "CheriConfig", instance: "typing.Optional[SimpleProject]", owner: "typing.Type",
@@ -525,6 +530,12 @@ class CommandLineConfigOption(ConfigOptionBase):
             assert len(set(_alias_names)) == len(_alias_names), "Found duplicates in" + str(_alias_names)
             for alias in _alias_names:
                 self.alias_actions.append(self._add_argparse_action(alias, None, default, group, kwargs))
+        # Options of lazily registered targets can be added after the command line has been parsed (see TargetIndex).
+        # They cannot have been passed on the command line since that would have registered them before parsing.
+        if self._loader._parsed_args is not None:
+            for action in [self.action] + self.alias_actions:
+                if not hasattr(self._loader._parsed_args, action.dest):
+                    setattr(self._loader._parsed_args, action.dest, None)
 
     def _add_argparse_action(self, name, shortname, default, group, kwargs):
         # add the default string to help if it is not lambda and help != argparse.SUPPRESS
@@ -686,6 +697,8 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
     def __init__(self):
         super().__init__(JsonAndCommandLineConfigOption)
         self._config_path = None  # type: typing.Optional[Path]
+        # Config files parsed ahead of time by the cheribuild daemon: path -> (loaded files, signature, parsed JSON)
+        self._preloaded_config_files = dict()  # type: typing.Dict[Path, typing.Tuple[typing.List[Path], list, dict]]
         # Choose the default config file based on argv[0]
         # This allows me to have symlinks for e.g. stable-cheribuild.py release-cheribuild.py debug-cheribuild.py
         # that pick up the right config file in ~/.config or the cheribuild directory
@@ -768,8 +781,10 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
                 a[key] = b[key]
         return a
 
-    def __load_json_with_includes(self, config_path: Path):
+    def __load_json_with_includes(self, config_path: Path, loaded_files: "typing.List[Path]" = None):
         result = dict()
+        if loaded_files is not None:
+            loaded_files.append(config_path)
         try:
             result = self.__load_json_with_comments(config_path)
         except Exception as e:
@@ -780,7 +795,7 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         include_value = result.get("#include")
         if include_value:
             included_path = config_path.parent / include_value.value
-            included_json = self.__load_json_with_includes(included_path)
+            included_json = self.__load_json_with_includes(included_path, loaded_files)
             del result["#include"]
             result = self.merge_dict_recursive(result, included_json, included_path, config_path)
             self.debug_msg(coloured(AnsiColour.cyan, "Merging JSON config file", included_path))
@@ -788,6 +803,44 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
 
         return result
 
+    @staticmethod
+    def _config_files_signature(paths: "typing.List[Path]") -> list:
+        result = []
+        for path in paths:
+            try:
+                st = path.stat()
+                result.append((str(path), st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                result.append((str(path), None))
+        return result
+
+    def preload_config_files(self) -> None:
+        """
+        Parse the default config files ahead of time (used by the cheribuild daemon). Cheribuild instances forked
+        from the daemon reuse the parsed values unless one of the files (or any file that it includes) has changed.
+        """
+        configdir = os.getenv("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+        for path in (self.default_config_path, Path(configdir, self.default_config_path.name)):
+            cached = self._preloaded_config_files.get(path)
+            if cached is not None and cached[1] == self._config_files_signature(cached[0]):
+                continue
+            self._preloaded_config_files.pop(path, None)
+            if not path.exists():
+                continue
+            loaded_files = []  # type: typing.List[Path]
+            try:
+                result = self.__load_json_with_includes(path, loaded_files)
+            except Exception:
+                continue  # The error will be reported when the file is loaded
+            self._preloaded_config_files[path] = (loaded_files, self._config_files_signature(loaded_files), result)
+
+    def __load_config_file(self, config_path: Path) -> "typing.Dict[str, typing.Any]":
+        cached = self._preloaded_config_files.get(config_path)
+        if cached is not None and cached[1] == self._config_files_signature(cached[0]):
+            self.debug_msg("Using preloaded config file", config_path)
+            return cached[2]
+        return self.__load_json_with_includes(config_path)
+
     @property
     def config_file_path(self) -> Path:
         assert self._config_path is not None
@@ -798,7 +851,7 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         if not self._config_path:
             self._config_path = Path(os.path.expanduser(self._parsed_args.config_file)).absolute()
         if self._config_path.exists():
-            self._json = self.__load_json_with_includes(self._config_path)
+            self._json = self.__load_config_file(self._config_path)
         elif hasattr(self._parsed_args, "config_file_given"):
             error_message("Configuration file", self._config_path, "does not exist, using only command line arguments.")
             raise FileNotFoundError(self._parsed_args.config_file)
@@ -810,7 +863,7 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
             print("Checking", Path(configdir, self._config_path.name), "since", self._config_path, "doesn't exist")
             self._config_path = Path(configdir, self._config_path.name)
             if self._config_path.exists():
-                self._json = self.__load_json_with_includes(self._config_path)
+                self._json = self.__load_config_file(self._config_path)
             else:
                 warning_message(coloured(AnsiColour.green, "Configuration file", self._config_path,
                                          "does not exist, using only command line arguments."))
@@ -832,7 +885,7 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         if fullname == "#include":
             return True
 
-        if fullname in self.options:
+        if fullname in self.options or fullname in self.lazily_registered_option_keys:
             return True
         # see if it is one of the alternate names is valid
         for option in self.options.values():
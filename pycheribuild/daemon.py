@@ -0,0 +1,409 @@
+#
+# Copyright (c) 2020 Alex Richardson
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+An optional resident cheribuild process that avoids the startup cost of repeated cheribuild invocations.
+
+`cheribuild.py --daemon` imports all projects, registers all command line options and parses the default config
+files once and then listens on a Unix socket. When it is running, cheribuild.py acts as a thin client: it sends its
+command line, working directory and environment together with its stdin/stdout/stderr file descriptors to the daemon,
+which forks a new cheribuild instance that writes directly to the client's terminal. The exit code is sent back to
+the client once that instance has exited. Command lines that the daemon can't handle (e.g. if the environment
+variables that affect the config defaults differ from the daemon's environment) are run by the client instead.
+
+This module must only import the standard library at the top level since the client runs before the rest of
+pycheribuild is imported.
+"""
+import array
+import hashlib
+import json
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+import tempfile
+import typing
+from pathlib import Path
+
+PROTOCOL_VERSION = 1
+_MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# The daemon was started with a different command line parser state, so always run these locally.
+_ARGS_REQUIRING_LOCAL_RUN = ("--daemon", "--stop-daemon", "--help-all", "--help-hidden")
+# Environment variables that are used when registering the config options, loading the config file or probing the
+# installed programs. These values are computed once when the daemon starts, so requests from a different environment
+# must be run locally.
+_ENVIRONMENT_AFFECTING_DEFAULTS = ("PATH", "HOME", "USER", "SHELL", "XDG_CONFIG_HOME", "XDG_CACHE_HOME", "CC",
+                                   "HOST_CC", "HOST_CXX", "HOST_CPP", "CMAKE_COMMAND", "QEMU_CHERI_PATH", "WORKSPACE")
+
+
+def environment_affecting_defaults(env: "typing.Mapping[str, str]") -> "typing.Dict[str, str]":
+    return {k: v for k, v in env.items() if k in _ENVIRONMENT_AFFECTING_DEFAULTS or k.startswith("CHERIBUILD_")}
+
+
+def socket_path(program: str = None) -> Path:
+    """Returns the socket for this cheribuild checkout and program name (e.g. debug-cheribuild.py)."""
+    if program is None:
+        program = sys.argv[0]
+    cheribuild_dir = Path(__file__).absolute().parent.parent
+    checkout_hash = hashlib.sha256(str(cheribuild_dir).encode("utf-8")).hexdigest()[:12]
+    # Keep this short, the maximum length of a Unix socket path is about 100 bytes
+    base_dir = os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return Path(base_dir, "cheribuild-" + str(os.getuid()), Path(program).name + "-" + checkout_hash + ".sock")
+
+
+def _check_socket_dir(directory: Path) -> bool:
+    # Anyone who can connect to the socket can run arbitrary commands as this user
+    try:
+        st = directory.lstat()
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and (st.st_mode & 0o077) == 0
+
+
+def send_message(sock: socket.socket, message: dict, fds: "typing.List[int]" = None) -> None:
+    data = json.dumps(message).encode("utf-8") + b"\n"
+    if fds:
+        sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+        data = data[sent:]
+    sock.sendall(data)
+
+
+def receive_message(sock: socket.socket, *, max_fds=0) -> "typing.Tuple[typing.Optional[dict], typing.List[int]]":
+    """Reads one newline-terminated JSON message (and any file descriptors sent with it) from sock."""
+    data = b""
+    fds = array.array("i")
+    while not data.endswith(b"\n"):
+        if len(data) > _MAX_REQUEST_SIZE:
+            raise ValueError("Message is too large")
+        ancillary_size = socket.CMSG_SPACE(max_fds * fds.itemsize) if max_fds else 0
+        chunk, ancdata, _, _ = sock.recvmsg(65536, ancillary_size)
+        for level, msg_type, msg_data in ancdata:
+            if level == socket.SOL_SOCKET and msg_type == socket.SCM_RIGHTS:
+                fds.frombytes(msg_data[:len(msg_data) - (len(msg_data) % fds.itemsize)])
+        if not chunk:
+            return None, list(fds)  # connection closed
+        data += chunk
+    return json.loads(data.decode("utf-8")), list(fds)
+
+
+def _exit_code_from_system_exit(e: SystemExit) -> int:
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def run_in_daemon(argv: "typing.List[str]") -> "typing.Optional[int]":
+    """
+    Runs the command line in the cheribuild daemon and returns the exit code. Returns None if there is no daemon
+    running (or it can't handle this command line) and cheribuild should be run in this process instead.
+    """
+    if os.getenv("CHERIBUILD_NO_DAEMON") or "_ARGCOMPLETE" in os.environ:
+        return None
+    if any(arg in _ARGS_REQUIRING_LOCAL_RUN for arg in argv[1:]):
+        return None
+    try:
+        stdio_fds = [f.fileno() for f in (sys.stdin, sys.stdout, sys.stderr)]
+    except (AttributeError, OSError, ValueError):
+        return None  # e.g. stdin is closed, the daemon needs all three file descriptors
+    path = socket_path(argv[0])
+    if not _check_socket_dir(path.parent):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        return None  # not running (or a stale socket)
+    with sock:
+        umask = os.umask(0o022)
+        os.umask(umask)
+        request = {"version": PROTOCOL_VERSION, "command": "run", "argv": argv, "cwd": os.getcwd(),
+                   "env": dict(os.environ), "umask": umask}
+        try:
+            send_message(sock, request, stdio_fds)
+        except OSError:
+            return None
+        instance_pid = None
+        previous_handlers = dict()
+
+        def forward_signal(signum, _):
+            if instance_pid is not None:
+                os.kill(instance_pid, signum)
+
+        try:
+            while True:
+                try:
+                    message, _ = receive_message(sock)
+                except InterruptedError:
+                    continue
+                if message is None:
+                    print("cheribuild daemon closed the connection unexpectedly", file=sys.stderr)
+                    return 1
+                if "fallback" in message:
+                    return None  # e.g. the sources have changed and the daemon is restarting
+                if "pid" in message:
+                    instance_pid = message["pid"]
+                    # Ctrl+C etc. are delivered to this process, forward them to the cheribuild instance.
+                    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT):
+                        previous_handlers[signum] = signal.signal(signum, forward_signal)
+                if "exit_code" in message:
+                    return message["exit_code"]
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+
+def stop_daemon(program: str = None) -> int:
+    path = socket_path(program)
+    if not _check_socket_dir(path.parent):
+        print("cheribuild daemon is not running", file=sys.stderr)
+        return 1
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError:
+            print("cheribuild daemon is not running", file=sys.stderr)
+            return 1
+        send_message(sock, {"version": PROTOCOL_VERSION, "command": "stop"})
+        message, _ = receive_message(sock)
+    return 0 if message and message.get("stopping") else 1
+
+
+class CheribuildDaemon(object):
+    def __init__(self, path: Path):
+        self.path = path
+        self.argv = list(sys.argv)
+        self._server = None  # type: typing.Optional[socket.socket]
+        self._wakeup_read_fd = None  # type: typing.Optional[int]
+        # Connections of running cheribuild instances, the exit code is sent once the instance has been reaped
+        self._instances = dict()  # type: typing.Dict[int, socket.socket]
+        self._stopping = False
+        self._restarting = False
+        # Imported lazily since the client should only import the standard library
+        from .__main__ import create_cheri_config
+        from .target_index import TargetIndex
+        self._source_fingerprint = TargetIndex.source_fingerprint
+        self._fingerprint = self._source_fingerprint()
+        self._environment = environment_affecting_defaults(os.environ)
+        self.cheri_config = create_cheri_config(register_all_options=True)
+        self._preload()
+
+    def _preload(self):
+        from .processutils import preload_program_probe_cache
+        self.cheri_config.loader.preload_config_files()
+        preload_program_probe_cache()
+
+    def _log(self, *args):
+        print("cheribuild daemon:", *args, flush=True)
+
+    def serve(self) -> None:
+        socket_dir = self.path.parent
+        socket_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if not _check_socket_dir(socket_dir):
+            sys.exit("Refusing to use " + str(socket_dir) + " for the cheribuild daemon socket: it must be a directory"
+                     " that is only accessible by the current user.")
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.path.unlink()  # remove stale socket from a previous daemon
+        except FileNotFoundError:
+            pass
+        self._server.bind(str(self.path))
+        self._server.listen(16)
+        # Wake up select() when a cheribuild instance exits
+        self._wakeup_read_fd, wakeup_write_fd = os.pipe()
+        os.set_blocking(self._wakeup_read_fd, False)
+        os.set_blocking(wakeup_write_fd, False)
+        signal.set_wakeup_fd(wakeup_write_fd)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self._log("listening on", self.path)
+        try:
+            while not ((self._stopping or self._restarting) and not self._instances):
+                readable, _, _ = select.select([self._server, self._wakeup_read_fd], [], [])
+                if self._wakeup_read_fd in readable:
+                    try:
+                        os.read(self._wakeup_read_fd, 4096)
+                    except BlockingIOError:
+                        pass
+                self._reap_instances()
+                if self._server in readable:
+                    conn, _ = self._server.accept()
+                    self._handle_connection(conn)
+        finally:
+            signal.set_wakeup_fd(-1)
+            self._server.close()
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+        if self._restarting:
+            self._log("cheribuild sources have changed, restarting")
+            os.execv(sys.executable, [sys.executable] + self.argv)
+        self._log("exiting")
+
+    def _reap_instances(self) -> None:
+        while self._instances:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            conn = self._instances.pop(pid, None)
+            if conn is None:
+                continue
+            exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+            self._log("instance", pid, "exited with code", exit_code)
+            try:
+                send_message(conn, {"exit_code": exit_code})
+            except OSError:
+                pass  # client is gone
+            conn.close()
+
+    def _handle_connection(self, conn: socket.socket) -> None:
+        fds = []  # type: typing.List[int]
+        try:
+            request, fds = receive_message(conn, max_fds=3)
+            if request is None or request.get("version") != PROTOCOL_VERSION:
+                send_message(conn, {"fallback": "unsupported protocol version"})
+            elif request.get("command") == "stop":
+                self._stopping = True
+                send_message(conn, {"stopping": True})
+            elif self._stopping or self._restarting:
+                send_message(conn, {"fallback": "daemon is shutting down"})
+            elif self._source_fingerprint() != self._fingerprint:
+                # Let the client run the updated sources and restart once all running instances have completed.
+                self._restarting = True
+                send_message(conn, {"fallback": "cheribuild sources have changed"})
+            elif request.get("command") != "run" or len(fds) != 3:
+                send_message(conn, {"fallback": "invalid request"})
+            elif environment_affecting_defaults(request.get("env", {})) != self._environment:
+                # The config defaults were computed using the daemon's environment.
+                send_message(conn, {"fallback": "environment differs from the daemon's environment"})
+            else:
+                self._preload()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    self._run_instance(conn, request, fds)  # does not return
+                self._log("instance", pid, "running", " ".join(request["argv"][1:]))
+                self._instances[pid] = conn
+                send_message(conn, {"pid": pid})
+                conn = None
+        except (OSError, ValueError) as e:
+            self._log("failed to handle request:", e)
+        finally:
+            for fd in fds:
+                os.close(fd)
+            if conn is not None:
+                conn.close()
+
+    def _run_instance(self, conn: socket.socket, request: dict, fds: "typing.List[int]") -> None:
+        exit_code = 1
+        try:
+            conn.close()
+            self._server.close()
+            signal.set_wakeup_fd(-1)
+            os.close(self._wakeup_read_fd)
+            for signum in (signal.SIGCHLD, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # Don't inherit the daemon's controlling terminal (if any) so that we can read from the client's terminal
+            os.setsid()
+            for target_fd, fd in enumerate(fds):
+                os.dup2(fd, target_fd)
+                os.close(fd)
+            sys.stdin = sys.__stdin__ = open(0, "r", closefd=False)
+            sys.stdout = sys.__stdout__ = open(1, "w", buffering=1 if os.isatty(1) else -1, closefd=False)
+            sys.stderr = sys.__stderr__ = open(2, "w", buffering=1, errors="backslashreplace", closefd=False)
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.umask(request["umask"])
+            sys.argv = request["argv"]
+            exit_code = self._run_cheribuild()
+        except SystemExit as e:
+            exit_code = _exit_code_from_system_exit(e)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            try:
+                # We exit using os._exit() to avoid running the daemon's cleanup code, so run the atexit handlers
+                # (e.g. saving the compiler probe cache) manually.
+                # noinspection PyUnresolvedReferences,PyProtectedMember
+                import atexit
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exit_code)
+
+    def _run_cheribuild(self) -> int:
+        from .__main__ import ensure_fd_is_blocking, run_cheribuild
+        from .processutils import run_and_kill_children_on_exit
+        from .projects.project import SimpleProject
+        ensure_fd_is_blocking(sys.stdin.fileno())
+        ensure_fd_is_blocking(sys.stdout.fileno())
+        ensure_fd_is_blocking(sys.stderr.fileno())
+        # This was computed based on the daemon's stdout
+        SimpleProject._clear_line_sequence = b"\x1b[2K\r" if sys.stdout.isatty() else b"\n"
+        try:
+            run_and_kill_children_on_exit(lambda: run_cheribuild(self.cheri_config))
+        except SystemExit as e:
+            return _exit_code_from_system_exit(e)
+        return 0
+
+
+def run_daemon() -> None:
+    from .__main__ import check_not_root
+    check_not_root()
+    daemon = CheribuildDaemon(socket_path())
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        daemon._log("exiting due to Ctrl+C")
+
+
+def handle_daemon_commands() -> None:
+    """Called by cheribuild.py before importing the rest of pycheribuild. Does not return if the daemon was used."""
+    if sys.argv[1:] == ["--daemon"]:
+        run_daemon()
+        sys.exit()
+    if sys.argv[1:] == ["--stop-daemon"]:
+        sys.exit(stop_daemon())
+    exit_code = run_in_daemon(sys.argv)
+    if exit_code is not None:
+        sys.exit(exit_code)
@@ -0,0 +1,158 @@
+#
+# Copyright (c) 2020 Alex Richardson
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import heapq
+import threading
+import typing
+from collections import OrderedDict
+
+from .utils import fatal_error, warning_message
+
+if typing.TYPE_CHECKING:  # no-combine
+    from .config.chericonfig import CheriConfig  # no-combine
+    from .projects.project import SimpleProject  # no-combine
+    from .targets import Target  # no-combine
+
+
+class DependencyGraph(object):
+    """
+    Resolves the dependencies of targets for one config. The direct dependencies of each project are only resolved
+    once and the transitive closures are memoized, so resolving the dependencies of all targets is linear in the size
+    of the graph instead of recomputing the closure of every dependency at every level.
+    """
+
+    def __init__(self, config: "CheriConfig"):
+        self.config = config
+        # Both are keyed by (project_class, include_toolchain_dependencies, include_sdk_dependencies)
+        self._direct_deps = dict()  # type: typing.Dict[tuple, typing.Tuple[Target, ...]]
+        self._closures = dict()  # type: typing.Dict[tuple, typing.Tuple[Target, ...]]
+        # Fingerprinting can query the dependencies from the --parallel-targets worker threads
+        self._lock = threading.RLock()
+
+    def direct_dependencies(self, project_class: "typing.Type[SimpleProject]", *,
+                            include_toolchain_dependencies: bool,
+                            include_sdk_dependencies: bool) -> "typing.Tuple[Target, ...]":
+        key = (project_class, include_toolchain_dependencies, include_sdk_dependencies)
+        result = self._direct_deps.get(key, None)
+        if result is None:
+            with self._lock:
+                # noinspection PyProtectedMember
+                deps = project_class._direct_dependencies(
+                    self.config, include_dependencies=True,
+                    include_toolchain_dependencies=include_toolchain_dependencies,
+                    include_sdk_dependencies=include_sdk_dependencies,
+                    explicit_dependencies_only=project_class.direct_dependencies_only)
+                result = tuple(OrderedDict((t, True) for t in deps).keys())
+                self._direct_deps[key] = result
+        return result
+
+    def recursive_dependencies(self, project_class: "typing.Type[SimpleProject]", *,
+                               include_toolchain_dependencies: bool,
+                               include_sdk_dependencies: bool) -> "typing.Tuple[Target, ...]":
+        """
+        Returns the transitive dependencies of project_class in the same order as the previous recursive
+        implementation: each direct dependency followed by its own dependencies (without duplicates).
+        """
+        key = (project_class, include_toolchain_dependencies, include_sdk_dependencies)
+        result = self._closures.get(key, None)
+        if result is None:
+            with self._lock:
+                result = self._closure(key, [])
+        return result
+
+    def _closure(self, key: tuple, stack: "typing.List[tuple]") -> "typing.Tuple[Target, ...]":
+        result = self._closures.get(key, None)
+        if result is not None:
+            return result
+        project_class, include_toolchain_dependencies, include_sdk_dependencies = key
+        if key in stack:
+            cycle = [k[0].target for k in stack[stack.index(key):]] + [project_class.target]
+            fatal_error("Found a dependency cycle:", " -> ".join(cycle))
+            return tuple()
+        stack.append(key)
+        deps = OrderedDict()  # type: typing.Dict[Target, bool]
+        for target in self.direct_dependencies(project_class,
+                                               include_toolchain_dependencies=include_toolchain_dependencies,
+                                               include_sdk_dependencies=include_sdk_dependencies):
+            deps[target] = True
+            if project_class.direct_dependencies_only:
+                continue  # don't add recursive dependencies for e.g. "build-and-run"
+            dep_key = (target.project_class, include_toolchain_dependencies, include_sdk_dependencies)
+            for r in self._closure(dep_key, stack):
+                deps[r] = True
+        stack.pop()
+        result = tuple(deps.keys())
+        self._closures[key] = result
+        return result
+
+
+def _ordering_rank(target: "Target") -> int:
+    if target.name.startswith("run"):
+        return 2  # run must be executed last
+    if target.name.startswith("disk-image"):
+        return 1  # disk-image should be done just before run
+    return 0
+
+
+def sort_in_dependency_order(targets: "typing.Iterable[Target]",
+                             dependencies: "typing.Callable[[Target], typing.Iterable[Target]]"
+                             ) -> "typing.List[Target]":
+    """
+    Returns the targets (without duplicates) ordered such that every target comes after all of its dependencies.
+    Independent targets keep their original relative order, except that disk-image targets are moved after all other
+    targets and run targets come last (unless a dependency requires them to be built earlier).
+    """
+    unique_targets = list(OrderedDict((t, True) for t in targets).keys())
+    index = dict((t, i) for i, t in enumerate(unique_targets))
+    # Build the adjacency sets once and then use Kahn's algorithm instead of pairwise comparisons.
+    dependents = dict((t, set()) for t in unique_targets)  # type: typing.Dict[Target, typing.Set[Target]]
+    num_pending_deps = dict()  # type: typing.Dict[Target, int]
+    for t in unique_targets:
+        deps = set(d for d in dependencies(t) if d in index and d is not t)
+        num_pending_deps[t] = len(deps)
+        for d in deps:
+            dependents[d].add(t)
+    ready = [(_ordering_rank(t), index[t]) for t in unique_targets if num_pending_deps[t] == 0]
+    heapq.heapify(ready)
+    result = []  # type: typing.List[Target]
+    while len(result) < len(unique_targets):
+        if not ready:
+            remaining = [t for t in unique_targets if num_pending_deps[t] > 0]
+            warning_message("Dependency cycle between", " ".join(t.name for t in remaining),
+                            "-> using the command line order for these targets")
+            num_pending_deps[remaining[0]] = 0
+            heapq.heappush(ready, (_ordering_rank(remaining[0]), index[remaining[0]]))
+        target = unique_targets[heapq.heappop(ready)[1]]
+        result.append(target)
+        for dependent in dependents[target]:
+            if num_pending_deps[dependent] > 0:
+                num_pending_deps[dependent] -= 1
+                if num_pending_deps[dependent] == 0:
+                    heapq.heappush(ready, (_ordering_rank(dependent), index[dependent]))
+    return result
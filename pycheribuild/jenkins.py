@@ -29,12 +29,16 @@
 #
 import argparse
 import contextlib
+import hashlib
 import inspect
+import json
 import os
 import pprint
 import shutil
 import sys
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 # noinspection PyUnresolvedReferences
 from pathlib import Path
 
@@ -53,6 +57,8 @@ from .utils import fatal_error, init_global_config, OSInfo, status_update, Threa
 
 EXTRACT_SDK_TARGET = "extract-sdk"
 RUN_EVERYTHING_TARGET = "__run_everything__"
+# Records the hashes of the archives that were extracted to a directory
+SDK_ARCHIVE_MANIFEST = ".cheribuild-sdk-archives.json"
 
 
 class JenkinsConfigLoader(ConfigLoaderBase):
@@ -94,14 +100,55 @@ class SdkArchive(object):
         self.archive = cheri_config.workspace / name  # type: Path
         self.required_globs = [] if required_globs is None else required_globs  # type: list
         self.extra_args = [] if extra_args is None else extra_args  # type: list
+        self._archive_hash = None  # type: typing.Optional[str]
+
+    def _decompress_program(self) -> "typing.Optional[str]":
+        # Note: GNU tar appends -d when extracting but bsdtar does not, so always pass it explicitly.
+        name = self.archive.name
+        if name.endswith((".xz", ".txz")):
+            return "pixz -d" if shutil.which("pixz") else "xz -T0 -d"
+        if name.endswith((".gz", ".tgz")) and shutil.which("pigz"):
+            return "pigz -d"
+        if name.endswith((".bz2", ".tbz2")):
+            for program in ("lbzip2", "pbzip2"):
+                if shutil.which(program):
+                    return program + " -d"
+        return None  # let tar detect the compression
 
     def extract(self):
         assert self.archive.exists(), str(self.archive)
         self.cheri_config.FS.makedirs(self.output_dir)
-        run_command(["tar", "Jxf", self.archive, "-C", self.output_dir] + self.extra_args,
-                    cwd=self.cheri_config.workspace)
+        start = time.time()
+        tar_cmd = ["tar", "-xf", self.archive, "-C", self.output_dir]
+        decompress_program = self._decompress_program()
+        if decompress_program:
+            tar_cmd.append("--use-compress-program=" + decompress_program)
+        run_command(tar_cmd + self.extra_args, cwd=self.cheri_config.workspace)
+        status_update("Extracting", self.archive.name, "took", round(time.time() - start, 1), "seconds")
         self.check_required_files()
 
+    @property
+    def archive_hash(self) -> str:
+        if self._archive_hash is None:
+            h = hashlib.sha256()
+            with self.archive.open("rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            self._archive_hash = h.hexdigest()
+        return self._archive_hash
+
+    def _manifest_entry(self) -> dict:
+        return {"sha256": self.archive_hash, "extra_args": [str(arg) for arg in self.extra_args]}
+
+    def is_up_to_date(self) -> bool:
+        """Returns true if exactly this archive has already been extracted to output_dir."""
+        if not self.archive.exists():
+            return False
+        manifest = read_sdk_manifest(self.output_dir)
+        if manifest.get(self.archive.name) != self._manifest_entry():
+            return False
+        return self.check_required_files(fatal=False)
+
     def check_required_files(self, fatal=True) -> bool:
         status_update("Checking for required files in", self.output_dir)
         for glob in self.required_globs:
@@ -142,15 +189,33 @@ def get_sdk_archives(cheri_config, needs_cheribsd_sysroot: bool) -> "typing.List
     return [clang_archive, sysroot_archive]
 
 
+def read_sdk_manifest(output_dir: Path) -> dict:
+    try:
+        with (output_dir / SDK_ARCHIVE_MANIFEST).open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
 def extract_sdk_archives(cheri_config: JenkinsConfig, archives: "typing.List[SdkArchive]"):
-    expected_bindir = cheri_config.compiler_archive_output_path / "bin"
-    if expected_bindir.is_dir():
-        status_update(expected_bindir, "already exists, not extracting SDK archives")
+    if not archives:
+        status_update("All SDK archives are unchanged, not extracting them again")
         return
+    # The archives are independent, so extract them concurrently
+    with ThreadPoolExecutor(max_workers=len(archives)) as executor:
+        for future in [executor.submit(archive.extract) for archive in archives]:
+            future.result()
+    # Record the extracted archives so that unchanged archives are not extracted again in the next job:
+    if not cheri_config.pretend:
+        for output_dir in set(a.output_dir for a in archives):
+            manifest = read_sdk_manifest(output_dir)
+            for a in archives:
+                if a.output_dir == output_dir:
+                    manifest[a.archive.name] = a._manifest_entry()
+            with (output_dir / SDK_ARCHIVE_MANIFEST).open("w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
 
-    for archive in archives:
-        archive.extract()
-
+    expected_bindir = cheri_config.compiler_archive_output_path / "bin"
     if not expected_bindir.exists():
         fatal_error("SDK bin dir", expected_bindir, "does not exist after extracting sysroot archives!")
 
@@ -171,24 +236,27 @@ def extract_sdk_archives(cheri_config: JenkinsConfig, archives: "typing.List[Sdk
                                        expected_bindir / "ld", relative=True)
 
 
-def create_sdk_from_archives(cheri_config: JenkinsConfig, needs_cheribsd_sysroot, extract_all: bool):
-    # If the archive is newer, delete the existing sdk unless --keep-sdk is passed install root:
+def create_sdk_from_archives(cheri_config: JenkinsConfig, needs_cheribsd_sysroot):
     all_archives = get_sdk_archives(cheri_config, needs_cheribsd_sysroot=needs_cheribsd_sysroot)
     status_update("Will use the following SDK archives:", all_archives)
-    if extract_all:
-        archives = all_archives
-    else:
-        # Only extract if the archive is newer
-        archives = []
+    # Only extract archives that differ from the ones that were extracted last time (according to the manifest).
+    archives = []
+    for a in all_archives:
+        if a.is_up_to_date():
+            status_update("SDK archive", a.archive, "has already been extracted to", a.output_dir)
+        elif cheri_config.keep_sdk_dir and (cheri_config.compiler_archive_output_path / "bin").is_dir():
+            warning_message("SDK archive", a.archive, "differs from the existing SDK directory, but not extracting "
+                            "it since --keep-sdk-dir was passed")
+        else:
+            archives.append(a)
+    if not cheri_config.keep_sdk_dir:
+        # Deleting an output directory also deletes the archives that were extracted to a subdirectory
         for a in all_archives:
-            if a.output_dir.stat().st_ctime < a.archive.stat().st_ctime:
-                msgkind = status_update if not cheri_config.keep_sdk_dir else warning_message
-                msgkind("SDK archive", a.archive, "is newer than the existing SDK directory")
+            if a not in archives and any(_is_subdirectory(a.output_dir, other.output_dir) for other in archives):
                 archives.append(a)
-                break
     # unpack the SDK if it has not been extracted yet:
     with contextlib.ExitStack() as stack:
-        if not cheri_config.keep_sdk_dir:
+        if not cheri_config.keep_sdk_dir and archives:
             status_update("Deleting old SDK and extracting archive")
             dirs_cleaned = set()  # avoid cleaning twice
             for a in archives:
@@ -198,6 +266,14 @@ def create_sdk_from_archives(cheri_config: JenkinsConfig, needs_cheribsd_sysroot
         extract_sdk_archives(cheri_config, archives)
 
 
+def _is_subdirectory(path: Path, parent: Path) -> bool:
+    try:
+        path.relative_to(parent)
+        return True
+    except ValueError:
+        return False
+
+
 def _jenkins_main():
     os.environ["_CHERIBUILD_JENKINS_BUILD"] = "1"
     all_target_names = list(sorted(target_manager.target_names))
@@ -216,7 +292,7 @@ def _jenkins_main():
     # special target to extract the sdk
     if JenkinsAction.EXTRACT_SDK in cheri_config.action or (
             len(cheri_config.targets) > 0 and cheri_config.targets[0] == EXTRACT_SDK_TARGET):
-        create_sdk_from_archives(cheri_config, not cheri_config.extract_compiler_only, extract_all=True)
+        create_sdk_from_archives(cheri_config, not cheri_config.extract_compiler_only)
         sys.exit()
 
     if RUN_EVERYTHING_TARGET in cheri_config.targets:
@@ -345,13 +421,15 @@ def create_tarball(cheri_config):
 def strip_binaries(_: JenkinsConfig, project: SimpleProject, directory: Path):
     status_update("Tarball directory size before stripping ELF files:")
     run_command("du", "-sh", directory)
+    files = []
     for root, dirs, filelist in os.walk(str(directory)):
         for file in filelist:
             # Try to shrink the size by stripping all elf binaries
             filepath = Path(root, file)
             if filepath.is_symlink():
                 continue
-            project.maybe_strip_elf_file(filepath)
+            files.append(filepath)
+    project.strip_elf_files_in_parallel(files)
     status_update("Tarball directory size after stripping ELF files:")
     run_command("du", "-sh", directory)
 
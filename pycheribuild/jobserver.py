@@ -0,0 +1,168 @@
+#
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import contextlib
+import errno
+import fcntl
+import os
+import select
+import typing
+from pathlib import Path
+
+from .utils import status_update
+
+__all__ = ["JobServer"]  # no-combine
+
+
+class JobServer(object):
+    """
+    A GNU make compatible jobserver that limits the total number of jobs started by all build tools.
+    See https://www.gnu.org/software/make/manual/html_node/POSIX-Jobserver.html for details on the protocol.
+
+    The token pool is a named pipe in the build root so that multiple cheribuild instances sharing the same build root
+    also share the same pool of jobs. The first instance to start fills the pipe with one token per job, later ones
+    just open the existing pipe. Note: tokens held by an instance that is killed are lost until all instances using
+    the pool have exited.
+
+    Every tool that is started takes one token for its implicit job slot (GNU make and ninja assume they can always
+    run one job without a token) and returns it once it exits. Tools that don't support the jobserver protocol
+    (e.g. bmake) reserve a number of tokens for their entire lifetime instead.
+    """
+    TOKEN = b"+"  # bmake aborts if it reads anything other than '+' so use that for all tokens
+
+    def __init__(self, fifo_path: Path, jobs: int):
+        self.fifo_path = fifo_path
+        self.jobs = max(1, jobs)
+        self._fd = -1  # non-blocking file descriptor used by cheribuild to take and return tokens
+        self._client_fds = (-1, -1)  # blocking read and write file descriptors passed to the build tools
+        self._users_lock_fd = -1
+
+    def start(self) -> None:
+        self.fifo_path.parent.mkdir(parents=True, exist_ok=True)
+        # Setting up the pipe is protected by a lock file. Additionally, every instance using the pipe holds a shared
+        # lock on the .users file which allows the next instance to find out whether the pipe needs to be refilled.
+        setup_lock_fd = os.open(str(self.fifo_path) + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(setup_lock_fd, fcntl.LOCK_EX)
+            self._users_lock_fd = os.open(str(self.fifo_path) + ".users", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(self._users_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                first_user = True
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                first_user = False
+            create_pipe = first_user or not self.fifo_path.exists()
+            if create_pipe:
+                # Nobody else is using the pipe, so any remaining tokens are stale -> create a new one
+                if self.fifo_path.exists() or self.fifo_path.is_symlink():
+                    self.fifo_path.unlink()
+                os.mkfifo(str(self.fifo_path), 0o600)
+            # Opening with O_RDWR ensures that the open does not block and the pipe is never seen as closed.
+            self._fd = os.open(str(self.fifo_path), os.O_RDWR | os.O_NONBLOCK)
+            client_read_fd = os.open(str(self.fifo_path), os.O_RDONLY | os.O_NONBLOCK)
+            # The build tools expect blocking reads (e.g. GNU make 3.81 treats EAGAIN as a fatal error)
+            fcntl.fcntl(client_read_fd, fcntl.F_SETFL, fcntl.fcntl(client_read_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            self._client_fds = (client_read_fd, os.open(str(self.fifo_path), os.O_WRONLY))
+            if create_pipe:
+                self._release_tokens(self.jobs)
+                status_update("Started jobserver with", self.jobs, "job slots in", self.fifo_path)
+            else:
+                status_update("Using job slots from the jobserver in", self.fifo_path,
+                              "that is shared with another cheribuild instance.")
+            fcntl.flock(self._users_lock_fd, fcntl.LOCK_SH)
+        finally:
+            os.close(setup_lock_fd)  # also releases the lock
+
+    def stop(self) -> None:
+        for fd in (self._fd,) + self._client_fds + (self._users_lock_fd,):
+            if fd != -1:
+                os.close(fd)
+        self._fd = -1
+        self._client_fds = (-1, -1)
+        self._users_lock_fd = -1
+
+    def __enter__(self) -> "JobServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    @property
+    def pass_fds(self) -> "typing.Tuple[int, int]":
+        """The file descriptors that must be passed to the jobserver clients"""
+        return self._client_fds
+
+    def makeflags(self, use_fifo: bool = False) -> str:
+        """
+        :param use_fifo: Use the named pipe (supported by GNU make 4.4 and ninja 1.13) instead of file descriptors.
+        :return: the value that needs to be added to $MAKEFLAGS to make the build tool use this jobserver
+        """
+        if use_fifo:
+            return "-j --jobserver-auth=fifo:" + str(self.fifo_path)
+        fds = str(self._client_fds[0]) + "," + str(self._client_fds[1])
+        # GNU make < 4.2 only understands --jobserver-fds. Unknown options in $MAKEFLAGS are ignored so pass both.
+        return "-j --jobserver-fds=" + fds + " --jobserver-auth=" + fds
+
+    def _take_token(self, blocking: bool) -> bool:
+        assert self._fd != -1, "jobserver not started"
+        while True:
+            if blocking:
+                select.select([self._fd], [], [])
+            try:
+                token = os.read(self._fd, 1)
+            except BlockingIOError:
+                # Someone else took the token before us
+                if blocking:
+                    continue
+                return False
+            assert len(token) == 1, "jobserver pipe should never be closed"
+            return True
+
+    def _release_tokens(self, count: int) -> None:
+        if count > 0:
+            os.write(self._fd, self.TOKEN * count)
+
+    @contextlib.contextmanager
+    def implicit_job_slot(self):
+        """Waits for a free job slot for a jobserver-aware tool and returns it once the tool exits"""
+        self._take_token(blocking=True)
+        try:
+            yield
+        finally:
+            self._release_tokens(1)
+
+    @contextlib.contextmanager
+    def reserved_job_slots(self, max_jobs: int):
+        """
+        Reserves between one and max_jobs job slots for a tool that does not support the jobserver protocol.
+        :return: the number of jobs that the tool may use
+        """
+        self._take_token(blocking=True)
+        jobs = 1
+        while jobs < max_jobs and self._take_token(blocking=False):
+            jobs += 1
+        try:
+            yield jobs
+        finally:
+            self._release_tokens(jobs)
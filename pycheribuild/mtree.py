@@ -30,18 +30,107 @@
 
 import io
 import os
-import shlex
+import re
 import stat
 import sys
 import typing
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
 from .processutils import commandline_to_str
 from .utils import status_update, warning_message
 
 
+# Python 3.6+ dicts preserve insertion order and are much smaller than an OrderedDict
+_AttributeDict = dict if sys.version_info >= (3, 6) else OrderedDict
+# A single whitespace-separated word of an mtree line (which may contain quoted sections and escapes)
+_MTREE_WORD_RE = re.compile(r"""(?:[^\s\\'"]+|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+""", re.DOTALL)
+# Escape sequences and quoted sections that need to be decoded in a word
+_MTREE_ESCAPE_RE = re.compile(r"""\\([0-7]{3})|\\(.)|'([^']*)'|"((?:[^"\\]|\\.)*)""" + '"', re.DOTALL)
+_DOUBLE_QUOTE_ESCAPE_RE = re.compile(r"""\\([\\"$`])""")
+# Characters that must be octal-escaped (like vis(3) with VIS_OCTAL) when writing a path: whitespace, non-printable
+# characters, the escape character, the comment character and the quote characters understood by the parser
+_MTREE_PATH_UNSAFE_RE = re.compile(r"""[\x00-\x20\x7f-\xa0\\#'"]""")
+# Attributes whose values are shared by most entries so we store only one copy of each value
+_INTERNED_VALUE_KEYS = frozenset(("type", "uname", "gname", "mode", "flags"))
+
+
+def _decode_mtree_escape(match: "typing.Match") -> str:
+    octal, escaped, single_quoted, double_quoted = match.groups()
+    if octal is not None:
+        return chr(int(octal, 8))  # mtree/vis(3) octal escapes (e.g. \040 for space)
+    if escaped is not None:
+        return escaped
+    if single_quoted is not None:
+        return single_quoted
+    return _DOUBLE_QUOTE_ESCAPE_RE.sub(r"\1", double_quoted)
+
+
+def _encode_mtree_path(path: str) -> str:
+    if _MTREE_PATH_UNSAFE_RE.search(path) is None:
+        return path
+    return _MTREE_PATH_UNSAFE_RE.sub(lambda m: "\\{:03o}".format(ord(m.group(0))), path)
+
+
+def _split_mtree_line(line: str) -> "typing.List[str]":
+    # Fast path: most lines don't contain any quotes or escapes
+    if "\\" not in line and "'" not in line and '"' not in line:
+        return line.split()
+    words = []
+    pos = 0
+    for match in _MTREE_WORD_RE.finditer(line):
+        if line[pos:match.start()].strip():
+            raise ValueError("Unbalanced quotes in mtree line")
+        pos = match.end()
+        words.append(_MTREE_ESCAPE_RE.sub(_decode_mtree_escape, match.group(0)))
+    if line[pos:].strip():
+        raise ValueError("Unbalanced quotes in mtree line")
+    return words
+
+
+def _normalize_mtree_path(path: str) -> str:
+    if path == ".":
+        return path
+    if path[:2] != "./":
+        raise ValueError("mtree path " + repr(path) + " does not start with ./")
+    # Only call normpath() if the path could contain ".", ".." or empty components
+    rest = path[2:]
+    if not rest or rest[0] == "." or rest[-1] == "/" or "/." in rest or "//" in rest:
+        return "./" + os.path.normpath(rest)
+    return path
+
+
+def _build_prefix_trie(prefixes: "typing.Iterable[str]") -> dict:
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[""] = True  # the empty string marks the end of a prefix
+    return trie
+
+
+def _match_prefix_trie(node: "typing.Optional[dict]", s: str) -> "typing.Union[dict, bool, None]":
+    """
+    Continue matching the prefix trie state node with s.
+    :return: True if one of the prefixes is a prefix of the string matched so far, None if no prefix can match any
+    longer string and otherwise the trie node that should be used to match the next characters.
+    """
+    if node is None or node is True:
+        return node
+    for c in s:
+        if "" in node:
+            return True
+        node = node.get(c)
+        if node is None:
+            return None
+    return True if "" in node else node
+
+
 class MtreeEntry(object):
+    __slots__ = ("path", "attributes")
+
     def __init__(self, path: str, attributes: "typing.Dict[str, str]"):
         self.path = path
         self.attributes = attributes
@@ -54,34 +143,32 @@ class MtreeEntry(object):
 
     @classmethod
     def parse(cls, line: str, contents_root: Path = None) -> "MtreeEntry":
-        elements = shlex.split(line)
-        path = elements[0]
+        elements = _split_mtree_line(line)
         # Ensure that the path is normalized:
-        if path != ".":
-            # print("Before:", path)
-            assert path[:2] == "./"
-            path = path[:2] + os.path.normpath(path[2:])
-            # print("After:", path)
-        attr_dict = OrderedDict()  # keep them in insertion order
-        for k, v in map(lambda s: s.split(sep="=", maxsplit=1), elements[1:]):
+        path = _normalize_mtree_path(elements[0])
+        attr_dict = _AttributeDict()  # keep them in insertion order
+        intern = sys.intern
+        for element in elements[1:]:
+            k, v = element.split("=", 1)
             # ignore some tags that makefs doesn't like
             # sometimes there will be time with nanoseconds in the manifest, makefs can't handle that
             # also the tags= key is not supported
-            if k in ("tags", "time"):
+            if k == "tags" or k == "time":
                 continue
             # convert relative contents=keys to absolute ones
             if contents_root and k == "contents":
                 if not os.path.isabs(v):
                     v = str(contents_root / v)
-            attr_dict[k] = v
-        return MtreeEntry(path, attr_dict)
-        # FIXME: use contents=
+            elif k in _INTERNED_VALUE_KEYS:
+                v = intern(v)
+            attr_dict[intern(k)] = v
+        return cls(path, attr_dict)
 
     @classmethod
     def parse_all_dirs_in_mtree(cls, mtree_file: Path) -> "typing.List[MtreeEntry]":
         with mtree_file.open("r", encoding="utf-8") as f:
             result = []
-            for line in f.readlines():
+            for line in f:
                 if " type=dir" in line:
                     try:
                         result.append(MtreeEntry.parse(line))
@@ -90,7 +177,7 @@ class MtreeEntry(object):
             return result
 
     def __str__(self):
-        return self.path + " " + commandline_to_str(k + "=" + v for k, v in self.attributes.items())
+        return _encode_mtree_path(self.path) + " " + commandline_to_str(k + "=" + v for k, v in self.attributes.items())
 
     def __repr__(self):
         return "<MTREE entry: " + str(self) + ">"
@@ -112,17 +199,18 @@ class MtreeFile(object):
         if "_TEST_SKIP_METALOG" in os.environ:
             status_update("Not parsing", file, "in test mode")
             return  # avoid parsing all metalog files in the basic sanity checks
-        for line in file.readlines():
+        mtree = self._mtree
+        # Iterate over the file instead of using readlines() to avoid keeping all lines in memory
+        for line in file:
             line = line.strip()
-            if not line or line.startswith("#"):
+            if not line or line[0] == "#":
                 continue
             try:
                 entry = MtreeEntry.parse(line, contents_root)
-                key = str(entry.path)
-                assert key == "." or os.path.normpath(key[2:]) == key[2:]
-                if key in self._mtree:
-                    warning_message("Found duplicate definition for", entry.path)
-                self._mtree[key] = entry
+                key = entry.path
+                if key in mtree:
+                    warning_message("Found duplicate definition for", key)
+                mtree[key] = entry
             except Exception as e:
                 warning_message("Could not parse line", line, "in mtree file", file, ":", e)
 
@@ -244,6 +332,69 @@ class MtreeFile(object):
             status_update("Adding dir", path, "to mtree", file=sys.stderr)
         self._mtree[mtree_path] = MtreeEntry(mtree_path, attribs)
 
+    def _listed_children(self) -> "typing.Dict[str, typing.Set[str]]":
+        # Map each (normalized) directory key to the names of the entries listed in it
+        result = {}  # type: typing.Dict[str, typing.Set[str]]
+        for key in self._mtree:
+            if key == ".":
+                continue
+            parent, _, name = key.rpartition("/")
+            children = result.get(parent)
+            if children is None:
+                children = result[parent] = set()
+            children.add(name)
+        return result
+
+    @staticmethod
+    def _scan_dir(dirpath: str, relpath: str, trie_state: "typing.Union[dict, bool, None]",
+                  listed_children: "typing.Dict[str, typing.Set[str]]"):
+        matched = []
+        unlisted = []
+        subdirs = []
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            return matched, unlisted, subdirs  # ignored just like os.walk() does
+        listed = listed_children.get("./" + relpath[:-1] if relpath else ".", frozenset())
+        for entry in entries:
+            name = entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Like os.walk(), don't descend into symlinks to directories and don't report them either
+                if not entry.is_symlink():
+                    subdirs.append((entry.path, relpath + name + "/", _match_prefix_trie(trie_state, name + "/")))
+                continue
+            if _match_prefix_trie(trie_state, name) is True:
+                matched.append(relpath + name)
+            elif name not in listed:
+                unlisted.append(relpath + name)
+        return matched, unlisted, subdirs
+
+    def find_unlisted_files(self, root: Path, auto_prefixes: "typing.Iterable[str]", max_workers: int = 8):
+        """
+        Walk root in parallel and find all files (not directories) that should be added to the mtree.
+        :return: a tuple of the files matching one of the auto_prefixes and the files that are not listed in the mtree.
+        Each file is returned as (absolute path, path relative to root), sorted by relative path.
+        """
+        listed_children = self._listed_children()
+        auto_prefix_trie = _match_prefix_trie(_build_prefix_trie(auto_prefixes), "")
+        matched = []
+        unlisted = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(self._scan_dir, str(root), "", auto_prefix_trie, listed_children)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_matched, dir_unlisted, subdirs = future.result()
+                    matched.extend(dir_matched)
+                    unlisted.extend(dir_unlisted)
+                    for subdir in subdirs:
+                        pending.add(executor.submit(self._scan_dir, *subdir, listed_children))
+        return ([(root / p, p) for p in sorted(matched)], [(root / p, p) for p in sorted(unlisted)])
+
     def __contains__(self, item):
         mtree_path = self._ensure_mtree_path_fmt(str(item))
         return mtree_path in self._mtree
@@ -31,9 +31,11 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import atexit
 import contextlib
 import fcntl
 import functools
+import json
 import os
 import re
 import shlex
@@ -43,17 +45,20 @@ import subprocess
 import sys
 import tempfile
 import termios
+import threading
 import typing
 from pathlib import Path
 from subprocess import CompletedProcess
 
+from .build_timing import get_build_timing_recorder, max_rss_bytes
 from .colour import AnsiColour, coloured
-from .utils import (ConfigBase, fatal_error, get_global_config, OSInfo, status_update, Type_T, warning_message)
+from .utils import (ConfigBase, fatal_error, get_global_config, get_output_prefix, OSInfo, status_update, Type_T,
+                    warning_message)
 
 __all__ = ["print_command", "get_compiler_info", "CompilerInfo", "popen", "popen_handle_noexec",  # no-combine
            "run_command", "latest_system_clang_tool", "commandline_to_str", "set_env", "extract_version",  # no-combine
            "get_program_version", "check_call_handle_noexec", "get_version_output", "keep_terminal_sane",  # no-combine
-           "run_and_kill_children_on_exit"]  # no-combine
+           "run_and_kill_children_on_exit", "getenv", "current_environ"]  # no-combine
 
 
 def __filter_env(env: dict) -> dict:
@@ -64,10 +69,30 @@ def __filter_env(env: dict) -> dict:
     return result
 
 
+# Environment variables set by set_env() in threads other than the main thread (i.e. while building targets in
+# parallel). These are passed to the processes started by that thread instead of changing os.environ for all threads.
+_thread_environ = threading.local()
+
+
+def _thread_environ_overrides() -> "typing.Dict[str, str]":
+    return getattr(_thread_environ, "overrides", dict())
+
+
+def getenv(key: str, default: str = None) -> "typing.Optional[str]":
+    """Same as os.getenv() but also includes the variables set by set_env() in the current thread"""
+    return _thread_environ_overrides().get(key, os.getenv(key, default))
+
+
+def current_environ() -> "typing.Dict[str, str]":
+    """Returns a copy of os.environ that includes the variables set by set_env() in the current thread"""
+    return dict(os.environ, **_thread_environ_overrides())
+
+
 @contextlib.contextmanager
 def set_env(*, print_verbose_only=True, config: ConfigBase = None, **environ):
     """
-    Temporarily set the process environment variables.
+    Temporarily set the process environment variables. When called from a thread other than the main thread, the
+    variables are only set for the processes started by the current thread and os.environ is not changed.
 
     >>> with set_env(PLUGINS_DIR=u'test/plugins'):
     ...   "PLUGINS_DIR" in os.environ
@@ -79,17 +104,28 @@ def set_env(*, print_verbose_only=True, config: ConfigBase = None, **environ):
     """
     if config is None:
         config = get_global_config()  # TODO: remove
-    old_environ = dict(os.environ)
     # make sure all environment variables are converted to string
     str_environ = dict((str(k), str(v)) for k, v in environ.items())
     for k, v in str_environ.items():
         print_command("export", k + "=" + v, print_verbose_only=print_verbose_only, config=config)
+    if threading.current_thread() is not threading.main_thread():
+        old_overrides = _thread_environ_overrides()
+        _thread_environ.overrides = dict(old_overrides, **str_environ)
+        try:
+            yield
+        finally:
+            _thread_environ.overrides = old_overrides
+        return
+    old_values = dict((k, os.environ.get(k)) for k in str_environ)
     os.environ.update(str_environ)
     try:
         yield
     finally:
-        os.environ.clear()
-        os.environ.update(old_environ)
+        for k, v in old_values.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
 
 
 class TtyState:
@@ -203,9 +239,10 @@ def print_command(arg1: "typing.Union[str, typing.Sequence[typing.Any]]", *remai
         new_args += (">", str(output_file))
     # Avoid a space before the actual command if there is no prefic:
     if not prefix:
-        print(coloured(colour, new_args, sep=sep), flush=True, **kwargs)
+        print(get_output_prefix() + coloured(colour, new_args, sep=sep), flush=True, **kwargs)
     else:
-        print(coloured(colour, prefix, sep=sep), coloured(colour, new_args, sep=sep), flush=True, **kwargs)
+        print(get_output_prefix() + coloured(colour, prefix, sep=sep), coloured(colour, new_args, sep=sep), flush=True,
+              **kwargs)
 
 
 def get_interpreter(cmdline: "typing.Sequence[str]") -> "typing.Optional[typing.List[str]]":
@@ -235,27 +272,80 @@ def _make_called_process_error(retcode, args, *, stdout=None, stderr=None, cwd=N
     return err
 
 
+class _TimedPopen(subprocess.Popen):
+    """
+    A subprocess.Popen that reports the wall time, CPU time and peak RSS of the child (including all of the child's
+    reaped descendants, e.g. the compiler processes started by make) to the build timing recorder.
+    Note: On Linux the peak RSS also includes the memory that the child inherited from cheribuild before exec().
+    """
+
+    def __init__(self, args, **kwargs):
+        self._timing_recorder = get_build_timing_recorder()
+        assert self._timing_recorder is not None
+        self._timing_start = self._timing_recorder.now()
+        self._timing_target = self._timing_recorder.current_target
+        self._timing_thread = self._timing_recorder.thread_id()
+        super().__init__(args, **kwargs)
+
+    # Override the POSIX implementation of Popen._try_wait() to use wait4() instead of waitpid()
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            cmdline = [str(arg) for arg in self.args] if isinstance(self.args, (list, tuple)) else [str(self.args)]
+            self._timing_recorder.add_process(os.path.basename(cmdline[0]), self._timing_start, self._timing_target,
+                                              self._timing_thread, rusage.ru_utime + rusage.ru_stime,
+                                              max_rss_bytes(rusage.ru_maxrss),
+                                              args={"cmdline": commandline_to_str(cmdline)})
+        return pid, sts
+
+
+def _popen_class() -> "typing.Type[subprocess.Popen]":
+    return subprocess.Popen if get_build_timing_recorder() is None else _TimedPopen
+
+
+def _check_call(cmdline: "typing.List[str]", **kwargs):
+    if get_build_timing_recorder() is None:
+        return subprocess.check_call(cmdline, **kwargs)
+    # Same as subprocess.check_call() but using _TimedPopen
+    with _TimedPopen(cmdline, **kwargs) as p:
+        try:
+            retcode = p.wait()
+        except:  # noqa: E722
+            p.kill()
+            raise
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmdline)
+    return 0
+
+
 def check_call_handle_noexec(cmdline: "typing.List[str]", **kwargs):
+    if kwargs.get("env") is None and _thread_environ_overrides():
+        kwargs["env"] = current_environ()
     try:
         with keep_terminal_sane():
-            return subprocess.check_call(cmdline, **kwargs)
+            return _check_call(cmdline, **kwargs)
     except PermissionError as e:
         interpreter = get_interpreter(cmdline)
         if interpreter:
             with keep_terminal_sane():
-                return subprocess.check_call(interpreter + cmdline, **kwargs)
+                return _check_call(interpreter + cmdline, **kwargs)
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
     except FileNotFoundError as e:
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
 
 
 def popen_handle_noexec(cmdline: "typing.List[str]", **kwargs) -> subprocess.Popen:
+    if kwargs.get("env") is None and _thread_environ_overrides():
+        kwargs["env"] = current_environ()
     try:
-        return subprocess.Popen(cmdline, **kwargs)
+        return _popen_class()(cmdline, **kwargs)
     except PermissionError as e:
         interpreter = get_interpreter(cmdline)
         if interpreter:
-            return subprocess.Popen(interpreter + cmdline, **kwargs)
+            return _popen_class()(interpreter + cmdline, **kwargs)
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
     except FileNotFoundError as e:
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
@@ -346,7 +436,7 @@ def run_command(*args, capture_output=False, capture_error=False, input: "typing
     if "env" in kwargs:
         env_arg = kwargs["env"]  # type: typing.Dict[str, str]
         if not replace_env:
-            new_env = os.environ.copy()
+            new_env = current_environ()
             env = {k: str(v) for k, v in env_arg.items()}  # make sure everything is a string
             new_env.update(env)
             kwargs["env"] = new_env
@@ -393,6 +483,110 @@ def commandline_to_str(args: "typing.Iterable[typing.Union[str,Path]]") -> str:
     return " ".join((shlex.quote(str(s)) for s in args))
 
 
+class _ProgramProbeCache(object):
+    """
+    On-disk cache for the results of running compilers and other tools to determine their version and capabilities.
+    Entries are keyed by the resolved path of the binary and are discarded when its inode, size or mtime changes.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._entries = None  # type: typing.Optional[typing.Dict[str, dict]]
+        self._dirty = set()  # type: typing.Set[str]
+        self._preloaded_signature = None  # type: typing.Optional[typing.List[int]]
+
+    @staticmethod
+    def _enabled() -> bool:
+        return not get_global_config().TEST_MODE and os.getenv("CHERIBUILD_NO_PROBE_CACHE") is None
+
+    @staticmethod
+    def _stat_signature(program: Path) -> "typing.Optional[typing.List[int]]":
+        try:
+            st = program.stat()
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def _read_cache_file(self) -> "typing.Dict[str, dict]":
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format_version") == self.FORMAT_VERSION:
+                return data["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass  # missing or corrupt cache -> start from scratch
+        return dict()
+
+    def _entry(self, program: Path) -> "typing.Optional[dict]":
+        if not program.is_absolute() or not self._enabled():
+            return None
+        signature = self._stat_signature(program)
+        if signature is None:
+            return None
+        if self._entries is None:
+            self._entries = self._read_cache_file()
+        entry = self._entries.get(str(program))
+        if entry is None or entry.get("stat") != signature:
+            # Binary has changed (or is not cached yet) -> discard all previous results
+            entry = {"stat": signature}
+            self._entries[str(program)] = entry
+        return entry
+
+    def preload(self) -> None:
+        """Read the cache file now (the cheribuild daemon calls this before forking a new cheribuild instance)."""
+        with self._lock:
+            signature = self._stat_signature(self.path)
+            if self._dirty or (self._entries is not None and signature == self._preloaded_signature):
+                return
+            self._entries = self._read_cache_file()
+            self._preloaded_signature = signature
+
+    def get(self, program: Path, key: str, default=None):
+        with self._lock:
+            entry = self._entry(program)
+            if entry is None:
+                return default
+            return entry.get(key, default)
+
+    def set(self, program: Path, key: str, value) -> None:
+        with self._lock:
+            entry = self._entry(program)
+            if entry is None:
+                return
+            entry[key] = value
+            if not self._dirty:
+                atexit.register(self.save)
+            self._dirty.add(str(program))
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            # Merge with the current file contents in case another cheribuild instance updated it in the meantime
+            entries = self._read_cache_file()
+            for program in self._dirty:
+                entries[program] = self._entries[program]
+            self._dirty.clear()
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile("w", dir=str(self.path.parent), prefix=self.path.name,
+                                                 delete=False, encoding="utf-8") as f:
+                    json.dump({"format_version": self.FORMAT_VERSION, "entries": entries}, f, sort_keys=True)
+                os.replace(f.name, str(self.path))
+            except OSError as e:
+                warning_message("Could not save cached compiler information to", self.path, e)
+
+
+def preload_program_probe_cache() -> None:
+    _program_probe_cache.preload()
+
+
+_program_probe_cache = _ProgramProbeCache(
+    Path(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "cheribuild", "program-probes.json"))
+
+
 class CompilerInfo(object):
     def __init__(self, path: Path, compiler: str, version: "typing.Tuple[int]", version_str: str, default_target: str,
                  *, config: ConfigBase):
@@ -402,8 +596,11 @@ class CompilerInfo(object):
         self.version_str = version_str
         self.default_target = default_target
         self.config = config
-        self._resource_dir = None  # type: typing.Optional[Path]
-        self._supported_warning_flags = dict()  # type: typing.Dict[str, bool]
+        cached_resource_dir = _program_probe_cache.get(path, "resource_dir")
+        self._resource_dir = Path(cached_resource_dir) if cached_resource_dir else None  # type: typing.Optional[Path]
+        # Copy the dict so that we can detect new entries
+        self._supported_warning_flags = dict(
+            _program_probe_cache.get(path, "warning_flags", {}))  # type: typing.Dict[str, bool]
         assert compiler in ("unknown compiler", "clang", "apple-clang", "gcc"), "unknown type: " + compiler
 
     def get_resource_dir(self) -> Path:
@@ -424,6 +621,8 @@ class CompilerInfo(object):
                                       capture_error=True, print_verbose_only=True, run_in_pretend_mode=True)
                 resource_dir_pat = re.compile(b'"-cc1".+"-resource-dir" "([^"]+)"')
                 self._resource_dir = Path(resource_dir_pat.search(cc1_cmd.stderr).group(1).decode("utf-8"))
+            if not self.config.pretend:
+                _program_probe_cache.set(self.path, "resource_dir", str(self._resource_dir))
         return self._resource_dir
 
     def _supports_warning_flag(self, flag: str):
@@ -442,6 +641,8 @@ class CompilerInfo(object):
         if result is None:
             result = self._supports_warning_flag(flag)
             self._supported_warning_flags[flag] = result
+            if not self.config.pretend:
+                _program_probe_cache.set(self.path, "warning_flags", self._supported_warning_flags)
         return result
 
     def get_matching_binutil(self, binutil):
@@ -497,6 +698,13 @@ def get_compiler_info(compiler: "typing.Union[str, Path]", *, config: ConfigBase
         if compiler_realpath in _cached_compiler_infos:
             _cached_compiler_infos[compiler] = _cached_compiler_infos[compiler_realpath]
         compiler = compiler_realpath
+    if compiler not in _cached_compiler_infos:
+        cached_info = _program_probe_cache.get(compiler, "compiler_info")
+        if cached_info is not None:
+            kind, version, version_str, target_string = cached_info
+            result = CompilerInfo(compiler, kind, tuple(version), version_str, target_string, config=config)
+            _cached_compiler_infos[compiler] = result
+            return result
     if compiler not in _cached_compiler_infos:
         clang_version_pattern = re.compile(b"clang version (\\d+)\\.(\\d+)\\.?(\\d+)?")
         gcc_version_pattern = re.compile(b"gcc version (\\d+)\\.(\\d+)\\.?(\\d+)?")
@@ -547,6 +755,7 @@ def get_compiler_info(compiler: "typing.Union[str, Path]", *, config: ConfigBase
         # Don't cache the result if the -v command failed (e.g. compiler doesn't exist yet)
         if executed_sucessfully:
             _cached_compiler_infos[compiler] = result
+            _program_probe_cache.set(compiler, "compiler_info", [kind, list(version), version_str, target_string])
         return result
     return _cached_compiler_infos[compiler]
 
@@ -558,8 +767,15 @@ def get_version_output(program: Path, command_args: tuple = None, *, config: Con
         config = get_global_config()  # TODO: remove
     if command_args is None:
         command_args = ["--version"]
+    resolved_program = Path(shutil.which(str(program)) or program).resolve()
+    cache_key = "version_output:" + commandline_to_str(command_args)
+    cached_output = _program_probe_cache.get(resolved_program, cache_key)
+    if cached_output is not None:
+        return cached_output.encode("latin-1")
     prog = run_command([str(program)] + list(command_args), config=config, stdin=subprocess.DEVNULL,
                        stderr=subprocess.STDOUT, capture_output=True, run_in_pretend_mode=True)
+    # Use latin-1 since it can represent arbitrary bytes
+    _program_probe_cache.set(resolved_program, cache_key, prog.stdout.decode("latin-1"))
     return prog.stdout
 
 
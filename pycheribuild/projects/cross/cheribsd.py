@@ -36,8 +36,8 @@ import typing
 from pathlib import Path
 
 from ..llvm import BuildLLVMMonoRepoBase
-from ..project import (CheriConfig, CPUArchitecture, DefaultInstallDir, flush_stdio, GitRepository,
-                       MakeCommandKind, MakeOptions, Project, SimpleProject, TargetBranchInfo)
+from ..project import (CheriConfig, CPUArchitecture, DefaultInstallDir, GitRepository, LineFilter, MakeCommandKind,
+                       MakeOptions, Project, SimpleProject, TargetBranchInfo)
 from ...config.compilation_targets import CompilationTargets, FreeBSDTargetInfo
 from ...config.loader import ComputedDefaultValue
 from ...config.target_info import AutoVarInit, CompilerType as FreeBSDToolchainKind, CrossCompileTarget
@@ -332,27 +332,15 @@ class BuildFreeBSD(BuildFreeBSDBase):
         else:
             assert False, "should be unreachable"
 
-    def _stdout_filter(self, line: bytes):
-        if line.startswith(b">>> "):  # major status update
-            if self._last_stdout_line_can_be_overwritten:
-                sys.stdout.buffer.write(Project._clear_line_sequence)
-            sys.stdout.buffer.write(line)
-            flush_stdio(sys.stdout)
-            self._last_stdout_line_can_be_overwritten = False
-        elif line.startswith(b"===> "):  # new subdirectory
-            self._line_not_important_stdout_filter(line)
-        elif line == b"--------------------------------------------------------------\n":
-            return  # ignore separator around status updates
-        elif line == b"\n":
-            return  # ignore empty lines when filtering
-        elif line.endswith(b"' is up to date.\n"):
-            return  # ignore these messages caused by (unnecessary?) recursive make invocations|
-        elif line.endswith(b"missing (created)\n"):
-            return  # ignore these from installworld
-        elif line.startswith(b"[Creating objdir") or line.startswith(b"[Creating nested objdir"):
-            return  # ignore the WITH_AUTO_OBJ messages
-        else:
-            self._show_line_stdout_filter(line)
+    _stdout_filter = LineFilter(
+        default=LineFilter.SHOW,
+        status_prefixes=(b">>> ",),  # major status update
+        progress_prefixes=(b"===> ",),  # new subdirectory
+        # ignore separator around status updates and empty lines when filtering
+        ignored_lines=(b"--------------------------------------------------------------", b""),
+        # ignore these messages caused by (unnecessary?) recursive make invocations and these from installworld
+        ignored_suffixes=(b"' is up to date.", b"missing (created)"),
+        ignored_prefixes=(b"[Creating objdir", b"[Creating nested objdir"))  # ignore the WITH_AUTO_OBJ messages
 
     @property
     def arch_build_flags(self):
@@ -1158,7 +1146,7 @@ class BuildFreeBSDUniverse(BuildFreeBSDBase):
         self.info("freebsd-universe is a compile-only target")
 
     # Don't filter lines here
-    _stdout_filter = Project._show_line_stdout_filter
+    _stdout_filter = LineFilter(default=LineFilter.SHOW)
 
     def process(self):
         if not OSInfo.IS_FREEBSD and not self.crossbuild:
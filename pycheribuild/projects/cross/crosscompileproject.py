@@ -28,7 +28,6 @@
 # SUCH DAMAGE.
 #
 
-import os
 import pprint
 import typing
 from pathlib import Path
@@ -37,6 +36,7 @@ from ..project import (AutotoolsProject, BuildType, CheriConfig, CMakeProject, C
                        GitRepository, Linkage, MakeCommandKind, MakefileProject, Project, commandline_to_str)
 from ...config.compilation_targets import CompilationTargets
 from ...config.target_info import AutoVarInit
+from ...processutils import getenv
 from ...utils import AnsiColour, coloured
 
 __all__ = ["CheriConfig", "CrossCompileCMakeProject", "CrossCompileAutotoolsProject",  # no-combine
@@ -154,7 +154,7 @@ class CrossCompileAutotoolsProject(CrossCompileMixin, AutotoolsProject):
     def process(self):
         if not self.compiling_for_host():
             # We run all these commands with $PATH containing $CHERI_SDK/bin to ensure the right tools are used
-            with self.set_env(PATH=str(self.sdk_bindir) + ":" + os.getenv("PATH")):
+            with self.set_env(PATH=str(self.sdk_bindir) + ":" + getenv("PATH", "")):
                 super().process()
         else:
             # when building the native target we just rely on the host tools in /usr/bin
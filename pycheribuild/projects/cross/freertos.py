@@ -29,11 +29,11 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
-import os
 
 from .crosscompileproject import (CheriConfig, CompilationTargets, CrossCompileAutotoolsProject, DefaultInstallDir,
                                   GitRepository)
 from ...config.loader import ComputedDefaultValue
+from ...processutils import getenv
 
 
 class BuildFreeRTOS(CrossCompileAutotoolsProject):
@@ -151,7 +151,7 @@ class BuildFreeRTOS(CrossCompileAutotoolsProject):
         if self.demo_app not in self.supported_demo_apps[self.demo]:
             self.fatal(self.demo + " Demo doesn't support/have " + self.demo_app)
 
-        with self.set_env(PATH=str(self.sdk_bindir) + ":" + os.getenv("PATH", ""),
+        with self.set_env(PATH=str(self.sdk_bindir) + ":" + getenv("PATH", ""),
                           # Add compiler-rt location to the search path
                           LDFLAGS="-L" + str(self.compiler_resource / "lib")):
             super().process()
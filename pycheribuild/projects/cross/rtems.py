@@ -29,9 +29,9 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
-import os
 
 from .crosscompileproject import CheriConfig, CompilationTargets, CrossCompileProject, DefaultInstallDir, GitRepository
+from ...processutils import getenv
 
 
 class BuildRtems(CrossCompileProject):
@@ -78,7 +78,7 @@ class BuildRtems(CrossCompileProject):
         self._run_waf("install")
 
     def process(self):
-        with self.set_env(PATH=str(self.sdk_bindir) + ":" + os.getenv("PATH", ""),
+        with self.set_env(PATH=str(self.sdk_bindir) + ":" + getenv("PATH", ""),
                           CFLAGS="--sysroot=" + str(self.sdk_sysroot),
                           LDFLAGS="--sysroot=" + str(self.sdk_sysroot)):
             super().process()
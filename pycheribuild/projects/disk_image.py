@@ -28,12 +28,17 @@
 # SUCH DAMAGE.
 #
 
+import contextlib
+import hashlib
 import io
+import json
 import os
 import shutil
 import sys
 import tempfile
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from .cross.cheribsd import (BuildCHERIBSD, BuildCheriBsdDeviceModel, BuildFreeBSD, BuildFreeBSDDeviceModel,
@@ -104,6 +109,39 @@ def _default_disk_image_name(config: CheriConfig, directory: Path, project: "_Bu
     return directory / (project.disk_image_prefix + project.build_configuration_suffix(xtarget) + ".img")
 
 
+def _disk_image_signature(image: Path) -> "typing.Optional[list]":
+    try:
+        st = image.stat()
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _incremental_disk_image_changes(previous: dict, manifest: dict,
+                                    image: Path) -> "typing.Tuple[typing.Optional[str], typing.List[str]]":
+    """
+    Compare the manifest of the existing image with the one for the new image.
+    :return: the reason why the image has to be rebuilt (None if it can be kept) and the list of modified files
+    """
+    if not previous:
+        return "there is no manifest for the existing image", []
+    if previous.get("version") != manifest["version"] or previous.get("options") != manifest["options"]:
+        return "the disk image options have changed", []
+    # The image could have been modified after it was built (e.g. by booting it in QEMU)
+    if previous.get("image") is None or previous.get("image") != _disk_image_signature(image):
+        return "the existing image has been modified since it was created", []
+    old_entries = previous.get("entries", {})
+    new_entries = manifest["entries"]
+    added = new_entries.keys() - old_entries.keys()
+    removed = old_entries.keys() - new_entries.keys()
+    changed = sorted(k for k in new_entries.keys() & old_entries.keys() if new_entries[k] != old_entries[k])
+    if not added and not removed and not changed:
+        return None, []
+    reason = "{} files were added, {} were removed and {} were modified".format(len(added), len(removed),
+                                                                                len(changed))
+    return reason, changed
+
+
 def _default_disk_image_hostname(prefix: str) -> "ComputedDefaultValue[str]":
     # noinspection PyProtectedMember
     return ComputedDefaultValue(
@@ -137,6 +175,8 @@ class _BuildDiskImageBase(SimpleProject):
         if "use_qcow2" not in cls.__dict__:
             cls.use_qcow2 = cls.add_bool_option("use-qcow2",
                                                 help="Convert the disk image to QCOW2 format instead of raw")
+        cls.compress_qcow2 = cls.add_bool_option("compress-qcow2",
+                                                 help="Compress the QCOW2 image (smaller, but slower to create)")
         cls.remote_path = cls.add_config_option("remote-path", show_help=False, metavar="PATH",
                                                 help="When set rsync will be used to update the image from "
                                                      "the remote server instead of building it locally.")
@@ -147,6 +187,9 @@ class _BuildDiskImageBase(SimpleProject):
                                               help="Include GDB in the disk image (if it exists)")
         cls.include_kgdb = cls.add_bool_option("include-kgdb", default=False,
                                                help="Include KGDB in the disk image (if it exists)")
+        cls.incremental = cls.add_bool_option("incremental", default=False,
+                                              help="Keep the existing disk image if none of the files and options "
+                                                   "that were used to create it have changed")
         assert cls.default_disk_image_path is not None
         cls.disk_image_path = cls.add_path_option("path", default=cls.default_disk_image_path, metavar="IMGPATH",
                                                   help="The output path for the QEMU disk image", show_help=True)
@@ -178,6 +221,8 @@ class _BuildDiskImageBase(SimpleProject):
         self.hostname = os.path.expandvars(self.hostname)  # Expand env vars in hostname to allow $CHERI_BITS
         # MIPS needs big-endian disk images
         self.big_endian = self.compiling_for_mips(include_purecap=True)
+        # (stage, seconds, output file size, allocated bytes) for each step of the disk image creation
+        self._image_stages = []  # type: typing.List[typing.Tuple[str, float, int, int]]
 
     def add_file_to_image(self, file: Path, *, base_directory: Path = None, user="root", group="wheel", mode=None,
                           path_in_target=None):
@@ -463,7 +508,8 @@ class _BuildDiskImageBase(SimpleProject):
     def run_mkimg(self, cmd: list, **kwargs):
         if not self.mkimg_cmd or not self.mkimg_cmd.exists():
             self.fatal("Missing mkimg command! Should be found in FreeBSD build dir (or set $MKIMG_CMD)")
-        self.run_cmd([self.mkimg_cmd] + cmd, **kwargs)
+        with self._timed_image_stage("mkimg", self.disk_image_path):
+            self.run_cmd([self.mkimg_cmd] + cmd, **kwargs)
 
     def make_x86_disk_image(self):
         assert self.is_x86
@@ -552,12 +598,13 @@ class _BuildDiskImageBase(SimpleProject):
                 efi_mtree.write(tmp_mtree, pretend=self.config.pretend)
                 tmp_mtree.flush()  # ensure the file is actually written
                 self.run_cmd("cat", tmp_mtree.name)
-                self.run_cmd([self.makefs_cmd, "-t", "msdos", "-s", "1m",  # 1 MB
-                              # "-d", "0x2fffffff",  # super verbose output
-                              # "-d", "0x20000000",  # MSDOSFS debug output
-                              "-B", "le",  # byte order little endian
-                              "-N", self.user_group_db_dir,
-                              str(efi_partition), str(tmp_mtree.name)], cwd=self.rootfs_dir)
+                with self._timed_image_stage("makefs (EFI)", efi_partition):
+                    self.run_cmd([self.makefs_cmd, "-t", "msdos", "-s", "1m",  # 1 MB
+                                  # "-d", "0x2fffffff",  # super verbose output
+                                  # "-d", "0x20000000",  # MSDOSFS debug output
+                                  "-B", "le",  # byte order little endian
+                                  "-N", self.user_group_db_dir,
+                                  str(efi_partition), str(tmp_mtree.name)], cwd=self.rootfs_dir)
             else:
                 # Use this (and mtools) instead: https://wiki.osdev.org/UEFI_Bare_Bones#Creating_the_FAT_image
                 if not (mtools_bin / "mformat").exists():
@@ -587,26 +634,27 @@ class _BuildDiskImageBase(SimpleProject):
             if self.is_x86:
                 # x86: -t ffs -f 200000 -s 8g -o version=2,bsize=32768,fsize=4096
                 extra_flags = ["-o", "bsize=32768,fsize=4096,label=root"]
-            self.run_cmd([self.makefs_cmd] + debug_options + extra_flags + [
-                "-t", "ffs",  # BSD fast file system
-                "-o", "version=2,label=root",  # UFS2
-                "-o", "softupdates=1",  # Enable soft updates journaling
-                "-Z",  # sparse file output
-                # For the minimal image 2mb of free space and 1k inodes should be enough
-                # For the larger images we need a lot more space (kyua needs around 400MB and the test might create
-                # big files)
-                "-b", "2m" if self.is_minimal else "1g",  # kyua needs a lot of space -> at least 1g
-                "-f", "1k" if self.is_minimal else "200k",
-                # minimum 1024 free inodes for minimal, otherwise at least 1M
-                "-R", "4m",  # round up size to the next 4m multiple
-                "-M", self.minimum_image_size,
-                "-B", "be" if self.big_endian else "le",  # byte order
-                "-N", self.user_group_db_dir,
-                # use master.passwd from the cheribsd source not the current systems passwd file
-                # which makes sure that the numeric UID values are correct
-                rootfs_img,  # output file
-                self.manifest_file,  # use METALOG as the manifest for the disk image
-            ], cwd=self.rootfs_dir)
+            with self._timed_image_stage("makefs", rootfs_img):
+                self.run_cmd([self.makefs_cmd] + debug_options + extra_flags + [
+                    "-t", "ffs",  # BSD fast file system
+                    "-o", "version=2,label=root",  # UFS2
+                    "-o", "softupdates=1",  # Enable soft updates journaling
+                    "-Z",  # sparse file output
+                    # For the minimal image 2mb of free space and 1k inodes should be enough
+                    # For the larger images we need a lot more space (kyua needs around 400MB and the test might create
+                    # big files)
+                    "-b", "2m" if self.is_minimal else "1g",  # kyua needs a lot of space -> at least 1g
+                    "-f", "1k" if self.is_minimal else "200k",
+                    # minimum 1024 free inodes for minimal, otherwise at least 1M
+                    "-R", "4m",  # round up size to the next 4m multiple
+                    "-M", self.minimum_image_size,
+                    "-B", "be" if self.big_endian else "le",  # byte order
+                    "-N", self.user_group_db_dir,
+                    # use master.passwd from the cheribsd source not the current systems passwd file
+                    # which makes sure that the numeric UID values are correct
+                    rootfs_img,  # output file
+                    self.manifest_file,  # use METALOG as the manifest for the disk image
+                ], cwd=self.rootfs_dir)
         except Exception:
             self.warning("makefs failed, if it reports an issue with METALOG report a bug (could be either cheribuild"
                          " or cheribsd) and attach the METALOG file.")
@@ -615,6 +663,7 @@ class _BuildDiskImageBase(SimpleProject):
             raise
 
     def make_disk_image(self):
+        self._image_stages = []
         # check that qemu-img exists before starting the potentially long-running makefs command
         qemu_img_command = self.config.qemu_bindir / "qemu-img"
         if not qemu_img_command.is_file():
@@ -641,17 +690,130 @@ class _BuildDiskImageBase(SimpleProject):
         if self.use_qcow2:
             if not qemu_img_command.exists():
                 self.fatal("Cannot create QCOW2 image without qemu-img command!")
-            # create a qcow2 version from the raw image:
+            # create a qcow2 version from the raw image (renaming the file is free, unlike copying it):
             raw_img = self.disk_image_path.with_suffix(".raw")
             self.run_cmd("mv", "-f", self.disk_image_path, raw_img)
-            self.run_cmd(qemu_img_command, "convert",
-                         "-f", "raw",  # input file is in raw format (not required as QEMU can detect it
-                         "-O", "qcow2",  # convert to qcow2 format
-                         raw_img,  # input file
-                         self.disk_image_path)  # output file
+            # Allow out-of-order writes for uncompressed images. qemu-img rejects -W together with -c ("Out of order
+            # write and compress are mutually exclusive").
+            convert_args = ["-c"] if self.compress_qcow2 else ["-W"]
+            with self._timed_image_stage("qemu-img convert" + (" (compressed)" if self.compress_qcow2 else ""),
+                                         self.disk_image_path):
+                self.run_cmd(qemu_img_command, "convert",
+                             "-f", "raw",  # input file is in raw format (not required as QEMU can detect it
+                             "-O", "qcow2",  # convert to qcow2 format
+                             # Use multiple coroutines. Since makefs creates a sparse file, only the allocated parts
+                             # of the raw image are read. With -c the clusters are compressed on the QEMU thread pool.
+                             "-m", str(max(1, min(16, self.config.make_jobs))),
+                             *convert_args,
+                             raw_img,  # input file
+                             self.disk_image_path)  # output file
             self.delete_file(raw_img, print_verbose_only=True)
             if self.config.verbose:
                 self.run_cmd(qemu_img_command, "info", self.disk_image_path)
+        self._print_image_stages()
+
+    @contextlib.contextmanager
+    def _timed_image_stage(self, stage: str, output: Path):
+        start = time.time()
+        yield
+        if self.config.pretend:
+            return
+        try:
+            st = output.stat()
+            size, allocated = st.st_size, st.st_blocks * 512
+        except OSError:
+            size, allocated = 0, 0
+        self._image_stages.append((stage, time.time() - start, size, allocated))
+
+    def _print_image_stages(self):
+        if not self._image_stages:
+            return
+
+        def mib(value: int) -> str:
+            return "{:.1f} MiB".format(value / (1024 * 1024))
+
+        self.info("Disk image creation time by stage:")
+        for stage, seconds, size, allocated in self._image_stages:
+            self.info("  {:<28} {:>7.1f}s  size {:>12}  written {:>12}".format(stage, seconds, mib(size),
+                                                                               mib(allocated)))
+        self._image_stages = []
+
+    @property
+    def _image_manifest_path(self) -> Path:
+        return self.disk_image_path.with_name(self.disk_image_path.name + ".cheribuild-manifest.json")
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _compute_image_manifest(self, previous: dict) -> dict:
+        # Content hashes are only recomputed for files whose size or mtime changed since the previous image.
+        previous_hashes = previous.get("hashes", {})
+        hashes = dict()  # type: typing.Dict[str, list]
+        to_hash = []
+        entries = dict()  # type: typing.Dict[str, list]
+        # noinspection PyProtectedMember
+        for key, entry in self.mtree._mtree.items():
+            attributes = [k + "=" + v for k, v in entry.attributes.items() if k != "contents"]
+            entries[key] = [" ".join(attributes), None]
+            if not entry.is_file():
+                continue
+            # makefs is run in the rootfs directory so relative contents= paths are relative to that directory
+            contents = os.path.join(str(self.rootfs_dir), entry.attributes.get("contents", key))
+            entries[key][1] = contents
+            if contents in hashes:
+                continue
+            try:
+                st = os.stat(contents)
+            except OSError:
+                hashes[contents] = [None, None, "<missing>"]
+                continue
+            cached = previous_hashes.get(contents)
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                hashes[contents] = cached
+            else:
+                hashes[contents] = [st.st_size, st.st_mtime_ns, None]
+                to_hash.append(contents)
+        if to_hash:
+            self.verbose_print("Computing content hashes for", len(to_hash), "files")
+            with ThreadPoolExecutor(max_workers=self.config.make_jobs) as executor:
+                for contents, digest in zip(to_hash, executor.map(self._hash_file, to_hash)):
+                    hashes[contents][2] = digest
+        for entry in entries.values():
+            if entry[1] is not None:
+                entry[1] = hashes[entry[1]][2]
+        image_options = [self.target, str(self.makefs_cmd), str(self.mkimg_cmd), self.minimum_image_size,
+                         self.big_endian, self.is_x86, self.use_qcow2, self.compress_qcow2, self.is_minimal]
+        return {"version": 2, "options": repr(image_options), "entries": entries, "hashes": hashes}
+
+    def make_disk_image_incrementally(self):
+        previous = dict()
+        if self.disk_image_path.is_file() and self._image_manifest_path.is_file():
+            try:
+                with self._image_manifest_path.open("r", encoding="utf-8") as f:
+                    previous = json.load(f)
+            except (OSError, ValueError) as e:
+                self.warning("Could not read", self._image_manifest_path, e)
+        manifest = self._compute_image_manifest(previous)
+        reason, changed = _incremental_disk_image_changes(previous, manifest, self.disk_image_path)
+        if reason is None:
+            self.info("None of the", len(manifest["entries"]), "files in", self.disk_image_path, "have changed, "
+                      "keeping the existing image.")
+            return
+        if previous:
+            self.info("Rebuilding", self.disk_image_path, "since", reason)
+        for path in changed[:20]:
+            self.verbose_print("  modified:", path)
+        self.delete_file(self._image_manifest_path, print_verbose_only=True)
+        self.delete_file(self.disk_image_path)
+        self.make_disk_image()
+        # Record the resulting image so that we notice if it is modified (or replaced) later
+        manifest["image"] = _disk_image_signature(self.disk_image_path)
+        self.write_file(self._image_manifest_path, json.dumps(manifest), overwrite=True, never_print_cmd=True)
 
     def copy_from_remote_host(self):
         self.info("Copying disk image instead of building it.")
@@ -697,7 +859,12 @@ class _BuildDiskImageBase(SimpleProject):
                           coloured(AnsiColour.cyan, "to", self.config.loader.config_file_path))
                 if not self.query_yes_no("Overwrite?", default_result=True):
                     return  # we are done here
-            self.delete_file(self.disk_image_path)
+            if not self.incremental or self.config.clean:
+                self.delete_file(self.disk_image_path)
+        if self._image_manifest_path.exists() and (
+                not self.incremental or self.config.clean or not self.disk_image_path.is_file()):
+            # The manifest is only valid for the image that was created together with it
+            self.delete_file(self._image_manifest_path, print_verbose_only=True)
 
         # we can only build disk images on FreeBSD, so copy the file if we aren't
         if self.remote_path is not None:
@@ -750,29 +917,19 @@ class _BuildDiskImageBase(SimpleProject):
             # Add/symlink GDB (if requested).
             self.add_gdb()
             # finally create the disk image
-            self.make_disk_image()
+            if self.incremental and not self.config.pretend:
+                self.make_disk_image_incrementally()
+            else:
+                self.make_disk_image()
         self.tmpdir = None
         self.manifest_file = None
 
     def add_unlisted_files_to_metalog(self):
-        unlisted_files = []
-        rootfs_str = str(self.rootfs_dir)  # compat with python < 3.6
-        for root, dirnames, filenames in os.walk(rootfs_str):
-            for filename in filenames:
-                full_path = Path(root, filename)
-                target_path = os.path.relpath(str(full_path), rootfs_str)
-                added = False
-                for prefix in self.auto_prefixes:
-                    if target_path.startswith(prefix):
-                        self.mtree.add_file(full_path, target_path, print_status=self.config.verbose)
-                        added = True
-                        break
-                if added:
-                    continue
-                elif target_path not in self.mtree:
-                    # METALOG is not added to the disk image
-                    if target_path not in ("METALOG", "METALOG.kernel", "METALOG.world"):
-                        unlisted_files.append((full_path, target_path))
+        auto_added_files, unlisted_files = self.mtree.find_unlisted_files(self.rootfs_dir, self.auto_prefixes)
+        for full_path, target_path in auto_added_files:
+            self.mtree.add_file(full_path, target_path, print_status=self.config.verbose)
+        # METALOG is not added to the disk image
+        unlisted_files = [i for i in unlisted_files if i[1] not in ("METALOG", "METALOG.kernel", "METALOG.world")]
         if unlisted_files:
             print("Found the following files in the rootfs that are not listed in METALOG:")
             for i in unlisted_files:
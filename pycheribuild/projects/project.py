@@ -29,61 +29,72 @@
 #
 import copy
 import datetime
-import errno
+import hashlib
 import inspect
 import os
 import re
 import shlex
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import threading
 import time
 import typing
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 from typing import Callable, Tuple, Union
 
+from ..build_log import (BuildLogFile, FilteredOutput, flush_stdio, iter_line_blocks, LineFilter, LogCompression,
+                         TerminalOutput)
+from ..build_timing import timed_phase
 from ..config.chericonfig import BuildType, CheriConfig
 from ..config.loader import (ComputedDefaultValue, ConfigLoaderBase, ConfigOptionBase, DefaultValueOnlyConfigOption)
 from ..config.target_info import (AutoVarInit, BasicCompilationTargets, CPUArchitecture, CrossCompileTarget, Linkage,
                                   TargetInfo)
 from ..filesystemutils import FileSystemUtils
-from ..processutils import (check_call_handle_noexec, commandline_to_str, CompilerInfo, get_compiler_info,
-                            get_program_version, get_version_output, popen_handle_noexec, print_command, run_command,
-                            set_env)
+from ..processutils import (check_call_handle_noexec, commandline_to_str, CompilerInfo, current_environ,
+                            get_compiler_info, get_program_version, get_version_output, popen_handle_noexec,
+                            print_command, run_command, set_env)
 from ..targets import MultiArchTarget, MultiArchTargetAlias, Target, target_manager
-from ..utils import (AnsiColour, cached_property, classproperty, coloured, fatal_error, include_local_file,
-                     is_jenkins_build, OSInfo, replace_one, status_update, ThreadJoiner, warning_message)
+from ..utils import (AnsiColour, cached_property, classproperty, coloured, fatal_error, get_output_prefix,
+                     include_local_file, is_jenkins_build, OSInfo, replace_one, status_update, ThreadJoiner,
+                     warning_message)
 
 __all__ = ["Project", "CMakeProject", "AutotoolsProject", "TargetAlias", "TargetAliasWithDependencies",  # no-combine
            "SimpleProject", "CheriConfig", "flush_stdio", "MakeOptions", "MakeCommandKind",  # no-combine
            "CrossCompileTarget", "CPUArchitecture", "GitRepository", "ComputedDefaultValue", "TargetInfo",  # no-combine
            "commandline_to_str", "ReuseOtherProjectRepository", "ExternallyManagedSourceRepository",  # no-combine
            "ReuseOtherProjectDefaultTargetRepository", "MakefileProject",  # no-combine
-           "TargetBranchInfo", "Linkage", "BasicCompilationTargets", "DefaultInstallDir", "BuildType"]  # no-combine
+           "TargetBranchInfo", "Linkage", "BasicCompilationTargets", "DefaultInstallDir", "BuildType",  # no-combine
+           "LineFilter"]  # no-combine
 
 Type_T = typing.TypeVar("Type_T")
 
 
-def flush_stdio(stream):
-    while True:
-        try:
-            # can lead to EWOULDBLOCK if stream cannot be flushed immediately
-            stream.flush()
-            break
-        except BlockingIOError as e:
-            if e.errno != errno.EWOULDBLOCK:
-                raise
-            else:
-                time.sleep(0.1)
-
-
 def _default_stdout_filter(_: bytes):
     raise NotImplementedError("Should never be called, this is a dummy")
 
 
+_cheribuild_fingerprint = None  # type: typing.Optional[str]
+
+
+def _cheribuild_source_fingerprint() -> str:
+    """:return: a hash of all pycheribuild sources (computed once per process)"""
+    global _cheribuild_fingerprint
+    if _cheribuild_fingerprint is None:
+        package_dir = Path(__file__).parent.parent
+        h = hashlib.sha256()
+        for path in sorted(package_dir.rglob("*.py")):
+            h.update(str(path.relative_to(package_dir)).encode("utf-8") + b"\0")
+            h.update(path.read_bytes())
+        _cheribuild_fingerprint = h.hexdigest()
+    return _cheribuild_fingerprint
+
+
 class ProjectSubclassDefinitionHook(type):
     # noinspection PyProtectedMember
     def __init__(cls: "typing.Type[SimpleProject]", name: str, bases, clsdict):
@@ -196,6 +207,54 @@ class ProjectSubclassDefinitionHook(type):
         # print("Adding target", target_name, "with deps:", cls.dependencies)
 
 
+def _elf_file_needs_stripping(path: str) -> "typing.Optional[bool]":
+    """
+    Check the ELF header and section headers of path without running any subprocess.
+    :return: None if path is not an ELF file, False if it has no symbol table or debug info, True otherwise.
+    """
+    with open(path, "rb") as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != b"\x7fELF":
+            return None
+        try:
+            endian = "<" if ident[5] == 1 else ">"
+            if ident[4] == 2:  # ELFCLASS64
+                header = f.read(48)
+                shoff, = struct.unpack(endian + "Q", header[24:32])
+                shdr_fmt = endian + "IIQQQQIIQQ"
+            else:
+                header = f.read(36)
+                shoff, = struct.unpack(endian + "I", header[16:20])
+                shdr_fmt = endian + "IIIIIIIIII"
+            # e_shentsize, e_shnum and e_shstrndx are the last fields of the ELF header
+            shentsize, shnum, shstrndx = struct.unpack(endian + "HHH", header[-6:])
+
+            def section_header(index: int):
+                f.seek(shoff + index * shentsize)
+                return struct.unpack(shdr_fmt, f.read(struct.calcsize(shdr_fmt)))
+
+            if shoff == 0:
+                return False  # no section headers at all
+            if shnum == 0 or shstrndx == 0xffff:
+                # Extended numbering: the real values are stored in section header 0
+                first = section_header(0)
+                shnum = shnum or first[5]
+                shstrndx = first[6] if shstrndx == 0xffff else shstrndx
+            headers = [section_header(i) for i in range(shnum)]
+            strtab = headers[shstrndx]
+            f.seek(strtab[4])
+            names = f.read(strtab[5])
+            for header in headers:
+                if header[1] == 2:  # SHT_SYMTAB
+                    return True
+                name = names[header[0]:names.find(b"\0", header[0])]
+                if name.startswith((b".debug", b".zdebug")):
+                    return True
+            return False
+        except (struct.error, IndexError):
+            return True  # Malformed or truncated file -> let llvm-strip decide
+
+
 class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
     _config_loader = None  # type: ConfigLoaderBase
 
@@ -369,24 +428,9 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         assert cls._xtarget is not None, cls
         if not include_dependencies:
             return []
-        result = []
-        for target in cls._direct_dependencies(config, include_dependencies=include_dependencies,
-                                               include_toolchain_dependencies=include_toolchain_dependencies,
-                                               include_sdk_dependencies=include_sdk_dependencies,
-                                               explicit_dependencies_only=cls.direct_dependencies_only):
-            if target not in result:
-                result.append(target)
-            if cls.direct_dependencies_only:
-                continue  # don't add recursive dependencies for e.g. "build-and-run"
-            # now recursively add the other deps:
-            recursive_deps = target.project_class._recursive_dependencies_impl(
-                config, include_dependencies=include_dependencies,
-                include_toolchain_dependencies=include_toolchain_dependencies,
-                include_sdk_dependencies=include_sdk_dependencies)
-            for r in recursive_deps:
-                if r not in result:
-                    result.append(r)
-        return result
+        return list(target_manager.dependency_graph(config).recursive_dependencies(
+            cls, include_toolchain_dependencies=include_toolchain_dependencies,
+            include_sdk_dependencies=include_sdk_dependencies))
 
     @classmethod
     def cached_full_dependencies(cls) -> "typing.List[Target]":
@@ -703,6 +747,8 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         super().__init__(config)
         self.config = config
         assert not self._should_not_be_instantiated, "Should not have instantiated " + self.__class__.__name__
+        if self.__class__ not in self.__config_options_set:
+            target_manager.register_config_options_for_class(self.__class__)
         assert self.__class__ in self.__config_options_set, "Forgot to call super().setup_config_options()? " + str(
             self.__class__)
         self.__required_system_tools = {}  # type: typing.Dict[str, typing.Any]
@@ -710,6 +756,7 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         self.__required_pkg_config = {}  # type: typing.Dict[str, typing.Any]
         self._system_deps_checked = False
         self._setup_called = False
+        self._terminal_output = TerminalOutput(clear_line_sequence=self._clear_line_sequence)
         assert not hasattr(self, "gitBranch"), "gitBranch must not be used: " + self.__class__.__name__
 
     def setup(self):
@@ -777,19 +824,16 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
             self.fatal(error_message)
 
     @staticmethod
-    def _handle_stderr(outfile, stream, file_lock, project: "Project"):
-        for errLine in stream:
+    def _handle_stderr(outfile, stream, file_lock, project: "Project", output_prefix: bytes = b"", quiet=False):
+        # Read large blocks of complete lines instead of individual lines to reduce the per-line overhead
+        for block in iter_line_blocks(stream.fileno()):
             with file_lock:
                 try:
-                    # noinspection PyProtectedMember
-                    if project._last_stdout_line_can_be_overwritten:
-                        sys.stdout.buffer.write(b"\n")
-                        flush_stdio(sys.stdout)
-                        project._last_stdout_line_can_be_overwritten = False
-                    sys.stderr.buffer.write(errLine)
-                    flush_stdio(sys.stderr)
-                    if project.config.write_logfile:
-                        outfile.write(errLine)
+                    if not quiet:
+                        # noinspection PyProtectedMember
+                        project._terminal_output.write_block(block, output_prefix, stream=sys.stderr.buffer)
+                    if outfile is not None and project.config.write_logfile:
+                        outfile.write(block)
                 except ValueError:
                     # Don't print a backtrace on ctrl+C (since that will exit the main thread and close the file)
                     # ValueError: write to closed file
@@ -797,25 +841,17 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
 
     def _line_not_important_stdout_filter(self, line: bytes):
         # by default we don't keep any line persistent, just have updating output
-        if self._last_stdout_line_can_be_overwritten:
-            sys.stdout.buffer.write(Project._clear_line_sequence)
-        sys.stdout.buffer.write(line[:-1])  # remove the newline at the end
-        sys.stdout.buffer.write(b" ")  # add a space so that there is a gap before error messages
-        flush_stdio(sys.stdout)
-        self._last_stdout_line_can_be_overwritten = True
+        self._terminal_output.progress(line, get_output_prefix().encode("utf-8"))
 
     def _show_line_stdout_filter(self, line: bytes):
-        if self._last_stdout_line_can_be_overwritten:
-            sys.stdout.buffer.write(b"\n")
-        sys.stdout.buffer.write(line)
-        flush_stdio(sys.stdout)
-        self._last_stdout_line_can_be_overwritten = False
+        self._terminal_output.show(line, get_output_prefix().encode("utf-8"))
 
-    def _stdout_filter(self, line: bytes):
-        self._line_not_important_stdout_filter(line)
+    # By default all lines are progress lines that overwrite each other.
+    # Note: this can also be a function that takes a single line, but a LineFilter is much faster for large outputs.
+    _stdout_filter = LineFilter()  # type: typing.Optional[typing.Union[LineFilter, typing.Callable[[bytes], None]]]
 
     def run_with_logfile(self, args: "typing.Sequence[str]", logfile_name: str, *, stdout_filter=None, cwd: Path = None,
-                         env: dict = None, append_to_logfile=False) -> None:
+                         env: dict = None, append_to_logfile=False, pass_fds: "typing.Sequence[int]" = ()) -> None:
         """
         Runs make and logs the output
         config.quiet doesn't display anything, normal only status updates and config.verbose everything
@@ -825,20 +861,23 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         :param cwd the directory to run make in (defaults to self.build_dir)
         :param stdout_filter a filter to use for standard output (a function that takes a single bytes argument)
         :param env the environment to pass to make
+        :param pass_fds file descriptors that should be inherited by the process (e.g. for the jobserver)
         """
         print_command(args, cwd=cwd, env=env)
         # make sure that env is either None or a os.environ with the updated entries entries
         if env:
-            new_env = os.environ.copy()  # type: typing.Optional[typing.Dict[str, str]]
+            new_env = current_environ()  # type: typing.Optional[typing.Dict[str, str]]
             env = {k: str(v) for k, v in env.items()}  # make sure everything is a string
             new_env.update(env)
         else:
             new_env = None
         assert not logfile_name.startswith("/")
         if self.config.write_logfile:
-            logfile_path = self.build_dir / (logfile_name + ".log")
+            log_compression = self.config.log_compression
+            logfile_path = self.build_dir / (logfile_name + ".log" + log_compression.suffix)
             print("Saving build log to", logfile_path)
         else:
+            log_compression = LogCompression.NONE
             logfile_path = Path(os.devnull)
         if self.config.pretend:
             return
@@ -850,48 +889,65 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         args = list(map(str, args))  # make sure all arguments are strings
 
         if not self.config.write_logfile:
-            if stdout_filter is None:
+            if stdout_filter is None and get_output_prefix():
+                # Building multiple targets concurrently -> pipe stdout and stderr so that we can prefix every line
+                make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           env=new_env, pass_fds=pass_fds)
+                self.__run_process_with_filtered_output(make, None, stdout_filter, args)
+            elif stdout_filter is None:
                 # just run the process connected to the current stdout/stdin
-                check_call_handle_noexec(args, cwd=str(cwd), env=new_env)
+                check_call_handle_noexec(args, cwd=str(cwd), env=new_env, pass_fds=pass_fds)
             else:
-                make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, env=new_env)
+                make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, env=new_env, pass_fds=pass_fds)
                 self.__run_process_with_filtered_output(make, None, stdout_filter, args)
             return
 
         # open file in append mode
-        with logfile_path.open("ab") as logfile:
+        with BuildLogFile(logfile_path, log_compression) as logfile:
             # print the command and then the logfile
             if append_to_logfile:
                 logfile.write(b"\n\n")
             if cwd:
                 logfile.write(("cd " + shlex.quote(str(cwd)) + " && ").encode("utf-8"))
             logfile.write(self.commandline_to_str(args).encode("utf-8") + b"\n\n")
-            if self.config.quiet:
+            if self.config.quiet and not logfile.is_compressed:
+                logfile.file.flush()
                 # a lot more efficient than filtering every line
-                check_call_handle_noexec(args, cwd=str(cwd), stdout=logfile, stderr=logfile, env=new_env)
+                check_call_handle_noexec(args, cwd=str(cwd), stdout=logfile.file, stderr=logfile.file, env=new_env,
+                                         pass_fds=pass_fds)
                 return
-            make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=new_env)
-            self.__run_process_with_filtered_output(make, logfile, stdout_filter, args)
+            make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=new_env,
+                                       pass_fds=pass_fds)
+            self.__run_process_with_filtered_output(make, logfile, stdout_filter, args, quiet=self.config.quiet)
 
-    def __run_process_with_filtered_output(self, proc: subprocess.Popen, logfile: "typing.Optional[typing.IO]",
-                                           stdout_filter: "typing.Callable[[bytes], None]",
-                                           args: "typing.List[str]"):
+    def __run_process_with_filtered_output(self, proc: subprocess.Popen, logfile: "typing.Optional[BuildLogFile]",
+                                           stdout_filter: "typing.Union[LineFilter, typing.Callable[[bytes], None]]",
+                                           args: "typing.List[str]", quiet=False):
         logfile_lock = threading.Lock()  # we need a mutex so the logfile line buffer doesn't get messed up
+        output_prefix = get_output_prefix().encode("utf-8")
         stderr_thread = None
-        if logfile:
+        if proc.stderr is not None:
             # use a thread to print stderr output and write it to logfile (not using a thread would block)
             stderr_thread = threading.Thread(target=self._handle_stderr,
-                                             args=(logfile, proc.stderr, logfile_lock, self))
+                                             args=(logfile, proc.stderr, logfile_lock, self, output_prefix, quiet))
             stderr_thread.start()
-        for line in proc.stdout:
+        filtered_output = None
+        if stdout_filter and not quiet:
+            filtered_output = FilteredOutput(stdout_filter, self._terminal_output, output_prefix)
+        # Read large blocks of complete lines instead of individual lines to reduce the per-line overhead
+        for block in iter_line_blocks(proc.stdout.fileno()):
             with logfile_lock:  # make sure we don't interleave stdout and stderr lines
                 if logfile:
-                    logfile.write(line)
-                if stdout_filter:
-                    stdout_filter(line)
+                    logfile.write(block)
+                if quiet:
+                    continue
+                if filtered_output is not None:
+                    filtered_output.feed(block)
                 else:
-                    sys.stdout.buffer.write(line)
-                    flush_stdio(sys.stdout)
+                    self._terminal_output.write_block(block, output_prefix)
+        if filtered_output is not None:
+            with logfile_lock:
+                filtered_output.finish()
         retcode = proc.wait()
         if stderr_thread:
             stderr_thread.join()
@@ -907,9 +963,6 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
             sys.stdout.buffer.write(remaining_out)
             if logfile:
                 logfile.write(remaining_err)
-        if stdout_filter and self._last_stdout_line_can_be_overwritten:
-            # add the final new line after the filtering
-            sys.stdout.buffer.write(b"\n")
         if retcode:
             message = ("See " + logfile.name + " for details.").encode("utf-8") if logfile else None
             raise subprocess.CalledProcessError(retcode, args, None, stderr=message)
@@ -932,6 +985,44 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
             self.warning("Failed to detect file type for", file, e)
         return False
 
+    def strip_elf_files_in_parallel(self, files: "typing.Iterable[Path]", batch_size=64) -> None:
+        """
+        Run llvm-strip on all ELF files in files that still contain a symbol table or debug info. The files are
+        stripped in place using batched llvm-strip invocations that run in parallel.
+        """
+        def check_file(file: Path):
+            try:
+                st = file.stat()
+                if stat.S_ISREG(st.st_mode) and _elf_file_needs_stripping(str(file)):
+                    return file, st
+            except IOError as e:
+                self.warning("Failed to detect file type for", file, e)
+            return None
+
+        to_strip = []
+        seen_inodes = set()
+        with ThreadPoolExecutor(max_workers=self.config.make_jobs) as executor:
+            for result in executor.map(check_file, files):
+                if result is None or (result[1].st_dev, result[1].st_ino) in seen_inodes:
+                    continue  # Not an unstripped ELF file or already handled via a different hardlink/symlink
+                seen_inodes.add((result[1].st_dev, result[1].st_ino))
+                if self.should_strip_elf_file_for_tarball(result[0]):
+                    to_strip.append(result)
+            if not to_strip:
+                self.info("No unstripped ELF files found")
+                return
+            self.info("Stripping", len(to_strip), "ELF files using", self.target_info.strip_tool)
+            batches = [to_strip[i:i + batch_size] for i in range(0, len(to_strip), batch_size)]
+            # The work is done in the llvm-strip processes, so threads are sufficient to use all cores.
+            list(executor.map(lambda batch: run_command([self.target_info.strip_tool] + [f for f, _ in batch],
+                                                        print_verbose_only=True), batches))
+        if self.config.pretend:
+            return
+        size_before = sum(st.st_size for _, st in to_strip)
+        size_after = sum(f.stat().st_size for f, _ in to_strip)
+        self.info("Stripping", len(to_strip), "ELF files saved {:.1f} MiB ({:.1f} MiB -> {:.1f} MiB)".format(
+            (size_before - size_after) / (1024 * 1024), size_before / (1024 * 1024), size_after / (1024 * 1024)))
+
     def should_strip_elf_file_for_tarball(self, f: Path):
         if f.suffix == ".o":
             # We musn't strip crt1.o, etc. sice if we do the linker can't find essential symbols such as __start
@@ -996,6 +1087,10 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
     def process(self):
         raise NotImplementedError()
 
+    def prefetch_sources(self) -> None:
+        """Download upstream changes without updating the working tree. Called concurrently for all targets."""
+        pass
+
     def run_tests(self):
         # for the --test option
         status_update("No tests defined for target", self.target)
@@ -1298,6 +1393,9 @@ class SourceRepository(object):
     def get_real_source_dir(self, caller: SimpleProject, base_project_source_dir: Path) -> Path:
         return base_project_source_dir
 
+    def prefetch(self, current_project: "Project", *, src_dir: Path) -> None:
+        pass
+
 
 class ExternallyManagedSourceRepository(SourceRepository):
     def ensure_cloned(self, current_project: "Project", src_dir: Path, **kwargs):
@@ -1358,6 +1456,10 @@ _PRETEND_RUN_GIT_COMMANDS = os.getenv("_TEST_SKIP_GIT_COMMANDS") is None
 
 
 class GitRepository(SourceRepository):
+    # Source directories for which "git fetch" has already been run by prefetch()
+    _prefetched_source_dirs = set()  # type: typing.Set[Path]
+    _prefetched_source_dirs_lock = threading.Lock()
+
     def __init__(self, url, *, old_urls: typing.List[bytes] = None, default_branch: str = None,
                  force_branch: bool = False,
                  per_target_branches: typing.Dict[CrossCompileTarget, TargetBranchInfo] = None):
@@ -1480,6 +1582,30 @@ class GitRepository(SourceRepository):
                          "worktree-fallback-" + target_override.branch, src_dir,
                          matching_remote + "/" + target_override.branch], print_verbose_only=False)
 
+    def prefetch(self, current_project: "Project", *, src_dir: Path) -> None:
+        if not (src_dir / ".git").exists():
+            return  # will be cloned later
+        if self.old_urls:
+            # Don't fetch from a repository that has moved, update() will fix the URL and fetch afterwards.
+            try:
+                remote_url = run_command(["git", "ls-remote", "--get-url"], cwd=src_dir, capture_output=True,
+                                         print_verbose_only=True).stdout.strip()
+            except subprocess.CalledProcessError:
+                return
+            if remote_url in self.old_urls:
+                return
+        with self._prefetched_source_dirs_lock:
+            if src_dir in self._prefetched_source_dirs:
+                return
+            self._prefetched_source_dirs.add(src_dir)
+        try:
+            # Capture the output since multiple repositories are fetched concurrently
+            run_command(["git", "fetch"], cwd=src_dir, capture_output=True, capture_error=True)
+        except subprocess.CalledProcessError as e:
+            current_project.warning("Failed to fetch upstream changes for", src_dir, "(will retry later):", e)
+            with self._prefetched_source_dirs_lock:
+                self._prefetched_source_dirs.discard(src_dir)
+
     def get_real_source_dir(self, caller: SimpleProject, base_project_source_dir: Path) -> Path:
         target_override = self.per_target_branches.get(caller.crosscompile_target, None)
         if target_override is None:
@@ -1521,11 +1647,17 @@ class GitRepository(SourceRepository):
                     if current_project.query_yes_no("Update to correct URL?"):
                         run_command("git", "remote", "set-url", remote_name, self.url,
                                     run_in_pretend_mode=_PRETEND_RUN_GIT_COMMANDS, cwd=src_dir)
+                        # The prefetch (if any) used the old URL, so we have to fetch again.
+                        with self._prefetched_source_dirs_lock:
+                            self._prefetched_source_dirs.discard(src_dir)
 
         # First fetch all the current upstream branch to see if we need to autostash/pull.
         # Note: "git fetch" without other arguments will fetch from the currently configured upstream.
         # If there is no upstream, it will just return immediately.
-        run_command(["git", "fetch"], cwd=src_dir)
+        with self._prefetched_source_dirs_lock:
+            already_fetched = src_dir in self._prefetched_source_dirs
+        if not already_fetched:
+            run_command(["git", "fetch"], cwd=src_dir)
 
         if revision is not None:
             # TODO: do some rev-parse stuff to check if we are on the right revision?
@@ -1604,10 +1736,15 @@ class GitRepository(SourceRepository):
                     # print("NO REAL CHANGES")
                     has_changes = False  # probably git diff showed something from a submodule
 
-        if not skip_submodules:
-            pull_cmd.append("--recurse-submodules")
-        rebase_flag = "--rebase=merges" if git_version >= (2, 18) else "--rebase=preserve"
-        run_command(pull_cmd + [rebase_flag], cwd=src_dir, print_verbose_only=True)
+        if already_fetched and has_autostash and git_version >= (2, 18):
+            # We already fetched the latest changes -> rebase onto them instead of fetching again using git pull
+            # Note: "git rebase" without an upstream argument uses --fork-point, so this matches "git pull --rebase".
+            run_command("git", "rebase", "--autostash", "--rebase-merges", cwd=src_dir, print_verbose_only=True)
+        else:
+            if not skip_submodules:
+                pull_cmd.append("--recurse-submodules")
+            rebase_flag = "--rebase=merges" if git_version >= (2, 18) else "--rebase=preserve"
+            run_command(pull_cmd + [rebase_flag], cwd=src_dir, print_verbose_only=True)
         if not skip_submodules:
             run_command("git", "submodule", "update", "--init", "--recursive", cwd=src_dir, print_verbose_only=True)
         if has_changes and not has_autostash:
@@ -2065,7 +2202,6 @@ class Project(SimpleProject):
         # non-assignable variables:
         self.configure_args = []  # type: typing.List[str]
         self.configure_environment = {}  # type: typing.Dict[str,str]
-        self._last_stdout_line_can_be_overwritten = False
         self.make_args = MakeOptions(self.make_kind, self)
         self._compiledb_tool = None  # type: typing.Optional[str]
         if self.config.create_compilation_db and self.compile_db_requires_bear:
@@ -2255,7 +2391,8 @@ class Project(SimpleProject):
         self.__dict__[name] = value
 
     def _get_make_commandline(self, make_target: "typing.Union[str, typing.List[str]]", make_command,
-                              options: MakeOptions, parallel: bool = True, compilation_db_name: str = None):
+                              options: MakeOptions, parallel: bool = True, compilation_db_name: str = None,
+                              j_flag: str = None):
         assert options is not None
         assert make_command is not None
         options = options.copy()
@@ -2281,7 +2418,7 @@ class Project(SimpleProject):
             else:
                 all_args.extend(make_target)
         if parallel and options.can_pass_jflag:
-            all_args.append(self.config.make_j_flag)
+            all_args.append(j_flag if j_flag is not None else self.config.make_j_flag)
         if not self.config.make_without_nice:
             all_args = ["nice"] + all_args
         if self.config.debug_output and options.kind == MakeCommandKind.Ninja:
@@ -2310,8 +2447,43 @@ class Project(SimpleProject):
             options = self.make_args
         if not make_command:
             make_command = self.make_args.command
+        if parallel and options.can_pass_jflag and self.config.jobserver is not None:
+            makeflags = self._jobserver_makeflags(options)
+            if makeflags is None:
+                # The tool does not support the jobserver protocol -> reserve a fixed number of job slots instead.
+                with self.config.jobserver.reserved_job_slots(self.config.make_jobs_per_target) as jobs:
+                    self._run_make_impl(make_target, make_command, options, logfile_name, cwd, append_to_logfile,
+                                        compilation_db_name, parallel, stdout_filter, j_flag="-j" + str(jobs))
+            else:
+                # Don't pass a -j flag, the number of jobs is limited by the jobserver instead
+                options = options.copy()
+                options.set_env(MAKEFLAGS=(makeflags + " " + options.env_vars.get("MAKEFLAGS", "")).strip())
+                with self.config.jobserver.implicit_job_slot():
+                    self._run_make_impl(make_target, make_command, options, logfile_name, cwd, append_to_logfile,
+                                        compilation_db_name, parallel=False, stdout_filter=stdout_filter,
+                                        pass_fds=self.config.jobserver.pass_fds)
+        else:
+            self._run_make_impl(make_target, make_command, options, logfile_name, cwd, append_to_logfile,
+                                compilation_db_name, parallel, stdout_filter)
+
+    def _jobserver_makeflags(self, options: MakeOptions) -> "typing.Optional[str]":
+        """:return: the $MAKEFLAGS value to use the jobserver or None if the tool does not support it"""
+        if options.kind == MakeCommandKind.GnuMake or (
+                options.kind == MakeCommandKind.DefaultMake and not OSInfo.IS_FREEBSD):
+            return self.config.jobserver.makeflags()
+        if options.kind == MakeCommandKind.Ninja:
+            # Ninja supports the jobserver protocol (but only using a named pipe) since version 1.13
+            ninja_path = shutil.which(options.command)
+            if ninja_path and get_program_version(Path(ninja_path), regex=b"(\\d+)\\.(\\d+)\\.(\\d+)",
+                                                  config=self.config) >= (1, 13, 0):
+                return self.config.jobserver.makeflags(use_fifo=True)
+        return None
+
+    def _run_make_impl(self, make_target, make_command: str, options: MakeOptions, logfile_name: str, cwd: Path,
+                       append_to_logfile: bool, compilation_db_name: str, parallel: bool, stdout_filter,
+                       j_flag: str = None, pass_fds: "typing.Sequence[int]" = ()) -> None:
         all_args = self._get_make_commandline(make_target, make_command, options, parallel=parallel,
-                                              compilation_db_name=compilation_db_name)
+                                              compilation_db_name=compilation_db_name, j_flag=j_flag)
         if not cwd:
             cwd = self.build_dir
         if not logfile_name:
@@ -2329,13 +2501,17 @@ class Project(SimpleProject):
             stdout_filter = self._stdout_filter
         env = options.env_vars
         self.run_with_logfile(all_args, logfile_name=logfile_name, stdout_filter=stdout_filter, cwd=cwd, env=env,
-                              append_to_logfile=append_to_logfile)
+                              append_to_logfile=append_to_logfile, pass_fds=pass_fds)
         # if we create a compilation db, copy it to the source dir:
         if self.config.copy_compilation_db_to_source_dir and (self.build_dir / compilation_db_name).exists():
             self.install_file(self.build_dir / compilation_db_name, self.source_dir / compilation_db_name, force=True)
         # add a newline at the end in case it ended with a filtered line (no final newline)
         print("Running", make_command, make_target, "took", time.time() - starttime, "seconds")
 
+    def prefetch_sources(self) -> None:
+        if self.repository and not self.skip_update:
+            self.repository.prefetch(self, src_dir=self.source_dir)
+
     def update(self):
         if not self.repository and not self.skip_update:
             self.fatal("Cannot update", self.project_name, "as it is missing a repository source",
@@ -2512,14 +2688,16 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
         """
         self.info("Stripping all ELF files in", benchmark_dir)
         self.run_cmd("du", "-sh", benchmark_dir)
+        files = []
         for root, dirnames, filenames in os.walk(str(benchmark_dir)):
             for filename in filenames:
                 file = Path(root, filename)
                 if file.suffix == ".dump":
                     # TODO: make this an error since we should have deleted them
                     self.warning("Will copy a .dump file to the FPGA:", file)
-                # Try to reduce the amount of copied data
-                self.maybe_strip_elf_file(file)
+                files.append(file)
+        # Try to reduce the amount of copied data
+        self.strip_elf_files_in_parallel(files)
         self.run_cmd("du", "-sh", benchmark_dir)
 
     # @cached_property is important to only compute it once since we encode seconds in the file name:
@@ -2560,6 +2738,109 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
     def _last_clean_counter_path(self):
         return Path(self.build_dir, ".cheribuild_last_clean_counter")
 
+    def _fingerprint_path(self):
+        return Path(self.build_dir, ".cheribuild_fingerprint")
+
+    # Global options that don't affect the build output and should therefore not invalidate the fingerprint. New
+    # options should pass affects_build_output=False when they are declared instead of being added here.
+    _fingerprint_ignored_global_options = (
+        "quiet", "verbose", "clean", "force", "logfile", "skip-update", "force-update", "confirm-clone",
+        "skip-configure", "reconfigure", "make-without-nice", "make-jobs", "pretend", "action", "print-targets-only",
+        "pass-k-to-make", "debug-output", "clang-colour-diags", "configure-only", "skip-install", "skip-build",
+        "include-dependencies", "include-toolchain-dependencies", "get-config-option", "dump-configuration",
+        "compilation-db-in-source-dir")
+    _fingerprint_ignored_global_option_prefixes = ("test-", "benchmark-", "docker", "qemu-gdb-", "gdb-", "run-",
+                                                   "debugger-", "wait-for-debugger", "interact-after-tests")
+
+    def _git_source_fingerprint(self) -> "typing.Optional[str]":
+        """:return: a hash of the git HEAD and all uncommitted changes or None if the source dir is not a git repo"""
+        if not (self.source_dir / ".git").exists():
+            return None
+
+        def git_output(*args) -> bytes:
+            return run_command(["git"] + list(args), cwd=self.source_dir, capture_output=True,
+                               print_verbose_only=True, run_in_pretend_mode=True).stdout
+
+        h = hashlib.sha256()
+        h.update(git_output("rev-parse", "HEAD"))
+        status = git_output("status", "--porcelain", "-z", "--untracked-files=normal", "--ignore-submodules=none")
+        h.update(status)
+        if status:
+            h.update(git_output("diff", "HEAD", "--binary", "--no-ext-diff"))
+            # Include size and modification time of untracked files since their contents are not part of the diff
+            for entry in status.split(b"\0"):
+                if entry.startswith(b"?? "):
+                    path = self.source_dir / os.fsdecode(entry[3:])
+                    if path.is_file():
+                        st = path.stat()
+                        h.update(entry + str((st.st_size, st.st_mtime_ns)).encode("utf-8"))
+        if (self.source_dir / ".gitmodules").exists():
+            h.update(git_output("submodule", "status", "--recursive"))
+        return h.hexdigest()
+
+    def _fingerprint_config_options(self) -> "typing.Dict[str, str]":
+        result = OrderedDict()  # type: typing.Dict[str, str]
+        # noinspection PyProtectedMember
+        for option in sorted(self.config.loader.options.values(), key=lambda o: o.full_option_name):
+            name = option.full_option_name
+            # noinspection PyProtectedMember
+            if option._owning_class is not None or not option.affects_build_output or \
+                    name in self._fingerprint_ignored_global_options or \
+                    name.startswith(self._fingerprint_ignored_global_option_prefixes):
+                continue
+            result[name] = repr(option.__get__(self.config, self.config.__class__))
+        # Now add all options of this project (including inherited ones such as build-type)
+        for cls in reversed(self.__class__.__mro__):
+            for attr_name, option in cls.__dict__.items():
+                if isinstance(option, ConfigOptionBase):
+                    result[option.full_option_name] = repr(getattr(self, attr_name))
+        return result
+
+    def compute_input_fingerprint(self) -> "typing.Optional[str]":
+        """
+        Compute a hash of all inputs that affect the build output: the source tree (git HEAD and any uncommitted
+        changes), all relevant configuration options, the compiler version and the fingerprints of all dependencies.
+        :return: the fingerprint or None if it cannot be computed (e.g. if the sources are not a git repository)
+        """
+        inputs = OrderedDict()  # type: typing.Dict[str, str]
+        source_fingerprint = self._git_source_fingerprint()
+        if source_fingerprint is None:
+            return None
+        inputs["source"] = source_fingerprint
+        inputs["source_dir"] = str(self.source_dir)
+        # Changes to the build logic (e.g. different configure flags) should also trigger a rebuild
+        inputs["cheribuild"] = _cheribuild_source_fingerprint()
+        inputs["options"] = repr(list(self._fingerprint_config_options().items()))
+        if self.CC and self.CC.exists():
+            cc_info = self.get_compiler_info(self.CC)
+            cc_stat = self.CC.stat()
+            inputs["compiler"] = repr((str(self.CC), cc_info.compiler, cc_info.version, cc_stat.st_size,
+                                       cc_stat.st_mtime_ns))
+        # noinspection PyProtectedMember
+        for dep in self._recursive_dependencies_impl(self.config, include_dependencies=True,
+                                                     include_toolchain_dependencies=True,
+                                                     include_sdk_dependencies=True):
+            dep_project = dep.get_or_create_project(None, self.config)
+            if isinstance(dep_project, Project):
+                # The fingerprint file is deleted whenever a target is rebuilt, so if the dependency was rebuilt
+                # without --skip-unchanged-targets we don't know whether it changed and have to rebuild.
+                dep_fingerprint_path = dep_project._fingerprint_path()
+                if not dep_fingerprint_path.is_file():
+                    self.verbose_print("Cannot compute fingerprint for", self.target, "since dependency", dep.name,
+                                       "has no fingerprint")
+                    return None
+                inputs["dep:" + dep.name] = dep_fingerprint_path.read_text().strip()
+        self.verbose_print("Fingerprint inputs for", self.target, inputs)
+        return hashlib.sha256(repr(list(inputs.items())).encode("utf-8")).hexdigest()
+
+    def _is_up_to_date(self, fingerprint: "typing.Optional[str]") -> bool:
+        if fingerprint is None or not self._fingerprint_path().is_file():
+            return False
+        if self.config.clean or self._force_clean or self.config.configure_only or self.config.skip_build or \
+                self.config.skip_install:
+            return False
+        return self._fingerprint_path().read_text().strip() == fingerprint
+
     def _parse_require_clean_build_counter(self) -> typing.Optional[int]:
         require_clean_path = Path(self.source_dir, ".require_clean_build")
         if not require_clean_path.exists():
@@ -2644,14 +2925,15 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                     other_instance.target + " reuses the same install prefix! This will cause conflicts: " + str(
                         other_instance.install_dir)
 
-        if self.skip_update:
-            # When --skip-update is set (or we don't have working internet) only check that the repository exists
-            if self.repository:
-                self.repository.ensure_cloned(self, src_dir=self.source_dir,
-                                              base_project_source_dir=self._initial_source_dir,
-                                              skip_submodules=self.skip_git_submodules)
-        else:
-            self.update()
+        with timed_phase("update"):
+            if self.skip_update:
+                # When --skip-update is set (or we don't have working internet) only check that the repository exists
+                if self.repository:
+                    self.repository.ensure_cloned(self, src_dir=self.source_dir,
+                                                  base_project_source_dir=self._initial_source_dir,
+                                                  skip_submodules=self.skip_git_submodules)
+            else:
+                self.update()
         if not self._system_deps_checked:
             self.check_system_dependencies()
         assert self._system_deps_checked, "self._system_deps_checked must be set by now!"
@@ -2695,8 +2977,19 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                     self.warning("Could not parse", last_clean_counter_path, "-> assuming clean build is required.", e)
                     self._force_clean = True
 
+        fingerprint = None  # type: typing.Optional[str]
+        if self.config.skip_unchanged_targets:
+            fingerprint = self.compute_input_fingerprint()
+            if self._is_up_to_date(fingerprint):
+                status_update(self.display_name, "is up to date (inputs unchanged since the last successful build).")
+                return
+        # Delete the fingerprint from the last build since it will no longer be valid once we start building
+        if self._fingerprint_path().exists():
+            self.delete_file(self._fingerprint_path(), print_verbose_only=True)
+
         # run the rm -rf <build dir> in the background
-        cleaning_task = self.clean() if (self._force_clean or self.config.clean) else ThreadJoiner(None)
+        with timed_phase("clean"):
+            cleaning_task = self.clean() if (self._force_clean or self.config.clean) else ThreadJoiner(None)
         if cleaning_task is None:
             cleaning_task = ThreadJoiner(None)
         assert isinstance(cleaning_task, ThreadJoiner), ""
@@ -2731,7 +3024,8 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
             if not self.config.skip_configure or self.config.configure_only:
                 if self.should_run_configure():
                     status_update("Configuring", self.display_name, "... ")
-                    self.configure()
+                    with timed_phase("configure"):
+                        self.configure()
             if self.config.configure_only:
                 return
 
@@ -2743,7 +3037,8 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                                    force=True)
                     # move any csetbounds stats from configuration (since they are not useful)
                 status_update("Building", self.display_name, "... ")
-                self.compile()
+                with timed_phase("compile"):
+                    self.compile()
 
             # Install step
             if not self.config.skip_install:
@@ -2751,9 +3046,13 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                 if install_dir_kind == DefaultInstallDir.DO_NOT_INSTALL:
                     self.info("Not installing", self.target, "since install dir is set to DO_NOT_INSTALL")
                 else:
-                    self.install()
+                    with timed_phase("install"):
+                        self.install()
                 if is_jenkins_build():
                     self.prepare_install_dir_for_archiving()
+                if fingerprint is not None and not self.config.skip_build and not self.config.skip_install and \
+                        not self.config.pretend:
+                    self.write_file(self._fingerprint_path(), fingerprint, overwrite=True, never_print_cmd=True)
 
 
 class CMakeProject(Project):
@@ -2868,11 +3167,8 @@ class CMakeProject(Project):
     def set_minimum_cmake_version(self, major: int, minor: int, patch: int = 0):
         self.__minimum_cmake_version = (major, minor, patch)
 
-    def _cmake_install_stdout_filter(self, line: bytes):
-        # don't show the up-to date install lines
-        if line.startswith(b"-- Up-to-date:"):
-            return
-        self._show_line_stdout_filter(line)
+    # don't show the up-to date install lines
+    _cmake_install_stdout_filter = LineFilter(default=LineFilter.SHOW, ignored_prefixes=(b"-- Up-to-date:",))
 
     def set_lto_binutils(self, ar, ranlib, nm, ld):
         # LD is never invoked directly, so the -fuse-ld= flag is sufficient
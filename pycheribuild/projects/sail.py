@@ -37,7 +37,7 @@ from typing import Any, Dict, Tuple, Union
 
 from .project import (AutotoolsProject, CheriConfig, DefaultInstallDir, GitRepository, MakeCommandKind, Project,
                       SimpleProject)
-from ..processutils import get_program_version
+from ..processutils import get_program_version, getenv
 from ..targets import target_manager
 from ..utils import AnsiColour, coloured, OSInfo, ThreadJoiner
 
@@ -304,7 +304,7 @@ class RunSailShell(OpamMixin, SimpleProject):
         self.info("Starting sail shell (using {})... ".format(shell))
         import subprocess
         try:
-            with self.set_env(PATH=str(self.config.cheri_sdk_bindir) + ":" + os.getenv("PATH", ""),
+            with self.set_env(PATH=str(self.config.cheri_sdk_bindir) + ":" + getenv("PATH", ""),
                               PS1="SAIL ENV:\\w> "):
                 self.run_cmd("which", "sail")
                 self.run_command_in_ocaml_env([shell, "--verbose", "--norc", "-i"], cwd=os.getcwd())
@@ -439,7 +439,7 @@ class BuildSailFromSource(OcamlProject):
         ottdir = BuildOtt.get_source_dir(self)
         linksemdir = BuildLinksem.get_source_dir(self)
         with self.set_env(LEMLIB=lemdir / "library",
-                          PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + os.environ["PATH"],
+                          PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + getenv("PATH", ""),
                           OCAMLPATH="{}:{}".format(lemdir / "ocaml-lib/local", linksemdir / "src/local")):
             super().process()
 
@@ -481,6 +481,6 @@ class BuildLinksem(OcamlProject):
         ottdir = BuildOtt.get_source_dir(self)
         # linksemdir = BuildLinkSem.get_source_dir(self)
         with self.set_env(LEMLIB=lemdir / "library",
-                          PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + os.environ["PATH"],
+                          PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + getenv("PATH", ""),
                           OCAMLPATH=lemdir / "ocaml-lib/local"):
             super().process()
@@ -33,6 +33,7 @@ import shutil
 from pathlib import Path
 
 from .project import CheriConfig, DefaultInstallDir, GitRepository, MakeCommandKind, Project
+from ..processutils import getenv
 from ..utils import OSInfo
 
 SMB_OUT_OF_SOURCE_BUILD_WORKS = False
@@ -121,9 +122,9 @@ class BuildSamba(Project):
             homebrew_dirs = ["/usr/local/opt/" + x for x in homebrew_keg_only_packages]
             with self.set_env(PATH=':'.join([x + "/bin" for x in homebrew_dirs]) + ':' +
                                    ':'.join([x + "/sbin" for x in homebrew_dirs]) + ':' +
-                                   os.getenv("PATH", ""),
+                                   getenv("PATH", ""),
                               PKG_CONFIG_PATH=':'.join([x + "/lib/pkgconfig" for x in homebrew_dirs]) + ':' +
-                                              os.getenv("PKG_CONFIG_PATH", ""),
+                                              getenv("PKG_CONFIG_PATH", ""),
                               LDFLAGS=' '.join(["-L" + x + "/lib" for x in homebrew_dirs]),
                               CPPFLAGS=' '.join(["-I" + x + "/include" for x in homebrew_dirs]),
                               CFLAGS=' '.join(["-I" + x + "/include" for x in homebrew_dirs])):
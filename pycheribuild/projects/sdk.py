@@ -34,6 +34,7 @@ import subprocess
 from .cross.cheribsd import BuildCHERIBSD
 from .project import (CheriConfig, CMakeProject, DefaultInstallDir, GitRepository, SimpleProject,
                       TargetAliasWithDependencies)
+from ..processutils import getenv
 from ..targets import target_manager
 from ..utils import classproperty, include_local_file, OSInfo
 
@@ -114,7 +115,7 @@ class StartCheriSDKShell(SimpleProject):
     target = "sdk-shell"
 
     def process(self):
-        new_man_path = str(self.config.cheri_sdk_dir / "share/man") + ":" + os.getenv("MANPATH", "") + ":"
+        new_man_path = str(self.config.cheri_sdk_dir / "share/man") + ":" + getenv("MANPATH", "") + ":"
         new_path = str(self.config.cheri_sdk_bindir) + ":" + str(self.config.dollar_path_with_other_tools)
         shell = os.getenv("SHELL", "/bin/sh")
         with self.set_env(MANPATH=new_man_path, PATH=new_path):
@@ -68,14 +68,14 @@ class QemuOptions:
         else:
             raise ValueError("Unknown target " + str(xtarget))
 
-    def disk_image_args(self, image) -> list:
+    def disk_image_args(self, image, image_format="raw") -> list:
         if self.virtio_disk:
             # RISC-V doesn't support virtio-blk-pci, we have to use virtio-blk-device
             device_kind = "virtio-blk-device" if self.xtarget.is_riscv(include_purecap=True) else "virtio-blk-pci"
-            return ["-drive", "if=none,file=" + str(image) + ",id=drv,format=raw",
+            return ["-drive", "if=none,file=" + str(image) + ",id=drv,format=" + image_format,
                     "-device", device_kind + ",drive=drv"]
         else:
-            return ["-drive", "file=" + str(image) + ",format=raw,index=0,media=disk"]
+            return ["-drive", "file=" + str(image) + ",format=" + image_format + ",index=0,media=disk"]
 
     def can_use_virtio_network(self):
         # We'd like to use virtio everwhere, but FreeBSD doesn't like it on BE mips.
@@ -114,7 +114,7 @@ class QemuOptions:
     def get_commandline(self, *, qemu_command=None, kernel_file: Path = None, disk_image: Path = None,
                         user_network_args: str = "", add_network_device=True, bios_args: "typing.List[str]" = None,
                         trap_on_unrepresentable=False, debugger_on_cheri_trap=False, add_virtio_rng=False,
-                        gui_options: "typing.List[str]" = None) -> "typing.List[str]":
+                        gui_options: "typing.List[str]" = None, disk_image_format="raw") -> "typing.List[str]":
         if qemu_command is None:
             qemu_command = self.get_qemu_binary()
         result = [str(qemu_command)]
@@ -135,7 +135,7 @@ class QemuOptions:
             result.append("-kernel")
             result.append(str(kernel_file))
         if disk_image:
-            result.extend(self.disk_image_args(disk_image))
+            result.extend(self.disk_image_args(disk_image, disk_image_format))
         if add_network_device:
             result.extend(self.user_network_args(user_network_args))
         if add_virtio_rng:
@@ -0,0 +1,187 @@
+#
+# Copyright (c) 2020 Alex Richardson
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory (Department of Computer Science and
+# Technology) under DARPA contract HR0011-18-C-0016 ("ECATS"), as part of the
+# DARPA SSITH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import bisect
+import hashlib
+import json
+import os
+import sys
+import typing
+from pathlib import Path
+
+from .config.loader import CommandLineConfigOption, ConfigLoaderBase
+
+if typing.TYPE_CHECKING:  # no-combine
+    from .targets import TargetManager  # no-combine
+
+# Registering the options requires all target-specific options to be known (e.g. for --help or when dumping the
+# full configuration).
+_OPTIONS_REQUIRING_ALL_TARGETS = ("--help", "--help-all", "--help-hidden", "--dump-configuration",
+                                  "--get-config-option")
+
+
+class TargetIndex(object):
+    """
+    A cache of the config options that are added by each target's setup_config_options(). Registering all options
+    takes much longer than importing all projects, so with a valid index cheribuild only registers the options for
+    the targets that are mentioned on the command line and the ones that are used later on (see
+    TargetManager.register_command_line_options()).
+    """
+    VERSION = 1
+
+    def __init__(self, fingerprint: str, target_options: "typing.Dict[str, typing.List[str]]",
+                 argument_owners: "typing.Dict[str, str]", config_file_keys: "typing.List[str]"):
+        self.fingerprint = fingerprint
+        # Maps target name -> names of the options added by that target
+        self.target_options = target_options
+        # Maps command line spellings (including --foo/no-bar and short names) -> target name
+        self.argument_owners = argument_owners
+        # All valid keys for target-specific options in the JSON config file
+        self.config_file_keys = frozenset(config_file_keys)
+        self._sorted_arguments = None  # type: typing.Optional[typing.List[str]]
+        self.option_owners = dict()  # type: typing.Dict[str, str]
+        for target_name, option_names in target_options.items():
+            for name in option_names:
+                self.option_owners[name] = target_name
+
+    @staticmethod
+    def default_path() -> Path:
+        cache_dir = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return Path(cache_dir, "cheribuild", "target-index.json")
+
+    @staticmethod
+    def source_fingerprint() -> str:
+        """Changes whenever any of the pycheribuild sources (and therefore possibly the options) change."""
+        h = hashlib.sha256()
+        h.update(repr((TargetIndex.VERSION, sys.version, sys.platform)).encode("utf-8"))
+        source_dir = Path(__file__).parent
+        for root, dirs, files in os.walk(str(source_dir)):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for f in sorted(files):
+                if f.endswith(".py"):
+                    st = os.stat(os.path.join(root, f))
+                    h.update(repr((os.path.join(root, f), st.st_size, st.st_mtime_ns)).encode("utf-8"))
+        return h.hexdigest()
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: str) -> "typing.Optional[TargetIndex]":
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("version") != cls.VERSION or data.get("fingerprint") != fingerprint:
+            return None  # stale
+        return cls(fingerprint, data["target_options"], data["argument_owners"], data["config_file_keys"])
+
+    def save(self, path: Path) -> None:
+        data = {"version": self.VERSION, "fingerprint": self.fingerprint, "target_options": self.target_options,
+                "argument_owners": self.argument_owners, "config_file_keys": sorted(self.config_file_keys)}
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + "." + str(os.getpid()) + ".tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(str(tmp), str(path))
+        except OSError:
+            pass  # The index is only an optimization (e.g. the cache directory might be read-only)
+
+    @classmethod
+    def from_registered_options(cls, manager: "TargetManager", loader: ConfigLoaderBase,
+                                fingerprint: str) -> "TargetIndex":
+        """Create the index after all options have been registered using register_command_line_options()."""
+        # noinspection PyProtectedMember
+        target_for_class = manager._targets_by_project_class()
+        target_options = dict((t.name, []) for t in target_for_class.values())  # type: typing.Dict[str, list]
+        argument_owners = dict()  # type: typing.Dict[str, str]
+        config_file_keys = []  # type: typing.List[str]
+        for name, option in loader.options.items():
+            # noinspection PyProtectedMember
+            target = target_for_class.get(option._owning_class) if option._owning_class else None
+            if target is None:
+                continue  # global option (always registered)
+            target_options[target.name].append(name)
+            config_file_keys.append(name)
+            config_file_keys.extend(option.alias_names or [])
+            if option.shortname and len(option.shortname) > 1:
+                config_file_keys.append(option.shortname.lstrip("-"))
+            if isinstance(option, CommandLineConfigOption):
+                spellings = list(option.action.option_strings)
+                if option.value_type == bool:
+                    slash_index = name.rfind("/")
+                    spellings.append("--" + name[:slash_index + 1] + "no-" + name[slash_index + 1:])
+                for spelling in spellings:
+                    argument_owners[spelling] = target.name
+        return cls(fingerprint, target_options, argument_owners, config_file_keys)
+
+    def _arguments_starting_with(self, prefix: str) -> "typing.Iterator[str]":
+        if self._sorted_arguments is None:
+            self._sorted_arguments = sorted(self.argument_owners.keys())
+        i = bisect.bisect_left(self._sorted_arguments, prefix)
+        while i < len(self._sorted_arguments) and self._sorted_arguments[i].startswith(prefix):
+            yield self._sorted_arguments[i]
+            i += 1
+
+    def owning_target(self, option_name: str) -> "typing.Optional[str]":
+        return self.option_owners.get(option_name)
+
+    def targets_for_arguments(self, args: "typing.Iterable[str]") -> "typing.Set[str]":
+        """Returns the targets whose options must be registered before parsing args."""
+        result = set()
+        for arg in args:
+            if arg == "--":
+                break
+            if not arg.startswith("-"):
+                continue
+            spelling = arg.split("=", 1)[0]
+            owner = self.argument_owners.get(spelling)
+            if owner is not None:
+                result.add(owner)
+            elif spelling.startswith("--") and len(spelling) > 2:
+                # argparse accepts unique prefixes of long options, so register all targets that it could match
+                matches = set(self.argument_owners[s] for s in self._arguments_starting_with(spelling))
+                target_name = spelling[2:].partition("/")[0]
+                if not matches and target_name in self.target_options:
+                    matches.add(target_name)  # unknown option: register the target to suggest similar names
+                result.update(matches)
+        return result
+
+    @staticmethod
+    def requires_all_targets(args: "typing.Iterable[str]") -> bool:
+        for arg in args:
+            if arg == "__run_everything__":
+                return True
+            if arg == "--":
+                break
+            if arg.startswith("-") and not arg.startswith("--") and "h" in arg:
+                return True  # -h (possibly combined with other short options)
+            spelling = arg.split("=", 1)[0]
+            if len(spelling) > 2 and any(o.startswith(spelling) for o in _OPTIONS_REQUIRING_ALL_TARGETS):
+                return True
+        return False
@@ -27,22 +27,34 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import concurrent.futures
 import os
 import sys
+import threading
 import time
 import typing
 from collections import OrderedDict
 
+from .build_timing import (report_build_timings, start_recording_build_timings, stop_recording_build_timings,
+                           timed_phase)
 from .config.chericonfig import CheriConfig
 from .config.target_info import CrossCompileTarget
-from .utils import AnsiColour, coloured, fatal_error, status_update, warning_message
+from .dependency_graph import DependencyGraph, sort_in_dependency_order
+from .jobserver import JobServer
+from .processutils import set_env
+from .utils import (AnsiColour, coloured, error_message, fatal_error, set_output_prefix, status_update,
+                    warning_message)
 
 if typing.TYPE_CHECKING:  # no-combine
     from .projects.project import SimpleProject  # no-combine
+    from .target_index import TargetIndex  # no-combine
 
 
 class Target(object):
     instantiating_targets_should_warn = True
+    # Projects can be instantiated lazily from worker threads when building with --parallel-targets.
+    # Note: this must be a recursive lock since creating a project can instantiate its dependencies.
+    _project_creation_lock = threading.RLock()
 
     def __init__(self, name, _project_class: "typing.Type[SimpleProject]"):
         self.name = name
@@ -58,6 +70,8 @@ class Target(object):
         result = self._project_class
         # noinspection PyProtectedMember
         assert result._xtarget is not None
+        if result not in target_manager.classes_with_config_options:
+            target_manager.register_config_options_lazily(self)
         return result
 
     def get_real_target(self, cross_target: typing.Optional[CrossCompileTarget], config, caller=None) -> "Target":
@@ -67,7 +81,9 @@ class Target(object):
         # Note: MultiArchTarget uses caller to select the right project (e.g. libcxxrt-native needs libunwind-native
         # path)
         if self.__project is None:
-            self.__project = self.create_project(config)
+            with Target._project_creation_lock:
+                if self.__project is None:
+                    self.__project = self.create_project(config)
         assert self.__project is not None
         return self.__project
 
@@ -109,7 +125,8 @@ class Target(object):
         if project.config.clang_colour_diags:
             new_env["CLANG_FORCE_COLOR_DIAGNOSTICS"] = "always"
         with project.set_env(**new_env):
-            func(project)
+            with timed_phase(self.name, category="target", target=self.name, args={"action": msg}):
+                func(project)
         status_update(msg, "for target '" + self.name + "' in", time.time() - starttime, "seconds")
 
     def execute(self, config: CheriConfig):
@@ -148,38 +165,6 @@ class Target(object):
         self._project_class._cached_full_deps = None
         self._project_class._cached_filtered_deps = None
 
-    # noinspection PyProtectedMember
-    def __lt__(self, other: "Target"):
-        # print(self, "__lt__", other)
-        # if this target is one of the dependencies order it before
-        other_deps = other.project_class.cached_full_dependencies()
-        # print("other deps:", other_deps)
-        if self in other_deps:
-            # print(self, "is in", other, "deps -> is less")
-            return True
-        # and if it is the other way around we are not less
-        if other in self.project_class.cached_full_dependencies():
-            # print(other, "is in", self, "deps -> is greater")
-            return False
-        if other.name.startswith("run") and not self.name.startswith("run"):
-            return True  # run must be executed last
-        elif self.name.startswith("run"):
-            return False
-        if other.name.startswith("disk-image") and not self.name.startswith("disk-image"):
-            return True  # disk-image should be done just before run
-        elif self.name.startswith("disk-image"):
-            return False
-        # print(self, "is not in", other, "deps -> is not less")
-        # otherwise just keep everything in order
-        return False
-        # This was previously done
-        # ownDeps = self.project_class.all_dependency_names()
-        # if len(ownDeps) < len(other_deps):
-        #     return True
-        # if len(ownDeps) > len(other_deps):
-        #     return False
-        # return self.name < other.name  # not a dep and number of deps is the same -> compare name
-
     def __repr__(self):
         return "<Target " + self.name + ">"
 
@@ -197,6 +182,8 @@ class MultiArchTarget(Target):
     @property
     def project_class(self) -> "typing.Type[SimpleProject]":
         assert self.target_arch is not None
+        if self._project_class not in target_manager.classes_with_config_options:
+            target_manager.register_config_options_lazily(self)
         return self._project_class
 
     def _create_project(self, config: CheriConfig) -> "SimpleProject":
@@ -210,6 +197,8 @@ class _TargetAliasBase(Target):
     @property
     def project_class(self) -> "typing.Type[SimpleProject]":
         assert self._project_class is not None
+        if self._project_class not in target_manager.classes_with_config_options:
+            target_manager.register_config_options_lazily(self)
         return self._project_class
 
     def _create_project(self, config: CheriConfig):
@@ -309,6 +298,16 @@ class TargetManager(object):
     def __init__(self):
         self._all_targets = {}  # type: typing.Dict[str, Target]
         self._targets_for_command_line_options_only = {}  # type: typing.Dict[str, MultiArchTargetAlias]
+        self._dependency_graph = None  # type: typing.Optional[DependencyGraph]
+        # The project classes whose setup_config_options() has been called
+        self.classes_with_config_options = set()  # type: typing.Set[typing.Type[SimpleProject]]
+        self._target_index = None  # type: typing.Optional[TargetIndex]
+        self._register_config_options_lock = threading.RLock()
+
+    def dependency_graph(self, config: CheriConfig) -> DependencyGraph:
+        if self._dependency_graph is None or self._dependency_graph.config is not config:
+            self._dependency_graph = DependencyGraph(config)
+        return self._dependency_graph
 
     def add_target_for_config_options_only(self, target: MultiArchTargetAlias):
         # TODO remove this ugly hack
@@ -326,17 +325,83 @@ class TargetManager(object):
         else:
             self._all_targets[name] = SimpleTargetAlias(name, real_target, self)
 
-    def register_command_line_options(self):
+    def register_command_line_options(self, target_index: "TargetIndex" = None,
+                                      args: "typing.List[str]" = None) -> None:
+        """
+        Registers the config options of all targets. If target_index is not None only the options for targets that
+        are referenced in args are registered now, all other targets register their options the first time that
+        Target.project_class is used.
+        """
+        self._target_index = target_index
+        if target_index is not None:
+            for name in sorted(target_index.targets_for_arguments(args)):
+                self._register_config_options(self.get_target_raw(name))
+            return
         # this cannot be done in the Project metaclass as otherwise we get
         # RuntimeError: super(): empty __class__ cell
         # https://stackoverflow.com/questions/13126727/how-is-super-in-python-3-implemented/28605694#28605694
         for tgt in self._all_targets.values():
             if not isinstance(tgt, SimpleTargetAlias):
-                tgt.project_class.setup_config_options()
+                self._register_config_options(tgt)
         # Ugly hack to keep registering the command line arguments for the fallback option name: for example,
         # cherisd-mips64-hybrid/foo loads the value from cheribsd/foo if it's not found.
         for tgt in self._targets_for_command_line_options_only.values():
-            tgt.project_class.setup_config_options()
+            self._register_config_options(tgt)
+
+    def register_config_options_lazily(self, target: Target) -> None:
+        if self._target_index is None:
+            return  # All options have already been registered (or are being registered right now)
+        if isinstance(target, SimpleTargetAlias):
+            target = target._real_target
+        self._register_config_options(target)
+
+    def register_config_options_for_class(self, cls: "typing.Type[SimpleProject]") -> None:
+        # Used for projects that are instantiated directly instead of using a Target (e.g. cherivis -> cheritrace)
+        if self._target_index is None or cls in self.classes_with_config_options:
+            return
+        target = self._targets_by_project_class().get(cls)
+        if target is not None:
+            self._register_config_options(target)
+
+    def register_config_options_for_dependencies(self, targets: "typing.List[Target]") -> None:
+        """
+        Registers the options of targets and all their (recursive) dependencies. This must be called before building
+        targets concurrently since lazily registering options modifies the shared config loader.
+        """
+        if self._target_index is None:
+            return
+        for target in targets:
+            # Accessing project_class registers the options of the target itself
+            for dep in target.project_class.cached_full_dependencies():
+                self.register_config_options_lazily(dep)
+
+    def _register_config_options(self, target: Target) -> None:
+        # noinspection PyProtectedMember
+        cls = target._project_class
+        with self._register_config_options_lock:
+            if cls in self.classes_with_config_options:
+                return
+            self.classes_with_config_options.add(cls)
+            cls.setup_config_options()
+            if self._target_index is None:
+                return
+            # Options such as gdb-riscv64/foo fall back to gdb/foo, so ensure that the fallback options exist as well.
+            # noinspection PyProtectedMember
+            options = cls._config_loader.options
+            for name in self._target_index.target_options.get(target.name, []):
+                # noinspection PyProtectedMember
+                for fallback_name in getattr(options.get(name), "_fallback_names", None) or []:
+                    owner = self._target_index.owning_target(fallback_name)
+                    if fallback_name not in options and owner is not None:
+                        self._register_config_options(self.get_target_raw(owner))
+
+    def _targets_by_project_class(self) -> "typing.Dict[typing.Type[SimpleProject], Target]":
+        result = dict()
+        for tgt in list(self._all_targets.values()) + list(self._targets_for_command_line_options_only.values()):
+            if not isinstance(tgt, SimpleTargetAlias):
+                # noinspection PyProtectedMember
+                result.setdefault(tgt._project_class, tgt)
+        return result
 
     @property
     def target_names(self):
@@ -377,35 +442,68 @@ class TargetManager(object):
 
     @staticmethod
     def sort_in_dependency_order(targets: "typing.Iterable[Target]") -> "typing.List[Target]":
-        # pythons sorted() is guaranteed to be stable:
-        sorted_targets = list(sorted(targets))
-        # remove duplicates (insert into an orderdict to keep order
-        return list(OrderedDict((x, True) for x in sorted_targets).keys())
+        # Note: the full dependencies must have been cached using Target.cache_dependencies()
+        return sort_in_dependency_order(targets, lambda t: t.project_class.cached_full_dependencies())
 
     def get_all_targets(self, explicit_targets: "typing.List[Target]", config: CheriConfig) -> "typing.List[Target]":
-        chosen_targets = []  # type: typing.List[Target]
+        chosen_targets = OrderedDict()  # type: typing.Dict[Target, bool]
         for t in explicit_targets:
             if isinstance(t, SimpleTargetAlias):
                 t = t.get_real_target(None, config)
-            # Ensure we don't add any duplicates to ensure correct order
-            # TODO: this can go away once we properly implement target sorting without the cached_deps hack.
-            if t not in chosen_targets:
-                chosen_targets.append(t)
+            chosen_targets[t] = True
             for dep in t.get_dependencies(config):
-                if dep not in chosen_targets:
-                    chosen_targets.append(dep)
+                chosen_targets[dep] = True
         for t in chosen_targets:
-            # Initialize the full dependency cache so that sort() works (otherwise we'd have to pass config to __lt__).
+            # Initialize the full dependency cache that is used for sorting and scheduling.
             t.cache_dependencies(config)
         sort = self.sort_in_dependency_order(chosen_targets)
         return sort
 
     def run(self, config: CheriConfig):
         chosen_targets = self.get_all_chosen_targets(config)
+        if (config.timing_trace or config.compare_timing_trace) and not config.print_targets_only:
+            recorder = start_recording_build_timings()
+            try:
+                self._run(chosen_targets, config)
+            finally:
+                stop_recording_build_timings()
+                report_build_timings(recorder, config.timing_trace, config.compare_timing_trace)
+        else:
+            self._run(chosen_targets, config)
 
+    def _run(self, chosen_targets: "typing.List[Target]", config: CheriConfig):
         for target in chosen_targets:
             target.check_system_deps(config)
+        if config.fetch_jobs > 1 and not config.skip_update and not config.print_targets_only:
+            with timed_phase("fetch-sources", target=""):
+                self._prefetch_sources(chosen_targets, config)
         # all dependencies exist -> run the targets
+        if config.use_jobserver and not config.pretend and not config.print_targets_only:
+            with JobServer(config.build_root / ".cheribuild-jobserver", config.make_jobs) as jobserver:
+                config.jobserver = jobserver
+                try:
+                    self._run_targets(chosen_targets, config)
+                finally:
+                    config.jobserver = None
+        else:
+            self._run_targets(chosen_targets, config)
+
+    @staticmethod
+    def _prefetch_sources(chosen_targets: "typing.List[Target]", config: CheriConfig):
+        # Fetch all repositories concurrently up front instead of one after the other in Project.update(). The
+        # working trees are only updated (which may require user interaction) once the target is built.
+        starttime = time.time()
+        projects = [t.get_or_create_project(None, config) for t in chosen_targets]
+        status_update("Fetching upstream changes for", len(projects), "targets")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.fetch_jobs) as executor:
+            for future in [executor.submit(project.prefetch_sources) for project in projects]:
+                future.result()
+        status_update("Fetched upstream changes in", time.time() - starttime, "seconds")
+
+    def _run_targets(self, chosen_targets: "typing.List[Target]", config: CheriConfig):
+        if config.parallel_targets > 1 and len(chosen_targets) > 1 and not config.print_targets_only:
+            self._run_in_parallel(chosen_targets, config)
+            return
         for target in chosen_targets:
             if config.print_targets_only:
                 status_update("Will build target", coloured(AnsiColour.yellow, target.name))
@@ -413,6 +511,89 @@ class TargetManager(object):
             else:
                 target.execute(config)
 
+    @staticmethod
+    def get_scheduling_dependencies(
+            sorted_targets: "typing.List[Target]") -> "typing.Dict[Target, typing.List[Target]]":
+        """
+        :return: a dict mapping each of the targets (which must already be sorted using sort_in_dependency_order())
+        to the targets that must have been built before it can be started.
+        In addition to the real dependencies this includes the ordering constraints that are implicit in the sort
+        order: disk-image targets wait for all other targets (since those install files to the rootfs) and run
+        targets wait for everything else.
+        """
+        result = OrderedDict()  # type: typing.Dict[Target, typing.List[Target]]
+        for i, target in enumerate(sorted_targets):
+            earlier_targets = sorted_targets[:i]
+            # Only use the targets that were sorted before this one to ensure we never create a cycle.
+            earlier_set = set(earlier_targets)
+            deps = [t for t in target.project_class.cached_full_dependencies() if t in earlier_set]
+            if target.name.startswith("run"):
+                deps = earlier_targets
+            elif target.name.startswith("disk-image"):
+                deps += [t for t in earlier_targets if not t.name.startswith(("run", "disk-image"))]
+            result[target] = list(OrderedDict((t, True) for t in deps).keys())
+        return result
+
+    def _run_in_parallel(self, chosen_targets: "typing.List[Target]", config: CheriConfig):
+        scheduling_deps = self.get_scheduling_dependencies(chosen_targets)
+        pending = list(chosen_targets)
+        completed = set()  # type: typing.Set[Target]
+        failed = OrderedDict()  # type: typing.Dict[Target, BaseException]
+        skipped = []  # type: typing.List[Target]
+        running = dict()  # type: typing.Dict[concurrent.futures.Future, Target]
+
+        def execute_target(target: Target):
+            set_output_prefix("[" + target.name + "] ")
+            try:
+                target.execute(config)
+            finally:
+                set_output_prefix("")
+
+        status_update("Building up to", config.parallel_targets, "targets in parallel")
+        self.register_config_options_for_dependencies(chosen_targets)
+        config.concurrent_target_count = min(config.parallel_targets, len(chosen_targets))
+        # Target._do_run() uses set_env() to update $PATH. Set it once for all worker threads here so that the
+        # per-target calls don't change anything.
+        new_env = {"PATH": config.dollar_path_with_other_tools}
+        if config.clang_colour_diags:
+            new_env["CLANG_FORCE_COLOR_DIAGNOSTICS"] = "always"
+        with set_env(config=config, **new_env):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=config.parallel_targets) as executor:
+                while running or (pending and (config.keep_going or not failed)):
+                    if config.keep_going:
+                        for target in list(pending):
+                            if any(dep in failed or dep in skipped for dep in scheduling_deps[target]):
+                                warning_message("Not building", target.name, "since one of its dependencies failed.")
+                                pending.remove(target)
+                                skipped.append(target)
+                    if not failed or config.keep_going:
+                        for target in list(pending):
+                            if len(running) >= config.parallel_targets:
+                                break
+                            if all(dep in completed for dep in scheduling_deps[target]):
+                                pending.remove(target)
+                                running[executor.submit(execute_target, target)] = target
+                    if not running:
+                        break
+                    done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        target = running.pop(future)
+                        exception = future.exception()
+                        if exception is None:
+                            completed.add(target)
+                        else:
+                            failed[target] = exception
+                            error_message("Failed to build", target.name + ":", exception)
+                            if not config.keep_going and running:
+                                status_update("Waiting for", len(running), "running targets to complete before "
+                                              "exiting (pass --keep-going to also build the remaining targets).")
+        if failed:
+            error_message("The following targets failed to build:", " ".join(t.name for t in failed))
+            not_built = skipped + pending
+            if not_built:
+                warning_message("The following targets were not built:", " ".join(t.name for t in not_built))
+            raise next(iter(failed.values()))
+
     def get_all_chosen_targets(self, config) -> "typing.Iterable[Target]":
         # check that all target dependencies are correct:
         if os.getenv("CHERIBUILD_DEBUG"):
@@ -454,6 +635,7 @@ class TargetManager(object):
         return chosen_targets
 
     def reset(self):
+        self._dependency_graph = None
         for i in self._all_targets.values():
             i.reset()
 
@@ -48,7 +48,8 @@ __all__ = ["typing", "include_local_file", "Type_T", "init_global_config",  # no
            "SafeDict", "error_message", "ConfigBase", "final",  # no-combine
            "default_make_jobs_count", "OSInfo", "is_jenkins_build", "get_global_config",  # no-combine
            "classproperty", "find_free_port", "have_working_internet_connection",  # no-combine
-           "is_case_sensitive_dir", "SocketAndPort", "replace_one", "cached_property", "remove_prefix"]  # no-combine
+           "is_case_sensitive_dir", "SocketAndPort", "replace_one", "cached_property", "remove_prefix",  # no-combine
+           "get_output_prefix", "set_output_prefix"]  # no-combine
 
 if sys.version_info < (3, 5, 2):
     sys.exit("This script requires at least Python 3.5.2")
@@ -190,31 +191,48 @@ def default_make_jobs_count():
     return make_jobs
 
 
+# Prefix that is added to all status messages printed by the current thread. This is used to identify the target that
+# printed a message when building multiple targets concurrently (--parallel-targets).
+_thread_local_output_state = threading.local()
+
+
+def get_output_prefix() -> str:
+    return getattr(_thread_local_output_state, "prefix", "")
+
+
+def set_output_prefix(prefix: str) -> None:
+    _thread_local_output_state.prefix = prefix
+
+
 def maybe_add_space(msg, sep) -> tuple:
     if sep == "":
         return msg, " "
     return msg,
 
 
+def _print_message(colour: AnsiColour, args: tuple, sep: str, **kwargs):
+    print(get_output_prefix() + coloured(colour, *args, sep=sep), **kwargs)
+
+
 def status_update(*args, sep=" ", **kwargs):
-    print(coloured(AnsiColour.cyan, *args, sep=sep), **kwargs)
+    _print_message(AnsiColour.cyan, args, sep=sep, **kwargs)
 
 
 def fixit_message(*args, sep=" "):
-    print(coloured(AnsiColour.blue, maybe_add_space("Possible solution:", sep) + args, sep=sep), file=sys.stderr,
-          flush=True)
+    _print_message(AnsiColour.blue, maybe_add_space("Possible solution:", sep) + args, sep=sep, file=sys.stderr,
+                   flush=True)
 
 
 def warning_message(*args, sep=" ", fixit_hint=None):
     # we ignore fatal errors when simulating a run
-    print(coloured(AnsiColour.magenta, maybe_add_space("Warning:", sep) + args, sep=sep), file=sys.stderr, flush=True)
+    _print_message(AnsiColour.magenta, maybe_add_space("Warning:", sep) + args, sep=sep, file=sys.stderr, flush=True)
     if fixit_hint:
         fixit_message(fixit_hint)
 
 
 def error_message(*args, sep=" ", fixit_hint=None):
     # we ignore fatal errors when simulating a run
-    print(coloured(AnsiColour.red, maybe_add_space("Error:", sep) + args, sep=sep), file=sys.stderr, flush=True)
+    _print_message(AnsiColour.red, maybe_add_space("Error:", sep) + args, sep=sep, file=sys.stderr, flush=True)
     if fixit_hint:
         fixit_message(fixit_hint)
 
@@ -224,16 +242,16 @@ def fatal_error(*args, sep=" ", fixit_hint=None, fatal_when_pretending=False, ex
         pretend = GlobalConfig.pretend  # TODO: remove
     # we ignore fatal errors when simulating a run
     if pretend:
-        print(coloured(AnsiColour.red, maybe_add_space("Potential fatal error:", sep) + args, sep=sep), file=sys.stderr,
-              flush=True)
+        _print_message(AnsiColour.red, maybe_add_space("Potential fatal error:", sep) + args, sep=sep,
+                       file=sys.stderr, flush=True)
         if fixit_hint:
             fixit_message(fixit_hint)
         if fatal_when_pretending:
             traceback.print_stack()
             sys.exit(exit_code)
     else:
-        print(coloured(AnsiColour.red, maybe_add_space("Fatal error:", sep) + args, sep=sep), file=sys.stderr,
-              flush=True)
+        _print_message(AnsiColour.red, maybe_add_space("Fatal error:", sep) + args, sep=sep, file=sys.stderr,
+                       flush=True)
         if fixit_hint:
             fixit_message(fixit_hint)
         sys.exit(exit_code)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+#
+# Copyright (c) 2020 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+import argparse
+import datetime
+import sqlite3
+import statistics
+import time
+import typing
+from pathlib import Path
+
+from run_tests_common import boot_cheribsd, junitparser
+
+TestKey = typing.Tuple[str, str]  # (JUnit class name, test name)
+
+
+def adaptive_timeout(previous_durations: "typing.Iterable[float]", default: int, *, factor=3.0,
+                     minimum: int = 60) -> int:
+    """Allow factor times the longest previous duration (but at least minimum seconds). If there is no history for
+    the test, the hard-coded default is used. The durations should only include successful runs since failures
+    (especially timeouts) would increase the timeout every time."""
+    previous_durations = list(previous_durations)
+    if not previous_durations:
+        return default
+    return max(minimum, int(factor * max(previous_durations) + 0.5))
+
+
+class TestDurationDatabase(object):
+    """
+    Stores the durations of previous test runs in a local SQLite database. The results are ingested from the JUnit
+    XML files written by the test scripts and are keyed by test suite (e.g. "libcxx") and target architecture.
+    """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, suite TEXT NOT NULL, target TEXT NOT NULL,
+                                 timestamp REAL NOT NULL, duration REAL, source TEXT, outcome TEXT);
+CREATE TABLE IF NOT EXISTS results (run_id INTEGER NOT NULL REFERENCES runs(id), classname TEXT NOT NULL,
+                                    name TEXT NOT NULL, duration REAL NOT NULL, outcome TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS runs_by_suite ON runs (suite, target, timestamp);
+CREATE INDEX IF NOT EXISTS results_by_run ON results (run_id);
+"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Shards or other test jobs may be writing at the same time -> wait for the lock
+        self.connection = sqlite3.connect(str(path), timeout=120)
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+            # Databases created by older versions don't record whether the run was successful
+            if "outcome" not in [row[1] for row in self.connection.execute("PRAGMA table_info(runs)")]:
+                self.connection.execute("ALTER TABLE runs ADD COLUMN outcome TEXT")
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _outcome(case: "junitparser.TestCase") -> str:
+        if isinstance(case.result, junitparser.Skipped):
+            return "skipped"
+        elif isinstance(case.result, junitparser.Failure):
+            return "failure"
+        elif isinstance(case.result, junitparser.Error):
+            return "error"
+        return "success"
+
+    def ingest_junit_xml(self, xml_files: "typing.Iterable[Path]", *, suite: str, target: str,
+                         run_duration: float = None, run_successful=True) -> int:
+        """Record a new run with all test cases in xml_files and return the run ID. run_successful should be False if
+        the run did not complete (e.g. due to a timeout) so that its duration is not used for timeouts."""
+        rows = []  # type: typing.List[typing.Tuple[str, str, float, str]]
+        sources = []  # type: typing.List[str]
+        for xml_file in xml_files:
+            try:
+                xml = junitparser.JUnitXml.fromfile(str(xml_file))
+            except Exception as e:
+                boot_cheribsd.failure("Could not load JUnit XML ", xml_file, ": ", e, exit=False)
+                continue
+            sources.append(Path(xml_file).name)
+            for test_suite in [xml] if isinstance(xml, junitparser.TestSuite) else xml:
+                for case in test_suite:
+                    rows.append((case.classname or test_suite.name or "", case.name or "", case.time or 0.0,
+                                 self._outcome(case)))
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (suite, target, timestamp, duration, source, outcome) VALUES (?, ?, ?, ?, ?, ?)",
+                (suite, target, time.time(), run_duration, ",".join(sources),
+                 "success" if run_successful else "failure"))
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO results (run_id, classname, name, duration, outcome) VALUES (?, ?, ?, ?, ?)",
+                ((run_id,) + row for row in rows))
+        boot_cheribsd.info("Recorded ", len(rows), " ", suite, " test durations for ", target, " in ", self.path)
+        return run_id
+
+    def _recent_run_ids(self, suite: str, target: str, history: int, before_run: int = None) -> typing.List[int]:
+        query = "SELECT id FROM runs WHERE suite = ? AND target = ?"
+        params = [suite, target]  # type: list
+        if before_run is not None:
+            query += " AND id < ?"
+            params.append(before_run)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(history)
+        return [row[0] for row in self.connection.execute(query, params)]
+
+    def test_durations(self, suite: str, target: str, *, history=5, before_run: int = None,
+                       successful_only=False) -> "typing.Dict[TestKey, typing.List[float]]":
+        """Return the durations of each test in the last history runs (skipped tests are ignored). If successful_only
+        is set, failing tests are ignored as well (this should be used for computing timeouts)."""
+        result = dict()  # type: typing.Dict[TestKey, typing.List[float]]
+        run_ids = self._recent_run_ids(suite, target, history, before_run)
+        if not run_ids:
+            return result
+        outcome_filter = "outcome = 'success'" if successful_only else "outcome != 'skipped'"
+        query = "SELECT classname, name, duration FROM results WHERE {} AND run_id IN ({})".format(
+            outcome_filter, ",".join("?" * len(run_ids)))
+        for classname, name, duration in self.connection.execute(query, run_ids):
+            result.setdefault((classname, name), []).append(duration)
+        return result
+
+    def median_test_durations(self, suite: str, target: str, *, history=5) -> "typing.Dict[TestKey, float]":
+        return dict((key, statistics.median(values)) for key, values in
+                    self.test_durations(suite, target, history=history).items())
+
+    def run_durations(self, suite: str, target: str, *, history=5) -> typing.List[float]:
+        """Return the wall-clock durations of the last history successful runs (for suites that are not timed per
+        test)."""
+        return [row[0] for row in self.connection.execute(
+            "SELECT duration FROM runs WHERE suite = ? AND target = ? AND duration IS NOT NULL AND outcome = 'success' "
+            "ORDER BY id DESC LIMIT ?", (suite, target, history))]
+
+    def slowest_tests(self, run_id: int, count: int) -> "typing.List[typing.Tuple[TestKey, float]]":
+        return [((classname, name), duration) for classname, name, duration in self.connection.execute(
+            "SELECT classname, name, duration FROM results WHERE run_id = ? ORDER BY duration DESC LIMIT ?",
+            (run_id, count))]
+
+    def regressions(self, run_id: int, *, factor=1.5, min_seconds=1.0,
+                    history=5) -> "typing.List[typing.Tuple[TestKey, float, float]]":
+        """Return the tests that took more than factor times their median duration in the previous runs as
+        (key, previous median, new duration) sorted by the absolute slowdown."""
+        suite, target = self.connection.execute("SELECT suite, target FROM runs WHERE id = ?", (run_id,)).fetchone()
+        previous = self.test_durations(suite, target, history=history, before_run=run_id)
+        result = []
+        for classname, name, duration in self.connection.execute(
+                "SELECT classname, name, duration FROM results WHERE run_id = ? AND outcome != 'skipped'", (run_id,)):
+            key = (classname, name)
+            if key not in previous or duration < min_seconds:
+                continue
+            median = statistics.median(previous[key])
+            if duration > factor * median:
+                result.append((key, median, duration))
+        result.sort(key=lambda x: x[2] - x[1], reverse=True)
+        return result
+
+    def print_run_summary(self, run_id: int, slowest=10):
+        if slowest <= 0:
+            return
+        slowest_tests = self.slowest_tests(run_id, slowest)
+        if slowest_tests:
+            boot_cheribsd.info("Slowest ", len(slowest_tests), " tests:")
+            for (classname, name), duration in slowest_tests:
+                print("  {:>10} {}.{}".format(str(datetime.timedelta(seconds=round(duration))), classname, name))
+        regressions = self.regressions(run_id)
+        if regressions:
+            boot_cheribsd.failure("Tests that became slower than in previous runs:", exit=False)
+            for (classname, name), previous, duration in regressions[:slowest]:
+                print("  {:.1f}s -> {:.1f}s {}.{}".format(previous, duration, classname, name))
+
+
+def open_test_duration_db(args: argparse.Namespace) -> "typing.Optional[TestDurationDatabase]":
+    if not args.test_duration_db or boot_cheribsd.PRETEND:
+        return None
+    try:
+        return TestDurationDatabase(Path(args.test_duration_db))
+    except sqlite3.Error as e:
+        boot_cheribsd.failure("Could not open test duration database ", args.test_duration_db, ": ", e, exit=False)
+        return None
+
+
+def record_test_results(args: argparse.Namespace, suite: str, xml_files: "typing.Iterable[Path]",
+                        run_duration: float = None, run_successful=True):
+    """Ingest the JUnit XML output of a test run and print the slowest tests and regressions."""
+    db = open_test_duration_db(args)
+    if db is None:
+        return
+    try:
+        run_id = db.ingest_junit_xml([f for f in xml_files if Path(f).is_file()], suite=suite,
+                                     target=args.architecture, run_duration=run_duration,
+                                     run_successful=run_successful)
+        db.print_run_summary(run_id, slowest=args.report_slowest_tests)
+    except sqlite3.Error as e:
+        boot_cheribsd.failure("Could not update test duration database ", db.path, ": ", e, exit=False)
+    finally:
+        db.close()
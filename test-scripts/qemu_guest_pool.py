@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+#
+# Copyright (c) 2020 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# Keep a pool of booted CheriBSD guests alive so that back-to-back lit test runs can reuse them instead of booting
+# a new VM for every run (or every shard):
+#
+#   qemu_guest_pool.py --pool-dir /tmp/pool --pool-size 4 --share-dir $HOME/cheri/build --architecture ... &
+#   run_libcxx_tests.py --guest-pool /tmp/pool --parallel-jobs 4 ...
+#   qemu_guest_pool.py --pool-dir /tmp/pool --stop
+#
+# Every guest is run by a separate process that boots it (using a QEMU snapshot if --qemu-snapshot is passed),
+# starts an SSH control master and then publishes the guest as guest-N.json in the pool directory. Clients lease a
+# guest by taking an exclusive flock() on guest-N.lock, so a lease is released automatically if the client dies.
+# The guest process watches the console for kernel panics and health-checks idle guests. Whenever something is
+# wrong (or a client requested it) the guest is unpublished and the process exits so that it is booted again.
+# All guests mount the same --share-dir using the host path, so any build directory below it can be used directly.
+#
+import argparse
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import typing
+from pathlib import Path
+
+from run_tests_common import boot_cheribsd, pexpect, run_tests_main
+
+POOL_SSH_HOST = "cheribsd-pool-guest"
+POOL_SHARE_IN_TARGET = "/pool-share"
+
+
+def _guest_file(pool_dir: Path, index: int, suffix: str) -> Path:
+    return pool_dir / ("guest-" + str(index) + suffix)
+
+
+def _write_json_atomically(path: Path, data: dict):
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(str(tmp), str(path))
+
+
+def _check_guest_health(ssh_config: Path, timeout: int) -> bool:
+    if boot_cheribsd.PRETEND:
+        return True
+    ssh_cmd = ["ssh", "-n", "-F", str(ssh_config), POOL_SSH_HOST]
+    try:
+        # Check that the control master is still running and that we can still run commands in the guest:
+        subprocess.run(ssh_cmd + ["-O", "check"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=timeout, check=True)
+        result = subprocess.run(ssh_cmd + ["--", "echo", "pool-guest-ok"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, timeout=timeout, check=True)
+        return b"pool-guest-ok" in result.stdout
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return False
+
+
+class PoolGuest(object):
+    """A booted guest that has been leased from the pool."""
+    ssh_host = POOL_SSH_HOST
+
+    def __init__(self, pool_dir: Path, index: int, info: dict):
+        self.pool_dir = pool_dir
+        self.index = index
+        self.ssh_port = info["ssh_port"]  # type: int
+        self.ssh_config = Path(info["ssh_config"])
+        self.share_dir = Path(info["share_dir"])
+        self.architecture = info["architecture"]  # type: str
+        self.booted_at = info["booted_at"]  # type: str
+
+    def __repr__(self):
+        return "<pool guest " + str(self.index) + " (SSH port " + str(self.ssh_port) + ")>"
+
+    def ssh_command(self, *args: str) -> typing.List[str]:
+        return ["ssh", "-n", "-F", str(self.ssh_config), self.ssh_host] + list(args)
+
+    def run(self, cmd: str, **kwargs):
+        boot_cheribsd.run_host_command(self.ssh_command("--", cmd), **kwargs)
+
+    def is_healthy(self, timeout=60) -> bool:
+        return _check_guest_health(self.ssh_config, timeout)
+
+    def is_visible_in_guest(self, host_path: str) -> bool:
+        try:
+            Path(os.path.abspath(host_path)).relative_to(self.share_dir)
+            return True
+        except ValueError:
+            return False
+
+    def request_recycle(self, reason: str):
+        boot_cheribsd.info("Requesting reboot of ", self, ": ", reason)
+        _guest_file(self.pool_dir, self.index, ".recycle").write_text(reason)
+
+
+def _try_lease_guest(pool_dir: Path) -> "typing.Tuple[typing.Optional[PoolGuest], typing.Optional[typing.IO]]":
+    for info_file in sorted(pool_dir.glob("guest-*.json")):
+        index = int(info_file.stem[len("guest-"):])
+        lock = _guest_file(pool_dir, index, ".lock").open("a")
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        # The guest might have been unpublished while we were trying to get the lock
+        try:
+            guest = PoolGuest(pool_dir, index, json.loads(info_file.read_text()))
+        except (OSError, ValueError, KeyError):
+            lock.close()
+            continue
+        if not guest.is_healthy(timeout=30):
+            guest.request_recycle("failed health check before use")
+            lock.close()
+            continue
+        return guest, lock
+    return None, None
+
+
+@contextlib.contextmanager
+def lease_guest(pool_dir: Path, *, timeout=4 * 60 * 60, recycle_after_use=False):
+    """Wait for an idle guest in the pool and lease it until the with block exits.
+    If the test suite modifies the guest (e.g. by replacing system libraries) recycle_after_use should be set so that
+    later users start with a clean guest. Guests that are no longer healthy after use are always rebooted."""
+    pool_dir = Path(pool_dir).absolute()
+    start_time = datetime.datetime.now()
+    end_time = time.time() + timeout
+    printed_waiting_message = False
+    while True:
+        guest, lock = _try_lease_guest(pool_dir)
+        if guest is not None:
+            break
+        if time.time() > end_time:
+            boot_cheribsd.failure("Could not lease a guest from ", pool_dir, " within ", timeout, " seconds")
+        if not printed_waiting_message:
+            boot_cheribsd.info("Waiting for an idle guest in ", pool_dir)
+            printed_waiting_message = True
+        time.sleep(1)
+    boot_cheribsd.success("Leased ", guest, " from ", pool_dir, " after ", datetime.datetime.now() - start_time)
+    try:
+        yield guest
+    finally:
+        if recycle_after_use:
+            guest.request_recycle("test suite modified the guest")
+        elif not guest.is_healthy():
+            guest.request_recycle("failed health check after use")
+        lock.close()
+
+
+def _ssh_config_contents(ssh_port: int, ssh_key: Path, control_path: Path) -> str:
+    return """
+Host {host}
+        User root
+        HostName localhost
+        Port {port}
+        IdentityFile {ssh_key}
+        # avoid errors due to changed host key:
+        UserKnownHostsFile /dev/null
+        StrictHostKeyChecking no
+        NoHostAuthenticationForLocalhost yes
+        # All connections are multiplexed over the control master that is kept open by the pool:
+        ControlPath {control_path}
+        ControlMaster no
+""".format(host=POOL_SSH_HOST, port=ssh_port, ssh_key=ssh_key, control_path=control_path)
+
+
+def serve_pool_guest(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.Namespace) -> bool:
+    pool_dir = args.pool_dir  # type: Path
+    index = args.internal_guest_index  # type: int
+    info_file = _guest_file(pool_dir, index, ".json")
+    recycle_file = _guest_file(pool_dir, index, ".recycle")
+    ssh_config = _guest_file(pool_dir, index, ".ssh_config")
+    control_path = _guest_file(pool_dir, index, ".ctl")
+    qemu.EXIT_ON_KERNEL_PANIC = False  # Panics are handled by rebooting the guest
+    ssh_config.write_text(_ssh_config_contents(qemu.ssh_port, Path(args.ssh_key).with_suffix(""), control_path))
+    boot_cheribsd.run_host_command(["ssh", "-n", "-F", str(ssh_config), "-f", "-N", "-o", "ControlMaster=yes",
+                                    "-o", "ControlPersist=yes", POOL_SSH_HOST])
+    if not _check_guest_health(ssh_config, timeout=60):
+        return boot_cheribsd.failure("Newly booted guest failed the health check", exit=False)
+
+    stop_requested = []  # type: typing.List[int]
+    signal.signal(signal.SIGTERM, lambda signum, _: stop_requested.append(signum))
+    lock = _guest_file(pool_dir, index, ".lock").open("a")
+    if recycle_file.exists():
+        recycle_file.unlink()
+    _write_json_atomically(info_file, dict(index=index, pid=os.getpid(), ssh_port=qemu.ssh_port,
+                                           ssh_config=str(ssh_config), share_dir=str(args.share_dir),
+                                           architecture=args.architecture,
+                                           booted_at=datetime.datetime.utcnow().isoformat()))
+    boot_cheribsd.success("===> Guest ", index, " is ready for use")
+    reason = "pool is shutting down"
+    next_health_check = time.time() + args.health_check_interval
+    # keep reading line-by-line to notice kernel panics (and to avoid filling up the pty buffer):
+    patterns = [pexpect.TIMEOUT, pexpect.EOF, "KDB: enter:", qemu.crlf]
+    while not stop_requested:
+        i = qemu.expect(patterns, timeout=1, log_patterns=False)
+        if boot_cheribsd.PRETEND:
+            time.sleep(1)
+        elif i == 1:
+            reason = "QEMU exited"
+            break
+        elif i == 2 or i >= len(patterns):
+            boot_cheribsd.debug_kernel_panic(qemu)
+            reason = "kernel panic"
+            break
+        if recycle_file.exists():
+            reason = "reboot requested by client (" + recycle_file.read_text() + ")"
+            break
+        if time.time() >= next_health_check:
+            try:
+                # Only check idle guests, clients check the guest when they release it
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                pass
+            else:
+                healthy = _check_guest_health(ssh_config, timeout=60)
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+                if not healthy:
+                    reason = "guest failed the health check"
+                    break
+            next_health_check = time.time() + args.health_check_interval
+
+    # Keep the guest locked until this process exits so that nobody can lease it while it is being shut down
+    boot_cheribsd.info("Shutting down guest ", index, ": ", reason)
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    if info_file.exists():
+        info_file.unlink()
+    try:
+        boot_cheribsd.run_host_command(["ssh", "-n", "-F", str(ssh_config), "-O", "exit", POOL_SSH_HOST])
+    except subprocess.CalledProcessError:
+        boot_cheribsd.failure("Could not close SSH controlmaster connection.", exit=False)
+    return True
+
+
+def add_pool_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--pool-dir", type=Path, required=True,
+                        help="Directory for the guest state files (should be short since it contains UNIX sockets)")
+    parser.add_argument("--pool-size", type=int, default=2, help="Number of guests to keep running")
+    parser.add_argument("--share-dir", required=True,
+                        help="Host directory that is shared (read-write) with all guests using the same path. The "
+                             "build directories of the test suites that use the pool must be inside this directory.")
+    parser.add_argument("--health-check-interval", type=int, default=60,
+                        help="Seconds between health checks of idle guests")
+    parser.add_argument("--internal-guest-index", type=int, help=argparse.SUPPRESS)
+
+
+def _run_guest_process():
+    def adjust_args(args: argparse.Namespace):
+        args.pool_dir = args.pool_dir.absolute()
+        args.share_dir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.share_dir)))
+        args.smb_mount_directories.append(
+            boot_cheribsd.SmbMount(args.share_dir, readonly=False, in_target=POOL_SHARE_IN_TARGET))
+        boot_cheribsd.MESSAGE_PREFIX = "\033[0;34m" + "guest" + str(args.internal_guest_index) + ": \033[0m"
+
+    def setup_share_dir(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.Namespace):
+        # Make the shared directory available under the host path so that the clients don't need any setup
+        qemu.run("mkdir -p '{}'".format(Path(args.share_dir).parent))
+        qemu.checked_run("ln -sf {} '{}'".format(POOL_SHARE_IN_TARGET, args.share_dir), timeout=60)
+
+    run_tests_main(test_function=serve_pool_guest, need_ssh=True, should_mount_builddir=False,
+                   test_setup_function=setup_share_dir, argparse_setup_callback=add_pool_args,
+                   argparse_adjust_args_callback=adjust_args)
+
+
+def _run_pool(argv: typing.List[str]):
+    parser = boot_cheribsd.get_argument_parser()
+    add_pool_args(parser)
+    args, _ = parser.parse_known_args(argv)
+    if args.pretend:
+        boot_cheribsd.PRETEND = True
+    if args.pool_size < 1:
+        boot_cheribsd.failure("Invalid pool size: ", args.pool_size)
+    pool_dir = args.pool_dir.absolute()  # type: Path
+    pool_dir.mkdir(parents=True, exist_ok=True)
+    pool_lock = (pool_dir / "pool.lock").open("a")
+    try:
+        fcntl.flock(pool_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        boot_cheribsd.failure("Another guest pool is already running in ", pool_dir)
+    (pool_dir / "pool.pid").write_text(str(os.getpid()))
+    for stale_file in pool_dir.glob("guest-*"):
+        if stale_file.suffix in (".json", ".recycle"):
+            stale_file.unlink()
+    boot_cheribsd.MESSAGE_PREFIX = "\033[0;35m" + "guest pool: \033[0m"
+    # Extract the kernel + disk image once to avoid races between the guest processes:
+    guest_argv = [sys.executable, str(Path(__file__).absolute())] + argv
+    if args.kernel:
+        kernel = boot_cheribsd.maybe_decompress(Path(args.kernel), True, True, args, what="kernel")
+        guest_argv.append("--internal-kernel-override=" + str(kernel))
+    if args.disk_image:
+        disk_image = boot_cheribsd.maybe_decompress(Path(args.disk_image), True, True, args, what="disk image")
+        guest_argv.append("--internal-disk-image-override=" + str(disk_image))
+
+    stop_requested = []  # type: typing.List[int]
+    signal.signal(signal.SIGTERM, lambda signum, _: stop_requested.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, _: stop_requested.append(signum))
+    processes = dict()  # type: typing.Dict[int, subprocess.Popen]
+    start_times = dict()  # type: typing.Dict[int, float]
+    quick_failures = dict((i, 0) for i in range(1, args.pool_size + 1))
+    boot_cheribsd.success("Starting ", args.pool_size, " guests in ", pool_dir)
+    while not stop_requested:
+        now = time.time()
+        for index in range(1, args.pool_size + 1):
+            proc = processes.get(index)
+            if proc is not None:
+                if proc.poll() is None:
+                    continue
+                uptime = now - start_times[index]
+                # A guest that exits shortly after being started probably failed to boot -> back off
+                quick_failures[index] = quick_failures[index] + 1 if uptime < 5 * 60 else 0
+                boot_cheribsd.info("Guest ", index, " exited with status ", proc.returncode, " after ",
+                                   datetime.timedelta(seconds=int(uptime)), ", starting it again")
+                info_file = _guest_file(pool_dir, index, ".json")
+                if info_file.exists():
+                    info_file.unlink()
+                del processes[index]
+                start_times[index] = now + min(5 * 60, 10 * quick_failures[index])
+            if now < start_times.get(index, 0):
+                continue
+            with _guest_file(pool_dir, index, ".out").open("a") as output:
+                cmd = guest_argv + ["--internal-guest-index=" + str(index),
+                                    "--qemu-logfile=" + str(_guest_file(pool_dir, index, ".log"))]
+                boot_cheribsd.print_cmd(cmd)
+                processes[index] = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=output, stderr=output)
+            start_times[index] = now
+        time.sleep(1)
+
+    boot_cheribsd.success("Stopping all guests")
+    for proc in processes.values():
+        proc.send_signal(signal.SIGTERM)
+    for index, proc in processes.items():
+        try:
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            boot_cheribsd.failure("Guest ", index, " did not exit cleanly, killing it", exit=False)
+            proc.kill()
+    (pool_dir / "pool.pid").unlink()
+
+
+def _print_pool_status(pool_dir: Path):
+    for info_file in sorted(pool_dir.glob("guest-*.json")):
+        info = json.loads(info_file.read_text())
+        with _guest_file(pool_dir, info["index"], ".lock").open("a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                state = "idle"
+            except OSError:
+                state = "leased"
+        print("guest ", info["index"], ": ", state, ", SSH port ", info["ssh_port"], ", booted at ", info["booted_at"],
+              sep="")
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--pool-dir", type=Path)
+    parser.add_argument("--stop", action="store_true", help="Stop the pool running in --pool-dir")
+    parser.add_argument("--status", action="store_true", help="Show the guests of the pool running in --pool-dir")
+    parser.add_argument("--internal-guest-index", type=int)
+    args, _ = parser.parse_known_args()
+    if args.internal_guest_index is not None:
+        _run_guest_process()
+    elif args.stop or args.status:
+        if args.pool_dir is None:
+            boot_cheribsd.failure("--pool-dir is required")
+        pid_file = args.pool_dir / "pool.pid"
+        if not pid_file.exists():
+            boot_cheribsd.failure("No guest pool running in ", args.pool_dir)
+        if args.status:
+            _print_pool_status(args.pool_dir)
+        else:
+            os.kill(int(pid_file.read_text()), signal.SIGTERM)
+    else:
+        _run_pool(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
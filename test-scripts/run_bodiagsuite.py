@@ -31,30 +31,163 @@
 #
 import argparse
 import os
+import re
+import shutil
 import sys
+import tempfile
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
 
-from run_tests_common import junitparser, run_tests_main, boot_cheribsd
+from durations_db import adaptive_timeout, open_test_duration_db, record_test_results
+from run_tests_common import run_tests_main, boot_cheribsd
 
 LONG_NAME_FOR_BUILDDIR = "/build-dir-with-long-name-to-ensure-cwd-causes-buffer-overflow"
 
 
+# Characters that are not allowed in XML 1.0 documents (the test output may contain arbitrary bytes)
+_INVALID_XML_CHARS_RE = re.compile("[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f\\ud800-\\udfff\\ufffe\\uffff]")
+
+
+def _xml_text(text: str) -> str:
+    return escape(_INVALID_XML_CHARS_RE.sub("\ufffd", text))
+
+
+def _xml_attr(text: str) -> str:
+    return quoteattr(_INVALID_XML_CHARS_RE.sub("\ufffd", text))
+
+
+class BODiagTestResult(object):
+    __slots__ = ("name", "kind", "result", "message", "system_out", "system_err")
+
+    def __init__(self, name: str, kind: str, result: str = None, message: str = None, system_out: str = None,
+                 system_err: str = None):
+        self.name = name
+        self.kind = kind  # one of BODiagTestsuite.SUITE_KINDS
+        self.result = result  # None for success, otherwise the JUnit result element name
+        self.message = message
+        self.system_out = system_out
+        self.system_err = system_err
+
+
+def parse_test_output(o: Path, tools: list, expected: bool) -> BODiagTestResult:
+    """Parse the exit code (and stderr) of one test. This does not modify any state so it can run in parallel."""
+    stem = o.stem
+    exit_code_str = o.read_text(encoding="utf-8", errors="replace").rstrip()
+    if not expected:
+        return BODiagTestResult(stem, "error", "error", "UNEXPECTED TEST NAME: " + o.name, system_out=exit_code_str)
+    system_err = None
+    stderr_path = o.with_suffix(".stderr")
+    if stderr_path.exists():
+        stderr = stderr_path.read_bytes().rstrip()  # type: bytes
+        stderr = stderr.replace(b"\x00", b"\\0")
+        system_err = stderr.decode("utf-8", errors="replace")
+    try:
+        exit_code = int(exit_code_str)
+    except ValueError:
+        return BODiagTestResult(stem, "error", "error", "INVALID OUTPUT FILE CONTENTS: " + o.name,
+                                system_out=exit_code_str)
+
+    signaled = os.WIFSIGNALED(exit_code)
+    exited = os.WIFEXITED(exit_code)
+    system_out = "WIFSIGNALED={} WIFEXITED={}, WTERMSIG={}, WEXITSTATUS={}" \
+                 " WCOREDUMP={}".format(signaled, exited, os.WTERMSIG(exit_code), os.WEXITSTATUS(exit_code),
+                                        os.WCOREDUMP(exit_code))
+    # -ok testcases are expected to run succesfully -> exit code zero
+    if stem.endswith("-ok"):
+        if not exited or os.WEXITSTATUS(exit_code) != 0:
+            # This is not just a failure, it means something is seriously wrong if the good case fails
+            return BODiagTestResult(stem, "ok", "error", "Expected exit code 0 but got " + exit_code_str,
+                                    system_out=system_out, system_err=system_err)
+        return BODiagTestResult(stem, "ok", system_out=system_out, system_err=system_err)
+    # all others should crash
+    for kind in ("min", "med", "large"):
+        if stem.endswith("-" + kind):
+            break
+    else:
+        return BODiagTestResult(stem, "error", "error", "INVALID OUTPUT FILE FOUND: " + o.name,
+                                system_out=system_out, system_err=system_err)
+    result = BODiagTestResult(stem, kind, system_out=system_out, system_err=system_err)
+    if exit_code == 1 and system_err and system_err.startswith("This test needs a CWD with length"):
+        result.result = "skipped"
+        result.message = "This test needs a large working directory"
+
+    # Handle tool-specific exit codes:
+    if "effectivesan" in tools:
+        # We do not instruct EffectiveSan to terminate on first error:
+        if "BOUNDS ERROR:\n" not in (system_err or ""):
+            result.result = "failure"
+            result.message = "EffectiveSan did not detect a bounds error. Exit code " + exit_code_str
+    elif "softboundcets" in tools:
+        # We do not instruct EffectiveSan to terminate on first error:
+        if "Softboundcets: Memory safety violation detected" not in (system_err or ""):
+            result.result = "failure"
+            result.message = "SoftBoundCETS did not detect a bounds error. Exit code " + exit_code_str
+    else:
+        # Otherwise we assume that the test must be killed by a signal
+        if not signaled:
+            # test should fail with a signal: (162 for CHERI)
+            # TODO: for CHERI check that it was signal 34?
+            result.result = "failure"
+            result.message = "Expected test to be killed by a SIGNAL but got exit code " + exit_code_str
+    return result
+
+
+class StreamingJUnitSuite(object):
+    """Writes the test cases of a suite to a temporary file as they are added and only keeps the statistics in
+    memory. The <testsuite> header (which contains the statistics) is written by copy_to() once all cases are known."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.tests = self.failures = self.errors = self.skipped = 0
+        self._cases = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+", encoding="utf-8")
+
+    def add(self, result: BODiagTestResult):
+        self.tests += 1
+        if result.result == "failure":
+            self.failures += 1
+        elif result.result == "error":
+            self.errors += 1
+        elif result.result == "skipped":
+            self.skipped += 1
+        f = self._cases
+        f.write("    <testcase name=" + _xml_attr(result.name) + ">\n")
+        if result.system_out is not None:
+            f.write("      <system-out>" + _xml_text(result.system_out) + "</system-out>\n")
+        if result.system_err is not None:
+            f.write("      <system-err>" + _xml_text(result.system_err) + "</system-err>\n")
+        if result.result is not None:
+            f.write("      <" + result.result + " message=" + _xml_attr(result.message) + " />\n")
+        f.write("    </testcase>\n")
+
+    def copy_to(self, output: typing.TextIO):
+        output.write('  <testsuite name={} tests="{}" failures="{}" errors="{}" skipped="{}" time="0"'.format(
+            _xml_attr(self.name), self.tests, self.failures, self.errors, self.skipped))
+        if not self.tests:
+            output.write(" />\n")
+            return
+        output.write(">\n")
+        self._cases.seek(0)
+        shutil.copyfileobj(self._cases, output)
+        self._cases.close()
+        output.write("  </testsuite>\n")
+
+
 class BODiagTestsuite(object):
-    def __init__(self, name: str, xml: "junitparser.JUnitXml"):
+    SUITE_KINDS = ("min", "med", "large", "ok", "error")
+
+    def __init__(self, name: str):
         self.test_prefix = name
-        self.min_suite = junitparser.TestSuite(name=name + "-min-overflow")
-        xml.add_testsuite(self.min_suite)
-        self.med_suite = junitparser.TestSuite(name=name + "-med-overflow")
-        xml.add_testsuite(self.med_suite)
-        self.large_suite = junitparser.TestSuite(name=name + "-large-overflow")
-        xml.add_testsuite(self.large_suite)
-        self.ok_suite = junitparser.TestSuite(name=name + "-in-bounds")
-        xml.add_testsuite(self.ok_suite)
-        self.error_suite = junitparser.TestSuite(name=name + "-test-broken")
-        xml.add_testsuite(self.error_suite)
+        self.suites = dict(min=StreamingJUnitSuite(name + "-min-overflow"),
+                           med=StreamingJUnitSuite(name + "-med-overflow"),
+                           large=StreamingJUnitSuite(name + "-large-overflow"),
+                           ok=StreamingJUnitSuite(name + "-in-bounds"),
+                           error=StreamingJUnitSuite(name + "-test-broken"))
 
         # There are 291 tests, we want to check that all of them were run
-        self.expected_test_names = []
+        self.expected_test_names = []  # type: typing.List[str]
         assert name in ("basic", "basic-heap")
         for i in range(291, 0, -1):
             prefix = "{}-{:0>5}".format(name, i)
@@ -62,130 +195,73 @@ class BODiagTestsuite(object):
             self.expected_test_names.append(prefix + "-med")
             self.expected_test_names.append(prefix + "-large")
             self.expected_test_names.append(prefix + "-ok")
+        self.remaining_test_names = set(self.expected_test_names)
 
     def check_all_cases_parsed(self):
         for missing_test in self.expected_test_names:
+            if missing_test not in self.remaining_test_names:
+                continue
             self.error("Could not find output file for test: ", missing_test)
-            testcase = junitparser.TestCase(name=missing_test)
-            testcase.result = junitparser.Error(message="Could not find output for test " + missing_test)
-            self.error_suite.add_testcase(testcase)
+            self.suites["error"].add(BODiagTestResult(missing_test, "error", "error",
+                                                      "Could not find output for test " + missing_test))
 
     def error(self, *args):
         print(self.test_prefix, "ERROR:", *args, file=sys.stderr)
 
-    def handle_testcase(self, o: Path, tools: list):
-        stem = o.stem
-        assert stem.startswith(self.test_prefix), stem
-        exit_code_str = o.read_text(encoding="utf-8", errors="replace").rstrip()
-        testcase = junitparser.TestCase(name=stem)
-        try:
-            index = self.expected_test_names.index(stem)
-        except ValueError:
-            self.error("Found output for unknown test: ", o)
-            testcase.result = junitparser.Error(message="UNEXPECTED TEST NAME: " + o.name)
-            testcase.system_out = exit_code_str
-            self.error_suite.add_testcase(testcase)
-            return
+    def handle_result(self, o: Path, result: BODiagTestResult):
+        if result.kind == "error":
+            self.error(result.message, ": ", o)
+        elif result.result == "error" and result.kind == "ok":
+            self.error("One of the good test cases failed: ", o)
         # test has been handled -> remove from expected list
-        del self.expected_test_names[index]
-        if o.with_suffix(".stderr").exists():
-            stderr = o.with_suffix(".stderr").read_bytes().rstrip()  # type: bytes
-            stderr = stderr.replace(b"\x00", b"\\0")
-            testcase.system_err = stderr.decode("utf-8", errors="replace")
-        try:
-            exit_code = int(exit_code_str)
-        except ValueError:
-            self.error("Malformed output for test: ", o)
-            testcase.result = junitparser.Error(message="INVALID OUTPUT FILE CONTENTS: " + o.name)
-            testcase.system_out = exit_code_str
-            self.error_suite.add_testcase(testcase)
-            return
+        self.remaining_test_names.discard(result.name)
+        self.suites[result.kind].add(result)
 
-        signaled = os.WIFSIGNALED(exit_code)
-        exited = os.WIFEXITED(exit_code)
-        testcase.system_out = "WIFSIGNALED={} WIFEXITED={}, WTERMSIG={}, WEXITSTATUS={}" \
-                              " WCOREDUMP={}".format(signaled, exited, os.WTERMSIG(exit_code),
-                                                     os.WEXITSTATUS(exit_code), os.WCOREDUMP(exit_code))
-        # -ok testcases are expected to run succesfully -> exit code zero
-        if stem.endswith("-ok"):
-            if not exited or os.WEXITSTATUS(exit_code) != 0:
-                # This is not just a failure, it means something is seriously wrong if the good case fails
-                self.error("One of the good test cases failed: ", o)
-                testcase.result = junitparser.Error(message="Expected exit code 0 but got " + exit_code_str)
-            self.ok_suite.add_testcase(testcase)
-        else:
-            # all others should crash
-            if stem.endswith("-min"):
-                suite = self.min_suite
-            elif stem.endswith("-med"):
-                suite = self.med_suite
-            elif stem.endswith("-large"):
-                suite = self.large_suite
-            else:
-                self.error("Malformed output for test: ", o)
-                testcase.result = junitparser.Error(message="INVALID OUTPUT FILE FOUND: " + o.name)
-                self.error_suite.add_testcase(testcase)
-                return
-            if exit_code == 1 and testcase.system_err and testcase.system_err.startswith(
-                    "This test needs a CWD with length"):
-                testcase.result = junitparser.Skipped(message="This test needs a large working directory")
-
-            # Handle tool-specific exit codes:
-            if "effectivesan" in tools:
-                # We do not instruct EffectiveSan to terminate on first error:
-                if "BOUNDS ERROR:\n" not in testcase.system_err:
-                    testcase.result = junitparser.Failure(
-                        message="EffectiveSan did not detect a bounds error. Exit code " + exit_code_str)
-            elif "softboundcets" in tools:
-                # We do not instruct EffectiveSan to terminate on first error:
-                if "Softboundcets: Memory safety violation detected" not in testcase.system_err:
-                    testcase.result = junitparser.Failure(
-                        message="SoftBoundCETS did not detect a bounds error. Exit code " + exit_code_str)
-            else:
-                # Otherwise we assume that the test must be killed by a signal
-                if not signaled:
-                    # test should fail with a signal: (162 for CHERI)
-                    # TODO: for CHERI check that it was signal 34?
-                    testcase.result = junitparser.Failure(
-                        message="Expected test to be killed by a SIGNAL but got exit code " + exit_code_str)
-            suite.add_testcase(testcase)
+    def write_suites(self, output: typing.TextIO):
+        for kind in self.SUITE_KINDS:
+            self.suites[kind].copy_to(output)
 
 
 def _create_junit_xml(builddir: Path, name, tools):
-    xml = junitparser.JUnitXml(name)
-
-    # TODO: check that all cases exist (otherwise add an error)
-    output_files = builddir.glob("run/*.out")
-    sorted_files = []
-    for o in output_files:
-        sorted_files.append(str(o))
-    sorted_files.sort()
-
-    expected_test_names = []
-    testsuite_basic = BODiagTestsuite("basic", xml)
-    testsuite_heap = BODiagTestsuite("basic-heap", xml)
-    # There are 291 tests, we want to check that all of them were run
-    for base_prefix in ("basic", "basic-heap"):
-        for i in range(291, 0, -1):
-            prefix = "{}-{:0>5}".format(base_prefix, i)
-            expected_test_names.append(prefix + "-min")
-            expected_test_names.append(prefix + "-med")
-            expected_test_names.append(prefix + "-large")
-            expected_test_names.append(prefix + "-ok")
-
-    for fullpath in sorted_files:
-        o = Path(fullpath)
-        if "-heap-" in o.stem:
-            testsuite_heap.handle_testcase(o, tools)
-        else:
-            testsuite_basic.handle_testcase(o, tools)
+    run_dir = builddir / "run"
+    output_stems = set()  # type: typing.Set[str]
+    if run_dir.is_dir():
+        output_stems = set(entry.name[:-len(".out")] for entry in os.scandir(str(run_dir))
+                           if entry.name.endswith(".out"))
+    testsuite_basic = BODiagTestsuite("basic")
+    testsuite_heap = BODiagTestsuite("basic-heap")
+    # Look up the expected tests directly instead of sorting all output files. Anything else is reported as an error.
+    work = []  # type: typing.List[typing.Tuple[BODiagTestsuite, Path, bool]]
+    for testsuite in (testsuite_basic, testsuite_heap):
+        for test_name in testsuite.expected_test_names:
+            if test_name in output_stems:
+                output_stems.remove(test_name)
+                work.append((testsuite, run_dir / (test_name + ".out"), True))
+    for stem in sorted(output_stems):
+        work.append((testsuite_heap if "-heap-" in stem else testsuite_basic, run_dir / (stem + ".out"), False))
+
+    # Reading the output files dominates, so parse them in parallel (in chunks to limit the memory usage)
+    chunk_size = 4096
+    with ThreadPoolExecutor(max_workers=min(32, 4 * (os.cpu_count() or 1))) as executor:
+        for chunk_start in range(0, len(work), chunk_size):
+            chunk = work[chunk_start:chunk_start + chunk_size]
+            results = executor.map(lambda w: parse_test_output(w[1], tools, w[2]), chunk)
+            for (testsuite, o, _), result in zip(chunk, results):
+                testsuite.handle_result(o, result)
 
     testsuite_basic.check_all_cases_parsed()
     testsuite_heap.check_all_cases_parsed()
 
-    xml.update_statistics()
+    all_suites = [s for ts in (testsuite_basic, testsuite_heap) for s in ts.suites.values()]
     # Older version of python only support str and not Path
-    xml.write(str(builddir / "test-results.xml"), pretty=True)
+    with open(str(builddir / "test-results.xml"), "w", encoding="utf-8") as output:
+        output.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        output.write('<testsuites name={} tests="{}" failures="{}" errors="{}" skipped="{}" time="0">\n'.format(
+            _xml_attr(name), sum(s.tests for s in all_suites), sum(s.failures for s in all_suites),
+            sum(s.errors for s in all_suites), sum(s.skipped for s in all_suites)))
+        testsuite_basic.write_suites(output)
+        testsuite_heap.write_suites(output)
+        output.write("</testsuites>\n")
 
 
 def create_junit_xml(builddir, name, tools):
@@ -203,18 +279,28 @@ def run_bodiagsuite(qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespa
     boot_cheribsd.info("Running BODiagSuite")
     assert not args.use_valgrind, "Not support for CheriBSD"
 
+    suite = "bodiagsuite-" + args.junit_testsuite_name
+    run_duration = None
     if not args.junit_xml_only:
+        db = open_test_duration_db(args)
+        previous_runs = db.run_durations(suite, args.architecture) if db is not None else []
+        if db is not None:
+            db.close()
+        run_start = time.time()
         qemu.checked_run("rm -rf {}/run".format(LONG_NAME_FOR_BUILDDIR))
         qemu.checked_run("cd {} && mkdir -p run".format(LONG_NAME_FOR_BUILDDIR))
         # Don't log all the CHERI traps while running (should speed up the tests a bit and produce shorter logfiles)
         qemu.run("sysctl machdep.log_user_cheri_exceptions=0 || true")
         qemu.checked_run("{} -r -f {}/Makefile.bsd-run all".format(args.bmake_path, LONG_NAME_FOR_BUILDDIR),
-                         timeout=120 * 60, ignore_cheri_trap=True)
+                         timeout=adaptive_timeout(previous_runs, default=120 * 60, minimum=10 * 60),
+                         ignore_cheri_trap=True)
+        run_duration = time.time() - run_start
         # restore old behaviour
         qemu.run("sysctl machdep.log_user_cheri_exceptions=1 || true")
 
     if not create_junit_xml(Path(args.build_dir), args.junit_testsuite_name, args.tools):
         return False
+    record_test_results(args, suite, [Path(args.build_dir, "test-results.xml")], run_duration=run_duration)
     return True
 
 
@@ -37,17 +37,22 @@ import operator
 import os
 import shlex
 import shutil
+import subprocess
 import sys
+import tarfile
+import tempfile
 import time
+import typing
 from pathlib import Path
 
+from durations_db import adaptive_timeout, open_test_duration_db, record_test_results
 from kyua_db_to_junit_xml import convert_kyua_db_to_junit_xml, fixup_kyua_generated_junit_xml
 from run_tests_common import boot_cheribsd, CrossCompileTarget, pexpect, run_tests_main
 
 
 # TODO: Remove old_binary_name once the new cheribsdtest names are merged to all relevant CheriBSD branches
 def run_cheribsdtest(qemu: boot_cheribsd.QemuCheriBSDInstance, binary_name, old_binary_name,
-                     args: argparse.Namespace) -> bool:
+                     args: argparse.Namespace, timeout=5 * 60) -> bool:
     try:
         qemu.checked_run("rm -f /tmp/{}.xml".format(binary_name))
         # Run it once with textual output (for debugging)
@@ -56,7 +61,7 @@ def run_cheribsdtest(qemu: boot_cheribsd.QemuCheriBSDInstance, binary_name, old_
         # Generate JUnit XML:
         qemu.run("if [ -x /bin/{0} ]; then /bin/{0} -a -x; else /bin/{1} -a -x; fi > /tmp/{0}.xml"
                  .format(binary_name, old_binary_name),
-                 ignore_cheri_trap=True, cheri_trap_fatal=False, timeout=5 * 60)
+                 ignore_cheri_trap=True, cheri_trap_fatal=False, timeout=timeout)
         qemu.sendline("echo EXITCODE=$?")
         qemu.expect(["EXITCODE=(\\d+)\r"], timeout=5, pretend_result=0)
         if boot_cheribsd.PRETEND:
@@ -89,6 +94,128 @@ def run_cheribsdtest(qemu: boot_cheribsd.QemuCheriBSDInstance, binary_name, old_
         return False
 
 
+CHERIBSDTEST_DRIVER_PATH = "/tmp/cheribsdtest-driver.sh"
+CHERIBSDTEST_RESULTS_DIR = "/tmp/cheribsdtest-results"
+CHERIBSDTEST_RESULTS_ARCHIVE = "/tmp/cheribsdtest-results.tar.gz"
+
+
+def cheribsdtest_driver_script(tests: "typing.List[typing.Tuple[str, str, int]]", jobs: int) -> str:
+    """Generate a shell script that runs all cheribsdtest variants (up to jobs at a time, 0 means one per CPU),
+    prints a progress marker after each one and finally packs all JUnit XML files into a single archive."""
+    lines = [
+        "#!/bin/sh",
+        "# Generated by " + Path(__file__).name,
+        "results=" + CHERIBSDTEST_RESULTS_DIR,
+        "rm -rf \"$results\" " + CHERIBSDTEST_RESULTS_ARCHIVE + " && mkdir -p \"$results\" || exit 1",
+        "if command -v timeout >/dev/null 2>&1; then have_timeout=1; else have_timeout=0; fi",
+        "run_test() {",
+        "    if [ -x \"/bin/$1\" ]; then binary=\"/bin/$1\"; else binary=\"/bin/$2\"; fi",
+        "    start=$(date +%s)",
+        "    if [ $have_timeout = 1 ]; then",
+        "        timeout \"$3\" \"$binary\" -a -x > \"$results/$1.xml\" 2> \"$results/$1.log\"",
+        "    else",
+        "        \"$binary\" -a -x > \"$results/$1.xml\" 2> \"$results/$1.log\"",
+        "    fi",
+        "    exit_code=$?",
+        "    echo \"CHERIBSDTEST-DONE: $1 EXITCODE=$exit_code TIME=$(($(date +%s) - start))\"",
+        "}",
+        "jobs=" + str(jobs),
+        "if [ \"$jobs\" -eq 0 ]; then jobs=$(sysctl -n hw.ncpu); fi",
+        # Use a FIFO with one line per free job slot as a work queue: a new variant starts as soon as any of the
+        # running ones has finished instead of waiting for a whole group of variants.
+        "slots=$results/.job-slots",
+        "mkfifo \"$slots\" && exec 3<>\"$slots\" && rm -f \"$slots\" || exit 1",
+        "i=0; while [ $i -lt $jobs ]; do echo >&3; i=$((i + 1)); done",
+    ]
+    # Start the slowest variants first so that the fast ones fill the gaps at the end
+    for test, old_test, timeout in sorted(tests, key=lambda t: t[2], reverse=True):
+        lines.append("read -r slot <&3; {{ run_test {} {} {}; echo >&3; }} &".format(
+            shlex.quote(test), shlex.quote(old_test), timeout))
+    lines.append("wait")
+    lines.append("exec 3>&-")
+    # The variants run concurrently, so print their stderr output one after the other to keep it readable
+    lines.append("for log in \"$results\"/*.log; do echo \"=== ${log##*/}:\"; cat \"$log\"; done")
+    lines.append("tar -czf " + CHERIBSDTEST_RESULTS_ARCHIVE + " -C \"$results\" .")
+    lines.append("echo \"CHERIBSDTEST-ARCHIVED: EXITCODE=$?\"")
+    return "\n".join(lines) + "\n"
+
+
+def run_cheribsdtests_batched(qemu: boot_cheribsd.QemuCheriBSDInstance,
+                              tests: "typing.List[typing.Tuple[str, str, int]]",
+                              args: argparse.Namespace) -> "typing.Dict[str, typing.Tuple[bool, float]]":
+    """Run all cheribsdtest variants using a single driver script instead of one console round-trip per variant.
+    Returns a mapping from test name to (successful, duration)."""
+    results = dict((test, (False, 0.0)) for test, _, _ in tests)  # type: typing.Dict[str, typing.Tuple[bool, float]]
+    script = cheribsdtest_driver_script(tests, args.cheribsdtest_jobs)
+    boot_cheribsd.info("Copying cheribsdtest driver script to ", CHERIBSDTEST_DRIVER_PATH, ":\n", script)
+    if not boot_cheribsd.PRETEND:
+        with tempfile.TemporaryFile() as f:
+            f.write(script.encode("utf-8"))
+            f.seek(0)
+            try:
+                qemu.run_command_via_ssh(["sh", "-c", "cat > " + CHERIBSDTEST_DRIVER_PATH], stdin=f)
+            except subprocess.CalledProcessError as e:
+                boot_cheribsd.failure("Failed to copy cheribsdtest driver script: ", e, exit=False)
+                return results
+    # The tests run concurrently, so allow for the slowest one (and the final archive creation).
+    marker_timeout = max(timeout for _, _, timeout in tests) + 60
+    start = time.time()
+    try:
+        qemu.sendline("sh " + CHERIBSDTEST_DRIVER_PATH)
+        remaining = set(results.keys())
+        while remaining:
+            i = qemu.expect([r"CHERIBSDTEST-DONE: (\S+) EXITCODE=(\d+) TIME=(\d+)\r", pexpect.TIMEOUT],
+                            timeout=marker_timeout, pretend_result=0)
+            if i == 1:
+                runtime = datetime.timedelta(seconds=time.time() - start)
+                raise boot_cheribsd.CheriBSDCommandTimeout("timeout waiting for cheribsdtest results: ", remaining,
+                                                           execution_time=runtime)
+            if boot_cheribsd.PRETEND:
+                for test in remaining:
+                    results[test] = (True, 0.0)
+                break
+            test = qemu.match.group(1)
+            exit_code = int(qemu.match.group(2))
+            results[test] = (exit_code == 0, float(qemu.match.group(3)))
+            remaining.discard(test)
+            boot_cheribsd.info("cheribsdtest progress: ", test, " exited with ", exit_code, " (",
+                               len(results) - len(remaining), "/", len(results), ")")
+        qemu.expect([r"CHERIBSDTEST-ARCHIVED: EXITCODE=0\r"], timeout=5 * 60, pretend_result=0)
+        qemu.expect_prompt()
+    except boot_cheribsd.CheriBSDCommandTimeout as e:
+        boot_cheribsd.failure("Timeout running cheribsdtest: " + str(e), exit=False)
+        qemu.sendintr()
+        qemu.sendintr()
+        # Try to cancel the running command and get back to having a sensible prompt
+        qemu.checked_run("pwd")
+        time.sleep(10)
+        # Still try to retrieve the results of the tests that completed
+        qemu.run("tar -czf {} -C {} .".format(CHERIBSDTEST_RESULTS_ARCHIVE, CHERIBSDTEST_RESULTS_DIR), timeout=5 * 60)
+    boot_cheribsd.success("Running all cheribsdtest variants took ", time.time() - start, " seconds")
+
+    # Transfer all XML files at once and unpack them on the host
+    host_archive = Path(args.test_output_dir, Path(CHERIBSDTEST_RESULTS_ARCHIVE).name)
+    try:
+        if qemu.smb_failed:
+            boot_cheribsd.info("SMB mount has failed, performing normal scp")
+            qemu.scp_from_guest(CHERIBSDTEST_RESULTS_ARCHIVE, host_archive)
+        else:
+            qemu.checked_run("cp -f {} /test-results/{}".format(CHERIBSDTEST_RESULTS_ARCHIVE, host_archive.name))
+            qemu.run("fsync /test-results/" + host_archive.name)
+        if not boot_cheribsd.PRETEND:
+            with tarfile.open(str(host_archive)) as archive:
+                for member in archive.getmembers():
+                    # Only extract the top-level XML and log files (and never outside of the output directory)
+                    if member.isfile() and member.name.endswith((".xml", ".log")):
+                        member.name = Path(member.name).name
+                        archive.extract(member, args.test_output_dir)
+            host_archive.unlink()
+    except (boot_cheribsd.CheriBSDCommandFailed, subprocess.CalledProcessError, tarfile.TarError, OSError) as e:
+        boot_cheribsd.failure("Failed to retrieve cheribsdtest results: ", e, exit=False)
+        return dict((test, (False, duration)) for test, (_, duration) in results.items())
+    return results
+
+
 def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.Namespace):
     boot_cheribsd.success("Booted successfully")
     # Enable userspace CHERI exception logging to aid debugging
@@ -114,6 +241,16 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
         tests_successful = False
 
     host_has_kyua = shutil.which("kyua") is not None
+    # Previous run times are used to choose the timeouts, the new ones are recorded once the JUnit XML is final
+    previous_runs = dict()  # type: typing.Dict[str, typing.List[float]]
+    db = open_test_duration_db(args)
+    if db is not None:
+        try:
+            for suite in _test_suite_names(args):
+                previous_runs[suite] = db.run_durations(suite, args.architecture)
+        finally:
+            db.close()
+    run_durations = dict()  # type: typing.Dict[str, typing.Tuple[Path, float, bool]]
 
     # Run the various cheribsdtest binaries
     if args.run_cheribsdtest:
@@ -122,14 +259,27 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
         # The minimal disk image only has the statically linked base variants:
         cheribsdtest_features = ["-dynamic", "-mt"] if not args.minimal_image else []
         cheribsdtest_bases = [("cheribsdtest-hybrid", "cheritest"), ("cheribsdtest-purecap", "cheriabitest")]
+        cheribsdtests = []  # type: typing.List[typing.Tuple[str, str, int]]
         for base in cheribsdtest_bases:
             for features in itertools.chain(*map(lambda r: itertools.combinations(cheribsdtest_features, r),
                                             range(0, len(cheribsdtest_features)+1))):
                 test = base[0] + ''.join(features)
                 old_test = base[1] + ''.join(features)
-                if not run_cheribsdtest(qemu, test, old_test, args):
-                    tests_successful = False
-                    boot_cheribsd.failure("At least one test failure in", test, exit=False)
+                timeout = adaptive_timeout(previous_runs.get(test, []), default=5 * 60, minimum=2 * 60)
+                cheribsdtests.append((test, old_test, timeout))
+        if args.batch_cheribsdtest:
+            results = run_cheribsdtests_batched(qemu, cheribsdtests, args)
+        else:
+            results = dict()
+            for test, old_test, timeout in cheribsdtests:
+                test_start = time.time()
+                results[test] = (run_cheribsdtest(qemu, test, old_test, args, timeout=timeout),
+                                 time.time() - test_start)
+        for test, (test_successful, duration) in results.items():
+            if not test_successful:
+                tests_successful = False
+                boot_cheribsd.failure("At least one test failure in", test, exit=False)
+            run_durations[test] = (Path(args.test_output_dir, test + ".xml"), duration, test_successful)
         qemu.run("sysctl machdep.log_user_cheri_exceptions=1 || sysctl machdep.log_cheri_exceptions=1")
 
     # Run kyua tests
@@ -144,8 +294,10 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
             # Allow up to 24 hours to run the full testsuite
             # Not a checked run since it might return false if some tests fail
             test_start = datetime.datetime.now()
+            timeout = adaptive_timeout(previous_runs.get(_kyua_suite_name(tests_file), []), default=24 * 60 * 60,
+                                       factor=2, minimum=60 * 60)
             qemu.run("kyua test --results-file=/tmp/results.db -k {}".format(shlex.quote(tests_file)),
-                     ignore_cheri_trap=True, cheri_trap_fatal=False, timeout=24 * 60 * 60)
+                     ignore_cheri_trap=True, cheri_trap_fatal=False, timeout=timeout)
             if i == 0:
                 result_name = "test-results.db"
             else:
@@ -160,6 +312,10 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
                 qemu.checked_run("cp -v /tmp/results.db {}".format(results_db))
                 qemu.checked_run("fsync " + str(results_db))
             boot_cheribsd.success("Running tests for ", tests_file, " took: ", datetime.datetime.now() - test_start)
+            # Note: kyua completed without a timeout, so the duration can be used even if some tests failed
+            run_durations[_kyua_suite_name(tests_file)] = (Path(args.test_output_dir, results_xml.name),
+                                                           (datetime.datetime.now() - test_start).total_seconds(),
+                                                           True)
 
             # run: kyua report-junit --results-file=test-results.db | vis -os > ${CPU}-${TEST_NAME}-test-results.xml
             # Not sure how much we gain by running it on the host instead.
@@ -214,6 +370,8 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
             except Exception as e:
                 boot_cheribsd.failure("Could not update stats in ", junit_dir, ": ", e, exit=False)
                 tests_successful = False
+        for suite, (xml_path, duration, successful) in run_durations.items():
+            record_test_results(args, suite, [xml_path], run_duration=duration, run_successful=successful)
 
     if args.interact or args.skip_poweroff:
         boot_cheribsd.info("Skipping poweroff step since --interact/--skip-poweroff was passed.")
@@ -241,6 +399,18 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
     return tests_successful
 
 
+def _kyua_suite_name(tests_file: str) -> str:
+    return "kyua:" + tests_file
+
+
+def _test_suite_names(args: argparse.Namespace) -> typing.List[str]:
+    result = [_kyua_suite_name(f) for f in args.kyua_tests_files]
+    if args.run_cheribsdtest:
+        for base in ("cheribsdtest-hybrid", "cheribsdtest-purecap"):
+            result.extend(base + suffix for suffix in ("", "-dynamic", "-mt", "-dynamic-mt"))
+    return result
+
+
 def cheribsd_setup_args(args: argparse.Namespace):
     if args.run_cheribsdtest is None:
         # Only hybrid and purecap images have cheribsdtest
@@ -288,6 +458,12 @@ def add_args(parser: argparse.ArgumentParser):
                         help="Run cheribsdtest programs")
     parser.add_argument("--no-run-cheribsdtest", dest="run_cheribsdtest", action="store_false",
                         help="Do not run cheribsdtest programs")
+    parser.add_argument("--batch-cheribsdtest", action="store_true",
+                        help="Run all cheribsdtest programs from a single script inside the guest and retrieve the "
+                             "results as one archive instead of running each one as a separate command")
+    parser.add_argument("--cheribsdtest-jobs", type=int, default=1,
+                        help="Number of cheribsdtest programs to run concurrently with --batch-cheribsdtest "
+                             "(0 means one per guest CPU)")
 
 
 if __name__ == '__main__':
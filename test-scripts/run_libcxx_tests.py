@@ -31,11 +31,14 @@
 #
 import argparse
 import atexit
+import copy
 import datetime
 import os
+import queue
 import signal
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import typing
@@ -43,10 +46,13 @@ from multiprocessing import Barrier, Process, Queue
 from pathlib import Path
 from queue import Empty
 
+import qemu_guest_pool
 import run_remote_lit_test
-from run_remote_lit_test import mp_debug
+from run_remote_lit_test import async_console, mp_debug
 # To combine the test result xmls
 from run_tests_common import boot_cheribsd, junitparser, run_tests_main
+from pycheribuild.qemu_utils import QemuOptions
+from pycheribuild.utils import find_free_port
 
 
 def add_cmdline_args(parser: argparse.ArgumentParser):
@@ -54,7 +60,8 @@ def add_cmdline_args(parser: argparse.ArgumentParser):
                                                 allow_multiprocessing=True)
 
 
-def run_shard(q: Queue, barrier: Barrier, num, total, ssh_port_queue, kernel, disk_image, build_dir):
+def run_shard(q: Queue, barrier: Barrier, num, total, ssh_port_queue, kernel, disk_image, build_dir,
+              test_batches: Queue = None):
     sys.argv.append("--internal-num-shards=" + str(total))
     sys.argv.append("--internal-shard=" + str(num))
     if kernel is not None:
@@ -68,14 +75,16 @@ def run_shard(q: Queue, barrier: Barrier, num, total, ssh_port_queue, kernel, di
     boot_cheribsd.QEMU_LOGFILE = Path(build_dir, "shard-" + str(num) + ".log")
     boot_cheribsd.info("writing CheriBSD output to ", boot_cheribsd.QEMU_LOGFILE)
     try:
-        libcxx_main(barrier=barrier, mp_queue=q, ssh_port_queue=ssh_port_queue, shard_num=num)
+        libcxx_main(barrier=barrier, mp_queue=q, ssh_port_queue=ssh_port_queue, shard_num=num,
+                    test_batches=test_batches)
         boot_cheribsd.success("====> Job ", num, " completed")
     except Exception as e:
         boot_cheribsd.failure("Job ", num, " failed: ", e, exit=False)
         raise
 
 
-def libcxx_main(barrier: Barrier = None, mp_queue: Queue = None, ssh_port_queue: Queue = None, shard_num: int = None):
+def libcxx_main(barrier: Barrier = None, mp_queue: Queue = None, ssh_port_queue: Queue = None, shard_num: int = None,
+                test_batches: Queue = None):
     def set_cmdline_args(args: argparse.Namespace):
         boot_cheribsd.info("Setting args:", args)
         if mp_queue:
@@ -94,8 +103,12 @@ def libcxx_main(barrier: Barrier = None, mp_queue: Queue = None, ssh_port_queue:
         with tempfile.TemporaryDirectory(prefix="cheribuild-libcxx-tests-") as tempdir:
             # TODO: do we need lit_extra_args=["-Denable_filesystem=False"]?
             # Some of the tests might fail on a SMBFS directory.
-            return run_remote_lit_test.run_remote_lit_tests("libcxx", qemu, args, tempdir, mp_q=mp_queue,
-                                                            barrier=barrier)
+            result = run_remote_lit_test.run_remote_lit_tests("libcxx", qemu, args, tempdir, mp_q=mp_queue,
+                                                              barrier=barrier, test_batches=test_batches)
+            if shard_num is None:
+                # The main process records the merged results when running multiple shards
+                run_remote_lit_test.record_lit_test_results(args, "libcxx")
+            return result
 
     try:
         run_tests_main(test_function=run_libcxx_tests, need_ssh=True,  # we need ssh running to execute the tests
@@ -135,12 +148,13 @@ def run_parallel(args: argparse.Namespace):
                                                  what="kernel") if args.kernel else None
     disk_image_path = boot_cheribsd.maybe_decompress(Path(args.disk_image), True, True,
                                                      args, what="disk image") if args.disk_image else None
+    test_batches = queue_test_batches(args, Queue())
     for i in range(args.parallel_jobs):
         shard_num = i + 1
         boot_cheribsd.info(args)
         p = LitShardProcess(target=run_shard, args=(
             mp_q, mp_barrier, shard_num, args.parallel_jobs, ssh_port_queue, kernel_path, disk_image_path,
-            args.build_dir))
+            args.build_dir, test_batches))
         p.stage = run_remote_lit_test.MultiprocessStages.FINDING_SSH_PORT
         p.daemon = True  # kill process on parent exit
         p.name = "<LIBCXX test shard " + str(shard_num) + ">"
@@ -157,46 +171,197 @@ def run_parallel(args: argparse.Namespace):
         wait_or_terminate_all_shards(processes, max_time=5, timed_out=False)
         # merge junit xml files
         if args.xunit_output:
-            boot_cheribsd.success("Merging JUnit XML outputs")
-            result = junitparser.JUnitXml()
-            xunit_file = Path(args.xunit_output).absolute()
             dump_processes(processes)
+            shard_errors = dict()  # type: typing.Dict[int, str]
             for i in range(args.parallel_jobs):
-                shard_num = i + 1
-                shard_file = xunit_file.with_name("shard-" + str(shard_num) + "-" + xunit_file.name)
                 mp_debug(args, processes[i], processes[i].stage)
-                if shard_file.exists():
-                    result += junitparser.JUnitXml.fromfile(str(shard_file))
-                else:
-                    error_msg = "ERROR: could not find JUnit XML " + str(shard_file) + " for shard " + str(shard_num)
-                    boot_cheribsd.failure(error_msg, exit=False)
-                    error_suite = junitparser.TestSuite(name="failed-shard-" + str(shard_num))
-                    error_case = junitparser.TestCase(name="cannot-find-file")
-                    error_case.classname = "failed-shard-" + str(shard_num)
-                    error_case.result = junitparser.Error(message=error_msg)
-                    error_suite.add_testcase(error_case)
-                    result.add_testsuite(error_suite)
                 if processes[i].stage != run_remote_lit_test.MultiprocessStages.EXITED:
-                    error_msg = "ERROR: shard " + str(shard_num) + " did not exit cleanly! Was in stage: " + processes[
+                    error_msg = "ERROR: shard " + str(i + 1) + " did not exit cleanly! Was in stage: " + processes[
                         i].stage.value
                     if hasattr(processes[i], "error_message"):
                         error_msg += "\nError message:\n" + processes[i].error_message
-                    error_suite = junitparser.TestSuite(name="bad-exit-shard-" + str(shard_num))
-                    error_case = junitparser.TestCase(name="bad-exit-status")
-                    error_case.result = junitparser.Error(message=error_msg)
-                    error_suite.add_testcase(error_case)
-                    result.add_testsuite(error_suite)
-
-            result.update_statistics()
-            result.write(str(xunit_file))
-            if args.pretend:
-                print(xunit_file.read_text())
-            boot_cheribsd.success("Done merging JUnit XML outputs into ", xunit_file)
-            print("Duration: ", result.time)
-            print("Tests: ", result.tests)
-            print("Failures: ", result.failures)
-            print("Errors: ", result.errors)
-            print("Skipped: ", result.skipped)
+                    shard_errors[i + 1] = error_msg
+            merge_xunit_outputs(args, args.parallel_jobs, shard_errors, test_batches)
+            run_remote_lit_test.record_lit_test_results(args, "libcxx")
+
+
+def merge_xunit_outputs(args: argparse.Namespace, num_shards: int, shard_errors: "typing.Dict[int, str]",
+                        test_batches: "typing.Union[Queue, queue.Queue]" = None):
+    boot_cheribsd.success("Merging JUnit XML outputs")
+    result = junitparser.JUnitXml()
+    xunit_file = Path(args.xunit_output).absolute()
+    for shard_num in range(1, num_shards + 1):
+        shard_file = xunit_file.with_name("shard-" + str(shard_num) + "-" + xunit_file.name)
+        if shard_file.exists():
+            result += junitparser.JUnitXml.fromfile(str(shard_file))
+        else:
+            error_msg = "ERROR: could not find JUnit XML " + str(shard_file) + " for shard " + str(shard_num)
+            boot_cheribsd.failure(error_msg, exit=False)
+            error_suite = junitparser.TestSuite(name="failed-shard-" + str(shard_num))
+            error_case = junitparser.TestCase(name="cannot-find-file")
+            error_case.classname = "failed-shard-" + str(shard_num)
+            error_case.result = junitparser.Error(message=error_msg)
+            error_suite.add_testcase(error_case)
+            result.add_testsuite(error_suite)
+        if shard_num in shard_errors:
+            error_suite = junitparser.TestSuite(name="bad-exit-shard-" + str(shard_num))
+            error_case = junitparser.TestCase(name="bad-exit-status")
+            error_case.result = junitparser.Error(message=shard_errors[shard_num])
+            error_suite.add_testcase(error_case)
+            result.add_testsuite(error_suite)
+    unfinished = run_remote_lit_test.unfinished_lit_test_batches_suite(test_batches)
+    if unfinished is not None:
+        result.add_testsuite(unfinished)
+
+    result.update_statistics()
+    result.write(str(xunit_file))
+    if args.pretend:
+        print(xunit_file.read_text())
+    boot_cheribsd.success("Done merging JUnit XML outputs into ", xunit_file)
+    print("Duration: ", result.time)
+    print("Tests: ", result.tests)
+    print("Failures: ", result.failures)
+    print("Errors: ", result.errors)
+    print("Skipped: ", result.skipped)
+
+
+def queue_test_batches(args: argparse.Namespace, test_batches: "typing.Union[Queue, queue.Queue]"):
+    # Returns None if static lit sharding should be used
+    if not args.dynamic_sharding or (args.parallel_jobs or 1) < 2:
+        return None
+    batch_args = copy.copy(args)
+    batch_args.build_dir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.build_dir)))
+    if not run_remote_lit_test.queue_lit_test_batches(batch_args, test_batches, num_workers=args.parallel_jobs,
+                                                      testsuite="libcxx", llvm_lit_path=args.llvm_lit_path):
+        return None
+    return test_batches
+
+
+def run_on_guest_pool(args: argparse.Namespace):
+    # Instead of booting one guest per shard, lease already booted guests from a qemu_guest_pool.py instance.
+    # Since the guests are reused there is no need for the barrier/queue synchronization used by run_parallel().
+    if args.pretend:
+        boot_cheribsd.PRETEND = True
+    num_shards = args.parallel_jobs or 1
+    if num_shards < 1:
+        boot_cheribsd.failure("Invalid number of parallel jobs: ", num_shards, exit=True)
+    args.build_dir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.build_dir)))
+    boot_cheribsd.success("Running libcxx tests on ", num_shards, " guest(s) from the pool in ", args.guest_pool)
+    starttime = datetime.datetime.now()
+    shard_errors = dict()  # type: typing.Dict[int, str]
+    shard_results = dict()  # type: typing.Dict[int, bool]
+    test_batches = queue_test_batches(args, queue.Queue())
+
+    def run_shard_on_pool_guest(shard_num: int):
+        shard_args = copy.copy(args)
+        shard_args.smb_mount_directories = []  # not used with the pool
+        shard_args.internal_shard = shard_num if num_shards > 1 else None
+        shard_args.internal_num_shards = num_shards if num_shards > 1 else None
+        try:
+            run_remote_lit_test.adjust_common_cmdline_args(shard_args)
+            with qemu_guest_pool.lease_guest(Path(args.guest_pool)) as guest:
+                shard_results[shard_num] = run_remote_lit_test.run_remote_lit_tests_on_pool_guest(
+                    "libcxx", guest, shard_args, test_batches=test_batches)
+        except BaseException as e:
+            boot_cheribsd.failure("Shard ", shard_num, " failed: ", e, exit=False)
+            boot_cheribsd.info("".join(traceback.format_tb(sys.exc_info()[2])))
+            shard_errors[shard_num] = str(type(e)) + ": " + str(e)
+
+    threads = [threading.Thread(target=run_shard_on_pool_guest, args=(i,), name="libcxx shard " + str(i))
+               for i in range(1, num_shards + 1)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if num_shards > 1 and args.xunit_output:
+        merge_xunit_outputs(args, num_shards, shard_errors, test_batches)
+    run_remote_lit_test.record_lit_test_results(args, "libcxx")
+    boot_cheribsd.success("Total execution time for libcxx tests on pool guests: ", datetime.datetime.now() - starttime)
+    if shard_errors:
+        boot_cheribsd.failure("Error running the test jobs!", exit=True)
+    if not all(shard_results.values()):
+        boot_cheribsd.failure("ERROR: Some tests failed!", exit=False)
+        sys.exit(2)  # different exit code for test failures
+
+
+def run_on_async_guests(args: argparse.Namespace):
+    # Boot all guests from this process and drive their consoles from a single event loop instead of using one
+    # process (and console flushing thread) per shard like run_parallel().
+    if args.pretend:
+        boot_cheribsd.failure("--async-guests cannot be used with --pretend", exit=True)
+    num_shards = args.parallel_jobs or 1
+    if num_shards < 1:
+        boot_cheribsd.failure("Invalid number of parallel jobs: ", num_shards, exit=True)
+    args.build_dir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.build_dir)))
+    xtarget = boot_cheribsd.SUPPORTED_ARCHITECTURES.get(args.architecture, None)
+    if xtarget is None:
+        boot_cheribsd.failure("Invalid architecture ", args.architecture, exit=True)
+    qemu_options = QemuOptions(xtarget)
+    qemu_cmd = Path(args.qemu_cmd).absolute() if args.qemu_cmd else qemu_options.get_qemu_binary()
+    if qemu_cmd is None:
+        boot_cheribsd.failure("ERROR: Cannot find QEMU binary for target ", qemu_options.qemu_arch_sufffix, exit=True)
+    kernel_path = boot_cheribsd.maybe_decompress(Path(args.kernel), True, True, args, what="kernel")
+    disk_image_path = boot_cheribsd.maybe_decompress(Path(args.disk_image), True, True,
+                                                     args, what="disk image") if args.disk_image else None
+    qemu_img = boot_cheribsd.find_qemu_img(qemu_cmd)
+    if disk_image_path is not None and qemu_img is None:
+        boot_cheribsd.failure("Cannot share the disk image between guests without qemu-img", exit=True)
+    boot_cheribsd.success("Running libcxx tests on ", num_shards, " guest(s) driven from a single process")
+    starttime = datetime.datetime.now()
+    test_batches = queue_test_batches(args, queue.Queue())
+
+    async def run_async_shard(shard_num: int, tempdir: Path) -> bool:
+        shard_args = copy.copy(args)
+        shard_args.internal_shard = shard_num if num_shards > 1 else None
+        shard_args.internal_num_shards = num_shards if num_shards > 1 else None
+        run_remote_lit_test.adjust_common_cmdline_args(shard_args)
+        overlay = None
+        if disk_image_path is not None:
+            # All guests boot the same image, so each one writes to its own copy-on-write overlay
+            overlay = tempdir / "disk.qcow2"
+            boot_cheribsd.run_host_command([str(qemu_img), "create", "-q", "-f", "qcow2", "-F", "raw", "-b",
+                                            str(disk_image_path.absolute()), str(overlay)])
+        free_port = find_free_port()
+        free_port.socket.close()
+        smb_dirs = [boot_cheribsd.SmbMount(args.build_dir, readonly=False, in_target="/build")]
+        with Path(args.build_dir, "shard-" + str(shard_num) + ".log").open("w") as logfile:
+            guest = await async_console.boot_cheribsd_async(
+                qemu_options, qemu_cmd, kernel_path, overlay, free_port.port, Path(args.ssh_key),
+                name="shard" + str(shard_num), smb_dirs=smb_dirs, bios_path=args.bios,
+                disk_image_format="qcow2" if overlay is not None else "raw",
+                logfile=logfile)
+            try:
+                await guest.run("sysctl kern.coredump=0")
+                await async_console.mount_smb_directories(guest)
+                # Also make the build directory available under the host path (see run_tests_main())
+                await guest.run("mkdir -p '{}'".format(Path(args.build_dir).parent))
+                await guest.checked_run("ln -sf /build '{}'".format(args.build_dir), timeout=60)
+                await guest.run("chmod 777 /tmp")
+                return await run_remote_lit_test.run_remote_lit_tests_on_async_guest(
+                    "libcxx", guest, shard_args, str(tempdir), llvm_lit_path=args.llvm_lit_path,
+                    test_batches=test_batches)
+            finally:
+                await guest.terminate()
+
+    with tempfile.TemporaryDirectory(prefix="cheribuild-libcxx-tests-") as tempdir:
+        shard_dirs = [Path(tempdir, "shard-" + str(i)) for i in range(1, num_shards + 1)]
+        for d in shard_dirs:
+            d.mkdir()
+        results = async_console.run_concurrently(run_async_shard(i, d) for i, d in enumerate(shard_dirs, start=1))
+    shard_errors = dict()  # type: typing.Dict[int, str]
+    for shard_num, result in enumerate(results, start=1):
+        if isinstance(result, BaseException):
+            boot_cheribsd.failure("Shard ", shard_num, " failed: ", result, exit=False)
+            shard_errors[shard_num] = str(type(result)) + ": " + str(result)
+    if num_shards > 1 and args.xunit_output:
+        merge_xunit_outputs(args, num_shards, shard_errors, test_batches)
+    run_remote_lit_test.record_lit_test_results(args, "libcxx")
+    boot_cheribsd.success("Total execution time for libcxx tests: ", datetime.datetime.now() - starttime)
+    if shard_errors:
+        boot_cheribsd.failure("Error running the test jobs!", exit=True)
+    if not all(results):
+        boot_cheribsd.failure("ERROR: Some tests failed!", exit=False)
+        sys.exit(2)  # different exit code for test failures
 
 
 def wait_or_terminate_all_shards(processes, max_time, timed_out):
@@ -379,7 +544,11 @@ def main():
     args, remainder = parser.parse_known_args(list(filter(lambda x: x != "-h" and x != "--help", sys.argv)))
     # If parallel is set spawn N processes and use the lit --num-shards + --run-shard flags to split the work
     # Since a full run takes about 16 hours this should massively reduce the amount of time needed.
-    if args.parallel_jobs and args.parallel_jobs != 1:
+    if args.guest_pool:
+        run_on_guest_pool(args)
+    elif args.async_guests:
+        run_on_async_guests(args)
+    elif args.parallel_jobs and args.parallel_jobs != 1:
         run_parallel(args)
     else:
         libcxx_main()
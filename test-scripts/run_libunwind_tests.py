@@ -30,43 +30,71 @@
 # SUCH DAMAGE.
 #
 import argparse
+import os
 import sys
 import tempfile
+from pathlib import Path
 
+import qemu_guest_pool
 import run_remote_lit_test
-from run_tests_common import boot_cheribsd, run_tests_main
+from run_tests_common import CrossCompileTarget, boot_cheribsd, run_tests_main
 
 
-def setup_libunwind_env(qemu: boot_cheribsd.CheriBSDInstance, _: argparse.Namespace):
+def libunwind_setup_commands(xtarget: CrossCompileTarget, build_dir="/build", sysroot_dir="/sysroot") -> list:
     # We also need libdl and libcxxrt from the sysroot:
-    libdir = "libcheri" if qemu.xtarget.is_cheri_purecap() else "lib64"
-    qemu.checked_run("ln -sfv /build/lib/libunwind.so* /usr/{libdir}/".format(libdir=libdir))
-    qemu.checked_run("ln -sfv /sysroot/usr/{libdir}/libcxxrt.so* /sysroot/usr/{libdir}/libdl.so* /usr/{libdir}/".format(
-        libdir=libdir))
-    # Add a fake libgcc_s link to libunwind (this works now that we build libunwind with version info)
-    qemu.checked_run("ln -sfv /usr/{libdir}/libunwind.so /usr/{libdir}/libgcc_s.so.1".format(libdir=libdir))
+    libdir = "libcheri" if xtarget.is_cheri_purecap() else "lib64"
+    return ["ln -sfv {build}/lib/libunwind.so* /usr/{libdir}/".format(build=build_dir, libdir=libdir),
+            "ln -sfv {sysroot}/usr/{libdir}/libcxxrt.so* {sysroot}/usr/{libdir}/libdl.so* /usr/{libdir}/".format(
+                sysroot=sysroot_dir, libdir=libdir),
+            # Add a fake libgcc_s link to libunwind (this works now that we build libunwind with version info)
+            "ln -sfv /usr/{libdir}/libunwind.so /usr/{libdir}/libgcc_s.so.1".format(libdir=libdir)]
+
+
+def setup_libunwind_env(qemu: boot_cheribsd.CheriBSDInstance, _: argparse.Namespace):
+    for cmd in libunwind_setup_commands(qemu.xtarget):
+        qemu.checked_run(cmd)
+
 
+def run_libunwind_tests(qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespace, guest=None):
+    def run_lit_tests(lit_extra_args: list) -> bool:
+        if guest is not None:
+            return run_remote_lit_test.run_remote_lit_tests_on_pool_guest("libunwind", guest, args,
+                                                                          lit_extra_args=lit_extra_args,
+                                                                          llvm_lit_path=args.llvm_lit_path)
+        return run_remote_lit_test.run_remote_lit_tests("libunwind", qemu, args, tempdir,
+                                                        lit_extra_args=lit_extra_args,
+                                                        llvm_lit_path=args.llvm_lit_path)
 
-def run_libunwind_tests(qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespace):
     with tempfile.TemporaryDirectory(prefix="cheribuild-libunwind-tests-") as tempdir:
         # run the tests both for shared and static libunwind by setting -Denable_shared=
         # First static binaries
-        static_everything_success = run_remote_lit_test.run_remote_lit_tests("libunwind", qemu, args, tempdir,
-                                                                             lit_extra_args=[
-                                                                                 "-Dforce_static_executable=True",
-                                                                                 "-Denable_shared=False"],
-                                                                             llvm_lit_path=args.llvm_lit_path)
+        static_everything_success = run_lit_tests(["-Dforce_static_executable=True", "-Denable_shared=False"])
         # dynamic binary with libunwind linked statically
-        static_libunwind_success = run_remote_lit_test.run_remote_lit_tests("libunwind", qemu, args, tempdir,
-                                                                            lit_extra_args=["-Denable_shared=False"],
-                                                                            llvm_lit_path=args.llvm_lit_path)
+        static_libunwind_success = run_lit_tests(["-Denable_shared=False"])
         # dynamic binary with libunwind linked shared
-        shared_success = run_remote_lit_test.run_remote_lit_tests("libunwind", qemu, args, tempdir,
-                                                                  lit_extra_args=["-Denable_shared=True"],
-                                                                  llvm_lit_path=args.llvm_lit_path)
+        shared_success = run_lit_tests(["-Denable_shared=True"])
         return static_libunwind_success and static_everything_success and shared_success
 
 
+def run_on_guest_pool(args: argparse.Namespace):
+    if args.pretend:
+        boot_cheribsd.PRETEND = True
+    args.build_dir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.build_dir)))
+    args.sysroot_dir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.sysroot_dir)))
+    adjust_cmdline_args(args)
+    xtarget = boot_cheribsd.SUPPORTED_ARCHITECTURES[args.architecture]
+    # The setup replaces libraries in /usr so the guest must be rebooted before it can be used by other test suites.
+    with qemu_guest_pool.lease_guest(Path(args.guest_pool), recycle_after_use=True) as guest:
+        if not guest.is_visible_in_guest(args.sysroot_dir):
+            boot_cheribsd.failure("Sysroot ", args.sysroot_dir, " is not inside the guest pool share directory ",
+                                  guest.share_dir)
+        for cmd in libunwind_setup_commands(xtarget, build_dir=args.build_dir, sysroot_dir=args.sysroot_dir):
+            guest.run(cmd)
+        if not run_libunwind_tests(None, args, guest=guest):
+            boot_cheribsd.failure("ERROR: Some tests failed!", exit=False)
+            sys.exit(2)  # different exit code for test failures
+
+
 def add_cmdline_args(parser: argparse.ArgumentParser):
     # Only 10 tests, don't do the multiprocessing here
     run_remote_lit_test.add_common_cmdline_args(parser, default_xunit_output="qemu-libunwind-test-results.xml",
@@ -80,10 +108,23 @@ def adjust_cmdline_args(args: argparse.Namespace):
     run_remote_lit_test.adjust_common_cmdline_args(args)
 
 
+def main():
+    parser = boot_cheribsd.get_argument_parser()
+    parser.add_argument("--build-dir")
+    parser.add_argument("--sysroot-dir")
+    add_cmdline_args(parser)
+    # Don't let this parser capture --help
+    args, _ = parser.parse_known_args(list(filter(lambda x: x != "-h" and x != "--help", sys.argv[1:])))
+    if args.guest_pool:
+        run_on_guest_pool(args)
+        return
+    run_tests_main(test_function=run_libunwind_tests, need_ssh=True,  # we need ssh running to execute the tests
+                   argparse_setup_callback=add_cmdline_args, argparse_adjust_args_callback=adjust_cmdline_args,
+                   should_mount_sysroot=True, should_mount_builddir=True, test_setup_function=setup_libunwind_env)
+
+
 if __name__ == '__main__':
     try:
-        run_tests_main(test_function=run_libunwind_tests, need_ssh=True,  # we need ssh running to execute the tests
-                       argparse_setup_callback=add_cmdline_args, argparse_adjust_args_callback=adjust_cmdline_args,
-                       should_mount_sysroot=True, should_mount_builddir=True, test_setup_function=setup_libunwind_env)
+        main()
     finally:
         print("Finished running ", " ".join(sys.argv))
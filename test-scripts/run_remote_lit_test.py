@@ -30,9 +30,13 @@
 # SUCH DAMAGE.
 #
 import argparse
+import asyncio
 import datetime
 import multiprocessing
 import os
+import queue
+import re
+import statistics
 import subprocess
 import sys
 import threading
@@ -41,7 +45,10 @@ import typing
 from enum import Enum
 from pathlib import Path
 
-from run_tests_common import boot_cheribsd, pexpect, commandline_to_str
+import durations_db
+from run_tests_common import boot_cheribsd, junitparser, pexpect, commandline_to_str
+# Must be imported after run_tests_common since that adds the pycheribuild directory to sys.path
+from pycheribuild.boot_cheribsd import async_console
 
 KERNEL_PANIC = False
 COMPLETED = "COMPLETED"
@@ -69,11 +76,24 @@ def add_common_cmdline_args(parser: argparse.ArgumentParser, default_xunit_outpu
     parser.add_argument("--llvm-lit-path")
     parser.add_argument("--xunit-output", default=default_xunit_output)
     parser.add_argument("--lit-debug-output", action="store_true")
+    parser.add_argument("--guest-pool", metavar="POOL_DIR",
+                        help="Run the tests on guests leased from the qemu_guest_pool.py instance managing POOL_DIR "
+                             "instead of booting a new guest")
     # For the parallel jobs
     if allow_multiprocessing:
         parser.add_argument("--multiprocessing-debug", action="store_true")
         parser.add_argument("--parallel-jobs", metavar="N", type=int,
                             help="Split up the testsuite into N parallel jobs")
+        parser.add_argument("--dynamic-sharding", action="store_true", default=True,
+                            help="Discover all tests on the host and hand out batches (longest tests first) to "
+                                 "whichever job becomes idle instead of using a static lit shard per job")
+        parser.add_argument("--no-dynamic-sharding", action="store_false", dest="dynamic_sharding")
+        parser.add_argument("--async-guests", action="store_true",
+                            help="Boot and monitor all --parallel-jobs guests from a single process (using asyncio) "
+                                 "instead of starting one process per guest")
+        parser.add_argument("--test-durations-from", metavar="XML", action="append", default=[],
+                            help="JUnit XML file with the test durations of a previous run that is used to schedule "
+                                 "the longest tests first (default: the previous --xunit-output)")
         parser.add_argument("--internal-num-shards", type=int, help=argparse.SUPPRESS)
         parser.add_argument("--internal-shard", type=int, help=argparse.SUPPRESS)
 
@@ -134,9 +154,51 @@ def flush_thread(f, qemu: boot_cheribsd.QemuCheriBSDInstance, should_exit_event:
     boot_cheribsd.success("QEMU output flushing thread terminated.")
 
 
+def ssh_config_contents(port: int, ssh_pubkey: str, control_persist: str,
+                        host: str = "cheribsd-test-instance") -> str:
+    user = "root"  # TODO: run these tests as non-root!
+    # TODO: move this to boot_cheribsd.py
+    return """
+Host {host}
+        User {user}
+        HostName localhost
+        Port {port}
+        IdentityFile {ssh_key}
+        # avoid errors due to changed host key:
+        UserKnownHostsFile /dev/null
+        StrictHostKeyChecking no
+        NoHostAuthenticationForLocalhost yes
+        # faster connection by reusing the existing one:
+        ControlPath {home}/.ssh/controlmasters/%r@%h:%p
+        # ConnectTimeout 20
+        # ConnectionAttempts 2
+        ControlMaster auto
+        ControlPersist {control_persist}
+""".format(host=host, user=user, port=port, ssh_key=Path(ssh_pubkey).with_suffix(""), home=Path.home(),
+           control_persist=control_persist)
+
+
+def ssh_executor_command(args: argparse.Namespace, ssh_host: str, ssh_config: Path,
+                         shared_mount_remote_dir: str) -> str:
+    """Returns the lit executor that runs the tests using ssh.py. The shared temporary directory (if used) must be
+    visible as shared_mount_remote_dir/<name> inside the guest."""
+    extra_ssh_args = commandline_to_str(("-n", "-4", "-F", str(ssh_config)))
+    ssh_executor_args = [args.ssh_executor_script, "--host", ssh_host, "--extra-ssh-args=" + extra_ssh_args]
+    if args.use_shared_mount_for_tests:
+        # If we have a shared directory use that to massively speed up running tests
+        ssh_executor_args.append("--shared-mount-local-path=" + str(args.shared_tmpdir_local))
+        remote_path = Path(shared_mount_remote_dir, args.shared_tmpdir_local.name)
+        ssh_executor_args.append("--shared-mount-remote-path=" + str(remote_path))
+    else:
+        # slow executor using scp:
+        ssh_executor_args.append("--extra-scp-args=" + commandline_to_str(("-F", str(ssh_config))))
+    return commandline_to_str(ssh_executor_args)
+
+
 def run_remote_lit_tests(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespace, tempdir: str,
                          mp_q: multiprocessing.Queue = None, barrier: multiprocessing.Barrier = None,
-                         llvm_lit_path: str = None, lit_extra_args: list = None) -> bool:
+                         llvm_lit_path: str = None, lit_extra_args: list = None,
+                         test_batches: multiprocessing.Queue = None) -> bool:
     try:
         import psutil  # noqa: F401
     except ImportError:
@@ -145,7 +207,8 @@ def run_remote_lit_tests(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, a
         if mp_q:
             assert barrier is not None
         result = run_remote_lit_tests_impl(testsuite=testsuite, qemu=qemu, args=args, tempdir=tempdir, barrier=barrier,
-                                           mp_q=mp_q, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args)
+                                           mp_q=mp_q, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args,
+                                           test_batches=test_batches)
         if mp_q:
             mp_q.put((COMPLETED, args.internal_shard))
         return result
@@ -159,7 +222,8 @@ def run_remote_lit_tests(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, a
 
 def run_remote_lit_tests_impl(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespace,
                               tempdir: str, mp_q: multiprocessing.Queue = None, barrier: multiprocessing.Barrier = None,
-                              llvm_lit_path: str = None, lit_extra_args: list = None) -> bool:
+                              llvm_lit_path: str = None, lit_extra_args: list = None,
+                              test_batches: multiprocessing.Queue = None) -> bool:
     qemu.EXIT_ON_KERNEL_PANIC = False  # since we run multiple threads we shouldn't use sys.exit()
     boot_cheribsd.info("PID of QEMU: ", qemu.pid)
 
@@ -172,30 +236,10 @@ def run_remote_lit_tests_impl(testsuite: str, qemu: boot_cheribsd.CheriBSDInstan
         raise RuntimeError("SOMETHING WENT WRONG!")
     qemu.checked_run("cat /root/.ssh/authorized_keys", timeout=20)
     port = args.ssh_port
-    user = "root"  # TODO: run these tests as non-root!
     test_build_dir = Path(args.build_dir)
-    # TODO: move this to boot_cheribsd.py
-    config_contents = """
-Host cheribsd-test-instance
-        User {user}
-        HostName localhost
-        Port {port}
-        IdentityFile {ssh_key}
-        # avoid errors due to changed host key:
-        UserKnownHostsFile /dev/null
-        StrictHostKeyChecking no
-        NoHostAuthenticationForLocalhost yes
-        # faster connection by reusing the existing one:
-        ControlPath {home}/.ssh/controlmasters/%r@%h:%p
-        # ConnectTimeout 20
-        # ConnectionAttempts 2
-        ControlMaster auto
-""".format(user=user, port=port, ssh_key=Path(args.ssh_key).with_suffix(""), home=Path.home())
-    config_contents += "        ControlPersist {control_persist}\n"
-    # print("Writing ssh config: ", config_contents)
     with Path(tempdir, "config").open("w") as c:
         # Keep socket open for 10 min (600) or indefinitely (yes)
-        c.write(config_contents.format(control_persist="yes"))
+        c.write(ssh_config_contents(port, args.ssh_key, control_persist="yes"))
     Path(Path.home(), ".ssh/controlmasters").mkdir(exist_ok=True)
     boot_cheribsd.run_host_command(["cat", str(Path(tempdir, "config"))])
 
@@ -223,51 +267,20 @@ Host cheribsd-test-instance
         boot_cheribsd.failure(
             "WARNING: Could not connect to ControlMaster SSH connection. Running tests will be slower", exit=False)
         with Path(tempdir, "config").open("w") as c:
-            c.write(config_contents.format(control_persist="no"))
+            c.write(ssh_config_contents(port, args.ssh_key, control_persist="no"))
         check_ssh_connection("Second SSH connection (without controlmaster)")
 
     if args.pretend:
         time.sleep(2.5)
 
-    extra_ssh_args = commandline_to_str(("-n", "-4", "-F", "{tempdir}/config".format(tempdir=tempdir)))
-    extra_scp_args = commandline_to_str(("-F", "{tempdir}/config".format(tempdir=tempdir)))
-    ssh_executor_args = [args.ssh_executor_script, "--host", "cheribsd-test-instance",
-                         "--extra-ssh-args=" + extra_ssh_args]
-    if args.use_shared_mount_for_tests:
-        # If we have a shared directory use that to massively speed up running tests
-        tmpdir_name = args.shared_tmpdir_local.name
-        ssh_executor_args.append("--shared-mount-local-path=" + str(args.shared_tmpdir_local))
-        ssh_executor_args.append("--shared-mount-remote-path=/build/" + tmpdir_name)
-    else:
-        # slow executor using scp:
-        ssh_executor_args.append("--extra-scp-args=" + extra_scp_args)
-    executor = commandline_to_str(ssh_executor_args)
+    executor = ssh_executor_command(args, "cheribsd-test-instance", Path(tempdir, "config"),
+                                    shared_mount_remote_dir="/build")
     # TODO: I was previously passing -t -t to ssh. Is this actually needed?
     boot_cheribsd.success("Running", testsuite, "tests with executor", executor)
     notify_main_process(args, MultiprocessStages.RUNNING_TESTS, mp_q)
-    # have to use -j1 since otherwise CheriBSD might wedge
-    if llvm_lit_path is None:
-        llvm_lit_path = str(test_build_dir / "bin/llvm-lit")
-    # Note: we require python 3 since otherwise it seems to deadlock in Jenkins
-    lit_cmd = [sys.executable, llvm_lit_path, "-j1", "-vv", "-Dexecutor=" + executor, "test"]
-    if lit_extra_args:
-        lit_cmd.extend(lit_extra_args)
-    if args.lit_debug_output:
-        lit_cmd.append("--debug")
-    # This does not work since it doesn't handle running ssh commands....
-    lit_cmd.append("--timeout=120")  # 2 minutes max per test (in case there is an infinite loop)
-    xunit_file = None  # type: typing.Optional[Path]
-    if args.xunit_output:
-        lit_cmd.append("--xunit-xml-output")
-        xunit_file = Path(args.xunit_output).absolute()
-        if args.internal_shard:
-            xunit_file = xunit_file.with_name("shard-" + str(args.internal_shard) + "-" + xunit_file.name)
-        lit_cmd.append(str(xunit_file))
+    lit_cmd, xunit_file = lit_command(args, executor, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args)
     qemu_logfile = qemu.logfile
     if args.internal_shard:
-        assert args.internal_num_shards, "Invalid call!"
-        lit_cmd.append("--num-shards=" + str(args.internal_num_shards))
-        lit_cmd.append("--run-shard=" + str(args.internal_shard))
         if xunit_file:
             assert qemu_logfile is not None, "Should have a valid logfile when running multiple shards"
             boot_cheribsd.success("Writing QEMU output to ", qemu_logfile)
@@ -281,6 +294,10 @@ Host cheribsd-test-instance
     t.start()
     shard_prefix = "SHARD" + str(args.internal_shard) + ": " if args.internal_shard else ""
     try:
+        if test_batches is not None:
+            # Stop taking new tests after a kernel panic, the other shards will run the remaining ones
+            return run_lit_test_batches(args, executor, test_batches, llvm_lit_path=llvm_lit_path,
+                                        lit_extra_args=lit_extra_args, should_stop=lambda: KERNEL_PANIC)
         boot_cheribsd.success("Starting llvm-lit: cd ", test_build_dir, " && ", " ".join(lit_cmd))
         boot_cheribsd.run_host_command(lit_cmd, cwd=str(test_build_dir))
         # lit_proc = pexpect.spawnu(lit_cmd[0], lit_cmd[1:], echo=True, timeout=60, cwd=str(test_build_dir))
@@ -327,3 +344,345 @@ Host cheribsd-test-instance
         if not qemu.isalive():
             boot_cheribsd.failure("QEMU died while running tests! ", qemu, exit=True)
     return True
+
+
+# 2 minutes max per test unless we know that the tests in a batch take longer (or are much faster)
+LIT_TEST_TIMEOUT = 120
+
+
+def _base_lit_command(args: argparse.Namespace, executor: str, llvm_lit_path: str = None,
+                      lit_extra_args: list = None) -> typing.List[str]:
+    # have to use -j1 since otherwise CheriBSD might wedge
+    if llvm_lit_path is None:
+        llvm_lit_path = str(Path(args.build_dir, "bin/llvm-lit"))
+    # Note: we require python 3 since otherwise it seems to deadlock in Jenkins
+    lit_cmd = [sys.executable, llvm_lit_path, "-j1", "-vv", "-Dexecutor=" + executor, "test"]
+    if lit_extra_args:
+        lit_cmd.extend(lit_extra_args)
+    if args.lit_debug_output:
+        lit_cmd.append("--debug")
+    return lit_cmd
+
+
+def lit_command(args: argparse.Namespace, executor: str, llvm_lit_path: str = None, lit_extra_args: list = None,
+                batch: "typing.Tuple[int, typing.List[str]]" = None, timeout: int = LIT_TEST_TIMEOUT
+                ) -> "typing.Tuple[typing.List[str], typing.Optional[Path]]":
+    lit_cmd = _base_lit_command(args, executor, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args)
+    # This does not work since it doesn't handle running ssh commands....
+    lit_cmd.append("--timeout=" + str(timeout))  # in case there is an infinite loop
+    xunit_file = None  # type: typing.Optional[Path]
+    if args.xunit_output:
+        lit_cmd.append("--xunit-xml-output")
+        xunit_file = _shard_xunit_file(args)
+        if batch is not None:
+            xunit_file = xunit_file.with_name("batch-" + str(batch[0]) + "-" + xunit_file.name)
+        lit_cmd.append(str(xunit_file))
+    if batch is not None:
+        # Select the tests by their full name (the same one that is printed by --show-tests)
+        lit_cmd.append("--filter=^(" + "|".join(re.escape(test) for test in batch[1]) + ")$")
+    elif args.internal_shard:
+        assert args.internal_num_shards, "Invalid call!"
+        lit_cmd.append("--num-shards=" + str(args.internal_num_shards))
+        lit_cmd.append("--run-shard=" + str(args.internal_shard))
+    return lit_cmd, xunit_file
+
+
+def _shard_xunit_file(args: argparse.Namespace) -> Path:
+    xunit_file = Path(args.xunit_output).absolute()
+    if args.internal_shard:
+        xunit_file = xunit_file.with_name("shard-" + str(args.internal_shard) + "-" + xunit_file.name)
+    return xunit_file
+
+
+def lit_test_junit_key(test: str) -> "typing.Tuple[str, str]":
+    # lit writes "<suite>.<directory>" as the JUnit class name and the file name as the test name (with '.' replaced
+    # in both the suite name and the directory). Compute the same key for a "<suite> :: <path>" test name.
+    suite, path = test.split(" :: ", 1)
+    components = path.split("/")
+    safe_suite = suite.replace(".", "-")
+    directory = "/".join(components[:-1]).replace(".", "_")
+    return safe_suite + "." + (directory or safe_suite), components[-1]
+
+
+def load_junit_test_durations(xunit_files: "typing.Iterable[Path]",
+                              successful_only=False) -> "typing.Dict[typing.Tuple[str, str], float]":
+    durations = dict()  # type: typing.Dict[typing.Tuple[str, str], float]
+    for xunit_file in xunit_files:
+        if not Path(xunit_file).is_file():
+            continue
+        try:
+            xml = junitparser.JUnitXml.fromfile(str(xunit_file))
+        except Exception as e:
+            boot_cheribsd.failure("Could not load test durations from ", xunit_file, ": ", e, exit=False)
+            continue
+        suites = [xml] if isinstance(xml, junitparser.TestSuite) else list(xml)
+        for suite in suites:
+            for case in suite:
+                if case.time is not None and not (successful_only and case.result is not None):
+                    durations[(case.classname, case.name)] = case.time
+    return durations
+
+
+def discover_lit_tests(args: argparse.Namespace, llvm_lit_path: str = None,
+                       lit_extra_args: list = None) -> typing.List[str]:
+    # The executor is not used for test discovery
+    cmd = _base_lit_command(args, "false", llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args)
+    cmd.append("--show-tests")
+    boot_cheribsd.print_cmd(cmd)
+    if boot_cheribsd.PRETEND:
+        return []
+    try:
+        output = subprocess.check_output(cmd, cwd=str(args.build_dir)).decode("utf-8")
+    except subprocess.CalledProcessError as e:
+        boot_cheribsd.failure("Could not list the lit tests: ", e, exit=False)
+        return []
+    return [line.strip() for line in output.splitlines() if " :: " in line]
+
+
+# Every lit invocation has to discover all tests again, so don't create batches that are too small:
+MIN_BATCH_SECONDS = 30
+# The batch is selected using a regex listing all test names, so also limit the number of tests:
+MAX_BATCH_TESTS = 200
+
+
+def schedule_lit_tests(tests: typing.List[str], durations: "typing.Dict[typing.Tuple[str, str], float]",
+                       num_workers: int) -> "typing.List[typing.List[str]]":
+    """Sort the tests by their previous duration (longest first) and split them into batches. Each batch is a fraction
+    of the remaining work, so the batches get smaller towards the end and the workers finish at about the same time."""
+    known_durations = [durations.get(lit_test_junit_key(test)) for test in tests]
+    measured = [d for d in known_durations if d is not None]
+    # Assume that tests without a previous result take an average amount of time
+    default_duration = sum(measured) / len(measured) if measured else 1.0
+    estimates = sorted(((d if d is not None else default_duration, test) for d, test in zip(known_durations, tests)),
+                       key=lambda x: x[0], reverse=True)
+    remaining = sum(estimate for estimate, _ in estimates)
+    batches = []  # type: typing.List[typing.List[str]]
+    current = []  # type: typing.List[str]
+    current_duration = 0.0
+    for estimate, test in estimates:
+        current.append(test)
+        current_duration += estimate
+        if current_duration >= max(MIN_BATCH_SECONDS, remaining / (4 * num_workers)) or \
+                len(current) >= MAX_BATCH_TESTS:
+            batches.append(current)
+            remaining -= current_duration
+            current = []
+            current_duration = 0.0
+    if current:
+        batches.append(current)
+    return batches
+
+
+def lit_batch_timeout(batch: typing.List[str], max_durations: "typing.Dict[typing.Tuple[str, str], float]") -> int:
+    previous = [max_durations.get(lit_test_junit_key(test)) for test in batch]
+    if any(d is None for d in previous):
+        return LIT_TEST_TIMEOUT
+    return durations_db.adaptive_timeout(previous, LIT_TEST_TIMEOUT, factor=5, minimum=60)
+
+
+def queue_lit_test_batches(args: argparse.Namespace, test_batches: "typing.Union[queue.Queue, multiprocessing.Queue]",
+                           num_workers: int, testsuite: str, llvm_lit_path: str = None,
+                           lit_extra_args: list = None) -> bool:
+    """Discover the tests on the host and add (batch, timeout) tuples to test_batches for run_lit_test_batches().
+    Returns False if the tests could not be discovered (and static sharding should be used instead)."""
+    tests = discover_lit_tests(args, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args)
+    if not tests:
+        boot_cheribsd.info("Could not discover tests, falling back to static lit sharding.")
+        return False
+    durations = dict()  # type: typing.Dict[typing.Tuple[str, str], float]
+    max_durations = dict()  # type: typing.Dict[typing.Tuple[str, str], float]
+    duration_files = list(args.test_durations_from)
+    db = durations_db.open_test_duration_db(args)
+    if db is not None:
+        try:
+            for key, values in db.test_durations(testsuite, args.architecture).items():
+                durations[key] = statistics.median(values)
+            # Tests that failed (e.g. due to a timeout) must not increase the timeouts
+            for key, values in db.test_durations(testsuite, args.architecture, successful_only=True).items():
+                max_durations[key] = max(values)
+        finally:
+            db.close()
+    elif args.xunit_output:
+        duration_files.append(Path(args.xunit_output).absolute())  # the output from the last run
+    # Explicitly passed JUnit files take precedence over the database
+    for key, value in load_junit_test_durations(duration_files).items():
+        durations[key] = value
+    for key, value in load_junit_test_durations(duration_files, successful_only=True).items():
+        max_durations[key] = max(value, max_durations.get(key, 0.0))
+    batches = schedule_lit_tests(tests, durations, num_workers)
+    boot_cheribsd.success("Distributing ", len(tests), " tests (", len(durations), " with previous durations) in ",
+                          len(batches), " batches to ", num_workers, " workers")
+    for batch in batches:
+        test_batches.put((batch, lit_batch_timeout(batch, max_durations)))
+    return True
+
+
+def record_lit_test_results(args: argparse.Namespace, testsuite: str):
+    if args.xunit_output:
+        durations_db.record_test_results(args, testsuite, [Path(args.xunit_output).absolute()])
+
+
+def run_lit_test_batches(args: argparse.Namespace, executor: str,
+                         test_batches: "typing.Union[queue.Queue, multiprocessing.Queue]", llvm_lit_path: str = None,
+                         lit_extra_args: list = None, should_stop: "typing.Callable[[], bool]" = lambda: False) -> bool:
+    """Keep running batches from the shared queue until it is empty, so that workers that draw fast tests take over
+    more of the remaining work."""
+    test_build_dir = Path(args.build_dir)
+    shard_prefix = "SHARD" + str(args.internal_shard) + ": " if args.internal_shard else ""
+    batch_xunit_files = []  # type: typing.List[Path]
+    result = True
+    batch_num = 0
+    while not should_stop():
+        try:
+            batch, timeout = test_batches.get(timeout=1)
+        except queue.Empty:
+            break
+        batch_num += 1
+        lit_cmd, xunit_file = lit_command(args, executor, llvm_lit_path=llvm_lit_path,
+                                          lit_extra_args=lit_extra_args, batch=(batch_num, batch), timeout=timeout)
+        boot_cheribsd.success(shard_prefix, "Running batch ", batch_num, " (", len(batch), " tests, timeout ",
+                              timeout, "s)")
+        try:
+            boot_cheribsd.run_host_command(lit_cmd, cwd=str(test_build_dir))
+        except subprocess.CalledProcessError as e:
+            boot_cheribsd.failure(shard_prefix + "SOME TESTS FAILED: ", e, exit=False)
+            # Should only ever return 1 (otherwise something else went wrong!)
+            if e.returncode != 1:
+                test_batches.put((batch, timeout))  # let another worker run this batch
+                raise
+            result = False
+        except BaseException:
+            test_batches.put((batch, timeout))
+            raise
+        if should_stop():
+            # The guest died while running this batch, so the results are meaningless. Another worker can run it
+            # and if there is none left, the batch is reported by unfinished_lit_test_batches_suite().
+            boot_cheribsd.failure(shard_prefix, "Returning batch ", batch_num, " to the queue", exit=False)
+            test_batches.put((batch, timeout))
+            if xunit_file is not None and xunit_file.exists():
+                xunit_file.unlink()
+            break
+        if xunit_file is not None:
+            batch_xunit_files.append(xunit_file)
+    if args.xunit_output:
+        # Combine the batch results so that the output is the same as when using static sharding
+        merged = junitparser.JUnitXml()
+        for xunit_file in batch_xunit_files:
+            if xunit_file.exists():
+                merged += junitparser.JUnitXml.fromfile(str(xunit_file))
+                xunit_file.unlink()
+        merged.update_statistics()
+        merged.write(str(_shard_xunit_file(args)))
+    return result
+
+
+def unfinished_lit_test_batches_suite(test_batches: "typing.Union[queue.Queue, multiprocessing.Queue, None]"
+                                      ) -> "typing.Optional[junitparser.TestSuite]":
+    """Report the tests from batches that are left in the queue once all workers have exited as errors, so that they
+    are not silently missing from the results."""
+    if test_batches is None:
+        return None
+    error_suite = junitparser.TestSuite(name="unfinished-batches")
+    num_tests = 0
+    while True:
+        try:
+            batch, _ = test_batches.get(timeout=0.1)
+        except queue.Empty:
+            break
+        for test in batch:
+            classname, name = lit_test_junit_key(test)
+            error_case = junitparser.TestCase(name=name)
+            error_case.classname = classname
+            error_case.result = junitparser.Error(message="Test was not run since all workers exited")
+            error_suite.add_testcase(error_case)
+            num_tests += 1
+    if num_tests == 0:
+        return None
+    boot_cheribsd.failure("ERROR: ", num_tests, " tests were not run", exit=False)
+    return error_suite
+
+
+def run_remote_lit_tests_on_pool_guest(testsuite: str, guest, args: argparse.Namespace, llvm_lit_path: str = None,
+                                       lit_extra_args: list = None, test_batches: "queue.Queue" = None) -> bool:
+    """Run the lit tests on a guest leased from a qemu_guest_pool.py instance (see lease_guest())."""
+    try:
+        import psutil  # noqa: F401
+    except ImportError:
+        boot_cheribsd.failure("Cannot run lit without `psutil` python module installed", exit=True)
+    test_build_dir = Path(args.build_dir)
+    if not guest.is_visible_in_guest(str(test_build_dir)):
+        boot_cheribsd.failure("Build directory ", test_build_dir, " is not inside the guest pool share directory ",
+                              guest.share_dir)
+    # The pool mounts the share directory using the host path, so the local and remote paths are the same.
+    executor = ssh_executor_command(args, guest.ssh_host, guest.ssh_config,
+                                    shared_mount_remote_dir=str(args.shared_tmpdir_local.parent))
+    boot_cheribsd.success("Running", testsuite, "tests on ", guest, " with executor", executor)
+    return run_lit_tests_with_executor(args, executor, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args,
+                                       test_batches=test_batches)
+
+
+def run_lit_tests_with_executor(args: argparse.Namespace, executor: str, llvm_lit_path: str = None,
+                                lit_extra_args: list = None, test_batches: "queue.Queue" = None,
+                                should_stop: "typing.Callable[[], bool]" = lambda: False) -> bool:
+    test_build_dir = Path(args.build_dir)
+    if test_batches is not None:
+        return run_lit_test_batches(args, executor, test_batches, llvm_lit_path=llvm_lit_path,
+                                    lit_extra_args=lit_extra_args, should_stop=should_stop)
+    lit_cmd, _ = lit_command(args, executor, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args)
+    shard_prefix = "SHARD" + str(args.internal_shard) + ": " if args.internal_shard else ""
+    try:
+        boot_cheribsd.success("Starting llvm-lit: cd ", test_build_dir, " && ", " ".join(lit_cmd))
+        boot_cheribsd.run_host_command(lit_cmd, cwd=str(test_build_dir))
+    except subprocess.CalledProcessError as e:
+        boot_cheribsd.failure(shard_prefix + "SOME TESTS FAILED: ", e, exit=False)
+        # Should only ever return 1 (otherwise something else went wrong!)
+        if e.returncode == 1:
+            return False
+        raise
+    return True
+
+
+async def run_remote_lit_tests_on_async_guest(testsuite: str, guest: async_console.AsyncCheriBSDInstance,
+                                              args: argparse.Namespace, tempdir: str, llvm_lit_path: str = None,
+                                              lit_extra_args: list = None, test_batches: "queue.Queue" = None) -> bool:
+    """Run the lit tests on a guest booted with boot_cheribsd_async(). The blocking llvm-lit invocations run in a
+    worker thread, while the event loop keeps watching the console of this (and every other) guest for kernel panics.
+    The build directory must be mounted as /build in the guest."""
+    ssh_config = Path(tempdir, "config")
+    ssh_config.write_text(ssh_config_contents(guest.ssh_port, str(guest.ssh_public_key), control_persist="yes"))
+    Path(Path.home(), ".ssh/controlmasters").mkdir(exist_ok=True)
+    executor = ssh_executor_command(args, "cheribsd-test-instance", ssh_config, shared_mount_remote_dir="/build")
+    ssh_command = ["ssh", "-F", str(ssh_config), "cheribsd-test-instance"]
+    guest_died = threading.Event()
+
+    def run_lit():
+        boot_cheribsd.run_host_command(ssh_command + ["--", "echo", "connection successful"],
+                                       cwd=str(args.build_dir))
+        boot_cheribsd.success(guest.name, ": running ", testsuite, " tests with executor ", executor)
+        # Stop taking new batches once the guest has died, the other guests will run the remaining ones
+        return run_lit_tests_with_executor(args, executor, llvm_lit_path=llvm_lit_path,
+                                           lit_extra_args=lit_extra_args, test_batches=test_batches,
+                                           should_stop=guest_died.is_set)
+
+    loop = asyncio.get_event_loop()
+    lit_future = loop.run_in_executor(None, run_lit)
+    # No further output is expected, so this only returns once the kernel panics or QEMU exits
+    console_watcher = asyncio.ensure_future(guest.expect([pexpect.EOF], timeout=None, log_patterns=False))
+    try:
+        await asyncio.wait([lit_future, console_watcher], return_when=asyncio.FIRST_COMPLETED)
+        if console_watcher.done():
+            guest_died.set()
+            what = "QEMU exited" if console_watcher.exception() is None and console_watcher.result() == 0 \
+                else "got kernel panic"
+            boot_cheribsd.failure(guest.name, ": ", what, " while running tests!", exit=False)
+            # The lit invocation that is currently running will fail, wait for it to finish
+            await asyncio.wait([lit_future])
+            raise boot_cheribsd.CheriBSDCommandFailed(guest.name, ": ", what, " while running tests",
+                                                      execution_time=datetime.timedelta())
+        return lit_future.result()
+    finally:
+        if not console_watcher.done():
+            console_watcher.cancel()
+        process = await asyncio.create_subprocess_exec(*ssh_command, "-O", "exit", stdout=subprocess.DEVNULL,
+                                                       stderr=subprocess.DEVNULL)
+        await process.wait()
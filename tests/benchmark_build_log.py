@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Replay a (captured or synthetic) buildworld log through the build log pipeline and compare it against the previous
+# implementation that handled one line at a time. The filtered output is written to /dev/null.
+#
+import argparse
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from pycheribuild.build_log import (BuildLogFile, FilteredOutput, flush_stdio, iter_line_blocks,  # noqa: E402
+                                    LogCompression, TerminalOutput)
+from pycheribuild.projects.cross.cheribsd import BuildFreeBSD  # noqa: E402
+
+
+class _LegacyFreeBSDFilter(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.last_line_can_be_overwritten = False
+
+    def _line_not_important(self, line: bytes):
+        if self.last_line_can_be_overwritten:
+            self.stream.write(b"\x1b[2K\r")
+        self.stream.write(line[:-1])
+        self.stream.write(b" ")
+        flush_stdio(self.stream)
+        self.last_line_can_be_overwritten = True
+
+    def _show_line(self, line: bytes):
+        if self.last_line_can_be_overwritten:
+            self.stream.write(b"\n")
+        self.stream.write(line)
+        flush_stdio(self.stream)
+        self.last_line_can_be_overwritten = False
+
+    def __call__(self, line: bytes):
+        if line.startswith(b">>> "):
+            if self.last_line_can_be_overwritten:
+                self.stream.write(b"\x1b[2K\r")
+            self.stream.write(line)
+            flush_stdio(self.stream)
+            self.last_line_can_be_overwritten = False
+        elif line.startswith(b"===> "):
+            self._line_not_important(line)
+        elif line == b"--------------------------------------------------------------\n":
+            return
+        elif line == b"\n":
+            return
+        elif line.endswith(b"' is up to date.\n"):
+            return
+        elif line.endswith(b"missing (created)\n"):
+            return
+        elif line.startswith(b"[Creating objdir") or line.startswith(b"[Creating nested objdir"):
+            return
+        else:
+            self._show_line(line)
+
+
+def _run_legacy(proc: subprocess.Popen, logfile, stream):
+    lock = threading.Lock()
+    stdout_filter = _LegacyFreeBSDFilter(stream)
+    for line in proc.stdout:
+        with lock:
+            logfile.write(line)
+            stdout_filter(line)
+
+
+def _run_new(proc: subprocess.Popen, logfile, stream):
+    lock = threading.Lock()
+    # noinspection PyProtectedMember
+    output = FilteredOutput(BuildFreeBSD._stdout_filter, TerminalOutput(b"\x1b[2K\r", stream))
+    for block in iter_line_blocks(proc.stdout.fileno()):
+        with lock:
+            logfile.write(block)
+            output.feed(block)
+    output.finish()
+
+
+def generate_buildworld_log(path: Path, num_lines: int):
+    with path.open("wb") as f:
+        for i in range(num_lines):
+            if i % 50000 == 0:
+                f.write(b"--------------------------------------------------------------\n")
+                f.write(b">>> stage " + str(i // 50000).encode() + b": building everything\n")
+                f.write(b"--------------------------------------------------------------\n")
+            elif i % 200 == 0:
+                f.write(b"===> lib/libfoo" + str(i).encode() + b" (all)\n")
+            elif i % 5000 == 1:
+                f.write(b"/src/lib/libfoo/foo.c:12:3: warning: unused variable 'x' [-Wunused-variable]\n")
+            elif i % 300 == 2:
+                f.write(b"`all' is up to date.\n")
+            else:
+                f.write(b"/usr/local/bin/clang -O2 -pipe -fno-common -g -MD -MF.depend.foo" + str(i).encode() +
+                        b".o -MTfoo" + str(i).encode() + b".o -std=gnu99 -Wno-format-zero-length -c /src/lib/foo" +
+                        str(i).encode() + b".c -o foo" + str(i).encode() + b".o\n")
+
+
+def _measure(impl: str, log: Path, compression: LogCompression) -> "tuple":
+    with tempfile.TemporaryDirectory() as td, open("/dev/null", "wb") as devnull:
+        start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        proc = subprocess.Popen(["cat", str(log)], stdout=subprocess.PIPE)
+        if impl == "legacy":
+            with Path(td, "build.log").open("ab") as logfile:
+                _run_legacy(proc, logfile, devnull)
+        else:
+            with BuildLogFile(Path(td, "build.log" + compression.suffix), compression) as logfile:
+                _run_new(proc, logfile, devnull)
+        proc.wait()
+        duration = time.perf_counter() - start
+        end_cpu = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (end_cpu.ru_utime - start_cpu.ru_utime) + (end_cpu.ru_stime - start_cpu.ru_stime)
+        log_size = sum(f.stat().st_size for f in Path(td).iterdir())
+    return duration, cpu, log_size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=2000000)
+    parser.add_argument("--log", type=Path, help="Use a captured (uncompressed) buildworld log instead of a synthetic "
+                                                 "one")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as td:
+        log = args.log
+        if log is None:
+            log = Path(td, "buildworld.log")
+            generate_buildworld_log(log, args.lines)
+        print("Replaying", log, "({} MB)".format(log.stat().st_size // (1024 * 1024)))
+        cases = [("legacy", LogCompression.NONE), ("new", LogCompression.NONE), ("new", LogCompression.GZIP)]
+        if subprocess.call(["sh", "-c", "command -v zstd"], stdout=subprocess.DEVNULL) == 0:
+            cases.append(("new", LogCompression.ZSTD))
+        for impl, compression in cases:
+            duration, cpu, log_size = _measure(impl, log, compression)
+            print("{:>7} ({:>4}): {:6.2f}s wall, {:6.2f}s CPU, log size {:5d} MB".format(
+                impl, compression.name.lower(), duration, cpu, log_size // (1024 * 1024)))
+
+
+if __name__ == "__main__":
+    main()
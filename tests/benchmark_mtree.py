@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Compare the mtree parser against the previous shlex-based implementation.
+# Each parser runs in a separate process so that the peak RSS numbers are independent.
+#
+import argparse
+import io
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from pycheribuild.mtree import MtreeFile  # noqa: E402
+
+
+class _LegacyMtreeEntry(object):
+    def __init__(self, path, attributes):
+        self.path = path
+        self.attributes = attributes
+
+
+def _legacy_load(file: io.TextIOBase) -> "OrderedDict":
+    result = OrderedDict()
+    for line in file.readlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        elements = shlex.split(line)
+        path = elements[0]
+        if path != ".":
+            path = path[:2] + os.path.normpath(path[2:])
+        attr_dict = OrderedDict()
+        for k, v in map(lambda s: s.split(sep="=", maxsplit=1), elements[1:]):
+            if k in ("tags", "time"):
+                continue
+            attr_dict[k] = v
+        result[path] = _LegacyMtreeEntry(path, attr_dict)
+    return result
+
+
+def generate_metalog(path: Path, num_lines: int):
+    with path.open("w") as f:
+        f.write("#mtree 2.0\n")
+        f.write(". type=dir uname=root gname=wheel mode=0755\n")
+        for i in range(num_lines - 1):
+            if i % 50 == 0:
+                f.write("./usr/dir{} type=dir uname=root gname=wheel mode=0755 tags=package=runtime\n".format(i // 50))
+            elif i % 1000 == 1:
+                f.write("./usr/dir{}/file\\040with\\040spaces{} type=file uname=root gname=wheel mode=0644 "
+                        "size=1234 time=1591892624.000000000\n".format(i // 50, i))
+            else:
+                f.write("./usr/dir{}/file{} type=file uname=root gname=wheel mode=0644 size={} "
+                        "time=1591892624.000000000 tags=package=runtime\n".format(i // 50, i, i * 7))
+
+
+def _run_child(impl: str, metalog: Path):
+    start = time.perf_counter()
+    if impl == "legacy":
+        with metalog.open("r") as f:
+            entries = len(_legacy_load(f))
+    else:
+        entries = len(MtreeFile(metalog)._mtree)
+    duration = time.perf_counter() - start
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        max_rss //= 1024  # bytes instead of KiB
+    print(entries, duration, max_rss)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--metalog", type=Path, help="Use an existing METALOG file instead of a synthetic one")
+    parser.add_argument("--child", choices=("legacy", "new"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _run_child(args.child, args.metalog)
+        return
+    with tempfile.TemporaryDirectory() as td:
+        metalog = args.metalog
+        if metalog is None:
+            metalog = Path(td, "METALOG")
+            generate_metalog(metalog, args.lines)
+        with metalog.open("r") as f:
+            num_lines = sum(1 for _ in f)
+        print("Parsing", metalog, "with", num_lines, "lines")
+        for impl in ("legacy", "new"):
+            output = subprocess.check_output([sys.executable, __file__, "--child", impl, "--metalog", str(metalog)],
+                                             universal_newlines=True)
+            entries, duration, max_rss = output.split()
+            print("{:>6}: {:>8} entries in {:6.2f}s ({:>9.0f} lines/sec), peak RSS {:>6.1f} MiB".format(
+                impl, entries, float(duration), num_lines / float(duration), int(max_rss) / 1024))
+
+
+if __name__ == "__main__":
+    main()
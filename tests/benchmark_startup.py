@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+#
+# Measure the cheribuild startup time with and without the cached target index (see pycheribuild/target_index.py)
+# for --list-targets, tab-completion and a single-target --pretend run.
+# Note: cheribuild refuses to run as root so this must be run as a normal user.
+#
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CHERIBUILD = Path(__file__).parent.parent / "cheribuild.py"
+
+
+def _run(args, env) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, str(CHERIBUILD)] + args, env=env, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--target", default="llvm-native", help="Target for the --pretend run")
+    args = parser.parse_args()
+    try:
+        import argcomplete  # noqa: F401
+        have_argcomplete = True
+    except ImportError:
+        have_argcomplete = False
+    with tempfile.TemporaryDirectory() as td:
+        base_env = dict(os.environ, XDG_CACHE_HOME=td)
+        base_env.pop("CHERIBUILD_NO_TARGET_INDEX", None)
+        # Completes all options starting with --sq (see get_argcomplete_prefix())
+        complete_env = dict(_ARGCOMPLETE="1", _ARGCOMPLETE_BENCHMARK="1")
+        cases = [("--list-targets", ["--list-targets"], {}),
+                 ("--pretend " + args.target, ["--pretend", "--skip-update", args.target], {})]
+        if have_argcomplete:
+            cases.append(("tab-completion", [], complete_env))
+        else:
+            print("argcomplete is not installed, skipping tab-completion benchmark")
+        # Generate the index first
+        _run(["--list-targets"], base_env)
+        for name, cheribuild_args, extra_env in cases:
+            for mode in ("all options", "target index"):
+                env = dict(base_env, **extra_env)
+                if mode == "all options":
+                    env["CHERIBUILD_NO_TARGET_INDEX"] = "1"
+                durations = [_run(cheribuild_args, env) for _ in range(args.iterations)]
+                print("{:>30} ({:>12}): {:6.3f}s (best of {})".format(name, mode, min(durations), args.iterations))
+
+
+if __name__ == "__main__":
+    main()
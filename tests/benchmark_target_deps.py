@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# Compare the memoized dependency graph against the previous recursive dependency resolution and the sorted()-based
+# target ordering using all registered targets (i.e. the equivalent of __run_everything__).
+#
+import argparse
+import sys
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from pycheribuild.projects import *  # noqa: F401, F403, E402
+from pycheribuild.projects.cross import *  # noqa: F401, F403, E402
+from pycheribuild.targets import MultiArchTargetAlias, SimpleTargetAlias, target_manager  # noqa: E402
+from tests.setup_mock_chericonfig import setup_mock_chericonfig  # noqa: E402
+
+
+# noinspection PyProtectedMember
+def _legacy_recursive_deps(cls, config) -> list:
+    result = []
+    for target in cls._direct_dependencies(config, include_dependencies=True, include_toolchain_dependencies=True,
+                                           include_sdk_dependencies=True,
+                                           explicit_dependencies_only=cls.direct_dependencies_only):
+        if target not in result:
+            result.append(target)
+        if cls.direct_dependencies_only:
+            continue
+        for r in _legacy_recursive_deps(target.project_class, config):
+            if r not in result:
+                result.append(r)
+    return result
+
+
+class _LegacySortKey(object):
+    def __init__(self, target, full_deps: dict):
+        self.target = target
+        self.full_deps = full_deps
+
+    def __lt__(self, other: "_LegacySortKey"):
+        if self.target in other.full_deps[other.target]:
+            return True
+        if other.target in self.full_deps[self.target]:
+            return False
+        if other.target.name.startswith("run") and not self.target.name.startswith("run"):
+            return True
+        elif self.target.name.startswith("run"):
+            return False
+        if other.target.name.startswith("disk-image") and not self.target.name.startswith("disk-image"):
+            return True
+        elif self.target.name.startswith("disk-image"):
+            return False
+        return False
+
+
+def _legacy(targets, config):
+    full_deps = OrderedDict()
+    for t in targets:
+        full_deps[t] = _legacy_recursive_deps(t.project_class, config)
+    return [k.target for k in sorted(_LegacySortKey(t, full_deps) for t in targets)]
+
+
+def _new(targets, config):
+    target_manager.reset()
+    for t in targets:
+        t.cache_dependencies(config)
+    return target_manager.sort_in_dependency_order(targets)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--show-violations", type=int, default=5, metavar="N")
+    args = parser.parse_args()
+    config = setup_mock_chericonfig(Path("/this/path/does/not/exist"))
+    config.include_dependencies = True
+    targets = [t for t in target_manager.targets if not isinstance(t, (MultiArchTargetAlias, SimpleTargetAlias))]
+    print("Resolving dependencies for", len(targets), "targets")
+    results = dict()
+    for name, impl in (("legacy", _legacy), ("new", _new)):
+        durations = []
+        for _ in range(args.iterations):
+            target_manager.reset()
+            start = time.perf_counter()
+            results[name] = impl(targets, config)
+            durations.append(time.perf_counter() - start)
+        print("{:>6}: {:8.3f}s (best of {})".format(name, min(durations), args.iterations))
+    # The legacy comparison function is not a total order so the results can differ, but both must be valid orders.
+    for name, order in results.items():
+        position = dict((t, i) for i, t in enumerate(order))
+        violations = [(t, dep) for t in order for dep in t.project_class.cached_full_dependencies()
+                      if dep in position and position[dep] > position[t]]
+        print("{:>6}: {} targets ordered before one of their dependencies".format(name, len(violations)))
+        for t, dep in violations[:args.show_violations]:
+            print("       ", t.name, "is ordered before", dep.name)
+    print("Orders are identical:", results["legacy"] == results["new"])
+
+
+if __name__ == "__main__":
+    main()
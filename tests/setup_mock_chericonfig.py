@@ -1,6 +1,7 @@
 from enum import Enum
 from pathlib import Path
 
+from pycheribuild.build_log import LogCompression
 from pycheribuild.config.chericonfig import CheriConfig
 from pycheribuild.config.loader import ConfigLoaderBase, DefaultValueOnlyConfigLoader
 from pycheribuild.projects.project import SimpleProject
@@ -43,10 +44,16 @@ class MockConfig(CheriConfig):
         self.preferred_xtarget = None
         self.mips_cheri_bits = 128
         self.make_jobs = 2
+        self.parallel_targets = 1
+        self.keep_going = False
+        self.use_jobserver = False
+        self.skip_unchanged_targets = False
+        self.fetch_jobs = 1
         self.make_without_nice = True
         self.force_update = False
         self.force = True
         self.write_logfile = True
+        self.log_compression = LogCompression.NONE
         self.test_extra_args = []
         self.load()
 
@@ -22,6 +22,7 @@ from pycheribuild.projects.disk_image import _BuildDiskImageBase, BuildCheriBSDD
 # Override the default config loader:
 from pycheribuild.projects.project import SimpleProject
 from pycheribuild.projects.run_qemu import LaunchCheriBSD
+from pycheribuild.target_index import TargetIndex
 from pycheribuild.targets import MultiArchTargetAlias, Target, target_manager
 
 _loader = JsonAndCommandLineConfigLoader()
@@ -832,3 +833,66 @@ def test_relative_paths_in_config():
         assert config.build_root == Path(td, "subdir/build")
         assert config.source_root == Path(td, "some-other-dir")
         assert config.output_root == Path(td, "output")
+
+
+def test_target_index(tmp_path):
+    _parse_arguments([])  # ensure all options have been registered
+    index = TargetIndex.from_registered_options(target_manager, _loader, "fingerprint")
+    assert index.owning_target("cheribsd/build-options") == "cheribsd"
+    assert index.owning_target("cheribsd-riscv64-purecap/build-options") == "cheribsd-riscv64-purecap"
+    assert index.owning_target("build-root") is None  # global options are always registered
+    assert "cheribsd/build-options" in index.config_file_keys
+    # Only the targets whose options are passed on the command line need to be registered before parsing
+    assert index.targets_for_arguments(["--pretend", "llvm", "--cheribsd-riscv64-purecap/build-options=-DFOO",
+                                        "--gdb-native/no-use-lto"]) == {"cheribsd-riscv64-purecap", "gdb-native"}
+    # argparse also accepts unique prefixes
+    assert "cheribsd-riscv64-purecap" in index.targets_for_arguments(["--cheribsd-riscv64-purecap/build-opt"])
+    assert index.targets_for_arguments(["--", "--cheribsd/build-options"]) == set()
+    assert TargetIndex.requires_all_targets(["llvm", "--help-a"])
+    assert TargetIndex.requires_all_targets(["-ph"])
+    assert TargetIndex.requires_all_targets(["__run_everything__"])
+    assert not TargetIndex.requires_all_targets(["--pretend", "llvm"])
+    # The index is discarded if any of the sources changed
+    index.save(tmp_path / "index.json")
+    loaded = TargetIndex.load(tmp_path / "index.json", "fingerprint")
+    assert loaded is not None and loaded.target_options == index.target_options
+    assert TargetIndex.load(tmp_path / "index.json", "other-fingerprint") is None
+
+
+def test_options_not_affecting_build_output():
+    config = _parse_arguments([])
+    options = config.loader.options
+    # Options that only change how cheribuild runs must not invalidate the --skip-unchanged-targets fingerprints
+    for name in ("fetch-jobs", "log-compression", "parallel-targets", "keep-going", "jobserver",
+                 "skip-unchanged-targets", "timing-trace", "compare-timing-trace"):
+        assert not options[name].affects_build_output, name
+    for name in ("skip-sdk", "cheribsd/build-options", "llvm/build-type"):
+        assert options[name].affects_build_output, name
+
+
+def test_lazily_registered_options(tmp_path):
+    # With a target index, targets that are referenced on the command line register their options before parsing and
+    # all other targets register them the first time they are used (i.e. after parsing).
+    loader = JsonAndCommandLineConfigLoader()
+    loader.options = dict()  # don't add the options to the loader that is used by the other tests
+    config = DefaultCheriConfig(loader, ["lazy-cli", "lazy-json"])
+    config.TEST_MODE = True
+    config_file = tmp_path / "config.json"
+    config_file.write_text('{ "lazy-json": { "option": "from-json" }, "lazy-cli/option": "from-json",'
+                           '  "lazy-fallback/option": "from-fallback-json" }')
+    loader._config_path = config_file
+    loader.unknown_config_option_is_error = True
+    loader.lazily_registered_option_keys = frozenset(["lazy-json/option", "lazy-json/unset", "lazy-fallback/option",
+                                                      "lazy-fallback-riscv64/option"])
+    cli_option = loader.add_option("lazy-cli/option")
+    sys.argv = ["cheribuild.py", "--lazy-cli/option=from-cli"]
+    config.load()
+    json_option = loader.add_option("lazy-json/option")
+    unset_option = loader.add_option("lazy-json/unset", default="default")
+    fallback_option = loader.add_option("lazy-fallback/option")
+    derived_option = loader.add_option("lazy-fallback-riscv64/option", _fallback_names=["lazy-fallback/option"])
+    assert cli_option.__get__(config, DefaultCheriConfig) == "from-cli"
+    assert json_option.__get__(config, DefaultCheriConfig) == "from-json"
+    assert unset_option.__get__(config, DefaultCheriConfig) == "default"
+    assert fallback_option.__get__(config, DefaultCheriConfig) == "from-fallback-json"
+    assert derived_option.__get__(config, DefaultCheriConfig) == "from-fallback-json"
@@ -0,0 +1,107 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+_cheribuild_root = Path(__file__).parent.parent
+sys.path.append(str(_cheribuild_root))
+if str((_cheribuild_root / "3rdparty/pexpect").resolve()) not in sys.path:
+    sys.path.append(str((_cheribuild_root / "3rdparty/pexpect").resolve()))
+from pycheribuild.boot_cheribsd import CheriBSDCommandFailed, CheriBSDCommandTimeout, pexpect  # noqa: E402
+from pycheribuild.boot_cheribsd.async_console import (AsyncCheriBSDInstance, run_concurrently,  # noqa: E402
+                                                      set_pexpect_sh_prompt)
+from pycheribuild.config.compilation_targets import CompilationTargets  # noqa: E402
+
+
+async def _start_shell(name: str, **kwargs) -> AsyncCheriBSDInstance:
+    # A POSIX shell on a pseudo-terminal behaves like the CheriBSD serial console once the prompt has been set
+    child = AsyncCheriBSDInstance(CompilationTargets.NATIVE, name=name, timeout=10, **kwargs)
+    await child.spawn("/bin/sh", [], env={"PATH": "/usr/bin:/bin", "ENV": ""})
+    await set_pexpect_sh_prompt(child)
+    return child
+
+
+def test_many_guests_in_one_process():
+    async def guest(i):
+        child = await _start_shell("shell" + str(i))
+        try:
+            await child.run("echo hello from {}".format(i), expected_output="hello from " + str(i))
+            assert await child.checked_run("test {} -ge 0".format(i))
+            with pytest.raises(CheriBSDCommandFailed):
+                await child.checked_run("false")
+            return i
+        finally:
+            await child.terminate()
+
+    assert run_concurrently(guest(i) for i in range(16)) == list(range(16))
+
+
+def test_timeout_and_eof():
+    async def check():
+        child = await _start_shell("timeout")
+        assert await child.expect(["will not match"], timeout=0.2, timeout_fatal=False) is None
+        assert await child.expect(["will not match", pexpect.TIMEOUT], timeout=0.2) == 1
+        child.sendline("exit")
+        assert await child.expect(["will not match", pexpect.EOF], timeout=5) == 1
+        await child.terminate()
+
+    assert run_concurrently([check()]) == [None]
+
+
+def test_fatal_timeout_only_fails_one_guest():
+    async def timeout():
+        child = await _start_shell("timeout")
+        try:
+            await child.expect(["will not match"], timeout=0.2)
+        finally:
+            await child.terminate()
+
+    async def other():
+        child = await _start_shell("other")
+        try:
+            await child.checked_run("sleep 1")
+            return "done"
+        finally:
+            await child.terminate()
+
+    result = run_concurrently([timeout(), other()])
+    assert isinstance(result[0], CheriBSDCommandTimeout), result
+    assert result[1] == "done"
+
+
+def test_kernel_panic_detection():
+    async def check():
+        child = await _start_shell("panic")
+        # Fake debugger that prints an endless backtrace (split strings to avoid matching the echoed input)
+        await child.run("bt() { for i in 1 2 3; do printf 'KDB: stack %s\\n' 'backtrace:'; done; }")
+        child.sendline("printf 'pan%s\\ndb%s\\n' 'ic: trap' '> '")
+        i = await child.expect(["will not match"], timeout=10)
+        await child.terminate()
+        return i
+
+    result = run_concurrently([check()])
+    assert isinstance(result[0], int) and result[0] >= 1, result
+
+
+def test_kernel_panic_in_run():
+    async def check():
+        child = await _start_shell("panic")
+        try:
+            await child.run("bt() { printf 'KDB: stack %s\\ndb%s\\n' 'backtrace:' '> '; }")
+            await child.run("printf 'pan%s\\ndb%s\\n' 'ic: trap' '> '")
+        finally:
+            await child.terminate()
+
+    result = run_concurrently([check()])
+    assert isinstance(result[0], CheriBSDCommandFailed), result
+    assert "kernel panic" in str(result[0])
+
+
+def test_buffer_is_bounded():
+    async def check():
+        child = await _start_shell("bounded", max_buffer=1000)
+        await child.checked_run("i=0; while [ $i -lt 5000 ]; do echo line $i; i=$((i+1)); done")
+        assert len(child.buffer) <= 1000
+        await child.terminate()
+
+    assert run_concurrently([check()]) == [None]
@@ -0,0 +1,76 @@
+import io
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / "test-scripts"))
+from run_bodiagsuite import BODiagTestResult, StreamingJUnitSuite  # noqa: E402
+from run_tests_common import junitparser  # noqa: E402
+
+_RESULT_CLASSES = {"failure": junitparser.Failure, "error": junitparser.Error, "skipped": junitparser.Skipped}
+
+
+def _streamed_suite(name: str, results: "list") -> "junitparser.TestSuite":
+    suite = StreamingJUnitSuite(name)
+    for result in results:
+        suite.add(result)
+    output = io.StringIO()
+    output.write("<testsuites>\n")
+    suite.copy_to(output)
+    output.write("</testsuites>\n")
+    suites = list(junitparser.JUnitXml.fromstring(output.getvalue()))
+    assert len(suites) == 1
+    return suites[0]
+
+
+def _junitparser_suite(name: str, results: "list") -> "junitparser.TestSuite":
+    # This is how the results were written before they were streamed
+    suite = junitparser.TestSuite(name=name)
+    for result in results:
+        testcase = junitparser.TestCase(name=result.name)
+        if result.system_out is not None:
+            testcase.system_out = result.system_out
+        if result.system_err is not None:
+            testcase.system_err = result.system_err
+        if result.result is not None:
+            testcase.result = _RESULT_CLASSES[result.result](message=result.message)
+        suite.add_testcase(testcase)
+    suite.update_statistics()
+    return junitparser.TestSuite.fromstring(suite.tostring())
+
+
+def _case_summary(case: "junitparser.TestCase") -> tuple:
+    result = case.result
+    return (case.name, case.system_out, case.system_err, result._tag if result is not None else None,
+            result.message if result is not None else None)
+
+
+def test_streaming_junit_suite():
+    results = [
+        BODiagTestResult("basic-00001-ok", "ok", system_out="WIFEXITED=True"),
+        BODiagTestResult("basic-00001-min", "min", "failure", "Expected test to be killed by a SIGNAL <&> \"'1'\"",
+                         system_out="WIFSIGNALED=False", system_err="Segmentation fault <core dumped> & more"),
+        BODiagTestResult("basic-00002-min", "min", "skipped", "This test needs a large working directory",
+                         system_err="This test needs a CWD with length"),
+        BODiagTestResult("basic-00003-min", "min", "error", "INVALID OUTPUT FILE CONTENTS: basic-00003-min.out",
+                         system_out="garbage"),
+        BODiagTestResult("basic-00004-min", "min"),
+        BODiagTestResult("basic-00005-min", "min", "failure", "binary output", system_err="\x00\x1b[0m"),
+        ]
+    streamed = _streamed_suite("basic-min-overflow", results)
+    assert streamed.name == "basic-min-overflow"
+    assert (streamed.tests, streamed.failures, streamed.errors, streamed.skipped) == (6, 2, 1, 1)
+    streamed_cases = [_case_summary(c) for c in streamed]
+    assert [c[0] for c in streamed_cases] == [r.name for r in results]
+    # Characters that are not valid in XML are replaced instead of producing an unparseable file
+    assert streamed_cases[-1] == ("basic-00005-min", None, "\ufffd\ufffd[0m", "failure", "binary output")
+    # All other cases must be identical to the output that junitparser generated
+    expected = _junitparser_suite("basic-min-overflow", results[:-1])
+    assert (expected.tests, expected.failures, expected.errors, expected.skipped) == (5, 1, 1, 1)
+    assert streamed_cases[:-1] == [_case_summary(c) for c in expected]
+
+
+def test_streaming_junit_suite_empty():
+    streamed = _streamed_suite("basic-test-broken", [])
+    assert streamed.name == "basic-test-broken"
+    assert (streamed.tests, streamed.failures, streamed.errors, streamed.skipped) == (0, 0, 0, 0)
+    assert len(streamed) == 0
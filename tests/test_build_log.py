@@ -0,0 +1,94 @@
+import gzip
+import io
+import os
+import tempfile
+from pathlib import Path
+
+from pycheribuild.build_log import (BuildLogFile, FilteredOutput, iter_line_blocks, LineFilter, LogCompression,
+                                    prefix_lines, TerminalOutput)
+# noinspection PyProtectedMember
+from pycheribuild.projects.cross.cheribsd import BuildFreeBSD
+
+
+def _filter_output(line_filter: LineFilter, *blocks: bytes, output_prefix=b"") -> bytes:
+    stream = io.BytesIO()
+    output = FilteredOutput(line_filter, TerminalOutput(b"<CLEAR>", stream), output_prefix, redraw_interval=0)
+    for block in blocks:
+        output.feed(block)
+    output.finish()
+    return stream.getvalue()
+
+
+def test_default_filter():
+    # Only the last progress line of each block is drawn
+    assert _filter_output(LineFilter(), b"a\nb\nc\n", b"d\n") == b"c <CLEAR>d \n"
+    # Skipped when building multiple targets concurrently
+    assert _filter_output(LineFilter(), b"a\nb\n", output_prefix=b"[llvm] ") == b""
+
+
+def test_freebsd_filter():
+    # noinspection PyProtectedMember
+    line_filter = BuildFreeBSD._stdout_filter
+    assert isinstance(line_filter, LineFilter)
+    output = _filter_output(line_filter,
+                            b"--------------------------------------------------------------\n"
+                            b">>> stage 1\n"
+                            b"--------------------------------------------------------------\n"
+                            b"===> lib/libc (all)\n"
+                            b"cc -c foo.c\n"
+                            b"===> lib/libm (all)\n"
+                            b"\n"
+                            b"`all' is up to date.\n"
+                            b"[Creating objdir /foo]\n"
+                            b"===> lib/libz (all)\n"
+                            b"warning: something\n"
+                            b"===> bin/sh (all)\n"
+                            b"===> bin/cat (all)\n"
+                            b">>> stage 2\n"
+                            b"./usr/bin missing (created)\n"
+                            b"done")
+    assert output == (b">>> stage 1\n"
+                      b"===> lib/libc (all) \ncc -c foo.c\n"
+                      b"===> lib/libz (all) \nwarning: something\n"
+                      b">>> stage 2\n"
+                      b"done\n")
+
+
+def test_show_filter_with_ignored_prefix():
+    line_filter = LineFilter(default=LineFilter.SHOW, ignored_prefixes=(b"-- Up-to-date:",))
+    assert _filter_output(line_filter, b"-- Installing: a\n-- Up-to-date: b\n-- Installing: c\n") == \
+        b"-- Installing: a\n-- Installing: c\n"
+
+
+def test_prefix_lines():
+    assert prefix_lines(b"a\nb\n", b"> ") == b"> a\n> b\n"
+    assert prefix_lines(b"a\nb", b"> ") == b"> a\n> b"
+    assert prefix_lines(b"a\n", b"") == b"a\n"
+
+
+def test_iter_line_blocks():
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, "wb") as f:
+        f.write(b"line1\nline2\npartial")
+    with os.fdopen(read_fd, "rb") as f:
+        blocks = list(iter_line_blocks(f.fileno(), chunk_size=8))
+    assert b"".join(blocks) == b"line1\nline2\npartial"
+    assert all(block.endswith(b"\n") for block in blocks[:-1])
+
+
+def test_gzip_logfile():
+    with tempfile.TemporaryDirectory() as td:
+        path = Path(td, "build.log" + LogCompression.GZIP.suffix)
+        for i in range(2):
+            with BuildLogFile(path, LogCompression.GZIP) as logfile:
+                logfile.write(b"run " + str(i).encode() + b"\n")
+        with gzip.open(str(path), "rb") as f:
+            assert f.read() == b"run 0\nrun 1\n"
+
+
+def test_no_compression_without_logfile(monkeypatch):
+    # Compressing the output that is discarded would start zstd (and fail if it is not installed)
+    monkeypatch.setattr("shutil.which", lambda _: None)
+    with BuildLogFile(Path(os.devnull), LogCompression.ZSTD) as logfile:
+        assert not logfile.is_compressed
+        logfile.write(b"discarded\n")
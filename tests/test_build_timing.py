@@ -0,0 +1,66 @@
+import json
+import tempfile
+from pathlib import Path
+
+from pycheribuild.build_timing import (compare_timings, get_build_timing_recorder, load_chrome_trace,
+                                       start_recording_build_timings, stop_recording_build_timings, summarize_timings,
+                                       timed_phase)
+from pycheribuild.processutils import check_call_handle_noexec, popen_handle_noexec
+
+
+def _trace_event(name, cat, target, dur_seconds):
+    return {"name": name, "cat": cat, "ph": "X", "ts": 0, "dur": int(dur_seconds * 1000000), "pid": 1, "tid": 1,
+            "args": {"target": target, "cpu_time": dur_seconds, "max_rss": 1024 * 1024}}
+
+
+def test_records_phases_and_processes():
+    recorder = start_recording_build_timings()
+    try:
+        with timed_phase("llvm", category="target", target="llvm"):
+            with timed_phase("compile"):
+                check_call_handle_noexec(["python3", "-c", "sum(range(3000000)); b = bytearray(64 * 1024 * 1024)"])
+            with timed_phase("install"):
+                popen_handle_noexec(["true"]).wait()
+        assert get_build_timing_recorder() is recorder
+    finally:
+        stop_recording_build_timings()
+    assert get_build_timing_recorder() is None
+    events = {(e.category, e.name): e for e in recorder.events}
+    assert set(events.keys()) == {("target", "llvm"), ("phase", "compile"), ("phase", "install"),
+                                  ("process", "python3"), ("process", "true")}
+    python = events[("process", "python3")]
+    assert python.target == "llvm"
+    assert python.max_rss >= 64 * 1024 * 1024
+    assert python.cpu_time > 0
+    # The resource usage of subprocesses is included in the enclosing phases
+    assert events[("phase", "compile")].max_rss == python.max_rss
+    assert events[("target", "llvm")].max_rss == python.max_rss
+    assert events[("target", "llvm")].cpu_time >= python.cpu_time
+    assert events[("phase", "install")].max_rss == events[("process", "true")].max_rss
+    assert events[("phase", "compile")].wall_time >= python.wall_time
+
+    with tempfile.TemporaryDirectory() as td:
+        path = Path(td, "trace.json")
+        recorder.write_chrome_trace(path)
+        with path.open() as f:
+            assert "traceEvents" in json.load(f)
+        trace_events = load_chrome_trace(path)
+    assert trace_events[0]["ph"] == "M"
+    assert {e["name"] for e in trace_events if e["ph"] == "X"} == {"llvm", "compile", "install", "python3", "true"}
+    table = summarize_timings(trace_events)
+    assert table[0].split() == ["Target", "update", "clean", "configure", "compile", "install", "total", "CPU", "peak",
+                                "RSS"]
+    assert table[1].split()[0] == "llvm"
+    assert len(table) == 2
+
+
+def test_compare_timings():
+    old = [_trace_event("llvm", "target", "llvm", 100), _trace_event("compile", "phase", "llvm", 90),
+           _trace_event("install", "phase", "llvm", 10), _trace_event("qemu", "target", "qemu", 50),
+           _trace_event("compile", "phase", "qemu", 50)]
+    new = [_trace_event("llvm", "target", "llvm", 120), _trace_event("compile", "phase", "llvm", 90.5),
+           _trace_event("install", "phase", "llvm", 29.5), _trace_event("qemu", "target", "qemu", 20),
+           _trace_event("compile", "phase", "qemu", 20), _trace_event("gdb", "target", "gdb", 30)]
+    assert compare_timings(old, new) == [("llvm", "total", 100, 120), ("llvm", "install", 10, 29.5)]
+    assert compare_timings(old, new, threshold=0.5) == [("llvm", "install", 10, 29.5)]
+    assert compare_timings(new, old) == [("qemu", "total", 20, 50), ("qemu", "compile", 20, 50)]
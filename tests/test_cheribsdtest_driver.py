@@ -0,0 +1,35 @@
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / "test-scripts"))
+import run_cheribsd_tests  # noqa: E402
+
+
+def test_driver_script_work_queue():
+    tests = [("slow", "oldslow", 30), ("fast1", "oldfast1", 10), ("fast2", "oldfast2", 10), ("renamed", "old", 10)]
+    with tempfile.TemporaryDirectory() as td:
+        bindir = Path(td, "bin")
+        bindir.mkdir()
+        for name, seconds in (("slow", 1.5), ("fast1", 0.5), ("fast2", 0.5), ("old", 0.5)):
+            binary = bindir / name
+            binary.write_text("#!/bin/sh\necho '<testsuite name=\"{0}\"/>'; echo {0} stderr >&2; sleep {1}\n"
+                              "[ {0} != fast2 ]\n".format(name, seconds))
+            binary.chmod(0o755)
+        script = run_cheribsd_tests.cheribsdtest_driver_script(tests, jobs=2)
+        script = script.replace("/tmp/", td + "/").replace("/bin/", str(bindir) + "/")
+        start = time.time()
+        output = subprocess.check_output(["sh", "-c", script], cwd=td).decode("utf-8")
+        # With fixed waves of two this would take at least 2.5 seconds
+        assert time.time() - start < 2.4, output
+        done = [line.split()[1:3] for line in output.splitlines() if line.startswith("CHERIBSDTEST-DONE:")]
+        assert sorted(done) == [["fast1", "EXITCODE=0"], ["fast2", "EXITCODE=1"], ["renamed", "EXITCODE=0"],
+                                ["slow", "EXITCODE=0"]]
+        # The textual output of each variant is printed in one block
+        assert "=== fast2.log:\nfast2 stderr\n" in output
+        assert "=== renamed.log:\nold stderr\n" in output
+        assert "CHERIBSDTEST-ARCHIVED: EXITCODE=0" in output
+        assert Path(td, "cheribsdtest-results", "renamed.xml").read_text() == '<testsuite name="old"/>\n'
+        assert Path(td, "cheribsdtest-results.tar.gz").is_file()
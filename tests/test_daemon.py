@@ -0,0 +1,110 @@
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from pycheribuild.config.loader import JsonAndCommandLineConfigLoader
+from pycheribuild.daemon import (CheribuildDaemon, environment_affecting_defaults, PROTOCOL_VERSION,
+                                 receive_message, run_in_daemon, send_message, socket_path)
+
+
+def test_socket_path():
+    assert socket_path("/foo/cheribuild.py").name.startswith("cheribuild.py-")
+    assert socket_path("/foo/debug-cheribuild.py").name.startswith("debug-cheribuild.py-")
+    assert socket_path("/foo/cheribuild.py").parent.name == "cheribuild-" + str(os.getuid())
+
+
+def test_message_with_fds():
+    client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client, server, tempfile.TemporaryFile() as f:
+        request = {"argv": ["cheribuild.py", "--pretend", "llvm"], "env": {"FOO": "x" * 10000}}
+        send_message(client, request, [f.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+        received, fds = receive_message(server, max_fds=3)
+        try:
+            assert received == request
+            assert len(fds) == 3
+            assert os.fstat(fds[0]).st_ino == os.fstat(f.fileno()).st_ino
+        finally:
+            for fd in fds:
+                os.close(fd)
+        send_message(server, {"exit_code": 3})
+        assert receive_message(client) == ({"exit_code": 3}, [])
+        server.close()
+        assert receive_message(client) == (None, [])
+
+
+def test_preloaded_config_files(monkeypatch):
+    with tempfile.TemporaryDirectory() as td:
+        monkeypatch.setenv("XDG_CONFIG_HOME", td)
+        loader = JsonAndCommandLineConfigLoader()
+        config_path = Path(td, loader.default_config_path.name)
+        config_path.write_text('{"#include": "common.json", "build-root": "/build"}')
+        Path(td, "common.json").write_text('{"source-root": "/source"}')
+        loader.preload_config_files()
+        # noinspection PyProtectedMember
+        loaded_files, _, parsed = loader._preloaded_config_files[config_path]
+        assert loaded_files == [config_path, Path(td, "common.json")]
+        assert parsed["source-root"].value == "/source"
+        # noinspection PyUnresolvedReferences
+        assert loader._JsonAndCommandLineConfigLoader__load_config_file(config_path) is parsed
+        # Changing an included file invalidates the preloaded values
+        time.sleep(0.01)
+        Path(td, "common.json").write_text('{"source-root": "/other-source"}')
+        # noinspection PyUnresolvedReferences
+        reparsed = loader._JsonAndCommandLineConfigLoader__load_config_file(config_path)
+        assert reparsed is not parsed and reparsed["source-root"].value == "/other-source"
+
+
+def _fake_daemon() -> CheribuildDaemon:
+    # Avoid the expensive (and global) setup of all config options that CheribuildDaemon.__init__ performs
+    daemon = CheribuildDaemon.__new__(CheribuildDaemon)
+    daemon._stopping = False
+    daemon._restarting = False
+    daemon._source_fingerprint = lambda: "fingerprint"
+    daemon._fingerprint = "fingerprint"
+    daemon._environment = environment_affecting_defaults(os.environ)
+    daemon._log = lambda *args: None
+    return daemon
+
+
+def test_daemon_rejects_different_environment():
+    daemon = _fake_daemon()
+    env = dict(os.environ)
+    env["PATH"] = "/other/bin:" + env.get("PATH", "")
+    env["UNRELATED_VARIABLE"] = "1"
+    client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client, tempfile.TemporaryFile() as f:
+        request = {"version": PROTOCOL_VERSION, "command": "run", "argv": ["cheribuild.py", "--pretend", "llvm"],
+                   "cwd": os.getcwd(), "env": env, "umask": 0o022}
+        send_message(client, request, [f.fileno(), f.fileno(), f.fileno()])
+        daemon._handle_connection(server)
+        message, _ = receive_message(client)
+        assert "fallback" in message and "environment" in message["fallback"]
+    # Only the variables that affect the config defaults are compared
+    del env["UNRELATED_VARIABLE"]
+    assert environment_affecting_defaults(dict(env, TERM="dumb", OLDPWD="/")) == environment_affecting_defaults(env)
+    assert environment_affecting_defaults(dict(env, CHERIBUILD_DEBUG="1")) != environment_affecting_defaults(env)
+
+
+def test_client_without_stdin(monkeypatch):
+    with tempfile.TemporaryDirectory() as td:
+        monkeypatch.setenv("XDG_RUNTIME_DIR", td)
+        path = socket_path("cheribuild.py")
+        path.parent.mkdir(mode=0o700)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(path))
+            server.listen(1)
+            server.setblocking(False)
+            for stdin in (None, open(os.devnull)):
+                if stdin is not None:
+                    stdin.close()
+                monkeypatch.setattr(sys, "stdin", stdin)
+                # Runs without the daemon instead of raising an exception
+                assert run_in_daemon(["cheribuild.py", "--pretend", "llvm"]) is None
+                try:
+                    server.accept()[0].close()
+                    raise AssertionError("Should not have connected to the daemon")
+                except BlockingIOError:
+                    pass
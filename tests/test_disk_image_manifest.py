@@ -0,0 +1,50 @@
+import os
+import tempfile
+from pathlib import Path
+
+# noinspection PyProtectedMember
+from pycheribuild.projects.disk_image import _disk_image_signature, _incremental_disk_image_changes
+
+
+def _manifest(entries: dict, options="['disk-image', 'makefs']") -> dict:
+    return {"version": 2, "options": options, "entries": entries, "hashes": {}}
+
+
+def test_reuse_or_rebuild():
+    with tempfile.TemporaryDirectory() as td:
+        image = Path(td, "cheribsd.img")
+        image.write_bytes(b"\0" * 4096)
+        entries = {"./bin/sh": ["type=file mode=0755", "abc"], "./etc": ["type=dir", None]}
+        previous = _manifest(entries)
+        previous["image"] = _disk_image_signature(image)
+        assert _incremental_disk_image_changes(previous, _manifest(dict(entries)), image) == (None, [])
+        # No manifest for the existing image
+        assert _incremental_disk_image_changes(dict(), _manifest(entries), image)[0] is not None
+        # Options or manifest format changed
+        reason, _ = _incremental_disk_image_changes(previous, _manifest(entries, options="['other']"), image)
+        assert reason == "the disk image options have changed"
+        outdated = dict(previous, version=1)
+        assert _incremental_disk_image_changes(outdated, _manifest(entries), image)[0] is not None
+        # Files added, removed and modified
+        new_entries = {"./bin/sh": ["type=file mode=0755", "def"], "./bin/cat": ["type=file mode=0755", "123"]}
+        reason, changed = _incremental_disk_image_changes(previous, _manifest(new_entries), image)
+        assert reason == "1 files were added, 1 were removed and 1 were modified"
+        assert changed == ["./bin/sh"]
+
+        # The image itself was written to after it had been created (e.g. by booting it)
+        st = image.stat()
+        with image.open("r+b") as f:
+            f.write(b"x")
+        os.utime(str(image), ns=(st.st_atime_ns, st.st_mtime_ns + 1000))  # in case of coarse timestamps
+        reason, _ = _incremental_disk_image_changes(previous, _manifest(entries), image)
+        assert reason == "the existing image has been modified since it was created"
+        # Different size (e.g. replaced by a compressed copy)
+        image.write_bytes(b"\0" * 1024)
+        os.utime(str(image), ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert _incremental_disk_image_changes(previous, _manifest(entries), image)[0] is not None
+        # Manifests written before the image was recorded and deleted images are never reused
+        assert _incremental_disk_image_changes(dict(previous, image=None), _manifest(entries), image)[0] is not None
+        image.unlink()
+        assert _disk_image_signature(image) is None
+        previous["image"] = None
+        assert _incremental_disk_image_changes(previous, _manifest(entries), image)[0] is not None
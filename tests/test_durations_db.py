@@ -0,0 +1,113 @@
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / "test-scripts"))
+import durations_db  # noqa: E402
+from run_tests_common import junitparser  # noqa: E402
+
+
+def _write_junit_xml(path: Path, durations: "dict", skipped=(), failed=()) -> Path:
+    suite = junitparser.TestSuite(name="suite")
+    for (classname, name), duration in durations.items():
+        case = junitparser.TestCase(name=name)
+        case.classname = classname
+        case.time = duration
+        if (classname, name) in skipped:
+            case.result = junitparser.Skipped(message="skipped")
+        elif (classname, name) in failed:
+            case.result = junitparser.Failure(message="failed")
+        suite.add_testcase(case)
+    xml = junitparser.JUnitXml()
+    xml.add_testsuite(suite)
+    xml.write(str(path))
+    return path
+
+
+def test_ingest_and_median_history():
+    db = durations_db.TestDurationDatabase(Path(":memory:"))
+    with tempfile.TemporaryDirectory() as td:
+        for i, duration in enumerate([1.0, 3.0, 2.0, 100.0]):
+            xml = _write_junit_xml(Path(td, "run" + str(i) + ".xml"), {("c", "a"): duration, ("c", "b"): 5.0},
+                                   skipped=[("c", "b")] if i == 3 else [])
+            db.ingest_junit_xml([xml], suite="libcxx", target="riscv64-purecap", run_duration=10.0 + i)
+        # A different suite/target does not affect the history
+        db.ingest_junit_xml([_write_junit_xml(Path(td, "other.xml"), {("c", "a"): 1000.0})], suite="libcxx",
+                            target="aarch64")
+        # Unparseable files are ignored
+        broken = Path(td, "broken.xml")
+        broken.write_text("<testsuites")
+        db.ingest_junit_xml([broken], suite="libunwind", target="riscv64-purecap")
+
+    assert db.test_durations("libcxx", "riscv64-purecap") == {("c", "a"): [1.0, 3.0, 2.0, 100.0],
+                                                              ("c", "b"): [5.0, 5.0, 5.0]}
+    assert db.median_test_durations("libcxx", "riscv64-purecap") == {("c", "a"): 2.5, ("c", "b"): 5.0}
+    assert db.median_test_durations("libcxx", "riscv64-purecap", history=3) == {("c", "a"): 3.0, ("c", "b"): 5.0}
+    assert db.median_test_durations("libcxx", "aarch64") == {("c", "a"): 1000.0}
+    assert db.median_test_durations("libunwind", "riscv64-purecap") == {}
+    assert db.run_durations("libcxx", "riscv64-purecap", history=2) == [13.0, 12.0]
+    db.close()
+
+
+def test_regressions():
+    db = durations_db.TestDurationDatabase(Path(":memory:"))
+    with tempfile.TemporaryDirectory() as td:
+        def ingest(durations: dict, **kwargs) -> int:
+            xml = _write_junit_xml(Path(td, "results.xml"), durations, **kwargs)
+            return db.ingest_junit_xml([xml], suite="libcxx", target="riscv64")
+
+        first = ingest({("c", "slow"): 10.0, ("c", "fast"): 0.1, ("c", "stable"): 10.0})
+        for duration in (10.0, 12.0):
+            ingest({("c", "slow"): duration, ("c", "fast"): 0.1, ("c", "stable"): 10.0})
+        latest = ingest({("c", "slow"): 30.0, ("c", "fast"): 0.9, ("c", "stable"): 14.0, ("c", "new"): 50.0,
+                         ("c", "skipped"): 100.0}, skipped=[("c", "skipped")])
+        # Tests below min_seconds, without history or within the factor are not regressions
+        assert db.regressions(latest) == [(("c", "slow"), 10.0, 30.0)]
+        assert db.regressions(latest, factor=1.3) == [(("c", "slow"), 10.0, 30.0), (("c", "stable"), 10.0, 14.0)]
+        assert db.regressions(latest, min_seconds=0.5) == [(("c", "slow"), 10.0, 30.0), (("c", "fast"), 0.1, 0.9)]
+        # Only earlier runs are used as the baseline
+        assert db.regressions(first) == []
+        assert db.slowest_tests(latest, 2) == [(("c", "skipped"), 100.0), (("c", "new"), 50.0)]
+    db.close()
+
+
+def test_adaptive_timeout():
+    assert durations_db.adaptive_timeout([], 1234) == 1234
+    assert durations_db.adaptive_timeout([1.0, 2.0], 1234) == 60
+    assert durations_db.adaptive_timeout([10.0, 40.0], 1234) == 120
+    assert durations_db.adaptive_timeout([10.0, 40.0], 1234, factor=5, minimum=10) == 200
+
+
+def test_timeouts_only_use_successful_runs():
+    db = durations_db.TestDurationDatabase(Path(":memory:"))
+    with tempfile.TemporaryDirectory() as td:
+        for i, (duration, failed) in enumerate([(10.0, False), (600.0, True), (20.0, False)]):
+            xml = _write_junit_xml(Path(td, "run" + str(i) + ".xml"), {("c", "a"): duration, ("c", "b"): 1.0},
+                                   failed=[("c", "a")] if failed else [])
+            db.ingest_junit_xml([xml], suite="libcxx", target="riscv64", run_duration=100.0 * (i + 1),
+                                run_successful=not failed)
+    # Failures are still used for scheduling, but not for computing timeouts
+    assert db.test_durations("libcxx", "riscv64") == {("c", "a"): [10.0, 600.0, 20.0], ("c", "b"): [1.0, 1.0, 1.0]}
+    successful = db.test_durations("libcxx", "riscv64", successful_only=True)
+    assert successful == {("c", "a"): [10.0, 20.0], ("c", "b"): [1.0, 1.0, 1.0]}
+    assert durations_db.adaptive_timeout(successful[("c", "a")], 1234) == 60
+    assert db.run_durations("libcxx", "riscv64") == [300.0, 100.0]
+    db.close()
+
+
+def test_upgrade_old_database():
+    with tempfile.TemporaryDirectory() as td:
+        path = Path(td, "durations.sqlite3")
+        connection = sqlite3.connect(str(path))
+        with connection:
+            connection.execute("CREATE TABLE runs (id INTEGER PRIMARY KEY, suite TEXT NOT NULL, target TEXT NOT NULL, "
+                               "timestamp REAL NOT NULL, duration REAL, source TEXT)")
+            connection.execute("INSERT INTO runs (suite, target, timestamp, duration) VALUES ('x', 'y', 0, 5000.0)")
+        connection.close()
+        db = durations_db.TestDurationDatabase(path)
+        # We don't know whether the old runs were successful
+        assert db.run_durations("x", "y") == []
+        db.ingest_junit_xml([], suite="x", target="y", run_duration=10.0)
+        assert db.run_durations("x", "y") == [10.0]
+        db.close()
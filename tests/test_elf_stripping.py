@@ -0,0 +1,79 @@
+import struct
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# noinspection PyProtectedMember
+from pycheribuild.projects.project import _elf_file_needs_stripping
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+
+
+def _make_elf(is_64: bool, big_endian: bool, sections: "list", with_section_headers=True) -> bytes:
+    endian = ">" if big_endian else "<"
+    ehdr_fmt = endian + ("HHIQQQIHHHHHH" if is_64 else "HHIIIIIHHHHHH")
+    shdr_fmt = endian + ("IIQQQQIIQQ" if is_64 else "IIIIIIIIII")
+    ehsize = 16 + struct.calcsize(ehdr_fmt)
+    sections = [("", 0)] + list(sections) + [(".shstrtab", SHT_STRTAB)]
+    names = b"\0"
+    name_offsets = []
+    for name, _ in sections:
+        if name:
+            name_offsets.append(len(names))
+            names += name.encode("ascii") + b"\0"
+        else:
+            name_offsets.append(0)
+    shoff = ehsize + len(names)
+    shdrs = b""
+    for (name, sh_type), name_offset in zip(sections, name_offsets):
+        offset, size = (ehsize, len(names)) if name == ".shstrtab" else (0, 0)
+        shdrs += struct.pack(shdr_fmt, name_offset, sh_type, 0, 0, offset, size, 0, 0, 1, 0)
+    ident = b"\x7fELF" + bytes([2 if is_64 else 1, 2 if big_endian else 1, 1]) + b"\0" * 9
+    header = struct.pack(ehdr_fmt, 2, 0, 1, 0, 0, shoff if with_section_headers else 0, 0, ehsize, 0, 0,
+                         struct.calcsize(shdr_fmt), len(sections), len(sections) - 1)
+    return ident + header + names + shdrs
+
+
+@pytest.fixture(params=[(False, False), (False, True), (True, False), (True, True)],
+                ids=["elf32-le", "elf32-be", "elf64-le", "elf64-be"])
+def elf_format(request):
+    return request.param
+
+
+def _check(contents: bytes) -> "bool":
+    with tempfile.TemporaryDirectory() as td:
+        path = Path(td, "file")
+        path.write_bytes(contents)
+        return _elf_file_needs_stripping(str(path))
+
+
+def test_stripped(elf_format):
+    assert _check(_make_elf(*elf_format, [(".text", SHT_PROGBITS), (".data", SHT_PROGBITS)])) is False
+    assert _check(_make_elf(*elf_format, [(".text", SHT_PROGBITS)], with_section_headers=False)) is False
+
+
+def test_unstripped(elf_format):
+    assert _check(_make_elf(*elf_format, [(".text", SHT_PROGBITS), (".symtab", SHT_SYMTAB),
+                                          (".strtab", SHT_STRTAB)])) is True
+    # Debug info without a symbol table
+    assert _check(_make_elf(*elf_format, [(".text", SHT_PROGBITS), (".debug_info", SHT_PROGBITS)])) is True
+    assert _check(_make_elf(*elf_format, [(".text", SHT_PROGBITS), (".zdebug_line", SHT_PROGBITS)])) is True
+
+
+def test_truncated(elf_format):
+    contents = _make_elf(*elf_format, [(".text", SHT_PROGBITS)])
+    # Let llvm-strip decide what to do with files that have a valid ELF header but are otherwise truncated
+    assert _check(contents[:-8]) is True
+    assert _check(contents[:20]) is True
+    # Not even the ELF identification is complete
+    assert _check(contents[:10]) is None
+
+
+def test_not_elf():
+    assert _check(b"") is None
+    assert _check(b"#!/bin/sh\necho hello\n") is None
+    assert _check(b"\x7fELX" + b"\0" * 60) is None
+    assert _check(b"!<arch>\n" + b"\0" * 60) is None
@@ -0,0 +1,157 @@
+import subprocess
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from pycheribuild.config.compilation_targets import CompilationTargets
+from pycheribuild.projects import project as project_module
+from pycheribuild.projects.project import DefaultInstallDir, ExternallyManagedSourceRepository, Project
+from .setup_mock_chericonfig import MockConfig, setup_mock_chericonfig
+
+
+# noinspection PyTypeChecker
+class FingerprintProject(Project):
+    do_not_add_to_targets = True
+    project_name = "fingerprint"
+    target = "fingerprint"
+    _xtarget = CompilationTargets.NATIVE
+    _should_not_be_instantiated = False
+    default_install_dir = DefaultInstallDir.CUSTOM_INSTALL_DIR
+    repository = ExternallyManagedSourceRepository()
+
+    def __init__(self, config: MockConfig, name: str):
+        self.project_name = name
+        self._initial_source_dir = config.source_root / "sources" / name
+        self._install_dir = config.source_root / "install" / name
+        self.build_dir = config.source_root / "build" / (name + "-build")
+        super().__init__(config)
+        self.source_dir.mkdir(parents=True)
+
+
+class _FakeDependency(object):
+    def __init__(self, project: Project):
+        self.name = project.target
+        self.project = project
+
+    def get_or_create_project(self, _caller, _config):
+        return self.project
+
+
+def _git(project: Project, *args):
+    subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args),
+                          cwd=str(project.source_dir), stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def project():
+    setup_mock_chericonfig(Path("/invalid/path"))
+    FingerprintProject.setup_config_options()
+    with tempfile.TemporaryDirectory() as td:
+        config = setup_mock_chericonfig(Path(td), pretend=False)
+        result = FingerprintProject(config, "foo")
+        # Only the dependencies added by the tests should be included
+        result._recursive_dependencies_impl = lambda *args, **kwargs: []
+        yield result
+
+
+def test_no_fingerprint_without_git(project):
+    assert project.compute_input_fingerprint() is None
+    assert not project._is_up_to_date(None)
+
+
+def test_fingerprint_changes_with_dirty_tree(project):
+    _git(project, "init", "-q")
+    Path(project.source_dir, "file.c").write_text("int x;\n")
+    _git(project, "add", "file.c")
+    _git(project, "commit", "-q", "-m", "initial")
+    clean = project.compute_input_fingerprint()
+    assert clean is not None
+    assert project.compute_input_fingerprint() == clean
+    # Uncommitted changes to tracked files
+    Path(project.source_dir, "file.c").write_text("int y;\n")
+    modified = project.compute_input_fingerprint()
+    assert modified != clean
+    Path(project.source_dir, "file.c").write_text("int x;\n")
+    assert project.compute_input_fingerprint() == clean
+    # Untracked files
+    Path(project.source_dir, "new.c").write_text("int z;\n")
+    untracked = project.compute_input_fingerprint()
+    assert untracked not in (clean, modified)
+    # Committing the changes changes HEAD
+    _git(project, "add", "new.c")
+    _git(project, "commit", "-q", "-m", "add new.c")
+    assert project.compute_input_fingerprint() not in (clean, modified, untracked)
+
+
+def test_fingerprint_changes_with_config_options(project):
+    _git(project, "init", "-q")
+    _git(project, "commit", "-q", "--allow-empty", "-m", "initial")
+    original = project.compute_input_fingerprint()
+    # Project options
+    project.use_asan = True
+    assert project.compute_input_fingerprint() != original
+    project.use_asan = False
+    assert project.compute_input_fingerprint() == original
+    # Global options, unless they don't affect the build output
+    # noinspection PyProtectedMember
+    options = project.config.loader.options
+    for name, value, changes_output in (("skip-sdk", True, True), ("pass-k-to-make", True, False),
+                                        ("test-extra-args", ["--foo"], False),
+                                        ("timing-trace", Path("/tmp/trace.json"), False)):
+        # noinspection PyProtectedMember
+        old_value = options[name]._cached
+        options[name]._cached = value
+        try:
+            assert (project.compute_input_fingerprint() != original) == changes_output, name
+        finally:
+            options[name]._cached = old_value
+    assert project.compute_input_fingerprint() == original
+
+
+def test_fingerprint_changes_with_dependencies(project):
+    dep = FingerprintProject(project.config, "dep")
+    project._recursive_dependencies_impl = lambda *args, **kwargs: [_FakeDependency(dep)]
+    _git(project, "init", "-q")
+    _git(project, "commit", "-q", "--allow-empty", "-m", "initial")
+    # The dependency was built without --skip-unchanged-targets (or is being rebuilt) -> always rebuild
+    assert project.compute_input_fingerprint() is None
+    dep.build_dir.mkdir(parents=True)
+    dep._fingerprint_path().write_text("1234\n")
+    first = project.compute_input_fingerprint()
+    assert first is not None
+    dep._fingerprint_path().write_text("5678\n")
+    assert project.compute_input_fingerprint() not in (None, first)
+    dep._fingerprint_path().unlink()
+    assert project.compute_input_fingerprint() is None
+
+
+def test_fingerprint_changes_with_cheribuild_sources(project, monkeypatch):
+    _git(project, "init", "-q")
+    _git(project, "commit", "-q", "--allow-empty", "-m", "initial")
+    original = project.compute_input_fingerprint()
+    monkeypatch.setattr(project_module, "_cheribuild_fingerprint", "0" * 64)
+    assert project.compute_input_fingerprint() != original
+
+
+def test_fingerprint_deleted_on_clean(project):
+    _git(project, "init", "-q")
+    _git(project, "commit", "-q", "--allow-empty", "-m", "initial")
+    fingerprint = project.compute_input_fingerprint()
+    project.build_dir.mkdir(parents=True)
+    project._fingerprint_path().write_text(fingerprint)
+    config = project.config
+    config.clean = False
+    config.skip_build = False
+    config.skip_install = False
+    assert project._is_up_to_date(fingerprint)
+    assert not project._is_up_to_date(project.compute_input_fingerprint() + "0")
+    config.clean = True
+    assert not project._is_up_to_date(fingerprint)
+    # Building (even if only the clean step is performed) must remove the stale fingerprint
+    config.skip_build = True
+    config.skip_install = True
+    config.skip_unchanged_targets = True
+    project.process()
+    assert project.build_dir.is_dir()
+    assert not project._fingerprint_path().exists()
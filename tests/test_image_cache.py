@@ -0,0 +1,159 @@
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+_cheribuild_root = Path(__file__).parent.parent
+sys.path.append(str(_cheribuild_root))
+if str((_cheribuild_root / "3rdparty/pexpect").resolve()) not in sys.path:
+    sys.path.append(str((_cheribuild_root / "3rdparty/pexpect").resolve()))
+from pycheribuild.boot_cheribsd import cached_file_hash, DecompressedImageCache  # noqa: E402
+
+
+def _add_entry(cache_dir: Path, name: str, size: int, mtime: int) -> Path:
+    entry = cache_dir / name
+    entry.write_bytes(b"x" * size)
+    os.utime(str(entry), (mtime, mtime))
+    return entry
+
+
+def _entry_names(cache_dir: Path) -> "list":
+    return sorted(p.name for p in cache_dir.iterdir() if p.suffix in (".img", ".kernel", ".tar"))
+
+
+def test_evict_least_recently_used():
+    with tempfile.TemporaryDirectory() as td:
+        cache_dir = Path(td)
+        _add_entry(cache_dir, "oldest.img", 100, 1000)
+        _add_entry(cache_dir, "old.kernel", 100, 2000)
+        _add_entry(cache_dir, "new.tar", 100, 3000)
+        _add_entry(cache_dir, "newest.img", 100, 4000)
+        # Partially written entries and unrelated files are never evicted
+        _add_entry(cache_dir, "partial.img.tmp123", 1000, 0)
+        _add_entry(cache_dir, "file-hashes.json", 1000, 0)
+        DecompressedImageCache(cache_dir, max_size=400).evict()
+        assert _entry_names(cache_dir) == ["new.tar", "newest.img", "old.kernel", "oldest.img"]
+        DecompressedImageCache(cache_dir, max_size=250).evict()
+        assert _entry_names(cache_dir) == ["new.tar", "newest.img"]
+        assert (cache_dir / "partial.img.tmp123").exists()
+        assert (cache_dir / "file-hashes.json").exists()
+        DecompressedImageCache(cache_dir, max_size=0).evict()
+        assert _entry_names(cache_dir) == []
+
+
+def test_evict_keep():
+    with tempfile.TemporaryDirectory() as td:
+        cache_dir = Path(td)
+        oldest = _add_entry(cache_dir, "oldest.img", 100, 1000)
+        _add_entry(cache_dir, "old.img", 100, 2000)
+        _add_entry(cache_dir, "new.img", 100, 3000)
+        DecompressedImageCache(cache_dir, max_size=150).evict(keep=oldest)
+        assert _entry_names(cache_dir) == ["oldest.img"]
+
+
+def test_evict_skips_locked_entries():
+    with tempfile.TemporaryDirectory() as td:
+        cache_dir = Path(td)
+        in_use = _add_entry(cache_dir, "in-use.img", 100, 1000)
+        _add_entry(cache_dir, "old.img", 100, 2000)
+        _add_entry(cache_dir, "new.img", 100, 3000)
+        # Another job holds the shared lock while QEMU is using the image
+        lock_fd = os.open(str(cache_dir / "in-use.img.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+            DecompressedImageCache(cache_dir, max_size=150).evict()
+            assert _entry_names(cache_dir) == ["in-use.img"]
+        finally:
+            os.close(lock_fd)
+        assert in_use.exists()
+        # The lock files remain since other jobs may already have opened them
+        assert (cache_dir / "old.img.lock").exists()
+        DecompressedImageCache(cache_dir, max_size=0).evict()
+        assert _entry_names(cache_dir) == []
+
+
+def test_decompress_shares_entries_and_evicts():
+    with tempfile.TemporaryDirectory() as td:
+        cache_dir = Path(td, "cache")
+        archives = []
+        for i in range(3):
+            archive = Path(td, "archive" + str(i) + ".img.xz")
+            archive.write_bytes(str(i).encode("utf-8") * 100)
+            archives.append(archive)
+        # "cat" is used as the decompression command
+        cache = DecompressedImageCache(cache_dir, max_size=250)
+        first = cache.decompress(archives[0], ["cat"], "disk image")
+        assert first.suffix == ".img" and first.read_bytes() == archives[0].read_bytes()
+        assert first.stat().st_mode & 0o222 == 0, "shared images must be read-only"
+        kernel = cache.decompress(archives[1], ["cat"], "kernel")
+        assert kernel.suffix == ".kernel"
+        # The same archive is only decompressed once
+        archives[0].write_bytes(archives[0].read_bytes())  # same contents, different mtime
+        assert cache.decompress(archives[0], ["false"], "disk image") == first
+        # All entries are in use by this cache, so nothing can be evicted
+        test_archive = cache.decompress(archives[2], ["cat"], "test archive")
+        assert test_archive.suffix == ".tar"
+        assert _entry_names(cache_dir) == sorted(p.name for p in (first, kernel, test_archive))
+        # Once the jobs have exited, another job evicts the least recently used entries
+        cache.release_all()
+        os.utime(str(kernel), (1000, 1000))
+        other = DecompressedImageCache(cache_dir, max_size=250)
+        assert other.decompress(archives[2], ["false"], "test archive") == test_archive
+        assert _entry_names(cache_dir) == sorted(p.name for p in (first, test_archive))
+        other.release_all()
+
+
+def test_release_entry():
+    with tempfile.TemporaryDirectory() as td:
+        cache_dir = Path(td, "cache")
+        archives = []
+        for i in range(2):
+            archive = Path(td, "archive" + str(i) + ".tar.xz")
+            archive.write_bytes(str(i).encode("utf-8") * 100)
+            archives.append(archive)
+        cache = DecompressedImageCache(cache_dir, max_size=0)
+        first = cache.decompress(archives[0], ["cat"], "test archive")
+        second = cache.decompress(archives[1], ["cat"], "test archive")
+        fds_before_release = len(os.listdir("/proc/self/fd")) if Path("/proc/self/fd").is_dir() else None
+        # Entries that are in use can't be evicted, but released ones can
+        assert _entry_names(cache_dir) == sorted(p.name for p in (first, second))
+        cache.release(first)
+        cache.release(archives[0])  # not an entry -> ignored
+        DecompressedImageCache(cache_dir, max_size=0).evict()
+        assert _entry_names(cache_dir) == [second.name]
+        # The lock file descriptors are closed when the entry is released
+        cache.release(second)
+        if fds_before_release is not None:
+            assert len(os.listdir("/proc/self/fd")) == fds_before_release - 2
+        DecompressedImageCache(cache_dir, max_size=0).evict()
+        assert _entry_names(cache_dir) == []
+
+
+def test_cached_file_hash_concurrent_update():
+    with tempfile.TemporaryDirectory() as td:
+        hash_cache = Path(td, "file-hashes.json")
+        files = []
+        for name in ("a", "b"):
+            files.append(Path(td, name))
+            files[-1].write_text(name)
+        hash_a = cached_file_hash(files[0], hash_cache)
+        assert hash_a == hashlib.sha256(b"a").hexdigest()
+        # Another job holds the lock and adds an entry while we are hashing the second file
+        lock_fd = os.open(str(Path(td, "file-hashes.json.lock")), os.O_RDWR | os.O_CREAT)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(cached_file_hash, files[1], hash_cache)
+            time.sleep(0.1)
+            assert not future.done()
+            other = json.loads(hash_cache.read_text())
+            other["other-job"] = "1234"
+            hash_cache.write_text(json.dumps(other))
+            os.close(lock_fd)
+            assert future.result() == hashlib.sha256(b"b").hexdigest()
+        assert sorted(json.loads(hash_cache.read_text()).values()) == sorted(["1234", hash_a, future.result()])
+        assert cached_file_hash(files[0], hash_cache) == hash_a
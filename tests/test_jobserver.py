@@ -0,0 +1,68 @@
+import fcntl
+import struct
+import sys
+import tempfile
+import termios
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from pycheribuild.jobserver import JobServer  # noqa: E402
+
+
+def _available_tokens(jobserver: JobServer) -> int:
+    # noinspection PyProtectedMember
+    return struct.unpack("i", fcntl.ioctl(jobserver._fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+
+def test_token_accounting():
+    with tempfile.TemporaryDirectory() as td:
+        with JobServer(Path(td, "jobserver.fifo"), 3) as jobserver:
+            assert _available_tokens(jobserver) == 3
+            with jobserver.implicit_job_slot():
+                assert _available_tokens(jobserver) == 2
+                # Tools without jobserver support get as many of the remaining slots as possible
+                with jobserver.reserved_job_slots(8) as jobs:
+                    assert jobs == 2
+                    assert _available_tokens(jobserver) == 0
+                assert _available_tokens(jobserver) == 2
+            assert _available_tokens(jobserver) == 3
+            with jobserver.reserved_job_slots(1) as jobs:
+                assert jobs == 1
+                assert _available_tokens(jobserver) == 2
+            # The token is returned even if the build fails
+            try:
+                with jobserver.reserved_job_slots(2):
+                    raise RuntimeError("build failed")
+            except RuntimeError:
+                pass
+            assert _available_tokens(jobserver) == 3
+
+
+def test_makeflags():
+    with tempfile.TemporaryDirectory() as td:
+        with JobServer(Path(td, "jobserver.fifo"), 0) as jobserver:
+            assert jobserver.jobs == 1
+            read_fd, write_fd = jobserver.pass_fds
+            fds = str(read_fd) + "," + str(write_fd)
+            assert jobserver.makeflags() == "-j --jobserver-fds=" + fds + " --jobserver-auth=" + fds
+            assert jobserver.makeflags(use_fifo=True) == "-j --jobserver-auth=fifo:" + str(Path(td, "jobserver.fifo"))
+        assert jobserver.pass_fds == (-1, -1)
+
+
+def test_fifo_shared_and_cleaned_up():
+    with tempfile.TemporaryDirectory() as td:
+        fifo = Path(td, "jobserver.fifo")
+        first = JobServer(fifo, 4)
+        first.start()
+        # noinspection PyProtectedMember
+        first._take_token(blocking=True)  # simulate a tool that was killed without returning its token
+        # A second instance using the same build root shares the pool instead of adding more tokens
+        with JobServer(fifo, 16) as second:
+            assert _available_tokens(second) == 3
+            with second.implicit_job_slot():
+                assert _available_tokens(first) == 2
+        first.stop()
+        # Once all users have exited the stale pipe is replaced and the lost token is available again
+        with JobServer(fifo, 2) as third:
+            assert _available_tokens(third) == 2
+        assert fifo.is_fifo()
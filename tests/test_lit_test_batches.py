@@ -0,0 +1,88 @@
+import argparse
+import queue
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent / "test-scripts"))
+import run_remote_lit_test  # noqa: E402
+from run_remote_lit_test import boot_cheribsd, unfinished_lit_test_batches_suite  # noqa: E402
+
+
+def _run_batches(monkeypatch, test_batches: queue.Queue, run_batch) -> "list":
+    """run_batch() is called with the list of tests and returns "die" to simulate the guest dying during the batch"""
+    ran = []
+    guest_died = []
+
+    def fake_lit_command(args, executor, batch, **kwargs):
+        return ["lit"] + batch[1], None
+
+    def fake_run_host_command(cmd, **kwargs):
+        ran.append(cmd[1:])
+        if run_batch(cmd[1:]) == "die":
+            guest_died.append(True)
+
+    monkeypatch.setattr(run_remote_lit_test, "lit_command", fake_lit_command)
+    monkeypatch.setattr(boot_cheribsd, "run_host_command", fake_run_host_command)
+    with tempfile.TemporaryDirectory() as td:
+        args = argparse.Namespace(build_dir=td, internal_shard=None, xunit_output=None)
+        result = run_remote_lit_test.run_lit_test_batches(args, "executor", test_batches,
+                                                          should_stop=lambda: bool(guest_died))
+    return [result, ran]
+
+
+def _queue(*batches) -> queue.Queue:
+    result = queue.Queue()
+    for batch in batches:
+        result.put((batch, 60))
+    return result
+
+
+def test_all_batches_run(monkeypatch):
+    test_batches = _queue(["s :: a"], ["s :: b"])
+    assert _run_batches(monkeypatch, test_batches, lambda batch: None) == [True, [["s :: a"], ["s :: b"]]]
+    assert test_batches.empty()
+    assert unfinished_lit_test_batches_suite(test_batches) is None
+
+
+def test_guest_death_returns_batch(monkeypatch):
+    test_batches = _queue(["s :: a"], ["s :: b/c.pass.cpp", "s :: d.pass.cpp"], ["s :: e"])
+    result, ran = _run_batches(monkeypatch, test_batches,
+                               lambda batch: "die" if batch[0] == "s :: b/c.pass.cpp" else None)
+    assert ran == [["s :: a"], ["s :: b/c.pass.cpp", "s :: d.pass.cpp"]]
+    # The batch that was running when the guest died is available to the other workers again
+    remaining = sorted(test_batches.get_nowait()[0] for _ in range(2))
+    assert remaining == [["s :: b/c.pass.cpp", "s :: d.pass.cpp"], ["s :: e"]]
+
+    # If no worker is left, the tests are reported as errors
+    test_batches = _queue(["s :: b/c.pass.cpp", "s :: d.pass.cpp"])
+    suite = unfinished_lit_test_batches_suite(test_batches)
+    cases = sorted((case.classname, case.name) for case in suite)
+    assert cases == [("s.b", "c.pass.cpp"), ("s.s", "d.pass.cpp")]
+    assert all(case.result for case in suite)
+
+
+def test_unexpected_error_returns_batch(monkeypatch):
+    def run_batch(batch):
+        raise subprocess.CalledProcessError(returncode=2, cmd=["lit"])
+
+    test_batches = _queue(["s :: a"], ["s :: b"])
+    with pytest.raises(subprocess.CalledProcessError):
+        _run_batches(monkeypatch, test_batches, run_batch)
+    assert sorted(test_batches.get_nowait()[0] for _ in range(2)) == [["s :: a"], ["s :: b"]]
+
+
+def test_junit_durations_for_timeouts():
+    with tempfile.TemporaryDirectory() as td:
+        xml = Path(td, "results.xml")
+        xml.write_text('<testsuites><testsuite name="libcxx">'
+                       '<testcase classname="libcxx" name="pass.cpp" time="2.0" />'
+                       '<testcase classname="libcxx" name="timeout.cpp" time="3600.0"><failure message="timeout" />'
+                       '</testcase></testsuite></testsuites>')
+        assert run_remote_lit_test.load_junit_test_durations([xml]) == {("libcxx", "pass.cpp"): 2.0,
+                                                                        ("libcxx", "timeout.cpp"): 3600.0}
+        assert run_remote_lit_test.load_junit_test_durations([xml], successful_only=True) == {
+            ("libcxx", "pass.cpp"): 2.0}
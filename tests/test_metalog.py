@@ -213,6 +213,41 @@ def test_contents_root():
 """ == _get_as_str(mtree)
 
 
+def test_escapes_and_ignored_keys():
+    # METALOG files use vis(3) octal escapes and may contain quoted values (as written by MtreeFile.write())
+    file = r"""#mtree 2.0
+. type=dir uname=root gname=wheel mode=0755 time=1591892624.000000000
+./a\040b type=file uname=root gname=wheel mode=0644 tags=package=runtime contents=/x
+'./c d' type=link uname=root gname=wheel mode=0755 link="e \"f\""
+"""
+    mtree = MtreeFile(io.StringIO(file))
+    assert len(mtree._mtree) == 3
+    assert mtree._mtree["./a b"].attributes == {"type": "file", "uname": "root", "gname": "wheel", "mode": "0644",
+                                                "contents": "/x"}
+    assert mtree._mtree["./c d"].attributes["link"] == 'e "f"'
+    assert mtree._mtree["."].attributes == {"type": "dir", "uname": "root", "gname": "wheel", "mode": "0755"}
+
+
+def test_escaped_paths_round_trip():
+    file = r"""#mtree 2.0
+. type=dir uname=root gname=wheel mode=0755
+./a\040b type=file uname=root gname=wheel mode=0644 contents=/x
+./tab\011and\134backslash type=file uname=root gname=wheel mode=0644
+./quote\047d\040\043x type=dir uname=root gname=wheel mode=0755
+"""
+    mtree = MtreeFile(io.StringIO(file))
+    paths = {"./a b", "./tab\tand\\backslash", "./quote'd #x"}
+    assert set(mtree._mtree.keys()) == {"."} | paths
+    written = _get_as_str(mtree)
+    assert "./a\\040b type=file" in written
+    assert "./quote\\047d\\040\\043x type=dir" in written
+    reparsed = MtreeFile(io.StringIO(written))
+    assert set(reparsed._mtree.keys()) == {"."} | paths
+    for path in paths:
+        assert reparsed._mtree[path].attributes == mtree._mtree[path].attributes
+    assert _get_as_str(reparsed) == written
+
+
 def test_add_file():
     mtree = MtreeFile()
     mtree.add_file(Path("/foo/bar"), "tmp/mysh", mode=0o755)
@@ -269,3 +304,25 @@ def test_symlink_infer_mode(temp_symlink):
 # END
 """.format(target=temp_symlink[2], testfile=str(temp_symlink[1]), symlink_perms=symlink_perms)
     assert expected == _get_as_str(mtree)
+
+
+def test_find_unlisted_files():
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td)
+        for d in ("bin", "usr/local/bin", "usr/local2", "opt/x", "etc/empty"):
+            (root / d).mkdir(parents=True)
+        for f in ("bin/sh", "bin/bash", "bin/bashbug", "bin/new", "usr/local/bin/foo", "usr/local2/bar", "opt/x/y",
+                  "etc/rc.conf", "METALOG"):
+            _create_file(root, f, 0o644)
+        (root / "etc/link").symlink_to("/does/not/exist")
+        (root / "dirlink").symlink_to("etc")
+        mtree = MtreeFile(io.StringIO("""#mtree 2.0
+. type=dir uname=root gname=wheel mode=0755
+./bin type=dir uname=root gname=wheel mode=0755
+./bin/sh type=file uname=root gname=wheel mode=0755
+./etc type=dir uname=root gname=wheel mode=0755
+./etc//rc.conf type=file uname=root gname=wheel mode=0755
+"""))
+        auto_added, unlisted = mtree.find_unlisted_files(root, ["usr/local/", "opt/", "bin/bash"])
+        assert auto_added == [(root / p, p) for p in ("bin/bash", "bin/bashbug", "opt/x/y", "usr/local/bin/foo")]
+        assert unlisted == [(root / p, p) for p in ("METALOG", "bin/new", "etc/link", "usr/local2/bar")]
@@ -0,0 +1,124 @@
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+# noinspection PyProtectedMember
+from pycheribuild.processutils import _ProgramProbeCache
+
+
+@pytest.fixture
+def tmpdir_with_binary(monkeypatch):
+    # The cache is disabled when running the test suite, so enable it for instances created by these tests
+    monkeypatch.setattr(_ProgramProbeCache, "_enabled", staticmethod(lambda: True))
+    with tempfile.TemporaryDirectory() as td:
+        binary = Path(td, "bin", "cc")
+        binary.parent.mkdir()
+        binary.write_bytes(b"\x7fELF compiler")
+        yield Path(td), binary
+
+
+def test_round_trip(tmpdir_with_binary):
+    td, binary = tmpdir_with_binary
+    cache = _ProgramProbeCache(td / "cache" / "probes.json")
+    assert cache.get(binary, "resource_dir") is None
+    cache.set(binary, "resource_dir", "/usr/lib/clang/12")
+    cache.set(binary, "warning_flags", {"-Wfoo": True})
+    cache.save()
+    assert not list((td / "cache").glob("probes.json?*")), "temporary file should have been renamed"
+    reloaded = _ProgramProbeCache(td / "cache" / "probes.json")
+    assert reloaded.get(binary, "resource_dir") == "/usr/lib/clang/12"
+    assert reloaded.get(binary, "warning_flags") == {"-Wfoo": True}
+    # Only absolute paths are cached
+    assert reloaded.get(Path("bin/cc"), "resource_dir", "default") == "default"
+    assert reloaded.get(td / "does-not-exist", "resource_dir", "default") == "default"
+
+
+def test_invalidated_when_binary_changes(tmpdir_with_binary):
+    td, binary = tmpdir_with_binary
+    cache = _ProgramProbeCache(td / "probes.json")
+    cache.set(binary, "resource_dir", "old")
+    cache.save()
+    # Same size, different mtime
+    st = binary.stat()
+    os.utime(str(binary), ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert _ProgramProbeCache(td / "probes.json").get(binary, "resource_dir") is None
+    cache = _ProgramProbeCache(td / "probes.json")
+    cache.set(binary, "resource_dir", "mtime-changed")
+    cache.save()
+    assert _ProgramProbeCache(td / "probes.json").get(binary, "resource_dir") == "mtime-changed"
+    # Same mtime, different size
+    st = binary.stat()
+    binary.write_bytes(b"\x7fELF new compiler")
+    os.utime(str(binary), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert _ProgramProbeCache(td / "probes.json").get(binary, "resource_dir") is None
+    # The already loaded entries are also checked
+    assert cache.get(binary, "resource_dir") is None
+
+
+@pytest.mark.parametrize("contents", ["", "{not json", "[]", '{"format_version": 1}', '{"entries": {}}',
+                                      '{"format_version": 0, "entries": {}}'])
+def test_corrupt_cache_file(tmpdir_with_binary, contents):
+    td, binary = tmpdir_with_binary
+    path = td / "probes.json"
+    path.write_text(contents)
+    cache = _ProgramProbeCache(path)
+    assert cache.get(binary, "resource_dir", "default") == "default"
+    cache.set(binary, "resource_dir", "value")
+    cache.save()
+    with path.open() as f:
+        data = json.load(f)
+    assert data["format_version"] == _ProgramProbeCache.FORMAT_VERSION
+    assert _ProgramProbeCache(path).get(binary, "resource_dir") == "value"
+
+
+def test_concurrent_writers(tmpdir_with_binary):
+    td, binary = tmpdir_with_binary
+    other_binary = binary.with_name("c++")
+    other_binary.write_bytes(b"\x7fELF other compiler")
+    path = td / "probes.json"
+    # Two cheribuild instances that both loaded the (empty) cache before either of them saved it
+    first = _ProgramProbeCache(path)
+    second = _ProgramProbeCache(path)
+    assert first.get(binary, "resource_dir") is None
+    assert second.get(other_binary, "resource_dir") is None
+    first.set(binary, "resource_dir", "first")
+    second.set(other_binary, "resource_dir", "second")
+    first.save()
+    second.save()  # must not discard the entry written by the first instance
+    reloaded = _ProgramProbeCache(path)
+    assert reloaded.get(binary, "resource_dir") == "first"
+    assert reloaded.get(other_binary, "resource_dir") == "second"
+
+    # Many threads updating the same instance
+    cache = _ProgramProbeCache(path)
+
+    def update(i):
+        cache.set(binary, "flag" + str(i), i)
+        cache.get(other_binary, "resource_dir")
+
+    threads = [threading.Thread(target=update, args=(i,)) for i in range(32)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cache.save()
+    reloaded = _ProgramProbeCache(path)
+    assert [reloaded.get(binary, "flag" + str(i)) for i in range(32)] == list(range(32))
+    assert reloaded.get(other_binary, "resource_dir") == "second"
+
+
+def test_preload_picks_up_changes(tmpdir_with_binary):
+    td, binary = tmpdir_with_binary
+    path = td / "probes.json"
+    daemon_cache = _ProgramProbeCache(path)
+    daemon_cache.preload()
+    assert daemon_cache.get(binary, "resource_dir") is None
+    writer = _ProgramProbeCache(path)
+    writer.set(binary, "resource_dir", "value")
+    writer.save()
+    daemon_cache.preload()
+    assert daemon_cache.get(binary, "resource_dir") == "value"
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+_cheribuild_root = Path(__file__).parent.parent
+sys.path.append(str(_cheribuild_root))
+if str((_cheribuild_root / "3rdparty/pexpect").resolve()) not in sys.path:
+    sys.path.append(str((_cheribuild_root / "3rdparty/pexpect").resolve()))
+from pycheribuild.boot_cheribsd import QemuSnapshot  # noqa: E402
+
+
+def test_snapshot_follows_moved_disk_image():
+    with tempfile.TemporaryDirectory() as td:
+        snapshot_dir = Path(td, "snapshots")
+        kernel = Path(td, "kernel")
+        kernel.write_bytes(b"kernel")
+        old_disk = Path(td, "old/disk.img")
+        old_disk.parent.mkdir()
+        old_disk.write_bytes(b"disk contents")
+        qemu_args = [sys.executable, "-kernel", str(kernel)]
+        snapshot = QemuSnapshot.create(snapshot_dir, Path("/qemu-img"), qemu_args, kernel, old_disk, "raw")
+        snapshot.link_disk_image(old_disk)
+        assert os.readlink(str(snapshot.base)) == str(old_disk.absolute())
+        assert snapshot.base.read_bytes() == b"disk contents"
+
+        # The same contents at a different path (e.g. a new Jenkins workspace) restore the same snapshot
+        new_disk = Path(td, "new/disk.img")
+        new_disk.parent.mkdir()
+        os.rename(str(old_disk.parent), str(new_disk.parent))
+        restored = QemuSnapshot.create(snapshot_dir, Path("/qemu-img"), qemu_args, kernel, new_disk, "raw")
+        assert restored.key == snapshot.key
+        assert restored.base == snapshot.base
+        restored.link_disk_image(new_disk)
+        assert snapshot.base.read_bytes() == b"disk contents"
+
+        # The disk image format is recorded in the overlay so it must be part of the key
+        qcow2 = QemuSnapshot.create(snapshot_dir, Path("/qemu-img"), qemu_args, kernel, new_disk, "qcow2")
+        assert qcow2.key != snapshot.key
+
+        restored.discard()
+        assert not snapshot.base.is_symlink()
@@ -0,0 +1,117 @@
+import io
+import tarfile
+import tempfile
+from pathlib import Path
+
+from pycheribuild.filesystemutils import FileSystemUtils
+from pycheribuild.jenkins import create_sdk_from_archives, SdkArchive
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def _write_tar(path: Path, files: "dict"):
+    with tarfile.open(str(path), "w:gz") as tar:
+        for name, contents in files.items():
+            info = tarfile.TarInfo(name)
+            data = contents.encode("utf-8")
+            info.size = len(data)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(data))
+
+
+def _write_compiler_archive(workspace: Path, version: str):
+    _write_tar(workspace / "cheri-clang-llvm.tar.gz",
+               dict(("sdk/bin/" + tool, version) for tool in ("clang", "llvm-ar", "llvm-ranlib", "llvm-nm", "ld.lld")))
+
+
+def _write_sysroot_archive(workspace: Path, version: str):
+    _write_tar(workspace / "cheribsd-sysroot.tar.gz", {"output/sysroot/usr/include/stdio.h": version})
+
+
+def _setup_config(workspace: Path):
+    config = setup_mock_chericonfig(workspace, pretend=False)
+    config.FS = FileSystemUtils(config)
+    config.workspace = workspace
+    config.compiler_archive_name = "cheri-clang-llvm.tar.gz"
+    config.compiler_archive_output_path = workspace / "cherisdk"
+    config.sysroot_archive_name = "cheribsd-sysroot.tar.gz"
+    # The default sysroot output path is inside the compiler output path
+    config.sysroot_archive_output_path = workspace / "cherisdk/sysroot"
+    config.keep_sdk_dir = False
+    config.extract_compiler_only = False
+    return config
+
+
+def _add_markers(config) -> "list":
+    # Files that are only removed if the directory is cleaned before extracting the archive again
+    markers = [config.compiler_archive_output_path / "marker", config.sysroot_archive_output_path / "marker"]
+    for marker in markers:
+        marker.write_text("")
+    return markers
+
+
+def test_sdk_archive_is_up_to_date():
+    with tempfile.TemporaryDirectory() as td:
+        workspace = Path(td)
+        config = _setup_config(workspace)
+        _write_compiler_archive(workspace, "1")
+        archive = SdkArchive(config, "cheri-clang-llvm.tar.gz", output_dir=workspace / "cherisdk",
+                             required_globs=["bin/clang"], extra_args=["--strip-components", "1"])
+        assert not archive.is_up_to_date()
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=False)
+        assert (workspace / "cherisdk/bin/clang").read_text() == "1"
+        assert (workspace / "cherisdk/bin/ar").is_symlink()
+        assert archive.is_up_to_date()
+        # Different extraction arguments or missing files require extracting the archive again
+        other_args = SdkArchive(config, "cheri-clang-llvm.tar.gz", output_dir=workspace / "cherisdk",
+                                required_globs=["bin/clang"], extra_args=[])
+        assert not other_args.is_up_to_date()
+        (workspace / "cherisdk/bin/clang").unlink()
+        assert not archive.is_up_to_date()
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=False)
+        assert archive.is_up_to_date()
+        # A new archive with the same name is detected by its contents
+        _write_compiler_archive(workspace, "2")
+        archive = SdkArchive(config, "cheri-clang-llvm.tar.gz", output_dir=workspace / "cherisdk",
+                             required_globs=["bin/clang"], extra_args=["--strip-components", "1"])
+        assert not archive.is_up_to_date()
+
+
+def test_create_sdk_only_extracts_changed_archives():
+    with tempfile.TemporaryDirectory() as td:
+        workspace = Path(td)
+        config = _setup_config(workspace)
+        _write_compiler_archive(workspace, "1")
+        _write_sysroot_archive(workspace, "1")
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=True)
+        assert (workspace / "cherisdk/bin/clang").read_text() == "1"
+        assert (workspace / "cherisdk/sysroot/usr/include/stdio.h").read_text() == "1"
+
+        # Nothing changed -> nothing is extracted again
+        compiler_marker, sysroot_marker = _add_markers(config)
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=True)
+        assert compiler_marker.exists() and sysroot_marker.exists()
+
+        # Only the sysroot changed -> the compiler is kept
+        _write_sysroot_archive(workspace, "2")
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=True)
+        assert compiler_marker.exists() and not sysroot_marker.exists()
+        assert (workspace / "cherisdk/sysroot/usr/include/stdio.h").read_text() == "2"
+
+        # A new compiler cleans the compiler directory, which also deletes the unchanged sysroot inside it, so the
+        # sysroot archive has to be extracted again.
+        compiler_marker, sysroot_marker = _add_markers(config)
+        _write_compiler_archive(workspace, "3")
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=True)
+        assert not compiler_marker.exists() and not sysroot_marker.exists()
+        assert (workspace / "cherisdk/bin/clang").read_text() == "3"
+        assert (workspace / "cherisdk/sysroot/usr/include/stdio.h").read_text() == "2"
+        _add_markers(config)
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=True)
+        assert compiler_marker.exists() and sysroot_marker.exists()
+
+        # With --keep-sdk-dir changed archives are not extracted
+        config.keep_sdk_dir = True
+        _write_compiler_archive(workspace, "4")
+        create_sdk_from_archives(config, needs_cheribsd_sysroot=True)
+        assert (workspace / "cherisdk/bin/clang").read_text() == "3"
+        assert compiler_marker.exists()
@@ -0,0 +1,47 @@
+import os
+import threading
+from pathlib import Path
+
+from pycheribuild.processutils import current_environ, getenv, run_command, set_env
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+config = setup_mock_chericonfig(Path("/this/path/does/not/exist"), pretend=False)
+
+
+def _run_printenv(name: str) -> str:
+    return run_command("sh", "-c", "echo \"$" + name + "\"", capture_output=True, config=config,
+                       run_in_pretend_mode=True).stdout.decode("utf-8").strip()
+
+
+def test_set_env_main_thread():
+    assert "CHERIBUILD_TEST_VAR" not in os.environ
+    with set_env(CHERIBUILD_TEST_VAR="main", config=config):
+        assert os.environ["CHERIBUILD_TEST_VAR"] == "main"
+        assert _run_printenv("CHERIBUILD_TEST_VAR") == "main"
+    assert "CHERIBUILD_TEST_VAR" not in os.environ
+
+
+def test_set_env_worker_threads_are_independent():
+    results = dict()
+    inside = threading.Barrier(2, timeout=30)
+
+    def worker(value: str):
+        with set_env(CHERIBUILD_TEST_VAR=value, config=config):
+            # Both threads are inside set_env() now, they must not see each other's value
+            inside.wait()
+            with set_env(CHERIBUILD_TEST_VAR=getenv("CHERIBUILD_TEST_VAR") + "-nested", config=config):
+                results[value] = (getenv("CHERIBUILD_TEST_VAR"), current_environ()["CHERIBUILD_TEST_VAR"],
+                                  _run_printenv("CHERIBUILD_TEST_VAR"), os.getenv("CHERIBUILD_TEST_VAR"))
+            inside.wait()
+            results[value + "-after-nested"] = _run_printenv("CHERIBUILD_TEST_VAR")
+        results[value + "-after"] = getenv("CHERIBUILD_TEST_VAR")
+
+    threads = [threading.Thread(target=worker, args=(value,)) for value in ("a", "b")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {
+        "a": ("a-nested", "a-nested", "a-nested", None), "b": ("b-nested", "b-nested", "b-nested", None),
+        "a-after-nested": "a", "b-after-nested": "b", "a-after": None, "b-after": None}
+    assert "CHERIBUILD_TEST_VAR" not in os.environ
@@ -11,7 +11,7 @@ from pycheribuild.projects import *  # noqa: F401, F403
 from pycheribuild.projects.cross import *  # noqa: F401, F403
 # First thing we need to do is set up the config loader (before importing anything else!)
 # We can"t do from pycheribuild.configloader import ConfigLoader here because that will only update the local copy
-from pycheribuild.targets import target_manager
+from pycheribuild.targets import MultiArchTargetAlias, SimpleTargetAlias, target_manager
 from .setup_mock_chericonfig import setup_mock_chericonfig
 
 global_config = setup_mock_chericonfig(Path("/this/path/does/not/exist"))
@@ -291,3 +291,45 @@ def test_skip_toolchain_deps(target_name, include_recursive_deps, include_toolch
     # TODO: should we do the same for all-<target>?
     assert _sort_targets([target_name], add_dependencies=include_recursive_deps, add_toolchain=include_toolchain,
                          build_morello_from_source=morello_from_source) == expected_deps
+
+
+def test_parallel_scheduling_dependencies():
+    target_manager.reset()
+    names = ["run-riscv64-hybrid", "disk-image-riscv64-hybrid", "cheribsd-riscv64-hybrid", "gdb-native", "qemu",
+             "gdb-riscv64-hybrid"]
+    global_config.include_dependencies = False
+    real_targets = [target_manager.get_target(t, None, global_config, caller="test") for t in names]
+    sorted_targets = target_manager.get_all_targets(real_targets, global_config)
+    deps = {t.name: sorted(d.name for d in ds)
+            for t, ds in target_manager.get_scheduling_dependencies(sorted_targets).items()}
+    # Independent targets can be built in parallel
+    assert deps["qemu"] == []
+    assert deps["gdb-native"] == []
+    assert deps["cheribsd-riscv64-hybrid"] == []
+    assert deps["gdb-riscv64-hybrid"] == ["cheribsd-riscv64-hybrid"]
+    # disk-image must wait for everything that might install to the rootfs and run waits for all other targets
+    assert deps["disk-image-riscv64-hybrid"] == ["cheribsd-riscv64-hybrid", "gdb-native",
+                                                 "gdb-riscv64-hybrid", "qemu"]
+    assert deps["run-riscv64-hybrid"] == sorted(n for n in names if n != "run-riscv64-hybrid")
+
+
+# noinspection PyProtectedMember
+def test_run_everything_order():
+    target_manager.reset()
+    global_config.include_dependencies = True
+    all_targets = [t for t in target_manager.targets if not isinstance(t, (MultiArchTargetAlias, SimpleTargetAlias))]
+    for t in all_targets:
+        t.cache_dependencies(global_config)
+    # The transitive closures are memoized per config
+    graph = target_manager.dependency_graph(global_config)
+    llvm_class = target_manager.get_target_raw("llvm-riscv64-purecap").project_class
+    assert graph.recursive_dependencies(llvm_class, include_toolchain_dependencies=True,
+                                        include_sdk_dependencies=True) is \
+        graph.recursive_dependencies(llvm_class, include_toolchain_dependencies=True, include_sdk_dependencies=True)
+    # All targets must come after their (transitive) dependencies
+    sorted_targets = target_manager.sort_in_dependency_order(all_targets)
+    assert len(sorted_targets) == len(all_targets)
+    position = {t: i for i, t in enumerate(sorted_targets)}
+    for t in sorted_targets:
+        for dep in t.project_class.cached_full_dependencies():
+            assert position[dep] < position[t], t.name + " sorted before dependency " + dep.name